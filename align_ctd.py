@@ -0,0 +1,95 @@
+import math
+
+import numpy as np
+
+import cnv_corrections
+import cnv_file
+
+# The Align CTD module this stage replaces, used to open its PSA files with "Edit PSA"
+SBE_MODULE = "AlignCTDW.exe"
+
+
+def advance(column, scans):
+    """
+    A column advanced by scans (a fraction of a scan is interpolated linearly; negative
+    values delay it). Scans the advance runs past the end (or start) of the cast become NaN.
+    """
+    positions = np.arange(len(column)) + scans
+    inside = (positions >= 0) & (positions <= len(column) - 1)
+    advanced = np.full(len(column), np.nan)
+    advanced[inside] = np.interp(positions[inside], np.arange(len(column)), column)
+    return advanced
+
+
+def column_advances(header, psa):
+    """(column, seconds) of the variables an Align CTD PSA advances."""
+    advances = [float(value or 0) for value in cnv_corrections.array_values(psa, "ValArray")]
+    return [(column, seconds) for column, seconds in zip(cnv_corrections.variable_columns(header, psa), advances)
+            if column is not None and seconds != 0]
+
+
+def correct(header, values, psa):
+    """Advance the variables of an Align CTD PSA by their <ValArray> seconds. Returns the alignctd_* header lines."""
+    interval = cnv_corrections.scan_interval(header)
+    done = []
+    for column, seconds in column_advances(header, psa):
+        values[:, column] = advance(values[:, column], seconds / interval)
+        done.append(f"{header.short_names[column]} {seconds:g}")
+
+    input_file, _ = cnv_corrections.stage_files(psa)
+    return [
+        f"# alignctd_date = {cnv_file.processing_date()}, align_ctd.py",
+        f"# alignctd_in = {input_file}",
+        f"# alignctd_adv = {', '.join(done)}",
+    ]
+
+
+class AlignStream:
+    """
+    advance() for a cast that is still being recorded: push() takes the next scans and returns
+    those whose advanced values are known (a variable advanced by n scans needs the n scans
+    after it), finish() the rest at the end of the cast. Only the scans the advances reach
+    back or forward to are kept.
+    """
+
+    def __init__(self, advances):
+        self.advances = advances  # (column, scans)
+        self.lead = max([math.ceil(scans) for _, scans in advances if scans > 0], default=0)
+        self.back = max([math.ceil(-scans) for _, scans in advances if scans < 0], default=0)
+        self.buffer = None
+        self.start = 0  # scan number of the first buffered scan
+        self.done = 0  # scans returned
+
+    def push(self, values):
+        self.buffer = values.copy() if self.buffer is None else np.concatenate([self.buffer, values])
+        return self.advanced(self.start + len(self.buffer) - self.lead)
+
+    def finish(self):
+        return self.advanced(self.start + len(self.buffer)) if self.buffer is not None else None
+
+    def advanced(self, end):
+        end = max(end, self.done)
+        total = self.start + len(self.buffer)
+        rows = self.buffer[self.done - self.start:end - self.start].copy()
+        scan_numbers = np.arange(self.start, total)
+        for column, scans in self.advances if len(rows) else ():
+            positions = np.arange(self.done, end) + scans
+            inside = (positions >= 0) & (positions <= total - 1)
+            rows[:, column] = np.nan
+            rows[inside, column] = np.interp(positions[inside], scan_numbers, self.buffer[:, column])
+        self.done = end
+        keep_from = max(self.start, end - self.back)
+        self.buffer = self.buffer[keep_from - self.start:]
+        self.start = keep_from
+        return rows
+
+
+def stream(header, psa):
+    """An AlignStream for the variables of an Align CTD PSA."""
+    interval = cnv_corrections.scan_interval(header)
+    return AlignStream([(column, seconds / interval) for column, seconds in column_advances(header, psa)])
+
+
+def run_psa(psa_path):
+    """Align the input file of a rendered Align CTD PSA and write it to its output. Returns a one-line summary."""
+    return cnv_corrections.run_chain([(correct, psa_path)])
@@ -0,0 +1,269 @@
+import csv
+import glob
+import json
+import os
+import sys
+import threading
+
+import ctd_pipeline
+import run_report
+
+# Failed attempts after which a cast is quarantined: left out until released with retry_quarantined
+MAX_ATTEMPTS = 3
+
+
+class ManifestCast:
+    """One line of a batch manifest: a raw .hex file, the configuration to run and the output directory."""
+
+    def __init__(self, raw_file, config, output_dir):
+        self.raw_file = raw_file
+        self.config = config
+        self.output_dir = output_dir
+        self.key = "|".join(os.path.normcase(os.path.abspath(path)) for path in (raw_file, config, output_dir))
+
+    @property
+    def name(self):
+        return ctd_pipeline.cast_name(self.raw_file)
+
+
+def load_manifest(manifest_path, default_config=None):
+    """
+    Read a batch manifest: a .csv file with raw_file, config and output_dir columns, or a .json
+    file with a list of {"raw_file", "config", "output_dir"} objects (or {"casts": [...]}).
+
+    raw_file may be a glob pattern (e.g. D:/cruise/raw/*.hex). Relative paths are resolved
+    from the manifest's folder. An empty config is default_config; an empty output_dir is the
+    configuration's output_file. Returns a list of ManifestCast, one per raw file.
+    Raises ValueError for a line without a raw file or configuration.
+    """
+    base_dir = os.path.dirname(os.path.abspath(manifest_path))
+    if manifest_path.lower().endswith(".json"):
+        with open(manifest_path, "r") as f:
+            rows = json.load(f)
+        if isinstance(rows, dict):
+            rows = rows.get("casts", [])
+    else:
+        with open(manifest_path, "r", newline="") as f:
+            rows = list(csv.DictReader(f))
+
+    def resolve(path):
+        path = (path or "").strip().strip('"')
+        return os.path.normpath(os.path.join(base_dir, path)) if path else ""
+
+    casts = []
+    output_dirs = {}
+    for line, row in enumerate(rows, 1):
+        pattern, config = resolve(row.get("raw_file")), resolve(row.get("config")) or default_config
+        if not pattern:
+            raise ValueError(f"{manifest_path}: cast {line} has no raw_file.")
+        if not config:
+            raise ValueError(f"{manifest_path}: cast {line} has no config and no default configuration was given.")
+
+        output_dir = resolve(row.get("output_dir"))
+        if not output_dir:
+            if config not in output_dirs:
+                output_dirs[config] = ctd_pipeline.load_config(config).get("output_file", "")
+            output_dir = output_dirs[config]
+
+        for raw_file in sorted(glob.glob(pattern)) or [pattern]:
+            casts.append(ManifestCast(raw_file, config, output_dir))
+    return casts
+
+
+class Journal:
+    """
+    Append-only JSON-lines record of a manifest batch, fsynced line by line, so that after a
+    crash or reboot the batch resumes exactly where it stopped.
+
+    A "stage" line is written as each (cast, stage) finishes ("done" or "failed") and a "cast"
+    line when a cast is "done", has "failed" an attempt, is "quarantined" after MAX_ATTEMPTS
+    failures or is "released" from quarantine. Opening a journal replays it; a line cut short
+    by a crash is ignored.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.done_stages = {}  # cast key -> psa files done
+        self.status = {}  # cast key -> last cast status
+        self.attempts = {}  # cast key -> failed attempts since the last release
+
+        if os.path.isfile(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        self.apply(json.loads(line))
+                    except ValueError:
+                        continue
+        self.file = open(path, "a", encoding="utf-8")
+        if self.file.tell() > 0:
+            # A line cut short by a crash must not swallow the next one
+            with open(path, "rb") as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b"\n":
+                    self.file.write("\n")
+
+    def apply(self, record):
+        key = record["cast"]
+        if record["type"] == "stage" and record["status"] == "done":
+            self.done_stages.setdefault(key, set()).add(record["stage"])
+        elif record["type"] == "cast":
+            self.status[key] = record["status"]
+            if record["status"] == "failed":
+                self.attempts[key] = self.attempts.get(key, 0) + 1
+            elif record["status"] == "released":
+                self.attempts[key] = 0
+
+    def write(self, record):
+        with self.lock:
+            self.apply(record)
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def record_stage(self, cast, psa_file, status, error=None):
+        record = {"type": "stage", "cast": cast.key, "raw_file": cast.raw_file, "stage": psa_file, "status": status}
+        if error:
+            record["error"] = error
+        self.write(record)
+
+    def record_cast(self, cast, status):
+        self.write({"type": "cast", "cast": cast.key, "raw_file": cast.raw_file, "status": status,
+                    "attempts": self.attempts.get(cast.key, 0) + (status == "failed")})
+
+    def group(self, casts):
+        """The journal of one group of casts for ctd_pipeline.run_pipeline(), which knows casts by raw file."""
+        return GroupJournal(self, {cast.raw_file: cast for cast in casts})
+
+    def close(self):
+        self.file.close()
+
+
+class GroupJournal:
+    def __init__(self, journal, casts):
+        self.journal = journal
+        self.casts = casts
+
+    def record_stage(self, raw_file, psa_file, status, error=None):
+        self.journal.record_stage(self.casts[raw_file], psa_file, status, error)
+
+
+def run_group(casts, config_path, journal, jobs, incremental, events, cancel_event, executables_dir=None, catalog=None,
+              batch_size=1, timeout=None, stage_retries=None, scratch_dir=None):
+    """
+    Run the pipeline of one configuration for the casts of one output directory, with the
+    stages the journal records as done skipped, registering the processed casts in catalog
+    (a cast_catalog.CastCatalog) if given, with batch_size casts per module run (see
+    ctd_pipeline.run_batches()). timeout and stage_retries override those of the
+    configuration (see ctd_pipeline.stage_limits()), scratch_dir its scratch folder (see
+    ctd_pipeline.workspace()). Returns the list of error messages.
+    """
+    config = ctd_pipeline.load_config(config_path)
+    psa_dir = config.get("psa_dir", "")
+    output_file_dir = casts[0].output_dir
+    raw_files = [cast.raw_file for cast in casts]
+    os.makedirs(output_file_dir, exist_ok=True)
+    report = run_report.RunReport(output_file_dir, raw_files)
+
+    try:
+        stages = ctd_pipeline.selected_stages(config, executables_dir)
+    except ValueError as e:
+        stages, errors = [], [f"{config_path}: {e}"]
+    else:
+        errors = [] if stages else [f"{config_path}: the configuration has no selected .psa files."]
+    graph, runnable = None, []
+    if not errors:
+        graph, runnable, errors = ctd_pipeline.preflight(raw_files, stages, psa_dir, output_file_dir,
+                                                         ctd_pipeline.stage_dependencies(config))
+    for err in errors:
+        ctd_pipeline.notify(events, "error", err)
+    if errors:
+        report.record_preflight([cast.name for cast in casts if cast.raw_file not in runnable], errors)
+
+    if runnable:
+        keys = {cast.raw_file: cast.key for cast in casts}
+        completed = {c: journal.done_stages.get(keys[raw_file], set()) for c, raw_file in enumerate(runnable)}
+        workspace = ctd_pipeline.workspace(config, output_file_dir, scratch_dir)
+        errors.extend(ctd_pipeline.run_pipeline(runnable, graph, psa_dir,
+                                                ctd_pipeline.work_folder(workspace, runnable, graph, output_file_dir), jobs,
+                                                incremental, events, cancel_event, report, completed, journal.group(casts),
+                                                catalog.with_config(config_path) if catalog else None, batch_size,
+                                                ctd_pipeline.stage_limits(config, timeout, stage_retries), workspace))
+
+    summary = report.close(errors)
+    print(run_report.format_summary(summary))
+
+    # A cast is done once every selected stage is and its products are published (the report's
+    # "cast" line); a cancelled batch leaves its casts as they are
+    if not (cancel_event is not None and cancel_event.is_set()):
+        finished = {r["cast"] for r in report.cast_records if r["status"] == "done"}
+        for cast in casts:
+            if cast.name in finished:
+                journal.record_cast(cast, "done")
+            else:
+                journal.record_cast(cast, "failed")
+                if journal.attempts[cast.key] >= MAX_ATTEMPTS:
+                    journal.record_cast(cast, "quarantined")
+                    print(f"[{cast.name}] Quarantined after {MAX_ATTEMPTS} failed attempts", file=sys.stderr)
+    return errors
+
+
+def run_manifest(manifest_path, journal_path=None, jobs=1, incremental=True, events=None, cancel_event=None,
+                 default_config=None, executables_dir=None, retries=MAX_ATTEMPTS - 1, retry_quarantined=False, catalog=None,
+                 batch_size=1, timeout=None, stage_retries=None, scratch_dir=None):
+    """
+    Process every cast of a batch manifest (see load_manifest()), recording progress in a
+    Journal (<manifest>.journal.jsonl by default). Running the same manifest again resumes it:
+    casts that are done or quarantined are left out and the stages a cast has already been
+    through are not run again. With incremental=True a stage killed while it rewrote
+    <cast>.cnv is restarted from the build cache's copy of its input (see build_cache.py).
+
+    Casts are processed by (configuration, output directory), in manifest order, with up to
+    jobs stages at a time. Casts that fail are tried again, up to retries more times, once
+    the rest of the manifest has been processed; a cast that has failed MAX_ATTEMPTS times
+    (over all runs) is quarantined. retry_quarantined releases the quarantined casts first.
+    Casts done are registered in catalog, a cast_catalog.CastCatalog, if given. With
+    batch_size > 1 the modules that can process several casts are run once per batch_size
+    casts of a group. A stage running longer than timeout seconds is killed and run again
+    up to stage_retries times, the configuration's values by default. With a scratch_dir
+    (by default the configuration's "scratch_dir") intermediates stay in that folder and only
+    the final products of each cast are published to its output directory; keep the folder
+    until the manifest is done, as a resumed cast continues from the files in it.
+
+    Returns (number of casts done, list of quarantined casts, error messages).
+    """
+    casts = load_manifest(manifest_path, default_config)
+    journal = Journal(journal_path or os.path.splitext(manifest_path)[0] + ".journal.jsonl")
+    errors = []
+
+    try:
+        if retry_quarantined:
+            for cast in casts:
+                if journal.status.get(cast.key) == "quarantined":
+                    journal.record_cast(cast, "released")
+
+        for attempt in range(retries + 1):
+            todo = [cast for cast in casts if journal.status.get(cast.key) not in ("done", "quarantined")]
+            if not todo or (cancel_event is not None and cancel_event.is_set()):
+                break
+            if attempt:
+                print(f"Retrying {len(todo)} failed cast(s)")
+            else:
+                print(f"{len(casts) - len(todo)}/{len(casts)} cast(s) already done or quarantined, {len(todo)} to process "
+                      f"(journal: {journal.path})")
+
+            groups = {}
+            for cast in todo:
+                groups.setdefault((cast.config, os.path.normcase(os.path.abspath(cast.output_dir))), []).append(cast)
+            for (config_path, _), group in groups.items():
+                if cancel_event is not None and cancel_event.is_set():
+                    break
+                print(f"Processing {len(group)} cast(s) with {config_path} into {group[0].output_dir}")
+                errors.extend(run_group(group, config_path, journal, jobs, incremental, events, cancel_event,
+                                        executables_dir, catalog, batch_size, timeout, stage_retries, scratch_dir))
+    finally:
+        journal.close()
+
+    done = sum(1 for cast in casts if journal.status.get(cast.key) == "done")
+    quarantined = [cast for cast in casts if journal.status.get(cast.key) == "quarantined"]
+    return done, quarantined, errors
@@ -0,0 +1,89 @@
+"""
+Check the built-in bin average against the BinAvgW output in test_data and time it.
+
+    python benchmarks/bench_bin_average.py
+
+For every test_data/proc/<cast>_avg.cnv whose <cast>.cnv input is available, the
+input is bin-averaged with test_data/procontrol/EN_BinAvg.psa and compared bin by bin:
+the bins and scan counts must be identical, and the largest difference of each
+column is printed in units of its last printed digit. Any other column must be within
+one digit, except in the first bin (extrapolated from the second); the script exits
+with 1 otherwise.
+"""
+import glob
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+from numpy.lib import recfunctions
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import bin_average
+import cnv_file
+import psa_template
+
+REPEATS = 5
+
+
+def load(path):
+    header, data = cnv_file.read_cnv(path)
+    return header, recfunctions.structured_to_unstructured(data, dtype=np.float64)
+
+
+def check_cast(expected_path, work_dir):
+    cast = os.path.basename(expected_path)[:-len("_avg.cnv")]
+    input_file = os.path.join(os.path.dirname(expected_path), f"{cast}.cnv")
+    if not os.path.isfile(input_file) or os.path.getsize(input_file) == 0:
+        print(f"{cast}: {cast}.cnv is missing or empty in test_data, skipped")
+        return True
+
+    template = psa_template.compile_psa(os.path.join(ROOT, "test_data", "procontrol", "EN_BinAvg.psa"))
+    psa_path = template.write(os.path.join(work_dir, "EN_BinAvg.psa"), os.path.dirname(input_file), work_dir,
+                              os.path.join(ROOT, "test_data", "raw", f"{cast}.XMLCON"), [f"{cast}.cnv"], f"{cast}.cnv")
+
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        bin_average.run_psa(psa_path)
+        times.append(time.perf_counter() - start)
+
+    expected_header, expected = load(expected_path)
+    header, output = load(os.path.join(work_dir, f"{cast}_avg.cnv"))
+    print(f"{cast}: {len(output)} bins in {min(times) * 1000:.1f} ms (read, bin average and write)")
+
+    if header.short_names != expected_header.short_names or output.shape != expected.shape:
+        print(f"  columns or number of bins differ: {output.shape} != {expected.shape}")
+        return False
+
+    column = bin_average.bin_column(header, bin_average.BinAvgSettings(psa_path).bin_type)
+    ok = True
+    for index, name in enumerate(header.names):
+        fmt = expected_header.formats[index]
+        if fmt.endswith("e"):
+            continue
+        step = 10.0 ** -int(fmt[1:-1])
+        diff = np.abs(output[:, index] - expected[:, index]) / step
+        worst = int(np.argmax(diff))
+        if index == column or name == "nbin":
+            mismatch = diff.max() > 0.5
+        else:
+            mismatch = len(diff) > 1 and diff[1:].max() > 1.5
+        ok = ok and not mismatch
+        print(f"  {name:<12} max difference {diff.max():6.1f} digit(s) at bin {worst}" + ("  MISMATCH" if mismatch else ""))
+    return ok
+
+
+def main():
+    ok = True
+    with tempfile.TemporaryDirectory() as work_dir:
+        for expected_path in sorted(glob.glob(os.path.join(ROOT, "test_data", "proc", "*_avg.cnv"))):
+            ok = check_cast(expected_path, work_dir) and ok
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
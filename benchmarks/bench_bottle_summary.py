@@ -0,0 +1,89 @@
+"""
+Check the built-in BottleSum against the BottleSumW output in test_data and time it.
+
+    python benchmarks/bench_bottle_summary.py
+
+Every test_data/proc/<cast>.ros is summarized with test_data/procontrol/EN_BottleSum.psa
+and the table of the .btl file is compared with test_data/proc/<cast>.cnv.btl field by
+field. Differences are counted in units of the last printed digit; a difference of one
+digit is a rounding difference.
+"""
+import glob
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import bottle_summary
+import psa_template
+
+REPEATS = 5
+
+
+def table(path):
+    """The lines after the header of a .btl file."""
+    with open(path, "r", encoding="latin-1") as f:
+        return [line.rstrip("\n") for line in f if not line.startswith(("*", "#"))]
+
+
+def digits(field):
+    """The value of a printed number and the size of its last digit."""
+    if "e" in field:
+        mantissa = field.split("e")[0]
+        return float(field), 10.0 ** (int(field.split("e")[1]) - len(mantissa.split(".")[1]))
+    decimals = len(field.split(".")[1]) if "." in field else 0
+    return float(field), 10.0 ** -decimals
+
+
+def compare(output_path, expected_path):
+    """Print the differences of the two tables; return False if any is more than one digit."""
+    output, expected = table(output_path), table(expected_path)
+    if len(output) != len(expected):
+        print(f"  {len(output)} table lines instead of {len(expected)}")
+        return False
+
+    names = expected[0].split()[2:]
+    worst = {}
+    for output_line, expected_line in zip(output[2:], expected[2:]):
+        if len(output_line) != len(expected_line):
+            print(f"  line layout differs:\n    {output_line}\n    {expected_line}")
+            return False
+        if output_line[:bottle_summary.LABEL_WIDTH] != expected_line[:bottle_summary.LABEL_WIDTH]:
+            print(f"  bottle/date differs: '{output_line[:22]}' '{expected_line[:22]}'")
+            return False
+        for index, name in enumerate(names):
+            start = bottle_summary.LABEL_WIDTH + 11 * index
+            field, expected_field = output_line[start:start + 11].strip(), expected_line[start:start + 11].strip()
+            if not expected_field:
+                continue
+            value, step = digits(expected_field)
+            worst[name] = max(worst.get(name, 0), round(abs(float(field) - value) / step))
+    for name, diff in worst.items():
+        print(f"  {name:<11} max {diff} digit(s)" + ("  MISMATCH" if diff > 1 else ""))
+    return max(worst.values(), default=0) <= 1 and output[0] == expected[0]
+
+
+def main():
+    ok = True
+    template = psa_template.compile_psa(os.path.join(ROOT, "test_data", "procontrol", "EN_BottleSum.psa"))
+    with tempfile.TemporaryDirectory() as work_dir:
+        for ros_path in sorted(glob.glob(os.path.join(ROOT, "test_data", "proc", "*.ros"))):
+            cast = os.path.splitext(os.path.basename(ros_path))[0]
+            expected_path = os.path.join(ROOT, "test_data", "proc", f"{cast}.cnv.btl")
+            psa_path = template.write(os.path.join(work_dir, f"{cast}.psa"), ros_path, work_dir,
+                                      os.path.join(ROOT, "test_data", "raw", f"{cast}.XMLCON"), [f"{cast}.ros"], f"{cast}.cnv")
+            times = []
+            for _ in range(REPEATS):
+                start = time.perf_counter()
+                message = bottle_summary.run_psa(psa_path)
+                times.append(time.perf_counter() - start)
+            print(f"{message} in {min(times) * 1000:.1f} ms")
+            ok = compare(os.path.join(work_dir, f"{cast}.cnv.btl"), expected_path) and ok
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
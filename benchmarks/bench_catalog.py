@@ -0,0 +1,119 @@
+"""
+Time cast catalog queries (cast_catalog.py) on a large synthetic archive.
+
+    python benchmarks/bench_catalog.py [--casts 50000] [--cruises 200]
+
+The test_data casts are indexed once, then --casts entries spread over --cruises cruises
+and the North Atlantic are stored from them, each with its own position, time and sensor
+serial numbers. Each query is timed on the catalog and on a scan of the entries held in
+memory, and both must give the same casts. Without the catalog, the entries would first
+have to be read from the files of every cast: the time that takes for one test_data cast
+gives the cost of that crawl for the whole archive.
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import cast_catalog
+
+REPEAT = 5
+
+
+def best_time(function, *args):
+    times = []
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        result = function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def synthetic_entries(template, casts, cruises, seed=1):
+    """casts copies of a cast_metadata() entry, each in its own cruise, place and time."""
+    generator = random.Random(seed)
+    start = datetime(2015, 1, 1)
+    entries = []
+    for n in range(casts):
+        cruise = n * cruises // casts
+        entry = dict(template)
+        entry["name"] = f"CTD{n % (casts // cruises or 1) + 1:03d}"
+        entry["output_dir"] = os.path.join("archive", f"EN{cruise:03d}", "proc")
+        entry["cruise"] = f"EN{cruise:03d}"
+        entry["latitude"] = round(generator.uniform(20, 60), 4)
+        entry["longitude"] = round(generator.uniform(-80, -10), 4)
+        entry["nmea_utc"] = (start + timedelta(days=cruise * 18, hours=generator.uniform(0, 18 * 24))).isoformat(timespec="seconds")
+        # Sensors move between instruments from cruise to cruise
+        entry["sensors"] = json.dumps([(sensor, f"{(int(serial) if serial.isdigit() else 0) + cruise % 40:04d}")
+                                       for sensor, serial in json.loads(template["sensors"])])
+        entries.append(entry)
+    return entries
+
+
+def scan(entries, predicate):
+    return sorted((entry["output_dir"], entry["name"]) for entry in entries if predicate(entry))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time cast catalog queries on a synthetic archive.")
+    parser.add_argument("--casts", type=int, default=50000, help="Number of catalog entries (default: 50000).")
+    parser.add_argument("--cruises", type=int, default=200, help="Number of cruises (default: 200).")
+    args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        catalog = cast_catalog.CastCatalog(os.path.join(work_dir, "catalog.sqlite"))
+        start = time.perf_counter()
+        count = catalog.index_folder(os.path.join(ROOT, "test_data", "proc"), [os.path.join(ROOT, "test_data", "raw")])
+        print(f"index_folder: {count} test_data cast(s) in {(time.perf_counter() - start) * 1000:.1f} ms")
+
+        read_time, template = best_time(cast_catalog.cast_metadata, "CTD01", os.path.join(ROOT, "test_data", "proc"),
+                                        os.path.join(ROOT, "test_data", "raw", "CTD01.hex"))
+        entries = synthetic_entries(template, args.casts, args.cruises)
+        start = time.perf_counter()
+        catalog.store(entries)
+        print(f"store: {len(entries)} entries in {time.perf_counter() - start:.2f} s "
+              f"({os.path.getsize(catalog.path) / 1e6:.1f} MB)")
+        print(f"reading the files of one cast: {read_time * 1000:.1f} ms, a crawl of {len(entries)} casts "
+              f"about {read_time * len(entries):.0f} s\n")
+
+        station = (entries[0]["latitude"], entries[0]["longitude"])
+        serial = json.loads(entries[len(entries) // 2]["sensors"])[0][1]
+        cruise = entries[-1]["cruise"]
+        since, until = "2020-03-01", "2020-03-31"
+        queries = [
+            (f"within 10 km of {station}", {"near": station, "radius_km": 10},
+             lambda entry: cast_catalog.distance_km(*station, entry["latitude"], entry["longitude"]) <= 10),
+            (f"serial number {serial}", {"serial": serial},
+             lambda entry: any(s == serial for _, s in json.loads(entry["sensors"]))),
+            (f"cruise {cruise}", {"cruise": cruise}, lambda entry: entry["cruise"] == cruise),
+            ("NMEA UTC in March 2020", {"since": since, "until": until},
+             lambda entry: since <= entry["nmea_utc"] <= until + "T23:59:59"),
+        ]
+
+        print(f"{'query':<42}{'casts':>7}{'catalog (ms)':>14}{'in-memory scan (ms)':>21}")
+        for name, conditions, predicate in queries:
+            catalog_time, found = best_time(lambda: catalog.find(**conditions))
+            scan_time, expected = best_time(scan, entries, predicate)
+            found = sorted((cast["output_dir"], cast["name"]) for cast in found
+                           if not cast["output_dir"].startswith(ROOT))
+            if found != expected:
+                print(f"{name}: the catalog found {len(found)} cast(s), the scan {len(expected)}")
+                return 1
+            print(f"{name:<42}{len(found):>7}{catalog_time * 1000:>14.2f}{scan_time * 1000:>21.1f}")
+        catalog.close()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
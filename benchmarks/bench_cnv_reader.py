@@ -0,0 +1,70 @@
+"""
+Compare cnv_file.read_cnv with line-by-line parsing of .cnv files.
+
+    python benchmarks/bench_cnv_reader.py [files ...]
+
+Defaults to the .cnv and .ros files in test_data/proc. The last column is the time
+to read only the first three columns (read_cnv(path, columns=...)).
+"""
+import glob
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cnv_file
+
+REPEATS = 5
+
+
+def read_lines(path):
+    """Line-by-line parser: split each data line and convert every value with float()."""
+    header_lines = []
+    rows = []
+    with open(path, "r", encoding="latin-1") as f:
+        for line in f:
+            header_lines.append(line)
+            if line.startswith("*END*"):
+                break
+        for line in f:
+            rows.append([float(value) for value in line.split()])
+    return header_lines, np.array(rows)
+
+
+def best_time(function, *args):
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        result = function(*args)
+        times.append(time.perf_counter() - start)
+    return min(times), result
+
+
+def main(paths):
+    if not paths:
+        root = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_data", "proc")
+        paths = sorted(glob.glob(os.path.join(root, "*.cnv")) + glob.glob(os.path.join(root, "*.ros")))
+
+    print(f"{'file':<20}{'scans':>8}{'cols':>6}{'lines (ms)':>12}{'read_cnv (ms)':>15}{'speedup':>9}{'3 columns (ms)':>16}")
+    for path in paths:
+        if os.path.getsize(path) == 0:
+            continue
+        line_time, (_, expected) = best_time(read_lines, path)
+        cnv_time, (header, data) = best_time(cnv_file.read_cnv, path)
+        columns_time, _ = best_time(cnv_file.read_cnv, path, header.names[:3])
+
+        values = np.column_stack([data[name] for name in header.names]) if len(data) else np.zeros((0, header.nquan))
+        if values.shape != expected.shape or not np.array_equal(values, expected):
+            print(f"{os.path.basename(path)}: read_cnv and line-by-line parsing disagree")
+            return 1
+
+        print(f"{os.path.basename(path):<20}{len(data):>8}{header.nquan:>6}"
+              f"{line_time * 1000:>12.1f}{cnv_time * 1000:>15.1f}{line_time / cnv_time:>8.1f}x{columns_time * 1000:>16.1f}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,130 @@
+"""
+Check the built-in AlignCTD, CellTM and Filter against SBE Data Processing and time them.
+
+    python benchmarks/bench_corrections.py
+
+Every test_data/raw/<cast>.hex with a processed test_data/proc/<cast>.cnv is converted with
+the built-in DatCnv (EN_DatCnv.psa), then aligned and corrected for the cell thermal mass
+with EN_AlignCTD.psa and EN_CellTM.psa: once stage by stage (each stage reads and writes
+<cast>.cnv) and once fused (read once, written once). The fused output is compared with
+the stage by stage one and with test_data/proc/<cast>.cnv (written by DatCnvW, AlignCTDW,
+CellTMW and DeriveW) in units of the last printed digit, as bench_datcnv.py does.
+
+There is no Filter PSA or FilterW output in test_data: the vectorized cell thermal-mass
+and low-pass filters are compared with a scan-by-scan loop of the same equations instead.
+"""
+import glob
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import align_ctd
+import bench_datcnv
+import cell_thermal_mass
+import cnv_corrections
+import datcnv
+import low_pass_filter
+import psa_template
+
+PSA_DIR = os.path.join(ROOT, "test_data", "procontrol")
+REPEATS = 3
+STAGES = (("EN_AlignCTD.psa", align_ctd), ("EN_CellTM.psa", cell_thermal_mass))
+
+
+def render(psa_file, work_dir, cast, input_dir):
+    return psa_template.compile_psa(os.path.join(PSA_DIR, psa_file)).write(
+        os.path.join(work_dir, psa_file), input_dir, work_dir, os.path.join(ROOT, "test_data", "raw", f"{cast}.XMLCON"),
+        [f"{cast}.cnv"], f"{cast}.cnv")
+
+
+def best_time(run, setup):
+    times = []
+    for _ in range(REPEATS):
+        setup()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def check_filters():
+    """Compare the vectorized filters with scan-by-scan loops; return False on a difference."""
+    rng = np.random.default_rng(0)
+    temperature = 20 + np.cumsum(rng.normal(0, 0.01, 20000))
+    interval, alpha, tau = 1 / 24, 0.03, 7.0
+    a = 2 * alpha / (interval / tau + 2)
+    b = 1 - 2 * a / alpha
+    loop = np.zeros(len(temperature))
+    for n in range(1, len(temperature)):
+        dc_dt = 0.1 * (1 + 0.006 * (temperature[n] - 20))
+        loop[n] = -b * loop[n - 1] + a * dc_dt * (temperature[n] - temperature[n - 1])
+    celltm = np.abs(cell_thermal_mass.thermal_mass_correction(temperature, interval, alpha, tau) - loop).max()
+
+    ok = celltm < 1e-9
+    for time_constant in (0.03, 0.15, 0.5, 2.0):
+        a = 1 / (1 + 2 * time_constant / interval)
+        b = a * (1 - 2 * time_constant / interval)
+        x = temperature
+        for _ in range(2):
+            y = np.empty(len(x))
+            y[0] = x[0]
+            for n in range(1, len(x)):
+                y[n] = a * (x[n] + x[n - 1]) - b * y[n - 1]
+            x = y[::-1]
+        difference = np.abs(low_pass_filter.low_pass(temperature, interval, time_constant) - x).max()
+        constant = np.abs(low_pass_filter.low_pass(np.full(100, 3.5), interval, time_constant) - 3.5).max()
+        ok = ok and difference < 1e-9 and constant < 1e-12
+        print(f"low pass {time_constant:g} s: max difference from the loop {difference:.1e}")
+    print(f"cell thermal mass: max difference from the loop {celltm:.1e}")
+    return ok
+
+
+def main():
+    ok = check_filters()
+    datcnv_template = psa_template.compile_psa(os.path.join(PSA_DIR, "EN_DatCnv.psa"))
+    for hex_path in sorted(glob.glob(os.path.join(ROOT, "test_data", "raw", "*.hex"))):
+        cast = os.path.splitext(os.path.basename(hex_path))[0]
+        expected_path = os.path.join(ROOT, "test_data", "proc", f"{cast}.cnv")
+        if not os.path.isfile(expected_path) or os.path.getsize(expected_path) == 0:
+            print(f"{cast}.cnv is missing or empty in test_data, not compared")
+            continue
+
+        with tempfile.TemporaryDirectory() as work_dir:
+            converted_dir = os.path.join(work_dir, "converted")
+            os.makedirs(converted_dir)
+            datcnv.run_psa(datcnv_template.write(os.path.join(converted_dir, "EN_DatCnv.psa"), os.path.dirname(hex_path),
+                                                 converted_dir, os.path.join(ROOT, "test_data", "raw", f"{cast}.XMLCON"),
+                                                 [f"{cast}.hex"], f"{cast}.cnv"))
+            converted = os.path.join(converted_dir, f"{cast}.cnv")
+            output = os.path.join(work_dir, f"{cast}.cnv")
+            psas = [render(psa_file, work_dir, cast, work_dir) for psa_file, _ in STAGES]
+
+            def setup():
+                with open(converted, "rb") as source, open(output, "wb") as target:
+                    target.write(source.read())
+
+            staged = best_time(lambda: [module.run_psa(psa) for psa, (_, module) in zip(psas, STAGES)], setup)
+            staged_path = os.path.join(work_dir, f"{cast}_staged.cnv")
+            os.replace(output, staged_path)
+            message = []
+            fused = best_time(lambda: message.append(
+                cnv_corrections.run_chain([(module.correct, psa) for psa, (_, module) in zip(psas, STAGES)])), setup)
+            print(f"{message[-1]}: {staged * 1000:.0f} ms stage by stage, {fused * 1000:.0f} ms fused")
+
+            # Stage by stage, the aligned values are rounded to the printed digits before CellTM
+            print("  fused against stage by stage:")
+            ok = bench_datcnv.compare(output, staged_path) and ok
+            print("  fused against SBE Data Processing:")
+            ok = bench_datcnv.compare(output, expected_path) and ok
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,79 @@
+"""
+Check the built-in DatCnv against the DatCnvW output in test_data and time it.
+
+    python benchmarks/bench_datcnv.py
+
+Every test_data/raw/<cast>.hex is converted with test_data/procontrol/EN_DatCnv_b.psa
+(which writes <cast>.cnv and <cast>.ros) and compared with test_data/proc:
+<cast>.ros column by column, and <cast>.cnv for the columns that the later stages
+(AlignCTD, CellTM) do not rewrite. Differences are counted in units of the last
+printed digit; a difference of one digit is a rounding difference.
+"""
+import glob
+import os
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import cnv_file
+import datcnv
+import psa_template
+
+REPEATS = 3
+
+# Columns of the shipped .cnv files changed after DatCnv by AlignCTD and CellTM
+REWRITTEN_COLUMNS = {"c0S/m", "c1S/m"}
+
+
+def compare(output_path, expected_path, skip=()):
+    """Print the differences of the shared columns; return False if any is more than one digit."""
+    header, output = cnv_file.read_cnv(output_path)
+    expected_header, expected = cnv_file.read_cnv(expected_path)
+    if len(output) != len(expected):
+        print(f"  {os.path.basename(expected_path)}: {len(output)} scans instead of {len(expected)}")
+        return False
+
+    ok = True
+    for index, name in enumerate(header.names):
+        if name in skip or name not in expected_header.names:
+            continue
+        fmt = header.formats[index]
+        step = 10.0 ** -int(fmt[1:-1]) if fmt.endswith("f") else 1.0
+        diff = np.round(np.abs(output[name] - expected[name]) / step, 3)
+        ok = ok and diff.max() <= 1
+        print(f"  {os.path.basename(expected_path):<10} {name:<10} {int((diff > 0.5).sum()):6} differ, "
+              f"max {diff.max():.0f} digit(s)" + ("  MISMATCH" if diff.max() > 1 else ""))
+    return ok
+
+
+def main():
+    ok = True
+    template = psa_template.compile_psa(os.path.join(ROOT, "test_data", "procontrol", "EN_DatCnv_b.psa"))
+    with tempfile.TemporaryDirectory() as work_dir:
+        for hex_path in sorted(glob.glob(os.path.join(ROOT, "test_data", "raw", "*.hex"))):
+            cast = os.path.splitext(os.path.basename(hex_path))[0]
+            psa_path = template.write(os.path.join(work_dir, f"{cast}.psa"), os.path.dirname(hex_path), work_dir,
+                                      os.path.join(ROOT, "test_data", "raw", f"{cast}.XMLCON"), [f"{cast}.hex"], f"{cast}.cnv")
+            times = []
+            for _ in range(REPEATS):
+                start = time.perf_counter()
+                message = datcnv.run_psa(psa_path)
+                times.append(time.perf_counter() - start)
+            print(f"{message} in {min(times) * 1000:.0f} ms")
+
+            for extension, skip in ((".ros", ()), (".cnv", REWRITTEN_COLUMNS)):
+                expected_path = os.path.join(ROOT, "test_data", "proc", cast + extension)
+                if not os.path.isfile(expected_path) or os.path.getsize(expected_path) == 0:
+                    print(f"  {cast}{extension} is missing or empty in test_data, not compared")
+                    continue
+                ok = compare(os.path.join(work_dir, cast + extension), expected_path, skip) and ok
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
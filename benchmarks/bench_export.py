@@ -0,0 +1,79 @@
+"""
+Compare loading exported casts (cnv_export.py) with parsing the ASCII .cnv files.
+
+    python benchmarks/bench_export.py [files ...]
+
+Defaults to the .cnv files in test_data/proc. For each file: line-by-line parsing,
+cnv_file.read_cnv, the exported .npz (read_npz) and the cast in a cruise dataset
+(CruiseDataset.cast, every value touched). The last lines load three variables of every
+cast, from the .cnv files and from the cruise dataset.
+"""
+import glob
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import cnv_export
+import cnv_file
+from bench_cnv_reader import best_time, read_lines
+
+
+def load_dataset_cast(dataset, name, variables):
+    arrays = dataset.cast(name, variables)
+    # The views are only read from disk when used
+    return sum(float(np.nansum(array)) for array in arrays.values())
+
+
+def main(paths):
+    if not paths:
+        root = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_data", "proc")
+        paths = sorted(glob.glob(os.path.join(root, "*.cnv")))
+    paths = [path for path in paths if os.path.getsize(path) > 0]
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        npz_paths = [cnv_export.export_cnv(path, os.path.join(work_dir, os.path.basename(path) + ".npz")) for path in paths]
+        dataset_dir = os.path.join(work_dir, "cruise")
+        cnv_export.build_dataset(paths, dataset_dir)
+        dataset = cnv_export.CruiseDataset(dataset_dir)
+
+        print(f"{'file':<20}{'scans':>8}{'MB':>7}{'npz MB':>8}{'lines (ms)':>12}{'read_cnv (ms)':>15}"
+              f"{'npz (ms)':>10}{'dataset (ms)':>14}{'vs read_cnv':>13}")
+        for path, npz_path in zip(paths, npz_paths):
+            name = os.path.splitext(os.path.basename(path))[0]
+            line_time, _ = best_time(read_lines, path)
+            cnv_time, (header, data) = best_time(cnv_file.read_cnv, path)
+            npz_time, (_, exported) = best_time(cnv_export.read_npz, npz_path)
+            dataset_time, _ = best_time(load_dataset_cast, cnv_export.CruiseDataset(dataset_dir), name, header.names)
+
+            if not all(np.array_equal(data[column], exported[column]) for column in header.names):
+                print(f"{os.path.basename(path)}: the exported .npz differs from the .cnv")
+                return 1
+            cast = dataset.cast(name, header.names)
+            if not all(np.array_equal(data[column].astype(np.float64), cast[column]) for column in header.names):
+                print(f"{os.path.basename(path)}: the cruise dataset differs from the .cnv")
+                return 1
+
+            print(f"{os.path.basename(path):<20}{len(data):>8}{os.path.getsize(path) / 1e6:>7.2f}"
+                  f"{os.path.getsize(npz_path) / 1e6:>8.2f}{line_time * 1000:>12.1f}{cnv_time * 1000:>15.1f}"
+                  f"{npz_time * 1000:>10.1f}{dataset_time * 1000:>14.2f}{cnv_time / dataset_time:>12.0f}x")
+
+        variables = [name for name in ("prDM", "t090C", "sal00") if name in dataset.variables]
+        cnv_time, _ = best_time(lambda: [cnv_file.read_cnv(path, [v for v in variables if v in cnv_file.read_header(path).names])
+                                         for path in paths])
+        dataset_time, _ = best_time(lambda: cnv_export.CruiseDataset(dataset_dir).select(variables=variables))
+        print(f"\n{len(paths)} cast(s), {', '.join(variables)}: .cnv files {cnv_time * 1000:.1f} ms, "
+              f"cruise dataset {dataset_time * 1000:.2f} ms ({cnv_time / dataset_time:.0f}x)")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,163 @@
+"""
+Follow a cast while it is recorded, by replaying a test_data .hex file into a growing file.
+
+    python benchmarks/bench_live.py --cast CTD01 --speed 50
+
+First the .hex file is written in blocks of --block seconds of scans, and after each block
+live_cast.LiveCast reads, converts, corrects and bins the new scans and writes the live
+profile and plot. The time per update is printed for the first and the last quarter of the
+cast: each update only costs its own scans, so they should be the same. The profile at the
+end must be the same as the bin averages of the whole cast (the built-in DatCnv, AlignCTD,
+CellTM and BinAvg, run in memory).
+
+Then the cast is replayed in real time, --speed times faster, while live_cast.follow_cast()
+follows it, and the pipeline is run on it as "ctd_cli live" does. The time from the last
+write to the final products is printed, and <cast>_live.cnv is compared with the bin averages
+of the whole cast in printed digits. It is not compared with the pipeline's <cast>_avg.cnv:
+the pipeline rounds <cast>.cnv to the printed digits between its stages, so a scan on the
+edge of a bin or at the deepest point can fall in another bin.
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import align_ctd
+import bench_datcnv
+import bin_average
+import cell_thermal_mass
+import cnv_file
+import ctd_pipeline
+import datcnv
+import live_cast
+import sbe_files
+
+PSA_DIR = os.path.join(ROOT, "test_data", "procontrol")
+STAGES = [("EN_DatCnv.psa", "DatCnv (built-in)", 1), ("EN_AlignCTD.psa", "AlignCTD (built-in)", 2),
+          ("EN_CellTM.psa", "CellTM (built-in)", 3), ("EN_BinAvg.psa", "BinAvg (built-in)", 4),
+          ("EN_SeaPlot_TSOO.psa", "SeaPlot (built-in)", 5)]
+CORRECTIONS = (("EN_AlignCTD.psa", align_ctd), ("EN_CellTM.psa", cell_thermal_mass))
+SCAN_RATE = 24
+UPDATE_INTERVAL = 1.0
+END_TIME = 1.0
+
+
+def copy_cast(cast, raw_dir):
+    """Copy the cast's .XMLCON, .hdr and .bl to raw_dir. Returns (the .hex path there, its header, its scan lines)."""
+    os.makedirs(raw_dir)
+    source = os.path.join(ROOT, "test_data", "raw", cast)
+    for extension in (".XMLCON", ".hdr", ".bl"):
+        shutil.copy(source + extension, raw_dir)
+    with open(source + ".hex", "rb") as f:
+        content = f.read()
+    data = content.index(b"\n", content.index(b"*END*")) + 1
+    return os.path.join(raw_dir, cast + ".hex"), content[:data], content[data:].splitlines(keepends=True)
+
+
+def whole_cast(hex_path):
+    """The bin averages of the whole cast, converted, corrected and binned in memory."""
+    settings = datcnv.DatCnvSettings(os.path.join(PSA_DIR, "EN_DatCnv.psa"))
+    hex_header, values, short_names, long_names, formats, conversion = datcnv.convert(
+        hex_path, ctd_pipeline.xmlcon_path(hex_path), settings)
+    header = datcnv.cnv_header(hex_header, short_names, long_names, formats, conversion, settings, [])
+    header.values["interval"] = f"seconds: {1 / conversion.rate:g}"
+    for psa_file, module in CORRECTIONS:
+        module.correct(header, values, sbe_files.load_psa(os.path.join(PSA_DIR, psa_file)))
+    return bin_average.bin_average(header, values, bin_average.BinAvgSettings(os.path.join(PSA_DIR, "EN_BinAvg.psa")))[0]
+
+
+def updates(cast, work_dir, block):
+    """Time LiveCast updates block by block; return False if its final profile is not the whole cast's."""
+    hex_path, header, lines = copy_cast(cast, os.path.join(work_dir, "raw"))
+    output_dir = os.path.join(work_dir, "updates")
+    os.makedirs(output_dir)
+    live = live_cast.LiveCast(hex_path, STAGES, PSA_DIR, output_dir)
+    times = []
+    with open(hex_path, "wb") as f:
+        f.write(header)
+        step = int(block * SCAN_RATE)
+        for start in range(0, len(lines), step):
+            f.write(b"".join(lines[start:start + step]))
+            f.flush()
+            begin = time.perf_counter()
+            scans = live.update()
+            updated = time.perf_counter()
+            live.write()
+            times.append((scans, updated - begin, time.perf_counter() - updated))
+
+    quarter = max(1, len(times) // 4)
+    for name, part in (("first", times[:quarter]), ("last", times[-quarter:])):
+        scans = sum(scans for scans, _, _ in part)
+        update = sum(update for _, update, _ in part)
+        write = sum(write for _, _, write in part)
+        print(f"{name} quarter: {update / len(part) * 1000:.2f} ms per update ({update / scans * 1e6:.1f} us per scan), "
+              f"{write / len(part) * 1000:.0f} ms to write the profile and plot")
+
+    live.finish()
+    profile = live.bins.profile(final=True)[0]
+    expected = whole_cast(hex_path)
+    same = profile.shape == expected.shape and np.array_equal(np.isnan(profile), np.isnan(expected))
+    difference = np.nanmax(np.abs(profile - expected) / (1 + np.abs(expected))) if same and len(expected) else 0.0
+    print(f"{len(times)} updates of {live.scans} scans; final profile against the whole cast: "
+          + (f"{len(profile)} bins, max relative difference {difference:.1e}" if same else
+             f"{profile.shape} instead of {expected.shape}  MISMATCH"))
+    return same and difference < 1e-9
+
+
+def replay(cast, work_dir, speed):
+    """Replay the cast into a growing file while follow_cast() follows it, then run the pipeline on it."""
+    hex_path, header, lines = copy_cast(cast, os.path.join(work_dir, "replay"))
+    output_dir = os.path.join(work_dir, "proc")
+    last_write = []
+
+    def record():
+        with open(hex_path, "wb") as f:
+            f.write(header)
+            for start in range(0, len(lines), SCAN_RATE):
+                f.write(b"".join(lines[start:start + SCAN_RATE]))
+                f.flush()
+                time.sleep(1 / speed)
+        last_write.append(time.monotonic())
+
+    writer = threading.Thread(target=record)
+    start = time.monotonic()
+    writer.start()
+    live_cast.follow_cast(hex_path, STAGES, PSA_DIR, output_dir, UPDATE_INTERVAL, END_TIME, poll_interval=0.2)
+    writer.join()
+    errors = ctd_pipeline.process_casts([hex_path], STAGES, PSA_DIR, output_dir)
+    done = time.monotonic()
+    print(f"{len(lines) / SCAN_RATE:.0f} s cast replayed in {last_write[0] - start:.0f} s; final products "
+          f"{done - last_write[0]:.1f} s after the last scan ({END_TIME:g} s of it waiting for the end of the cast)")
+
+    live_path = os.path.join(output_dir, f"{cast}_live.cnv")
+    expected_path = os.path.join(work_dir, f"{cast}_whole.cnv")
+    header, _ = cnv_file.read_cnv(live_path)
+    cnv_file.write_cnv(expected_path, header, whole_cast(hex_path))
+    print(f"  {os.path.basename(live_path)} against the whole cast:")
+    return bench_datcnv.compare(live_path, expected_path) and not errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--cast", default="CTD01", help="test_data/raw cast to replay (default: CTD01).")
+    parser.add_argument("--speed", type=float, default=50, help="Replay this many times faster than recorded (default: 50).")
+    parser.add_argument("--block", type=float, default=5, help="Seconds of scans per update (default: 5).")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        ok = updates(args.cast, work_dir, args.block)
+        ok = replay(args.cast, work_dir, args.speed) and ok
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
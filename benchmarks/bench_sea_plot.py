@@ -0,0 +1,56 @@
+"""
+Time the built-in SeaPlot and compare its image sizes with the SeaPlotW bitmaps in test_data.
+
+    python benchmarks/bench_sea_plot.py
+
+Every test_data/proc .cnv file is plotted with both Sea Plot PSA files, first building a new
+figure for every image (as a process per plot would) and then reusing one figure per PSA.
+"""
+import glob
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import sea_plot
+
+REPEATS = 3
+
+
+def main():
+    psa_paths = sorted(glob.glob(os.path.join(ROOT, "test_data", "procontrol", "EN_SeaPlot_*.psa")))
+    cnv_files = [f for f in sorted(glob.glob(os.path.join(ROOT, "test_data", "proc", "*.cnv"))) if os.path.getsize(f)]
+    bitmaps = glob.glob(os.path.join(ROOT, "test_data", "proc", "*.bmp"))
+    images = len(psa_paths) * len(cnv_files) * REPEATS
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        start = time.perf_counter()
+        for _ in range(REPEATS):
+            for psa_path in psa_paths:
+                for cnv_file in cnv_files:
+                    sea_plot._figures.cache = {}
+                    sea_plot.plot_files(psa_path, [cnv_file], output_dir)
+        fresh = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for _ in range(REPEATS):
+            for psa_path in psa_paths:
+                sea_plot.plot_files(psa_path, cnv_files, output_dir)
+        reused = time.perf_counter() - start
+
+        pngs = glob.glob(os.path.join(output_dir, "*.png"))
+        png_size = sum(os.path.getsize(f) for f in pngs) / len(pngs)
+
+    print(f"{images} images, new figure each: {fresh / images * 1000:.0f} ms per image")
+    print(f"{images} images, figure reused:   {reused / images * 1000:.0f} ms per image")
+    if bitmaps:
+        bmp_size = sum(os.path.getsize(f) for f in bitmaps) / len(bitmaps)
+        print(f"average image size: PNG {png_size / 1024:.0f} kB, SeaPlotW BMP {bmp_size / 1024:.0f} kB")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,127 @@
+"""
+Spread a manifest over several worker processes through a spool directory (job_spool.py).
+
+    python benchmarks/bench_spool.py [--casts 12] [--workers 3] [--latency 0.2] [--lease 4]
+
+--casts synthetic casts are processed by the config.json pipeline run by stand-in modules,
+first by one worker, then by --workers workers, each a `ctd_cli work` process started next
+to a `ctd_cli coordinate` process on this machine. A last run kills one of two workers
+(SIGKILL) while it holds a lease: its cast must be given to the other worker once the
+lease expires. Every run must leave the products of every cast in the output directory.
+"""
+import argparse
+import csv
+import json
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import job_spool
+import sbe_stand_in
+import synthetic_casts
+
+PSA_DIR = os.path.join(ROOT, "test_data", "procontrol")
+
+
+def write_setup(work_dir, casts, latency):
+    """Synthetic casts, a configuration run by stand-in modules and a manifest of the casts. Returns the manifest path."""
+    raw_files = synthetic_casts.make_casts(os.path.join(work_dir, "raw"), casts)
+    with open(os.path.join(ROOT, "config.json")) as f:
+        config = json.load(f)
+    config.update(psa_dir=PSA_DIR, executables_dir=sbe_stand_in.install(os.path.join(work_dir, "sbe"), latency),
+                  output_file=os.path.join(work_dir, "proc"), raw_files=[])
+    config_path = os.path.join(work_dir, "config.json")
+    with open(config_path, "w") as f:
+        json.dump(config, f, indent=4)
+
+    manifest_path = os.path.join(work_dir, "manifest.csv")
+    with open(manifest_path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["raw_file", "config", "output_dir"])
+        for raw_file in raw_files:
+            writer.writerow([raw_file, config_path, ""])
+    return manifest_path, [os.path.splitext(os.path.basename(raw_file))[0] for raw_file in raw_files], config["output_file"]
+
+
+def start(arguments, log_path):
+    log = open(log_path, "w")
+    return subprocess.Popen([sys.executable, "-m", "ctd_cli"] + arguments, cwd=ROOT, stdout=log, stderr=subprocess.STDOUT)
+
+
+def run(work_dir, manifest_path, casts, output_dir, workers, lease, kill_after_lease=False):
+    """Process the manifest with workers worker processes. Returns (wall time, spool)."""
+    name = f"{workers}_workers" + ("_kill" if kill_after_lease else "")
+    spool_dir = os.path.join(work_dir, f"spool_{name}")
+    shutil.rmtree(output_dir, ignore_errors=True)
+    logs = os.path.join(work_dir, f"logs_{name}")
+    os.makedirs(logs)
+
+    begin = time.perf_counter()
+    coordinator = start(["coordinate", "--spool", spool_dir, "--manifest", manifest_path, "--lease", str(lease)],
+                        os.path.join(logs, "coordinator.log"))
+    spool = job_spool.Spool(spool_dir)
+    # Workers told to exit when idle would find an empty spool before the coordinator fills it
+    while len(spool.list(job_spool.QUEUED_DIR)) < len(casts):
+        time.sleep(0.05)
+    processes = [start(["work", "--spool", spool_dir, "--name", f"w{n}", "--exit-when-idle",
+                        "--scratch", os.path.join(work_dir, f"scratch_{name}_w{n}")], os.path.join(logs, f"w{n}.log"))
+                 for n in range(workers)]
+
+    if kill_after_lease:
+        while not any(name.endswith("@w0.json") for name in spool.list(job_spool.LEASED_DIR)):
+            time.sleep(0.05)
+        processes[0].send_signal(signal.SIGKILL)
+        held = [name for name in spool.list(job_spool.LEASED_DIR) if name.endswith("@w0.json")]
+        print(f"  killed worker w0 while it held {', '.join(held)}")
+
+    if coordinator.wait(timeout=600) != 0:
+        raise RuntimeError(f"the coordinator failed, see {logs}")
+    wall_time = time.perf_counter() - begin
+    for process in processes:
+        process.wait(timeout=60)
+
+    missing = [cast for cast in casts if not os.path.isfile(os.path.join(output_dir, f"{cast}_avg.cnv"))]
+    if missing:
+        raise RuntimeError(f"no products for {', '.join(missing)}")
+    return wall_time, spool
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Process a manifest with worker processes sharing a spool directory.")
+    parser.add_argument("--casts", type=int, default=12, help="Number of synthetic casts (default: 12).")
+    parser.add_argument("--workers", type=int, default=3, help="Number of workers of the second run (default: 3).")
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds each stand-in module takes (default: 0.2).")
+    parser.add_argument("--lease", type=float, default=4, help="Lease time in seconds (default: 4).")
+    args = parser.parse_args(argv)
+
+    work_dir = tempfile.mkdtemp()
+    try:
+        manifest_path, casts, output_dir = write_setup(work_dir, args.casts, args.latency)
+        times = {}
+        for workers in sorted({1, args.workers}):
+            times[workers], _ = run(work_dir, manifest_path, casts, output_dir, workers, args.lease)
+            print(f"{workers} worker(s): {len(casts)} casts in {times[workers]:.1f} s "
+                  f"({len(casts) * 3600 / times[workers]:.0f} casts/hour, {times[1] / times[workers]:.2f}x)")
+
+        print("2 workers, one killed while it runs a cast:")
+        wall_time, spool = run(work_dir, manifest_path, casts, output_dir, 2, args.lease, kill_after_lease=True)
+        retried = [job for job in spool.finished() if job["attempt"] > 1]
+        print(f"  {len(casts)} casts in {wall_time:.1f} s; run again after the lease expired: "
+              + (", ".join(f"{job['cast']} (attempt {job['attempt']} on {job['worker']})" for job in retried) or "none"))
+        if not retried:
+            return 1
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,296 @@
+"""
+Throughput benchmarks of the batch processor, saved as JSON to compare commits.
+
+    python benchmarks/bench_suite.py [--casts 8] [--scale 1] [--latency 0.2] [--jobs 4] [--batch-size 8]
+    python benchmarks/bench_suite.py --compare results/old.json results/new.json
+
+Synthetic casts (benchmarks/synthetic_casts.py) are processed with:
+
+  batch_stand_in  the example pipeline of config.json with stand-in SBE modules
+                  (benchmarks/sbe_stand_in.py), with 1 and --jobs workers
+  batch_built_in  the built-in DatCnv, BottleSum, BinAvg and SeaPlot stages, same jobs
+  batch_invocation  the stand-in pipeline with one module run per cast and with up to
+                  --batch-size casts per module run (ctd_pipeline.run_batches()), 1 worker
+  psa_render      parsing and rendering the PSA files of every (cast, stage)
+  config_load     loading a configuration with --psa-rows PSA entries, and the pre-flight check
+  gui_psa_rows    building the GUI rows of --psa-rows PSA files (needs a display)
+
+The results are written to benchmarks/results/<date>_<commit>.json (or --output) with the
+commit, machine and parameters. --compare prints the times of two result files side by side.
+"""
+import argparse
+import contextlib
+import glob
+import importlib.util
+import json
+import os
+import platform
+import queue
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import ctd_pipeline
+import psa_template
+import sbe_files
+import sbe_stand_in
+import synthetic_casts
+
+PSA_DIR = os.path.join(ROOT, "test_data", "procontrol")
+RESULTS_DIR = os.path.join(ROOT, "benchmarks", "results")
+
+BUILT_IN_STAGES = [("EN_DatCnv_b.psa", "DatCnv (built-in)"), ("EN_BottleSum.psa", "BottleSum (built-in)"),
+                   ("EN_BinAvg.psa", "BinAvg (built-in)"), ("EN_SeaPlot_TSOO.psa", "SeaPlot (built-in)"),
+                   ("EN_SeaPlot_TTSS.psa", "SeaPlot (built-in)")]
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                                    capture_output=True, text=True).stdout.strip())
+    except OSError:
+        return "unknown", False
+    return commit or "unknown", dirty
+
+
+def example_stages(work_dir, latency):
+    """The selected stages of config.json, run by stand-in modules installed in work_dir."""
+    executables_dir = sbe_stand_in.install(os.path.join(work_dir, "sbe"), latency)
+    return ctd_pipeline.selected_stages(ctd_pipeline.load_config(os.path.join(ROOT, "config.json")), executables_dir)
+
+
+def module_launches(output_dir):
+    """Number of module processes the run in output_dir started, from its run report."""
+    launches = set()
+    for report_path in glob.glob(os.path.join(output_dir, "ctd_run_*.jsonl")):
+        with open(report_path) as f:
+            for line in f:
+                record = json.loads(line)
+                if record["type"] == "stage" and record["status"] in ("done", "failed", "timeout") and "built-in" not in record["executable"]:
+                    # The casts of a batched run share its command and start time
+                    launches.add((tuple(record["command"]), record["start"]))
+    return len(launches)
+
+
+def run_batch(raw_files, stages, output_dir, jobs, batch_size=1):
+    shutil.rmtree(output_dir, ignore_errors=True)
+    start = time.perf_counter()
+    # The batch prints every stage; only the times are of interest here
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        errors = ctd_pipeline.process_casts(raw_files, stages, PSA_DIR, output_dir, jobs=jobs, events=queue.Queue(),
+                                            batch_size=batch_size)
+    wall_time = time.perf_counter() - start
+    if errors:
+        raise RuntimeError(f"batch failed: {errors[0]}")
+    return {"wall_time": round(wall_time, 3), "casts_per_hour": round(len(raw_files) * 3600 / wall_time, 1),
+            "launches": module_launches(output_dir)}
+
+
+def bench_batch_stand_in(raw_files, work_dir, args):
+    stages = example_stages(work_dir, args.latency)
+    results = {"stages": len(stages), "latency": args.latency,
+               "module_time": round(args.latency * len(stages) * len(raw_files), 3)}
+    for jobs in sorted({1, args.jobs}):
+        results[f"jobs_{jobs}"] = run_batch(raw_files, stages, os.path.join(work_dir, f"stand_in_{jobs}"), jobs)
+    return results
+
+
+def bench_batch_built_in(raw_files, work_dir, args):
+    stages = [(psa_file, executable, order) for order, (psa_file, executable) in enumerate(BUILT_IN_STAGES, 1)]
+    if importlib.util.find_spec("matplotlib") is None:
+        stages = [stage for stage in stages if "SeaPlot" not in stage[1]]
+    results = {"stages": len(stages)}
+    for jobs in sorted({1, args.jobs}):
+        results[f"jobs_{jobs}"] = run_batch(raw_files, stages, os.path.join(work_dir, f"built_in_{jobs}"), jobs)
+    return results
+
+
+def bench_batch_invocation(raw_files, work_dir, args):
+    stages = example_stages(work_dir, args.latency)
+    results = {"stages": len(stages), "batched_stages": sum(ctd_pipeline.can_batch(executable) for _, executable, _ in stages),
+               "latency": args.latency}
+    for batch_size in sorted({1, args.batch_size}):
+        results[f"batch_{batch_size}"] = run_batch(raw_files, stages, os.path.join(work_dir, f"batch_{batch_size}"), 1,
+                                                   batch_size)
+    return results
+
+
+def bench_psa_render(raw_files, work_dir, args):
+    stages = example_stages(work_dir, args.latency)
+    output_dir = os.path.join(work_dir, "render")
+    psa_template._templates.clear()
+
+    start = time.perf_counter()
+    for raw_file in raw_files:
+        ctd_pipeline.prepare_cast_workdir(raw_file, stages, PSA_DIR, output_dir)
+    wall_time = time.perf_counter() - start
+    renders = len(raw_files) * len(stages)
+    return {"renders": renders, "wall_time": round(wall_time, 4), "per_render_us": round(wall_time / renders * 1e6, 1)}
+
+
+def psa_rows_dir(work_dir, rows):
+    """A PSA directory with rows copies of the test_data PSA files, and a configuration selecting them all."""
+    psa_dir = os.path.join(work_dir, f"psa_{rows}")
+    os.makedirs(psa_dir, exist_ok=True)
+    sources = sorted(name for name in os.listdir(PSA_DIR) if name.lower().endswith(".psa"))
+    entries = []
+    for n in range(rows):
+        source = sources[n % len(sources)]
+        psa_file = f"{os.path.splitext(source)[0]}_{n:04d}.psa"
+        shutil.copy(os.path.join(PSA_DIR, source), os.path.join(psa_dir, psa_file))
+        module = sbe_files.load_psa(os.path.join(PSA_DIR, source)).module
+        entries.append({"psa_file": psa_file, "executable": module, "order": str(n + 1), "selected": True})
+
+    config_path = os.path.join(work_dir, f"config_{rows}.json")
+    with open(config_path, "w") as f:
+        json.dump({"psa_dir": psa_dir, "executables_dir": os.path.join(work_dir, "sbe"), "output_file": work_dir,
+                   "raw_files": [], "executables": sbe_stand_in.MODULES, "psa_files": entries}, f, indent=4)
+    return psa_dir, config_path
+
+
+def bench_config_load(raw_files, work_dir, args):
+    _, config_path = psa_rows_dir(work_dir, args.psa_rows)
+
+    start = time.perf_counter()
+    config = ctd_pipeline.load_config(config_path)
+    stages = ctd_pipeline.selected_stages(config)
+    load_time = time.perf_counter() - start
+
+    example = example_stages(work_dir, args.latency)
+    times = []
+    for _ in range(2):
+        start = time.perf_counter()
+        _, runnable, errors = ctd_pipeline.preflight(raw_files, example, PSA_DIR, os.path.join(work_dir, "preflight"))
+        times.append(time.perf_counter() - start)
+    return {"psa_rows": len(stages), "load_time": round(load_time, 4),
+            "preflight_time": round(times[0], 4), "preflight_cached_time": round(times[1], 4),
+            "preflight_errors": len(errors)}
+
+
+def bench_gui_psa_rows(raw_files, work_dir, args):
+    psa_dir, config_path = psa_rows_dir(work_dir, args.psa_rows)
+    import tkinter
+    from tkinter import messagebox, ttk
+    import python_runpsa as gui
+
+    try:
+        root = tkinter.Tk()
+    except tkinter.TclError as e:
+        return {"skipped": f"no display: {e}"}
+    root.withdraw()
+    # Only the widgets the PSA rows use; the theme modules are not needed
+    gui.tk, gui.ttk, gui.messagebox = tkinter, ttk, messagebox
+    gui.root = root
+    gui.psa_files_frame = gui.build_psa_table(root)
+    gui.psa_files_frame.pack()
+    for name in ("raw_files_var", "psa_dir_var", "executables_dir_var", "output_file_var"):
+        setattr(gui, name, tkinter.StringVar(root))
+    gui.jobs_var, gui.batch_size_var, gui.incremental_var = tkinter.IntVar(root), tkinter.IntVar(root), tkinter.BooleanVar(root)
+    gui.raw_file_display_label = tkinter.Label(root)
+
+    try:
+        start = time.perf_counter()
+        gui.load_psa_files(psa_dir)
+        root.update_idletasks()
+        rows_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        gui.load_config_to_gui(ctd_pipeline.load_config(config_path))
+        root.update_idletasks()
+        config_time = time.perf_counter() - start
+    finally:
+        root.destroy()
+    return {"psa_rows": args.psa_rows, "build_rows_time": round(rows_time, 3), "load_config_time": round(config_time, 3)}
+
+
+BENCHMARKS = {
+    "batch_stand_in": bench_batch_stand_in,
+    "batch_built_in": bench_batch_built_in,
+    "batch_invocation": bench_batch_invocation,
+    "psa_render": bench_psa_render,
+    "config_load": bench_config_load,
+    "gui_psa_rows": bench_gui_psa_rows,
+}
+
+
+def flatten(results, prefix=""):
+    """{"batch_stand_in.jobs_4.wall_time": 1.2, ...} of the numbers in a result tree."""
+    values = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            values.update(flatten(value, f"{prefix}{key}."))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            values[prefix + key] = value
+    return values
+
+
+def compare(old_path, new_path):
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{'':52}{old['commit']:>12}{new['commit']:>12}")
+    old_values, new_values = flatten(old["results"]), flatten(new["results"])
+    for key in old_values:
+        if key in new_values and key.endswith(("time", "_us", "per_hour", "launches")):
+            ratio = f"{new_values[key] / old_values[key]:8.2f}x" if old_values[key] else ""
+            print(f"{key:52}{old_values[key]:12g}{new_values[key]:12g}{ratio}")
+    return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the batch processor and save the results as JSON.")
+    parser.add_argument("--casts", type=int, default=8, help="Number of synthetic casts (default: 8).")
+    parser.add_argument("--scale", type=int, default=1, help="Times each cast is made longer (default: 1).")
+    parser.add_argument("--latency", type=float, default=0.2, help="Seconds each stand-in module takes (default: 0.2).")
+    parser.add_argument("--jobs", type=int, default=4, help="Workers for the parallel runs (default: 4).")
+    parser.add_argument("--batch-size", type=int, default=8, help="Casts per module run for batch_invocation (default: 8).")
+    parser.add_argument("--psa-rows", type=int, default=300, help="PSA files for the config and GUI benchmarks (default: 300).")
+    parser.add_argument("--only", nargs="+", choices=list(BENCHMARKS), help="Run only these benchmarks.")
+    parser.add_argument("--output", help="Result file (default: benchmarks/results/<date>_<commit>.json).")
+    parser.add_argument("--compare", nargs=2, metavar=("OLD", "NEW"), help="Compare two result files instead.")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        return compare(*args.compare)
+
+    commit, dirty = git_commit()
+    report = {
+        "commit": commit + ("-dirty" if dirty else ""),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "parameters": {"casts": args.casts, "scale": args.scale, "latency": args.latency, "jobs": args.jobs,
+                       "batch_size": args.batch_size, "psa_rows": args.psa_rows},
+        "results": {},
+    }
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        raw_files = synthetic_casts.make_casts(os.path.join(work_dir, "raw"), args.casts, args.scale)
+        for name in args.only or BENCHMARKS:
+            print(f"--- {name}")
+            try:
+                report["results"][name] = BENCHMARKS[name](raw_files, work_dir, args)
+            except Exception as e:
+                report["results"][name] = {"error": f"{type(e).__name__}: {e}"}
+            print(json.dumps(report["results"][name]))
+
+    output = args.output or os.path.join(RESULTS_DIR, f"{datetime.now():%Y%m%d_%H%M%S}_{report['commit']}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as f:
+        json.dump(report, f, indent=4)
+    print(f"Results written to {output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,82 @@
+"""
+Time from the end of a cast to its processed products in watch mode.
+
+    python benchmarks/bench_watch_folder.py
+
+The test_data/raw casts are copied into a temporary raw directory the way Seasave writes
+them (the .hex grows in chunks while the cast runs, the .bl last) while
+ctd_pipeline.watch_casts() watches it with the built-in DatCnv and BinAvg stages. The
+latency is measured from the last write of each cast to its _avg.cnv appearing.
+"""
+import glob
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import ctd_pipeline
+
+SETTLE_TIME = 1.0
+POLL_INTERVAL = 0.2
+HEX_CHUNKS = 5
+STAGES = [("EN_DatCnv.psa", "DatCnv (built-in)", 1), ("EN_BinAvg.psa", "BinAvg (built-in)", 2)]
+
+
+def write_cast(hex_path, raw_dir):
+    """Copy one cast into raw_dir as Seasave would write it. Returns the time of the last write."""
+    cast = os.path.splitext(os.path.basename(hex_path))[0]
+    source = os.path.dirname(hex_path)
+    shutil.copy(os.path.join(source, f"{cast}.hdr"), raw_dir)
+    xmlcon = glob.glob(os.path.join(source, f"{cast}.[xX][mM][lL][cC][oO][nN]"))[0]
+    target_hex = os.path.join(raw_dir, os.path.basename(hex_path))
+    shutil.copy(xmlcon, ctd_pipeline.xmlcon_path(target_hex))
+
+    with open(hex_path, "rb") as f:
+        content = f.read()
+    with open(target_hex, "wb") as f:
+        for i in range(HEX_CHUNKS):
+            f.write(content[i * len(content) // HEX_CHUNKS:(i + 1) * len(content) // HEX_CHUNKS])
+            f.flush()
+            time.sleep(SETTLE_TIME / 2)
+    shutil.copy(os.path.join(source, f"{cast}.bl"), raw_dir)
+    return time.time()
+
+
+def main():
+    hex_files = sorted(glob.glob(os.path.join(ROOT, "test_data", "raw", "*.hex")))
+    psa_dir = os.path.join(ROOT, "test_data", "procontrol")
+    with tempfile.TemporaryDirectory() as work_dir:
+        raw_dir, output_dir = os.path.join(work_dir, "raw"), os.path.join(work_dir, "proc")
+        os.makedirs(raw_dir)
+        stop_event = threading.Event()
+        watcher = threading.Thread(target=ctd_pipeline.watch_casts,
+                                   args=(raw_dir, STAGES, psa_dir, output_dir, 2, True, None, stop_event,
+                                         SETTLE_TIME, POLL_INTERVAL))
+        watcher.start()
+
+        ok = True
+        for hex_path in hex_files:
+            cast = os.path.splitext(os.path.basename(hex_path))[0]
+            finished = write_cast(hex_path, raw_dir)
+            product = os.path.join(output_dir, f"{cast}_avg.cnv")
+            while not os.path.exists(product) and time.time() - finished < 30:
+                time.sleep(0.05)
+            if os.path.exists(product):
+                print(f"{cast}: {product} {time.time() - finished:.2f} s after the cast ended "
+                      f"(settle time {SETTLE_TIME:g} s)")
+            else:
+                print(f"{cast}: not processed")
+                ok = False
+
+        stop_event.set()
+        watcher.join()
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,187 @@
+"""
+Stand-ins for the SBE Data Processing modules, so batches can be timed on Linux.
+
+    python benchmarks/sbe_stand_in.py --install /tmp/sbe --latency 0.5
+
+--install writes one executable script per module (DatCnvW.exe, AlignCTDW.exe, ...) to a
+directory that can be used as the executables directory of a configuration. Each one takes
+the module's command line (/i<input> /o<output dir> /f<output file> /p<psa> /c<xmlcon> /s),
+sleeps for the latency (the SBE_STAND_IN_LATENCY environment variable, in seconds,
+overrides the installed value) and writes small files where the module would. Without /i
+it processes every file of the PSA's <InputDir> and <InputFileArray>, each named after its
+input, with a single latency for the whole run:
+
+    DatCnvW     <cast>.cnv and/or <cast>.ros, as the PSA's CreateFile asks
+    BinAvgW     <cast><NameAppend>.cnv with one scan in 24
+    BottleSumW  <cast>.cnv<NameAppend>.btl
+    SeaPlotW    <cast><NameAppend>.bmp
+    others      <cast><NameAppend>.cnv, the input with a <module>_date header line
+
+A missing input or XMLCON fails the way the modules do: a message and exit code 1.
+"""
+import argparse
+import os
+import re
+import sys
+import time
+import xml.etree.ElementTree as ET
+from datetime import datetime
+
+MODULES = ["DatCnvW.exe", "AlignCTDW.exe", "CellTMW.exe", "FilterW.exe", "LoopEditW.exe", "WildEditW.exe",
+           "DeriveW.exe", "BinAvgW.exe", "BottleSumW.exe", "SeaPlotW.exe", "StripW.exe", "SectionW.exe"]
+
+DEFAULT_LATENCY = 0.5
+
+# A 1x1 pixel bitmap, standing in for the SeaPlotW image
+BITMAP = (b"BM" + (58).to_bytes(4, "little") + bytes(4) + (54).to_bytes(4, "little") + (40).to_bytes(4, "little")
+          + (1).to_bytes(4, "little") + (1).to_bytes(4, "little") + (1).to_bytes(2, "little") + (24).to_bytes(2, "little")
+          + bytes(24) + b"\xff\xff\xff\x00")
+
+WRAPPER = """#!{python}
+import sys
+sys.path.insert(0, {directory!r})
+import sbe_stand_in
+sys.exit(sbe_stand_in.main({module!r}, sys.argv[1:], {latency!r}))
+"""
+
+
+def parse_arguments(argv):
+    """{letter: value} of an SBE module command line, e.g. {"i": "D:/raw/CTD01.hex", "s": ""}."""
+    return {arg[1].lower(): arg[2:] for arg in argv if len(arg) >= 2 and arg[0] == "/"}
+
+
+def psa_value(psa_path, tag, default=""):
+    element = next(ET.parse(psa_path).getroot().iter(tag), None)
+    return element.get("value", default) if element is not None else default
+
+
+def header_lines(path):
+    """The header lines of a .hex or .cnv file, up to *END*."""
+    lines = []
+    with open(path, "r", encoding="latin-1") as f:
+        for line in f:
+            if line.startswith("*END*"):
+                break
+            lines.append(line.rstrip("\r\n"))
+    return lines
+
+
+def scan_lines(path):
+    """The data lines of a .hex or .cnv file."""
+    with open(path, "r", encoding="latin-1") as f:
+        for line in f:
+            if line.startswith("*END*"):
+                break
+        return [line.rstrip("\r\n") for line in f]
+
+
+def write_lines(path, lines):
+    with open(path, "w", encoding="latin-1", newline="") as f:
+        f.write("\r\n".join(lines) + "\r\n")
+
+
+def convert(module, input_file, output_dir, cast, append, psa_path):
+    """DatCnvW: a .cnv with the scan number and a flag for every scan of the .hex file."""
+    scans = scan_lines(input_file)
+    header = header_lines(input_file) + [
+        "# nquan = 2",
+        f"# nvalues = {len(scans)}",
+        "# units = specified",
+        "# name 0 = scan: Scan Count",
+        "# name 1 = flag:  0.000e+00",
+        f"# datcnv_date = {datetime.now():%b %d %Y %H:%M:%S}, stand-in",
+        "*END*",
+    ]
+    rows = [f"{n + 1:11d} {0.0:10.3e}" for n in range(len(scans))]
+    create_file = psa_value(psa_path, "CreateFile", "0")
+    outputs = []
+    if create_file in ("0", "2"):
+        outputs.append((".cnv", rows))
+    if create_file in ("1", "2"):
+        outputs.append((".ros", rows[::100]))
+    for extension, data in outputs:
+        write_lines(os.path.join(output_dir, cast + append + extension), header + data)
+
+
+def rewrite(module, input_file, output_dir, cast, append, every=1, extension=".cnv"):
+    """The input .cnv with a <module>_date header line (and only one scan in every)."""
+    header = header_lines(input_file)
+    header.append(f"# {module.lower()[:-5]}_date = {datetime.now():%b %d %Y %H:%M:%S}, stand-in")
+    write_lines(os.path.join(output_dir, cast + append + extension), header + ["*END*"] + scan_lines(input_file)[::every])
+
+
+def psa_input_files(psa_path):
+    """The input files of a PSA: <InputDir> joined with each <InputFileArray> item."""
+    root = ET.parse(psa_path).getroot()
+    input_dir = psa_value(psa_path, "InputDir")
+    items = next(root.iter("InputFileArray"), None)
+    return [os.path.join(input_dir, item.get("value", "")) for item in (items if items is not None else [])]
+
+
+def main(module, argv, latency=DEFAULT_LATENCY):
+    args = parse_arguments(argv)
+    latency = float(os.environ.get("SBE_STAND_IN_LATENCY", latency))
+    output_dir, psa_path = args.get("o", ""), args.get("p", "")
+
+    for letter, description in (("i", "input file"), ("p", "PSA file"), ("c", "configuration file")):
+        if letter in args and not os.path.isfile(args[letter]):
+            print(f"{module}: {description} not found: {args[letter]}", file=sys.stderr)
+            return 1
+    if not os.path.isdir(output_dir):
+        print(f"{module}: output directory not found: {output_dir}", file=sys.stderr)
+        return 1
+    input_files = [args["i"]] if "i" in args else psa_input_files(psa_path) if psa_path else []
+    if not input_files:
+        print(f"{module}: no input file", file=sys.stderr)
+        return 1
+
+    time.sleep(latency)
+    for input_file in input_files:
+        # Like the modules, stop at the first input that is missing
+        if not os.path.isfile(input_file):
+            print(f"{module}: input file not found: {input_file}", file=sys.stderr)
+            return 1
+        process(module, input_file, output_dir, psa_path, args.get("f") if "i" in args else None)
+    return 0
+
+
+def process(module, input_file, output_dir, psa_path, output_file=None):
+    """Write the outputs of one input file."""
+    cast = re.sub(r"\.cnv$", "", output_file or os.path.basename(input_file), flags=re.IGNORECASE)
+    cast = os.path.splitext(cast)[0] if cast.lower().endswith((".hex", ".ros")) else cast
+    append = psa_value(psa_path, "NameAppend") if psa_path else ""
+    name = module.lower()
+
+    if name == "datcnvw.exe":
+        convert(module, input_file, output_dir, cast, append, psa_path)
+    elif name == "binavgw.exe":
+        rewrite(module, input_file, output_dir, cast, append, every=24)
+    elif name == "bottlesumw.exe":
+        rewrite(module, input_file, output_dir, cast + ".cnv", append, extension=".btl")
+    elif name == "seaplotw.exe":
+        with open(os.path.join(output_dir, cast + append + ".bmp"), "wb") as f:
+            f.write(BITMAP)
+    else:
+        rewrite(module, input_file, output_dir, cast, append)
+
+
+def install(directory, latency=DEFAULT_LATENCY, modules=MODULES):
+    """Write an executable stand-in for each module to directory. Returns the directory."""
+    os.makedirs(directory, exist_ok=True)
+    here = os.path.dirname(os.path.abspath(__file__))
+    for module in modules:
+        path = os.path.join(directory, module)
+        with open(path, "w") as f:
+            f.write(WRAPPER.format(python=sys.executable, directory=here, module=module, latency=latency))
+        os.chmod(path, 0o755)
+    return directory
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Install stand-ins for the SBE Data Processing modules.")
+    parser.add_argument("--install", required=True, help="Directory the stand-in executables are written to.")
+    parser.add_argument("--latency", type=float, default=DEFAULT_LATENCY,
+                        help=f"Seconds each module takes (default: {DEFAULT_LATENCY:g}).")
+    args = parser.parse_args()
+    install(args.install, args.latency)
+    print(f"{len(MODULES)} stand-in module(s) written to {args.install}")
@@ -0,0 +1,87 @@
+"""
+Make any number of raw casts, of any length, from the test_data/raw casts.
+
+    python benchmarks/synthetic_casts.py --casts 50 --scale 4 --output /tmp/raw
+
+Cast n (SYN0001, SYN0002, ...) is a copy of one of the test_data casts that have a .hex
+file, taken in turn, with its .hdr, .XMLCON and .bl files. With --scale M the scans of the
+.hex file are repeated M times, so the cast is M times longer; the bottles of the .bl file
+stay where they were fired.
+"""
+import argparse
+import glob
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RAW_DIR = os.path.join(ROOT, "test_data", "raw")
+
+# Files copied with the .hex
+COMPANION_FILES = (".hdr", ".XMLCON", ".bl")
+
+
+def source_casts(raw_dir=RAW_DIR):
+    """The .hex files of raw_dir that have all their companion files."""
+    casts = []
+    for hex_path in sorted(glob.glob(os.path.join(raw_dir, "*.hex"))):
+        base = os.path.splitext(hex_path)[0]
+        if all(os.path.isfile(base + extension) for extension in COMPANION_FILES):
+            casts.append(hex_path)
+    return casts
+
+
+def scaled_hex(content, name, scale):
+    """The text of a .hex file with its scans repeated scale times and its FileName set to name."""
+    header, end, scans = content.partition(b"*END*")
+    first_line, _, scans = scans.partition(b"\n")
+    lines = []
+    for line in header.split(b"\n"):
+        if line.startswith(b"* FileName = "):
+            line = line[:line.rindex(b"\\") + 1] + name.encode("latin-1") + b".hex" + (b"\r" if line.endswith(b"\r") else b"")
+        lines.append(line)
+    return b"\n".join(lines) + end + first_line + b"\n" + scans * scale
+
+
+def make_casts(output_dir, count, scale=1, raw_dir=RAW_DIR, prefix="SYN"):
+    """Write count casts to output_dir. Returns the paths of their .hex files."""
+    os.makedirs(output_dir, exist_ok=True)
+    sources = source_casts(raw_dir)
+    if not sources:
+        raise ValueError(f"no complete cast (.hex, .hdr, .XMLCON and .bl) in {raw_dir}")
+
+    contents = {}
+    hex_files = []
+    for n in range(count):
+        source = sources[n % len(sources)]
+        name = f"{prefix}{n + 1:04d}"
+        if source not in contents:
+            with open(source, "rb") as f:
+                contents[source] = f.read()
+
+        hex_path = os.path.join(output_dir, name + ".hex")
+        with open(hex_path, "wb") as f:
+            f.write(scaled_hex(contents[source], name, scale))
+        for extension in COMPANION_FILES:
+            with open(os.path.splitext(source)[0] + extension, "rb") as f:
+                data = f.read()
+            with open(os.path.join(output_dir, name + extension), "wb") as f:
+                f.write(data)
+        hex_files.append(hex_path)
+    return hex_files
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--casts", type=int, default=10, help="Number of casts (default: 10).")
+    parser.add_argument("--scale", type=int, default=1, help="Times the scans of each cast are repeated (default: 1).")
+    parser.add_argument("--output", required=True, help="Directory the casts are written to.")
+    args = parser.parse_args(argv)
+
+    hex_files = make_casts(args.output, args.casts, args.scale)
+    size = sum(os.path.getsize(path) for path in hex_files)
+    print(f"{len(hex_files)} cast(s), {size / 1e6:.1f} MB of .hex, written to {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,396 @@
+import os
+import xml.etree.ElementTree as ET
+
+import numpy as np
+from numpy.lib import recfunctions
+
+import cnv_file
+
+# BinType values of a Bin Average PSA and the unit written to the header
+BIN_TYPES = {0: "scans", 1: "decibars", 2: "meters", 3: "seconds"}
+
+# Columns binned on for each bin type, matched on the start and end of the short name
+BIN_COLUMNS = {"scans": ("scan", ""), "decibars": ("pr", ""), "meters": ("dep", "M"), "seconds": ("timeS", "")}
+
+# CastToProcess values of a Bin Average PSA
+CAST_TYPES = {0: "both", 1: "down", 2: "up"}
+
+# The Bin Average module this stage replaces, used to open its PSA files with "Edit PSA"
+SBE_MODULE = "BinAvgW.exe"
+
+
+class BinAvgSettings:
+    """The bin averaging parameters of a Bin Average PSA file (EN_BinAvg.psa)."""
+
+    def __init__(self, psa_path):
+        root = ET.parse(psa_path).getroot()
+
+        def value(tag, default=""):
+            element = root.find(tag)
+            return element.get("value", default) if element is not None else default
+
+        self.input_dir = value("InputDir")
+        input_files = root.find("InputFileArray")
+        self.input_files = [item.get("value") for item in input_files.iter("ArrayItem")] if input_files is not None else []
+        self.output_dir = value("OutputDir")
+        self.output_file = value("OutputFile")
+        self.name_append = value("NameAppend")
+
+        self.bin_type = BIN_TYPES[int(value("BinType", "1"))]
+        self.bin_size = float(value("BinSize", "1"))
+        self.include_number_scans = value("IncludeNumberScans", "1") == "1"
+        self.exclude_marked_bad = value("ExcludeMarkedBad", "1") == "1"
+        self.scans_to_skip = int(value("ScansToSkip", "0"))
+        self.scans_to_omit = int(value("ScansToOmit", "0"))
+        self.min_scans_per_bin = int(value("MinScansPerBin", "1"))
+        self.max_scans_per_bin = int(value("MaxScansPerBin", "2147483647"))
+        self.cast = CAST_TYPES[int(value("CastToProcess", "1"))]
+        self.include_surface_bin = value("IncludeSurfaceBin", "0") == "1"
+        self.surface_bin_min = float(value("SurfaceBinMinVal", "0"))
+        self.surface_bin_max = float(value("SurfaceBinMaxVal", "0"))
+        self.surface_bin_value = float(value("SurfaceBinVal", "0"))
+        self.interpolate = value("Interpolate", "1") == "1"
+
+    def output_path(self, input_file):
+        """<OutputDir>/<OutputFile without extension><NameAppend>.cnv, e.g. CTD02_avg.cnv."""
+        output_file = self.output_file or os.path.basename(input_file)
+        return os.path.join(self.output_dir, os.path.splitext(output_file)[0] + self.name_append + ".cnv")
+
+    def header_lines(self, input_file):
+        """The binavg_* processing history lines added to the output header."""
+        return [
+            f"# binavg_date = {cnv_file.processing_date()}, bin_average.py",
+            f"# binavg_in = {input_file}",
+            f"# binavg_bintype = {self.bin_type}",
+            f"# binavg_binsize = {self.bin_size:g}",
+            f"# binavg_excl_bad_scans = {'yes' if self.exclude_marked_bad else 'no'}",
+            f"# binavg_skipover = {self.scans_to_skip}",
+            f"# binavg_omit = {self.scans_to_omit}",
+            f"# binavg_min_scans_bin = {self.min_scans_per_bin}",
+            f"# binavg_max_scans_bin = {self.max_scans_per_bin}",
+            f"# binavg_surface_bin = {'yes' if self.include_surface_bin else 'no'}, min = {self.surface_bin_min:.3f}, "
+            f"max = {self.surface_bin_max:.3f}, value = {self.surface_bin_value:.3f}",
+        ]
+
+
+def bin_column(header, bin_type):
+    """
+    Index of the column binned on (e.g. depSM for meters). Like SBE Bin Average this is the
+    last matching column, e.g. the depth Derive added with the cast's latitude rather than
+    the one DatCnv wrote.
+    """
+    prefix, suffix = BIN_COLUMNS[bin_type]
+    for index in reversed(range(len(header.short_names))):
+        name = header.short_names[index]
+        if name.startswith(prefix) and name.endswith(suffix):
+            return index
+    raise ValueError(f"no column to bin in {bin_type}")
+
+
+def limit_scans_per_bin(bins, omit, maximum):
+    """Keep-mask dropping the first omit scans and everything after maximum scans of each bin."""
+    order = np.argsort(bins, kind="stable")
+    sorted_bins = bins[order]
+    starts = np.searchsorted(sorted_bins, sorted_bins, side="left")
+    rank = np.empty(len(bins), dtype=np.int64)
+    rank[order] = np.arange(len(bins)) - starts
+    return (rank >= omit) & (rank < omit + maximum)
+
+
+def average_bins(values, bins):
+    """
+    Average the scans of each bin, ignoring NaN (bad) values.
+    Returns (bin numbers in the order first reached, means, scans per bin).
+    """
+    numbers, first, inverse, counts = np.unique(bins, return_index=True, return_inverse=True, return_counts=True)
+    valid = ~np.isnan(values)
+    sums = np.zeros((len(numbers), values.shape[1]))
+    valid_counts = np.zeros((len(numbers), values.shape[1]))
+    np.add.at(sums, inverse, np.where(valid, values, 0.0))
+    np.add.at(valid_counts, inverse, valid)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / valid_counts
+
+    order = np.argsort(first)
+    return numbers[order], means[order], counts[order]
+
+
+def interpolate_to_centers(means, centers, column):
+    """
+    Interpolate each bin's averages to the bin center along the bin column, from the
+    averages of the bin before it (the first bin is extrapolated from the second),
+    as SBE Bin Average does for pressure and depth bins.
+    """
+    if len(means) < 2:
+        return means
+    previous = np.r_[1, np.arange(len(means) - 1)]
+    x = means[:, column]
+    x0 = means[previous, column]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        weight = (centers - x0) / (x - x0)
+    weight = np.where(np.isfinite(weight), weight, 1.0)
+    return means[previous] + (means - means[previous]) * weight[:, None]
+
+
+def bin_cast(values, x, settings, column, direction):
+    """Bin one cast direction (1 = down, -1 = up). Returns (rows, scans per bin)."""
+    size = settings.bin_size
+    rows, counts = [], []
+
+    if settings.include_surface_bin:
+        surface = (x >= settings.surface_bin_min) & (x <= settings.surface_bin_max)
+        if surface.sum() >= max(settings.min_scans_per_bin, 1):
+            row = np.nanmean(values[surface][:settings.max_scans_per_bin], axis=0)
+            row[column] = settings.surface_bin_value
+            rows.append(row)
+            counts.append(min(surface.sum(), settings.max_scans_per_bin))
+        values, x = values[~surface], x[~surface]
+
+    # Bin n holds (n - size/2, n + size/2]. A scan going back into a bin that has
+    # already been left (the package heaving on the wire) is not used.
+    bins = np.ceil(x / size - 0.5).astype(np.int64)
+    reached = np.maximum.accumulate(bins) if direction > 0 else np.minimum.accumulate(bins)
+    keep = bins == reached
+    keep[keep] = limit_scans_per_bin(bins[keep], settings.scans_to_omit, settings.max_scans_per_bin)
+    numbers, means, bin_counts = average_bins(values[keep], bins[keep])
+
+    enough = bin_counts >= settings.min_scans_per_bin
+    numbers, means, bin_counts = numbers[enough], means[enough], bin_counts[enough]
+    if settings.interpolate:
+        means = interpolate_to_centers(means, numbers * size, column)
+
+    rows.extend(means)
+    counts.extend(bin_counts)
+    return rows, counts
+
+
+def bin_average(header, values, settings):
+    """
+    Bin-average a (scans, columns) array read from a .cnv file.
+    Returns (output values, output short names, output long names, output formats),
+    with a "nbin" column before "flag" when settings.include_number_scans is set.
+    """
+    values = np.array(values[settings.scans_to_skip:], dtype=np.float64)
+    if header.bad_flag is not None:
+        values[np.isclose(values, header.bad_flag, rtol=1e-6, atol=0)] = np.nan
+
+    if settings.exclude_marked_bad and "flag" in header.short_names:
+        flag = values[:, header.short_names.index("flag")]
+        values = values[np.nan_to_num(flag) == 0]
+
+    column = bin_column(header, settings.bin_type)
+    x = values[:, column]
+
+    if settings.bin_type in ("scans", "seconds"):
+        bins = np.floor((x - x[0]) / settings.bin_size).astype(np.int64) if len(x) else np.zeros(0, np.int64)
+        keep = limit_scans_per_bin(bins, settings.scans_to_omit, settings.max_scans_per_bin)
+        _, rows, counts = average_bins(values[keep], bins[keep])
+        enough = counts >= settings.min_scans_per_bin
+        rows, counts = list(rows[enough]), list(counts[enough])
+    else:
+        # The downcast runs to the scan after the deepest one, like SBE Bin Average
+        deepest = int(np.nanargmax(x)) + 2 if len(x) else 0
+        rows, counts = [], []
+        if settings.cast in ("down", "both"):
+            down_rows, down_counts = bin_cast(values[:deepest], x[:deepest], settings, column, 1)
+            rows += down_rows
+            counts += down_counts
+        if settings.cast in ("up", "both"):
+            up_rows, up_counts = bin_cast(values[deepest:], x[deepest:], settings, column, -1)
+            rows += up_rows
+            counts += up_counts
+    return output_columns(header, rows, counts, settings)
+
+
+def output_columns(header, rows, counts, settings):
+    """The (output values, short names, long names, formats) of the bin rows and their scan counts."""
+    output = np.array(rows).reshape(len(rows), len(header.short_names))
+    short_names = list(header.short_names)
+    long_names = list(header.long_names)
+    formats = list(header.formats)
+
+    if settings.include_number_scans:
+        index = short_names.index("flag") if "flag" in short_names else len(short_names)
+        output = np.insert(output, index, counts, axis=1)
+        short_names.insert(index, "nbin")
+        long_names.insert(index, "number of scans per bin")
+        formats.insert(index, ".0f")
+
+    return output, short_names, long_names, formats
+
+
+def output_header(header, settings, input_file):
+    """Turn the header of a time series into that of its bin averages: the bin interval and the binavg_* lines."""
+    interval = f"# interval = {settings.bin_type}: {settings.bin_size:g}".ljust(cnv_file.PADDED_LINE_WIDTH)
+    header.lines = [interval if line.startswith("# interval") else line for line in header.lines]
+    file_type = next((i for i, line in enumerate(header.lines) if line.startswith("# file_type")), len(header.lines))
+    header.lines[file_type:file_type] = settings.header_lines(input_file)
+
+
+class BinStream:
+    """
+    bin_average() for a cast that is still being recorded. add() bins the next scans (NaN for
+    bad values) into running sums per bin, so each call costs only the scans given, and
+    profile() returns the bins so far, as bin_average() returns them.
+
+    For pressure and depth bins the scans up to the one after the deepest so far are binned as
+    the downcast; the later scans are kept and binned when a deeper scan comes in. Until
+    profile(final=True) at the end of the cast, the profile is the downcast whatever the PSA's
+    CastToProcess; the final one has the casts it asks for, the same as bin_average().
+    """
+
+    def __init__(self, header, settings):
+        self.header = header
+        self.settings = settings
+        self.column = bin_column(header, settings.bin_type)
+        self.flag = header.short_names.index("flag") if settings.exclude_marked_bad and "flag" in header.short_names else None
+        self.by_scan = settings.bin_type in ("scans", "seconds")
+        self.to_skip = settings.scans_to_skip
+        width = len(header.short_names)
+
+        # Running sums, one row per bin in the order the bins were reached
+        self.slots = {}
+        self.numbers = []
+        self.sums = np.zeros((0, width))
+        self.valid = np.zeros((0, width))
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.seen = np.zeros(0, dtype=np.int64)  # scans of the bin before ScansToOmit and MaxScansPerBin
+
+        self.origin = None  # bin column of the first scan, for scan and time bins
+        self.reached = None
+        self.deepest = None  # (bin column value, scan index) of the deepest scan so far
+        self.scans = 0
+        self.binned = 0
+        self.after_deepest = np.zeros((0, width))
+        self.surface_sums = np.zeros(width)
+        self.surface_valid = np.zeros(width)
+        self.surface_seen = 0
+
+    def add(self, values):
+        values = np.asarray(values, dtype=np.float64)
+        skip = min(self.to_skip, len(values))
+        values = values[skip:]
+        self.to_skip -= skip
+        if self.flag is not None:
+            values = values[np.nan_to_num(values[:, self.flag]) == 0]
+        if not len(values):
+            return
+
+        x = values[:, self.column]
+        if self.by_scan:
+            if self.origin is None:
+                self.origin = x[0]
+            self.add_to_bins(values, np.floor((x - self.origin) / self.settings.bin_size).astype(np.int64))
+            return
+
+        if not np.isnan(x).all():
+            deepest = int(np.nanargmax(x))
+            if self.deepest is None or x[deepest] > self.deepest[0]:
+                self.deepest = (x[deepest], self.scans + deepest)
+        self.scans += len(values)
+        pending = np.concatenate([self.after_deepest, values])
+        # The downcast runs to the scan after the deepest one, like bin_average()
+        end = min(self.deepest[1] + 2, self.scans) if self.deepest else self.binned
+        self.bin_down(pending[:end - self.binned])
+        self.after_deepest = pending[end - self.binned:]
+        self.binned = end
+
+    def bin_down(self, rows):
+        """bin_cast() of the next downcast scans."""
+        settings = self.settings
+        x = rows[:, self.column]
+        if settings.include_surface_bin:
+            surface = (x >= settings.surface_bin_min) & (x <= settings.surface_bin_max)
+            used = rows[surface][:max(0, settings.max_scans_per_bin - self.surface_seen)]
+            self.surface_sums += np.nansum(used, axis=0)
+            self.surface_valid += (~np.isnan(used)).sum(axis=0)
+            self.surface_seen += int(surface.sum())
+            rows, x = rows[~surface], x[~surface]
+        if not len(rows):
+            return
+
+        bins = np.ceil(x / settings.bin_size - 0.5).astype(np.int64)
+        reached = np.maximum.accumulate(bins if self.reached is None else np.r_[self.reached, bins])[-len(bins):]
+        self.reached = reached[-1]
+        keep = bins == reached
+        self.add_to_bins(rows[keep], bins[keep])
+
+    def add_to_bins(self, rows, bins):
+        if not len(bins):
+            return
+        numbers, first, inverse, counts = np.unique(bins, return_index=True, return_inverse=True, return_counts=True)
+        for number in numbers[np.argsort(first)]:
+            if number not in self.slots:
+                self.slots[number] = len(self.numbers)
+                self.numbers.append(number)
+        grow = len(self.numbers) - len(self.counts)
+        if grow:
+            self.sums = np.concatenate([self.sums, np.zeros((grow, self.sums.shape[1]))])
+            self.valid = np.concatenate([self.valid, np.zeros((grow, self.valid.shape[1]))])
+            self.counts = np.r_[self.counts, np.zeros(grow, dtype=np.int64)]
+            self.seen = np.r_[self.seen, np.zeros(grow, dtype=np.int64)]
+        slots = np.array([self.slots[number] for number in numbers])
+
+        # Rank of each scan in its bin, counting the scans the bin already had
+        order = np.argsort(inverse, kind="stable")
+        sorted_inverse = inverse[order]
+        rank = np.empty(len(bins), dtype=np.int64)
+        rank[order] = np.arange(len(bins)) - np.searchsorted(sorted_inverse, sorted_inverse, side="left")
+        rank += self.seen[slots][inverse]
+        self.seen[slots] += counts
+
+        settings = self.settings
+        used = (rank >= settings.scans_to_omit) & (rank < settings.scans_to_omit + settings.max_scans_per_bin)
+        targets, rows = slots[inverse][used], rows[used]
+        valid = ~np.isnan(rows)
+        np.add.at(self.sums, targets, np.where(valid, rows, 0.0))
+        np.add.at(self.valid, targets, valid)
+        np.add.at(self.counts, targets, 1)
+
+    def profile(self, final=False):
+        """The (output values, short names, long names, formats) of the bins so far."""
+        settings = self.settings
+        with np.errstate(invalid="ignore", divide="ignore"):
+            means = self.sums / self.valid
+        enough = self.counts >= settings.min_scans_per_bin
+        if self.by_scan:
+            return output_columns(self.header, list(means[enough]), list(self.counts[enough]), settings)
+
+        rows, counts = [], []
+        if settings.cast in ("down", "both") or not final:
+            if settings.include_surface_bin and self.surface_seen >= max(settings.min_scans_per_bin, 1):
+                with np.errstate(invalid="ignore", divide="ignore"):
+                    row = self.surface_sums / self.surface_valid
+                row[self.column] = settings.surface_bin_value
+                rows.append(row)
+                counts.append(min(self.surface_seen, settings.max_scans_per_bin))
+            numbers, means = np.array(self.numbers)[enough], means[enough]
+            if settings.interpolate:
+                means = interpolate_to_centers(means, numbers * settings.bin_size, self.column)
+            rows.extend(means)
+            counts.extend(self.counts[enough])
+        if final and settings.cast in ("up", "both"):
+            up_rows, up_counts = bin_cast(self.after_deepest, self.after_deepest[:, self.column], settings, self.column, -1)
+            rows += up_rows
+            counts += up_counts
+        return output_columns(self.header, rows, counts, settings)
+
+
+def run_psa(psa_path):
+    """
+    Bin-average the input file of a rendered Bin Average PSA and write <cast><NameAppend>.cnv
+    to its output directory. Returns a one-line summary.
+    """
+    settings = BinAvgSettings(psa_path)
+    if not settings.input_files:
+        raise ValueError(f"{psa_path}: no input file")
+    input_file = os.path.join(settings.input_dir, settings.input_files[0])
+
+    header, data = cnv_file.read_cnv(input_file)
+    values = recfunctions.structured_to_unstructured(data, dtype=np.float64)
+    output, header.short_names, header.long_names, header.formats = bin_average(header, values, settings)
+    output_header(header, settings, input_file)
+
+    output_path = settings.output_path(input_file)
+    cnv_file.write_cnv(output_path, header, output)
+    return f"{os.path.basename(input_file)}: {len(values)} scans -> {len(output)} bins in {os.path.basename(output_path)}"
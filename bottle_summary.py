@@ -0,0 +1,229 @@
+import math
+import os
+import xml.etree.ElementTree as ET
+from datetime import datetime, timedelta
+
+import numpy as np
+from numpy.lib import recfunctions
+
+import cnv_file
+import seawater
+
+# The Bottle Summary module this stage replaces, used to open its PSA files with "Edit PSA"
+SBE_MODULE = "BottleSumW.exe"
+
+# Width of the Bottle Position and Date/Time columns at the start of each .btl line
+LABEL_WIDTH = 22
+
+# Standard deviations printed with another format than the column (a fraction of a second in days)
+SDEV_FORMATS = {"timeJ": ".4e"}
+
+# Header lines of the .ros file that describe its data block and are not copied to the .btl file
+DATA_BLOCK_KEYS = ("# nquan", "# nvalues", "# units", "# name ", "# span ", "# bad_flag", "# file_type")
+
+
+class BottleSumSettings:
+    """The parameters of a Bottle Summary PSA file (EN_BottleSum.psa)."""
+
+    def __init__(self, psa_path):
+        root = ET.parse(psa_path).getroot()
+
+        def value(tag, default=""):
+            element = root.find(tag)
+            return element.get("value", default) if element is not None else default
+
+        def full_names(tag):
+            array = root.find(tag)
+            return [item.find("Calc/FullName").get("value") for item in array.iter("CalcArrayItem")] if array is not None else []
+
+        self.instrument_path = value("InstrumentPath")
+        self.input_dir = value("InputDir")
+        input_files = root.find("InputFileArray")
+        self.input_files = [item.get("value") for item in input_files.iter("ArrayItem")] if input_files is not None else []
+        self.output_dir = value("OutputDir")
+        self.output_file = value("OutputFile")
+        self.name_append = value("NameAppend")
+        self.output_min_max = value("OutputMinMaxValues", "1") == "1"
+
+        select = root.find("SelectArray")
+        selected = [item.get("value") == "1" for item in select.iter("ArrayItem")] if select is not None else []
+        averaged = full_names("AverageCalcArray")
+        selected += [True] * (len(averaged) - len(selected))
+        self.averaged = [name for name, keep in zip(averaged, selected) if keep]
+
+        self.derived = full_names("DeriveCalcArray")
+        for full_name in self.derived:
+            if full_name not in seawater.DERIVED_VARIABLES:
+                raise ValueError(f"'{full_name}' is not supported by the built-in BottleSum, use BottleSumW.exe")
+
+    def input_path(self):
+        # The pipeline passes the full .ros path as InputDir for Bottle Summary
+        if os.path.isfile(self.input_dir):
+            return self.input_dir
+        if not self.input_files:
+            raise ValueError("no input file")
+        return os.path.join(self.input_dir, self.input_files[0])
+
+    def output_path(self, input_file):
+        """<OutputDir>/<OutputFile><NameAppend>.btl, e.g. CTD02.cnv.btl."""
+        output_file = self.output_file or os.path.basename(input_file)
+        root, extension = os.path.splitext(output_file)
+        if extension.lower() == ".btl":
+            output_file = root
+        return os.path.join(self.output_dir, output_file + self.name_append + ".btl")
+
+
+def bottle_positions(bl_path):
+    """Bottle position of each firing sequence number in a .bl file, or {} when there is none."""
+    positions = {}
+    if not os.path.isfile(bl_path):
+        return positions
+    with open(bl_path, "r", encoding="latin-1") as f:
+        for line in f:
+            parts = [part.strip() for part in line.split(",")]
+            if len(parts) == 5 and parts[0].isdigit() and parts[1].isdigit():
+                positions[int(parts[0])] = int(parts[1])
+    return positions
+
+
+def bottle_statistics(values, bottles):
+    """
+    Mean, standard deviation, minimum and maximum of each column per bottle, ignoring NaN
+    (bad) values. Returns (bottle numbers, means, sdevs, minimums, maximums).
+
+    The standard deviation is sqrt((sum(x^2) - sum(x)^2 / n) / (n - 1)) with the sums taken
+    scan by scan, as BottleSumW computes it: the scans of every bottle are laid out in a
+    (bottles, scans, columns) block and added one scan position at a time.
+    """
+    order = np.argsort(bottles, kind="stable")
+    values, bottles = values[order], bottles[order]
+    numbers, starts, lengths = np.unique(bottles, return_index=True, return_counts=True)
+
+    block = np.full((len(numbers), lengths.max(initial=0), values.shape[1]), np.nan)
+    block[np.repeat(np.arange(len(numbers)), lengths), np.arange(len(values)) - np.repeat(starts, lengths)] = values
+    valid = ~np.isnan(block)
+    x = np.where(valid, block, 0.0)
+
+    sums = np.zeros((len(numbers), values.shape[1]))
+    squares = np.zeros_like(sums)
+    minimums = np.full_like(sums, np.nan)
+    maximums = np.full_like(sums, np.nan)
+    for scan in range(block.shape[1]):
+        sums += x[:, scan]
+        squares += x[:, scan] * x[:, scan]
+        # Replaced only by a smaller/larger value, so -0 and 0 keep the first one seen
+        minimums = np.where((block[:, scan] < minimums) | np.isnan(minimums), block[:, scan], minimums)
+        maximums = np.where((block[:, scan] > maximums) | np.isnan(maximums), block[:, scan], maximums)
+    counts = valid.sum(axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = sums / counts
+        sdevs = np.sqrt(np.maximum((squares - sums * sums / counts) / (counts - 1), 0.0))
+    return numbers, means, sdevs, minimums, maximums
+
+
+def derive(settings, header, means):
+    """The derived variables of the PSA computed from the bottle means. Returns (short names, formats, columns)."""
+    short_names, formats, columns = [], [], []
+    for full_name in settings.derived:
+        short_name, fmt, column = seawater.derive(full_name, header.long_names, means)
+        short_names.append(short_name)
+        formats.append(fmt)
+        columns.append(column)
+    return short_names, formats, columns
+
+
+def bottle_times(header, means):
+    """Date and time of each bottle from its mean elapsed time (or Julian days), or None when unknown."""
+    start = header.values.get("start_time", "")
+    try:
+        start = datetime.strptime(" ".join(start.split()[:4]), "%b %d %Y %H:%M:%S")
+    except ValueError:
+        return [None] * len(means)
+
+    if "Time, Elapsed [seconds]" in header.long_names:
+        base = start
+        seconds = means[:, header.long_names.index("Time, Elapsed [seconds]")]
+    elif "Julian Days" in header.long_names:
+        base = datetime(start.year, 1, 1) - timedelta(days=1)
+        seconds = means[:, header.long_names.index("Julian Days")] * 86400
+    else:
+        return [None] * len(means)
+    # BottleSumW truncates the bottle time to the second and adds one
+    return [base + timedelta(seconds=math.floor(s) + 1) if np.isfinite(s) else None for s in seconds]
+
+
+def format_row(label, blank_columns, values, formats, bad_flag, suffix):
+    fields = [" " * cnv_file.ASCII_FIELD_WIDTH] * blank_columns
+    for value, fmt in zip(values, formats):
+        value = value if np.isfinite(value) else bad_flag
+        fields.append(f"{value:{cnv_file.ASCII_FIELD_WIDTH}{fmt}}")
+    return label.rjust(LABEL_WIDTH) + "".join(fields) + suffix
+
+
+def bottle_summary(header, values, settings, positions):
+    """
+    Summarize the bottles of a .ros file read as a (scans, columns) array. Returns (lines of the
+    .btl table: column names, then avg and sdev (and min and max) rows per bottle, bottle count).
+    """
+    indexes = []
+    for full_name in settings.averaged:
+        if full_name not in header.long_names:
+            raise ValueError(f"no '{full_name}' column in the .ros file")
+        indexes.append(header.long_names.index(full_name))
+    if "nbf" not in header.short_names:
+        raise ValueError("no 'nbf' (bottles fired) column in the .ros file")
+
+    bad_flag = header.bad_flag if header.bad_flag is not None else -9.990e-29
+    bottles = values[:, header.short_names.index("nbf")]
+    numbers, means, sdevs, minimums, maximums = bottle_statistics(values, bottles)
+    derived_names, derived_formats, derived_columns = derive(settings, header, means)
+    times = bottle_times(header, means)
+
+    short_names = [header.short_names[i] for i in indexes]
+    formats = [header.formats[i] for i in indexes]
+    sdev_formats = [SDEV_FORMATS.get(name, fmt) for name, fmt in zip(short_names, formats)]
+    blank = len(derived_names)
+    width = LABEL_WIDTH + cnv_file.ASCII_FIELD_WIDTH * (blank + len(short_names))
+
+    names = "".join(f"{name[0].upper() + name[1:]:>{cnv_file.ASCII_FIELD_WIDTH}}" for name in derived_names + short_names)
+    lines = ["    Bottle        Date" + names, "  Position        Time".ljust(width)]
+    for row, number in enumerate(numbers):
+        position = str(positions.get(int(number), int(number)))
+        date = f"{times[row]:%b %d %Y}" if times[row] else ""
+        time_of_day = f"{times[row]:%H:%M:%S}" if times[row] else ""
+        averages = [column[row] for column in derived_columns] + list(means[row, indexes])
+
+        lines.append(format_row(f"{position:>7}    {date:>11}", 0, averages, derived_formats + formats, bad_flag, " (avg)"))
+        lines.append(format_row(time_of_day, blank, sdevs[row, indexes], sdev_formats, bad_flag, " (sdev)"))
+        if settings.output_min_max:
+            lines.append(format_row("", blank, minimums[row, indexes], formats, bad_flag, " (min)"))
+            lines.append(format_row("", blank, maximums[row, indexes], formats, bad_flag, " (max)"))
+    return lines, len(numbers)
+
+
+def run_psa(psa_path):
+    """
+    Summarize the bottles of the .ros file of a rendered Bottle Summary PSA and write
+    <OutputFile>.btl to its output directory. Returns a one-line summary.
+    """
+    settings = BottleSumSettings(psa_path)
+    input_file = settings.input_path()
+
+    header, data = cnv_file.read_cnv(input_file, bad_to_nan=True)
+    values = recfunctions.structured_to_unstructured(data, dtype=np.float64)
+    # Bottle positions come from the .bl file next to the .ros file; without it the
+    # bottles are numbered by firing sequence, as BottleSumW does
+    positions = bottle_positions(os.path.splitext(input_file)[0] + ".bl")
+    table, count = bottle_summary(header, values, settings, positions)
+
+    lines = [line for line in header.lines if not line.startswith(DATA_BLOCK_KEYS)]
+    lines += [
+        f"# bottlesum_date = {cnv_file.processing_date()}, bottle_summary.py",
+        f"# bottlesum_in = {input_file} {settings.instrument_path}",
+    ]
+
+    output_path = settings.output_path(input_file)
+    newline = header.newline.decode("latin-1")
+    with open(output_path, "w", encoding="latin-1", newline="") as f:
+        f.write(newline.join(lines + table) + newline)
+    return f"{os.path.basename(input_file)}: {count} bottles in {os.path.basename(output_path)}"
@@ -0,0 +1,190 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+# Manifest and snapshot folder written to the output directory
+CACHE_FILE_NAME = ".ctd_build_cache.json"
+SNAPSHOT_DIR_NAME = ".ctd_build_cache"
+
+_manifest_lock = threading.Lock()
+_hash_lock = threading.Lock()
+_file_hashes = {}
+
+
+def file_hash(path):
+    """
+    Return the SHA-256 of a file, or "missing" if it does not exist.
+    Hashes are remembered by (path, size, mtime) so unchanged files are only read once.
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return "missing"
+
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _hash_lock:
+        if key in _file_hashes:
+            return _file_hashes[key]
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+
+    with _hash_lock:
+        _file_hashes[key] = digest.hexdigest()
+    return _file_hashes[key]
+
+
+def load_manifest(output_file_dir):
+    """Load the build-cache manifest of an output directory (empty if there is none)."""
+    path = os.path.join(output_file_dir, CACHE_FILE_NAME)
+    try:
+        with open(path, "r") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return {"casts": {}}
+    manifest.setdefault("casts", {})
+    return manifest
+
+
+def save_cast_entries(output_file_dir, base_name, entries):
+    """Store the cache entries of one cast, keeping the other casts' entries written by other workers."""
+    path = os.path.join(output_file_dir, CACHE_FILE_NAME)
+    with _manifest_lock:
+        manifest = load_manifest(output_file_dir)
+        manifest["casts"][base_name] = entries
+
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=4)
+        os.replace(tmp_path, path)
+
+
+def list_output_files(output_file_dir):
+    """Return {file name: (size, mtime)} for every file in the output directory."""
+    files = {}
+    for entry in os.scandir(output_file_dir):
+        if entry.is_file():
+            stat = entry.stat()
+            files[entry.name] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+
+def list_cast_files(output_file_dir, base_name):
+    """Return {file name: (size, mtime)} for the files of one cast in the output directory."""
+    prefix = base_name.lower()
+    files = {}
+    for entry in os.scandir(output_file_dir):
+        name = entry.name.lower()
+        if entry.is_file() and name.startswith(prefix) and name[len(prefix):len(prefix) + 1] in (".", "_"):
+            stat = entry.stat()
+            files[entry.name] = (stat.st_size, stat.st_mtime_ns)
+    return files
+
+
+class CastCache:
+    """
+    Build cache for the stages of one cast.
+
+    Each (cast, stage) entry records a signature made from the hashes of the stage's input
+    file, rendered PSA, XMLCON and executable, plus the hashes of the files the stage wrote.
+    A copy of those files is kept in the snapshot folder, because later stages rewrite
+    <cast>.cnv in place: when a stage in the middle of the pipeline has to run again, its
+    input is restored from the snapshot of the stage before it.
+    """
+
+    def __init__(self, output_file_dir, base_name):
+        self.output_file_dir = os.path.abspath(output_file_dir)
+        self.base_name = base_name
+        self.snapshot_dir = os.path.join(self.output_file_dir, SNAPSHOT_DIR_NAME, base_name)
+        self.entries = load_manifest(self.output_file_dir)["casts"].get(base_name, {})
+
+        # What each cast file should contain at the current point of the pipeline
+        self.state = {}
+        self.sources = {}
+        # Stages of the same cast can run at the same time
+        self.lock = threading.RLock()
+
+    def input_hash(self, input_file):
+        """Hash of a stage's input: the expected content if an earlier stage wrote it, otherwise the file on disk."""
+        name = os.path.basename(input_file)
+        with self.lock:
+            if os.path.dirname(os.path.abspath(input_file)) == self.output_file_dir and name in self.state:
+                return self.state[name]
+        return file_hash(input_file)
+
+    def signature(self, psa_file, rendered_psa_path, input_file, xmlcon_file, executable):
+        digest = hashlib.sha256()
+        for part in (psa_file, file_hash(rendered_psa_path), self.input_hash(input_file),
+                     file_hash(xmlcon_file), file_hash(executable)):
+            digest.update(part.encode("utf-8"))
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def is_up_to_date(self, key, signature):
+        with self.lock:
+            entry = self.entries.get(key)
+        if not entry or entry["signature"] != signature:
+            return False
+        return all(os.path.isfile(os.path.join(self.snapshot_dir, entry["snapshot"], name)) for name in entry["outputs"])
+
+    def skip(self, key):
+        """Account for a stage that is up to date without touching any file."""
+        with self.lock:
+            entry = self.entries[key]
+            for name, sha in entry["outputs"].items():
+                self.state[name] = sha
+                self.sources[name] = os.path.join(self.snapshot_dir, entry["snapshot"], name)
+
+    def materialize(self, names=None):
+        """Make the cast files in the output directory (or only those in names) match the current pipeline state."""
+        with self.lock:
+            for name, sha in self.state.items():
+                if names is not None and name not in names:
+                    continue
+                path = os.path.join(self.output_file_dir, name)
+                if file_hash(path) != sha:
+                    print(f"[{self.base_name}] Restoring {name} from the build cache")
+                    shutil.copy2(self.sources[name], path)
+
+    def before_run(self, input_file):
+        """Restore the input of a stage about to run; returns the cast files before it runs, for after_run()."""
+        self.materialize({os.path.basename(input_file)})
+        return list_cast_files(self.output_file_dir, self.base_name)
+
+    def after_run(self, key, signature, before, outputs=None):
+        """
+        Record the files a stage wrote (those changed since before_run(), limited by outputs,
+        a function filtering file names, when other stages of the cast ran at the same time),
+        snapshot them and save the entry.
+        """
+        after = list_cast_files(self.output_file_dir, self.base_name)
+        written = [name for name, stat in after.items() if before.get(name) != stat]
+        if outputs is not None:
+            written = outputs(written)
+
+        snapshot = key.replace(":", "_")
+        stage_dir = os.path.join(self.snapshot_dir, snapshot)
+        shutil.rmtree(stage_dir, ignore_errors=True)
+        os.makedirs(stage_dir, exist_ok=True)
+
+        with self.lock:
+            entry_outputs = {}
+            for name in written:
+                path = os.path.join(self.output_file_dir, name)
+                shutil.copy2(path, os.path.join(stage_dir, name))
+                entry_outputs[name] = file_hash(path)
+                self.state[name] = entry_outputs[name]
+                self.sources[name] = os.path.join(stage_dir, name)
+
+            self.entries[key] = {"signature": signature, "snapshot": snapshot, "outputs": entry_outputs}
+            save_cast_entries(self.output_file_dir, self.base_name, self.entries)
+
+    def discard(self, key):
+        """Forget a stage whose run failed."""
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                save_cast_entries(self.output_file_dir, self.base_name, self.entries)
@@ -0,0 +1,394 @@
+import json
+import math
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+import build_cache
+import cnv_file
+import ctd_pipeline
+import hex_file
+import sbe_files
+
+# Default catalog file, in the output directory, when the configuration names none
+CATALOG_FILE_NAME = "ctd_catalog.sqlite"
+
+# Mean Earth radius, and the length of a degree of latitude, for the distance queries
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = math.pi * EARTH_RADIUS_KM / 180
+
+# "** Cruise: EN734" lines typed into Seasave's header form
+USER_HEADER_PATTERN = re.compile(r"^\*\*\s*([^:]+):\s*(.*?)\s*$")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS casts (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL COLLATE NOCASE,
+    output_dir TEXT NOT NULL,
+    raw_file TEXT,
+    cruise TEXT COLLATE NOCASE,
+    ship TEXT,
+    latitude REAL,
+    longitude REAL,
+    nmea_utc TEXT,
+    upload_time TEXT,
+    scans INTEGER,
+    pressure_min REAL,
+    pressure_max REAL,
+    config TEXT,
+    psa_dir TEXT,
+    psa_files TEXT,
+    sensors TEXT,
+    outputs TEXT,
+    indexed_at REAL NOT NULL,
+    UNIQUE (output_dir, name)
+);
+-- The serial numbers of casts.sensors again, one row each, for the serial number index
+CREATE TABLE IF NOT EXISTS sensors (
+    cast_id INTEGER NOT NULL REFERENCES casts (id) ON DELETE CASCADE,
+    sensor TEXT NOT NULL,
+    serial_number TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS casts_name ON casts (name);
+CREATE INDEX IF NOT EXISTS casts_cruise ON casts (cruise);
+CREATE INDEX IF NOT EXISTS casts_position ON casts (latitude, longitude);
+CREATE INDEX IF NOT EXISTS casts_nmea_utc ON casts (nmea_utc);
+CREATE INDEX IF NOT EXISTS sensors_serial_number ON sensors (serial_number);
+CREATE INDEX IF NOT EXISTS sensors_cast_id ON sensors (cast_id);
+"""
+
+# Columns of a casts row, in the order of the INSERT below
+CAST_COLUMNS = ("name", "output_dir", "raw_file", "cruise", "ship", "latitude", "longitude", "nmea_utc", "upload_time",
+                "scans", "pressure_min", "pressure_max", "config", "psa_dir", "psa_files", "sensors", "outputs", "indexed_at")
+
+# Registering a cast again replaces its entry, except that an entry without the run's
+# configuration (from index_folder()) keeps the one recorded by the pipeline
+KEPT_COLUMNS = ("raw_file", "config", "psa_dir", "psa_files")
+UPSERT_CAST = (
+    f"INSERT INTO casts ({', '.join(CAST_COLUMNS)}) VALUES ({', '.join('?' * len(CAST_COLUMNS))}) "
+    "ON CONFLICT (output_dir, name) DO UPDATE SET "
+    + ", ".join(f"{column} = COALESCE(excluded.{column}, casts.{column})" if column in KEPT_COLUMNS
+                else f"{column} = excluded.{column}"
+                for column in CAST_COLUMNS if column not in ("name", "output_dir"))
+)
+
+
+def distance_km(latitude1, longitude1, latitude2, longitude2):
+    """Great-circle distance between two positions in decimal degrees (haversine)."""
+    phi1, phi2 = math.radians(latitude1), math.radians(latitude2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(longitude2 - longitude1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_KM * math.asin(min(1.0, math.sqrt(a)))
+
+
+def instrument_header(base_name, output_dir, raw_file=None):
+    """
+    The Seasave header of a cast as a hex_file.HexHeader: from the raw .hdr (or .hex) file
+    when there is one, else from the header lines SBE Data Processing copies into the .cnv
+    and .ros files. None if no file of the cast has a header.
+    """
+    if raw_file:
+        for path in (os.path.splitext(raw_file)[0] + ".hdr", raw_file):
+            if os.path.isfile(path):
+                return hex_file.read_header(path)
+    for extension in (".cnv", ".ros"):
+        path = os.path.join(output_dir, base_name + extension)
+        if os.path.isfile(path) and os.path.getsize(path) > 0:
+            return hex_file.parse_header(cnv_file.read_header(path).lines)
+    return None
+
+
+def scan_summary(base_name, output_dir, raw_file=None):
+    """
+    (scans, lowest pressure, highest pressure) of a cast. The scans are counted by the header
+    of the full-resolution <cast>.cnv, else in the raw .hex file. The pressure range is the
+    span of the pressure column of <cast>.cnv, else of another .cnv file of the cast (e.g.
+    <cast>_avg.cnv) or of the .ros file; the column is only read when there is no span line.
+    """
+    scans = pressure_min = pressure_max = None
+    candidates = [os.path.join(output_dir, base_name + ".cnv")]
+    candidates += sorted(os.path.join(output_dir, name) for name in build_cache.list_cast_files(output_dir, base_name)
+                         if name.lower().endswith(".cnv") and name.lower() != base_name.lower() + ".cnv")
+    candidates.append(os.path.join(output_dir, base_name + ".ros"))
+    for n, path in enumerate(candidates):
+        if not os.path.isfile(path) or os.path.getsize(path) == 0:
+            continue
+        header = cnv_file.read_header(path)
+        if n == 0:
+            scans = header.nvalues
+        pressure = [i for i, name in enumerate(header.short_names) if name.lower().startswith("pr")]
+        if not pressure:
+            continue
+        i = pressure[0]
+        if header.spans[i] is not None:
+            pressure_min, pressure_max = header.spans[i]
+        else:
+            _, data = cnv_file.read_cnv(path, [header.names[i]], bad_to_nan=True)
+            values = data[header.names[i]]
+            if not len(values):
+                continue
+            pressure_min, pressure_max = float(np.nanmin(values)), float(np.nanmax(values))
+        break
+
+    if scans is None and raw_file and os.path.isfile(raw_file):
+        try:
+            scans = hex_file.count_scans(raw_file)
+        except ValueError:
+            pass
+    return scans, pressure_min, pressure_max
+
+
+def sensor_serial_numbers(header, raw_file=None):
+    """
+    [(sensor, serial number)] of a cast: the channels in use in its .XMLCON file, then the
+    "* Temperature SN = 4695" header lines for serial numbers not already listed.
+    """
+    serials = []
+    if raw_file:
+        xmlcon = ctd_pipeline.xmlcon_path(raw_file)
+        if os.path.isfile(xmlcon):
+            serials = [(sensor, serial) for sensor, serial in sbe_files.load_xmlcon(xmlcon).serial_numbers if serial]
+    known = {serial for _, serial in serials}
+    for key, value in (header.values.items() if header else ()):
+        if key.endswith(" SN") and value.strip() and value.strip() not in known:
+            serials.append((key[:-3].strip(), value.strip()))
+            known.add(value.strip())
+    return serials
+
+
+def header_time(header, key):
+    try:
+        value = header.time(key)
+    except ValueError:
+        return None
+    return value.isoformat() if value else None
+
+
+def cast_metadata(base_name, output_dir, raw_file=None):
+    """A catalog entry for one cast: a dict of CAST_COLUMNS, without the run's configuration."""
+    header = instrument_header(base_name, output_dir, raw_file)
+    user_values = {}
+    for line in (header.lines if header else ()):
+        match = USER_HEADER_PATTERN.match(line)
+        if match:
+            user_values[match.group(1).strip().lower()] = match.group(2)
+    scans, pressure_min, pressure_max = scan_summary(base_name, output_dir, raw_file)
+    outputs = sorted(build_cache.list_cast_files(output_dir, base_name))
+
+    return {
+        "name": base_name,
+        "output_dir": output_dir,
+        "raw_file": os.path.abspath(raw_file) if raw_file else None,
+        "cruise": user_values.get("cruise") or None,
+        "ship": user_values.get("ship") or None,
+        "latitude": header.nmea_position("NMEA Latitude") if header else None,
+        "longitude": header.nmea_position("NMEA Longitude") if header else None,
+        "nmea_utc": header_time(header, "NMEA UTC (Time)") if header else None,
+        "upload_time": header_time(header, "System UpLoad Time") if header else None,
+        "scans": scans,
+        "pressure_min": pressure_min,
+        "pressure_max": pressure_max,
+        "outputs": json.dumps([os.path.join(output_dir, name) for name in outputs]),
+        "sensors": json.dumps(sensor_serial_numbers(header, raw_file)),
+    }
+
+
+def output_cast_names(output_dir):
+    """
+    The casts with products in an output directory: the names of its .cnv and .ros files,
+    without those that are another cast's name plus a suffix (CTD01_avg.cnv is CTD01's).
+    """
+    names = set()
+    for name in os.listdir(output_dir):
+        base_name, extension = os.path.splitext(name)
+        if extension.lower() in (".cnv", ".ros") and os.path.isfile(os.path.join(output_dir, name)):
+            names.add(base_name)
+    lower = {name.lower() for name in names}
+    return sorted(name for name in names
+                  if not any(name.lower().startswith(other + "_") for other in lower if other != name.lower()))
+
+
+class CastCatalog:
+    """
+    SQLite catalog of processed casts: position, NMEA time and upload time, cruise and ship,
+    sensor serial numbers, scan count, pressure range, the configuration and PSA files of
+    the run and the output files, indexed for queries across cruises:
+
+        catalog = CastCatalog("D:/ctd/catalog.sqlite")
+        catalog.find(near=(36.68, -66.93), radius_km=20, serial="4695")
+
+    The pipeline registers each cast when its last stage is done (register_cast());
+    index_folder() registers the casts of an output directory processed before. A cast is
+    one row per (output directory, cast name): registering it again replaces its entry.
+    Safe to share between the pipeline's worker threads.
+    """
+
+    def __init__(self, path, config=None):
+        self.path = path
+        self.config = os.path.abspath(config) if config else None
+        self.lock = threading.Lock()
+        if os.path.dirname(os.path.abspath(path)):
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+    def with_config(self, config):
+        """The catalog as seen by the runs of one configuration file (see batch_manifest.run_group())."""
+        return ConfigCatalog(self, config)
+
+    def store(self, entries):
+        """Insert or replace cast_metadata() entries in one transaction."""
+        now = time.time()
+        with self.lock, self.connection:
+            for entry in entries:
+                row = dict(entry, indexed_at=now)
+                values = [row.get(column) for column in CAST_COLUMNS]
+                self.connection.execute(UPSERT_CAST, values)
+                cast_id = self.connection.execute("SELECT id FROM casts WHERE output_dir = ? AND name = ?",
+                                                  (row["output_dir"], row["name"])).fetchone()[0]
+                self.connection.execute("DELETE FROM sensors WHERE cast_id = ?", (cast_id,))
+                self.connection.executemany("INSERT INTO sensors (cast_id, sensor, serial_number) VALUES (?, ?, ?)",
+                                            [(cast_id, sensor, serial) for sensor, serial in json.loads(entry["sensors"])])
+
+    def register_cast(self, raw_file, output_dir, stages=None, psa_dir=None, config=None):
+        """Record (or update) a processed cast with the stages, (psa_file, executable, order), that made it."""
+        output_dir = os.path.abspath(output_dir)
+        entry = cast_metadata(ctd_pipeline.cast_name(raw_file), output_dir, raw_file)
+        if stages is not None:
+            entry["psa_files"] = json.dumps([[psa_file, executable] for psa_file, executable, _ in stages])
+            entry["psa_dir"] = os.path.abspath(psa_dir) if psa_dir else None
+            entry["config"] = os.path.abspath(config) if config else self.config
+        self.store([entry])
+
+    def index_folder(self, output_dir, raw_dirs=()):
+        """
+        Register every cast of an output directory (see output_cast_names()). The raw .hex,
+        .hdr and .XMLCON files are looked for in raw_dirs (then where an earlier registration
+        found them), for the full header and the sensor serial numbers; without them the
+        header lines of the .cnv files are used.
+        Returns the number of casts registered.
+        """
+        output_dir = os.path.abspath(output_dir)
+        raw_files = {}
+        for raw_dir in raw_dirs:
+            for name in os.listdir(raw_dir):
+                base_name, extension = os.path.splitext(name)
+                if extension.lower() in (".hex", ".hdr"):
+                    raw_files.setdefault(base_name.lower(), os.path.join(raw_dir, base_name + ".hex"))
+        with self.lock:
+            # Raw files recorded by an earlier registration, for casts not in raw_dirs
+            for name, raw_file in self.connection.execute(
+                    "SELECT name, raw_file FROM casts WHERE output_dir = ? AND raw_file IS NOT NULL", (output_dir,)):
+                if os.path.isfile(raw_file) or os.path.isfile(os.path.splitext(raw_file)[0] + ".hdr"):
+                    raw_files.setdefault(name.lower(), raw_file)
+        entries = [cast_metadata(name, output_dir, raw_files.get(name.lower())) for name in output_cast_names(output_dir)]
+        self.store(entries)
+        return len(entries)
+
+    def find(self, cast=None, cruise=None, serial=None, near=None, radius_km=10.0, since=None, until=None, limit=None):
+        """
+        Casts matching every given condition, as dicts of the casts columns ("sensors" a
+        list of [sensor, serial number]) plus, with near, "distance_km":
+
+          cast, cruise  name, with * and ? wildcards (case-insensitive)
+          serial        a sensor serial number
+          near          (latitude, longitude) in decimal degrees, within radius_km
+          since, until  NMEA UTC time range, ISO text or datetime
+
+        The position is narrowed by the (latitude, longitude) index to a bounding box, then
+        by distance; results are sorted by distance with near, else by time.
+        """
+        conditions, parameters = [], []
+        for column, pattern in (("name", cast), ("cruise", cruise)):
+            if pattern and ("*" in pattern or "?" in pattern):
+                conditions.append(f"casts.{column} LIKE ? ESCAPE '\\'")
+                parameters.append(like_pattern(pattern))
+            elif pattern:
+                conditions.append(f"casts.{column} = ?")
+                parameters.append(pattern)
+        if serial:
+            conditions.append("casts.id IN (SELECT cast_id FROM sensors WHERE serial_number = ?)")
+            parameters.append(str(serial).strip())
+        if since:
+            conditions.append("casts.nmea_utc >= ?")
+            parameters.append(since if isinstance(since, str) else since.isoformat())
+        if until:
+            until = until if isinstance(until, str) else until.isoformat()
+            conditions.append("casts.nmea_utc <= ?")
+            # A date alone is the whole day
+            parameters.append(until + "T23:59:59" if len(until) == 10 else until)
+        if near:
+            latitude, longitude = near
+            latitude_span = radius_km / KM_PER_DEGREE
+            conditions.append("casts.latitude BETWEEN ? AND ?")
+            parameters += [latitude - latitude_span, latitude + latitude_span]
+            # Near a pole (or across the date line) every longitude is in the box
+            cos_latitude = math.cos(math.radians(min(89.0, abs(latitude) + latitude_span)))
+            longitude_span = latitude_span / cos_latitude
+            if longitude_span < 180 and -180 <= longitude - longitude_span and longitude + longitude_span <= 180:
+                conditions.append("casts.longitude BETWEEN ? AND ?")
+                parameters += [longitude - longitude_span, longitude + longitude_span]
+            else:
+                conditions.append("casts.longitude IS NOT NULL")
+
+        query = "SELECT * FROM casts" + (" WHERE " + " AND ".join(conditions) if conditions else "")
+        query += " ORDER BY casts.nmea_utc, casts.name"
+        if limit and not near:
+            query += f" LIMIT {int(limit)}"
+        with self.lock:
+            cursor = self.connection.execute(query, parameters)
+            columns = [description[0] for description in cursor.description]
+            rows = [dict(zip(columns, row)) for row in cursor]
+
+        for row in rows:
+            for column in ("sensors", "psa_files", "outputs"):
+                row[column] = json.loads(row[column]) if row[column] else []
+        if near:
+            for row in rows:
+                row["distance_km"] = distance_km(latitude, longitude, row["latitude"], row["longitude"])
+            rows = sorted((row for row in rows if row["distance_km"] <= radius_km), key=lambda row: row["distance_km"])
+        return rows[:limit] if limit else rows
+
+    def count(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM casts").fetchone()[0]
+
+
+class ConfigCatalog:
+    def __init__(self, catalog, config):
+        self.catalog = catalog
+        self.config = config
+
+    def register_cast(self, raw_file, output_dir, stages=None, psa_dir=None):
+        self.catalog.register_cast(raw_file, output_dir, stages, psa_dir, self.config)
+
+
+def like_pattern(pattern):
+    """A SQL LIKE pattern from a name with * and ? wildcards."""
+    escaped = pattern.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return escaped.replace("*", "%").replace("?", "_")
+
+
+def catalog_path(config, output_file_dir):
+    """The catalog file of a configuration: its "catalog" entry, else CATALOG_FILE_NAME in the output directory."""
+    return config.get("catalog") or os.path.join(output_file_dir, CATALOG_FILE_NAME)
+
+
+def format_cast(row):
+    """One line describing a find() result."""
+    position = (f"{row['latitude']:9.4f} {row['longitude']:10.4f}" if row["latitude"] is not None
+                and row["longitude"] is not None else f"{'-':>9} {'-':>10}")
+    pressure = (f"{row['pressure_min']:7.1f}-{row['pressure_max']:<7.1f}" if row["pressure_max"] is not None
+                else f"{'-':>15}")
+    distance = f" {row['distance_km']:7.2f} km" if "distance_km" in row else ""
+    return (f"{row['name']:<12}{row['cruise'] or '-':<10}{row['nmea_utc'] or '-':<21}{position} "
+            f"{row['scans'] if row['scans'] is not None else '-':>8} {pressure}{distance}  {row['output_dir']}")
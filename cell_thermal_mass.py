@@ -0,0 +1,105 @@
+import numpy as np
+
+import cnv_corrections
+import cnv_file
+
+# The Cell Thermal Mass module this stage replaces, used to open its PSA files with "Edit PSA"
+SBE_MODULE = "CellTMW.exe"
+
+# Conductivity and temperature columns of the <Primary> and <Secondary> corrections; TempSensor
+# picks the temperature (0 = primary, 1 = secondary)
+SENSORS = {"Primary": "Conductivity [S/m]", "Secondary": "Conductivity, 2 [S/m]"}
+TEMPERATURES = {0: "Temperature [ITS-90, deg C]", 1: "Temperature, 2 [ITS-90, deg C]"}
+
+
+def thermal_mass_correction(temperature, interval, alpha, tau, previous=None, ctm0=0.0):
+    """
+    The conductivity correction (S/m) of SBE's cell thermal-mass filter for a temperature series:
+    ctm[n] = -b ctm[n-1] + a dc/dT (T[n] - T[n-1]), with a = 2 alpha / (interval / tau + 2),
+    b = 1 - 2 a / alpha and dc/dT = 0.1 (1 + 0.006 (T - 20)). A bad temperature adds nothing.
+    For a series continuing an earlier one, previous is the temperature and ctm0 the correction
+    of the scan before it.
+    """
+    a = 2 * alpha / (interval / tau + 2)
+    b = 1 - 2 * a / alpha
+    change = np.nan_to_num(np.diff(temperature, prepend=temperature[:1] if previous is None else previous))
+    dc_dt = 0.1 * (1 + 0.006 * (np.nan_to_num(temperature) - 20))
+    return cnv_corrections.recursive_filter(a * dc_dt * change, -b, ctm0)
+
+
+def sensor_corrections(header, psa):
+    """
+    The corrections a Cell Thermal Mass PSA asks for, as (conductivity column, temperature
+    column, alpha, tau, temperature sensor) tuples.
+    """
+    corrections = []
+    for tag, conductivity in SENSORS.items():
+        settings = psa.root.find(tag)
+        if settings is None or settings.find("Correct").get("value") != "1":
+            continue
+        temperature_sensor = int(settings.find("TempSensor").get("value", "0"))
+        alpha = float(settings.find("TA_Amplitude").get("value"))
+        tau = float(settings.find("TA_TimeConstant").get("value"))
+        for name in (conductivity, TEMPERATURES[temperature_sensor]):
+            if name not in header.long_names:
+                raise ValueError(f"the {tag.lower()} correction needs '{name}', which the file does not have")
+        corrections.append((header.long_names.index(conductivity), header.long_names.index(TEMPERATURES[temperature_sensor]),
+                            alpha, tau, temperature_sensor))
+    return corrections
+
+
+def correct(header, values, psa):
+    """Correct the conductivities of a Cell Thermal Mass PSA. Returns the celltm_* header lines."""
+    interval = cnv_corrections.scan_interval(header)
+    alphas, taus, sensors = [], [], []
+    for conductivity, temperature, alpha, tau, temperature_sensor in sensor_corrections(header, psa):
+        values[:, conductivity] += thermal_mass_correction(values[:, temperature], interval, alpha, tau)
+        alphas.append(f"{alpha:.4f}")
+        taus.append(f"{tau:.4f}")
+        sensors.append("secondary" if temperature_sensor else "primary")
+
+    input_file, _ = cnv_corrections.stage_files(psa)
+    return [
+        f"# celltm_date = {cnv_file.processing_date()}, cell_thermal_mass.py",
+        f"# celltm_in = {input_file}",
+        f"# celltm_alpha = {', '.join(alphas)}",
+        f"# celltm_tau = {', '.join(taus)}",
+        f"# celltm_temp_sensor_use_for_cond = {', '.join(sensors)}",
+    ]
+
+
+class CellTMStream:
+    """
+    The cell thermal-mass correction of a cast that is still being recorded: push() corrects
+    the next scans and returns them at once, carrying the last temperature and correction of
+    each sensor over to the next scans.
+    """
+
+    def __init__(self, corrections, interval):
+        self.corrections = corrections
+        self.interval = interval
+        self.state = [(None, 0.0)] * len(corrections)  # (previous temperature, previous correction)
+
+    def push(self, values):
+        values = values.copy()
+        for i, (conductivity, temperature, alpha, tau, _) in enumerate(self.corrections):
+            if not len(values):
+                break
+            previous, ctm0 = self.state[i]
+            ctm = thermal_mass_correction(values[:, temperature], self.interval, alpha, tau, previous, ctm0)
+            values[:, conductivity] += ctm
+            self.state[i] = (values[-1:, temperature], ctm[-1])
+        return values
+
+    def finish(self):
+        return None
+
+
+def stream(header, psa):
+    """A CellTMStream for the corrections of a Cell Thermal Mass PSA."""
+    return CellTMStream(sensor_corrections(header, psa), cnv_corrections.scan_interval(header))
+
+
+def run_psa(psa_path):
+    """Correct the input file of a rendered Cell Thermal Mass PSA and write it to its output. Returns a one-line summary."""
+    return cnv_corrections.run_chain([(correct, psa_path)])
@@ -0,0 +1,90 @@
+import math
+import os
+
+import numpy as np
+from numpy.lib import recfunctions
+
+import cnv_file
+import sbe_files
+
+# recursive_filter() works in blocks over which the filter's gain changes by at most this factor
+BLOCK_GAIN = 1e6
+
+
+def stage_files(psa):
+    """(input file, output file) of a rendered correction PSA (an sbe_files.PsaFile)."""
+    input_files = psa.root.find("InputFileArray")
+    names = [item.get("value") for item in input_files.iter("ArrayItem")] if input_files is not None else []
+    if not names:
+        raise ValueError(f"{psa.path}: no input file")
+    input_file = os.path.join(psa.value("InputDir"), names[0])
+    output_file = psa.value("OutputFile") or os.path.basename(input_file)
+    output_path = os.path.join(psa.value("OutputDir"), os.path.splitext(output_file)[0] + psa.value("NameAppend") + ".cnv")
+    return input_file, output_path
+
+
+def scan_interval(header):
+    """Seconds between scans, from the "# interval = seconds: ..." line."""
+    unit, _, value = header.values.get("interval", "").partition(":")
+    if unit.strip() != "seconds":
+        raise ValueError("the file is not a time series (its interval is not in seconds)")
+    return float(value)
+
+
+def variable_columns(header, psa):
+    """Column index of each CalcArray variable of a PSA (None for a variable the file does not have)."""
+    return [header.long_names.index(full_name) if full_name in header.long_names else None
+            for full_name, _ in psa.variables]
+
+
+def array_values(psa, tag):
+    """The value attributes of the items of an array element (e.g. <ValArray>), in index order."""
+    element = psa.root.find(tag)
+    items = sorted(element, key=lambda item: int(item.get("index", "0"))) if element is not None else []
+    return [item.get("value", "") for item in items]
+
+
+def recursive_filter(x, r, y0=0.0):
+    """
+    y[n] = r * y[n - 1] + x[n] with y[-1] = y0, without a loop over the scans: within a
+    block, y is r^n times the cumulative sum of x[n] / r^n. Blocks are kept short enough
+    for r^n to stay within BLOCK_GAIN, so the sums lose no precision.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    if r == 0 or len(x) == 0:
+        return x.copy()
+    size = len(x) if abs(r) >= 1 else max(1, min(len(x), int(math.log(BLOCK_GAIN) / -math.log(abs(r)))))
+    powers = np.power(float(r), np.arange(size))
+    y = np.empty_like(x)
+    previous = y0
+    for start in range(0, len(x), size):
+        block = x[start:start + size]
+        n = len(block)
+        y[start:start + n] = powers[:n] * (r * previous + np.cumsum(block / powers[:n]))
+        previous = y[start + n - 1]
+    return y
+
+
+def run_chain(steps):
+    """
+    Apply corrections to one .cnv file in memory and write it once. steps is a list of
+    (correct, rendered psa path): the file is the input of the first PSA and is written to the
+    output of the last one; correct(header, values, psa) changes values (scans x columns,
+    NaN for bad values) in place and returns the header lines recording what it did.
+    Returns a one-line summary.
+    """
+    psas = [sbe_files.load_psa(psa_path) for _, psa_path in steps]
+    input_file, _ = stage_files(psas[0])
+    _, output_path = stage_files(psas[-1])
+
+    header, data = cnv_file.read_cnv(input_file, bad_to_nan=True)
+    values = recfunctions.structured_to_unstructured(data, dtype=np.float64, copy=True)
+    history = []
+    for (correct, _), psa in zip(steps, psas):
+        history += correct(header, values, psa)
+
+    file_type = next((i for i, line in enumerate(header.lines) if line.startswith("# file_type")), len(header.lines))
+    header.lines[file_type:file_type] = history
+    cnv_file.write_cnv(output_path, header, values)
+    done = ", ".join(sbe_files.PSA_ROOTS.get(psa.tag, psa.tag).replace("W.exe", "") for psa in psas)
+    return f"{os.path.basename(input_file)}: {len(values)} scans through {done} -> {os.path.basename(output_path)}"
@@ -0,0 +1,191 @@
+import json
+import os
+import re
+
+import numpy as np
+
+import cnv_file
+import hex_file
+
+# Key of the header metadata in an exported .npz file
+HEADER_KEY = "__header__"
+
+# Index file and layout version of a cruise dataset folder
+INDEX_FILE_NAME = "index.json"
+DATASET_FORMAT = 1
+
+
+def header_metadata(header):
+    """The header of a .cnv file as JSON-serializable metadata (the header lines rebuild the rest)."""
+    return {
+        "lines": header.lines,
+        "names": header.names,
+        "short_names": header.short_names,
+        "long_names": header.long_names,
+        "units": header.units,
+        "formats": header.formats,
+        "bad_flag": header.bad_flag,
+        "newline": header.newline.decode("ascii"),
+    }
+
+
+def header_from_metadata(metadata):
+    """A cnv_file.CnvHeader from header_metadata(), as read_header() would return it."""
+    header = cnv_file.parse_header("\n".join(metadata["lines"]).encode("latin-1"))
+    header.formats = list(metadata["formats"])
+    header.newline = metadata["newline"].encode("ascii")
+    return header
+
+
+def export_cnv(cnv_path, output_path=None):
+    """
+    Write a .cnv (or .ros) file as an uncompressed .npz file: one array per column, keyed by
+    the column's unique short name (CnvHeader.names), and the header metadata as JSON under
+    __header__. Returns the path written, <file>.npz next to the .cnv by default.
+    """
+    header, data = cnv_file.read_cnv(cnv_path)
+    output_path = output_path or cnv_path + ".npz"
+    arrays = {name: np.ascontiguousarray(data[name]) for name in header.names}
+    # As UTF-8 bytes: a NumPy string array would take four bytes per character
+    arrays[HEADER_KEY] = np.frombuffer(json.dumps(header_metadata(header)).encode("utf-8"), dtype=np.uint8)
+
+    # np.savez appends .npz to a name without it; write to a temporary name so readers never see half a file
+    tmp_path = output_path + ".tmp.npz"
+    np.savez(tmp_path, **arrays)
+    os.replace(tmp_path, output_path)
+    return output_path
+
+
+def read_npz(path, columns=None):
+    """Read a file written by export_cnv(). Returns (header, data) like cnv_file.read_cnv()."""
+    with np.load(path) as npz:
+        header = header_from_metadata(json.loads(npz[HEADER_KEY].tobytes().decode("utf-8")))
+        names = list(columns) if columns is not None else header.names
+        arrays = [npz[name] for name in names]
+    data = np.empty(len(arrays[0]) if arrays else 0, [(name, array.dtype) for name, array in zip(names, arrays)])
+    for name, array in zip(names, arrays):
+        data[name] = array
+    return header, data
+
+
+def variable_file_name(index, name):
+    """File name of a variable's array in a cruise dataset (names like sbeox0Mm/L are not file names)."""
+    return f"{index:03d}_{re.sub(r'[^A-Za-z0-9_.-]', '_', name)}.npy"
+
+
+def build_dataset(cnv_paths, dataset_dir):
+    """
+    Consolidate .cnv files into one cruise dataset folder: a float64 .npy array per variable
+    holding the scans of every cast one after the other (NaN for a cast without that variable)
+    and index.json, with the variables (long name, unit) and the casts (name, source file,
+    first row, number of rows, position and header metadata).
+
+    The headers are read first to lay the arrays out, then each cast is read once and copied
+    into the memory-mapped arrays, so only one cast is in memory at a time.
+    Returns the number of rows written. Raises ValueError when two files have the same cast
+    name (e.g. CTD01.cnv and CTD01.ros).
+    """
+    names = [os.path.splitext(os.path.basename(path))[0] for path in cnv_paths]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError(f"more than one file for cast(s) {', '.join(duplicates)}")
+    headers = [cnv_file.read_header(path) for path in cnv_paths]
+
+    variables = {}
+    for header in headers:
+        for name, long_name, unit in zip(header.names, header.long_names, header.units):
+            variables.setdefault(name, {"long_name": long_name, "unit": unit})
+    for index, (name, variable) in enumerate(variables.items()):
+        variable["file"] = variable_file_name(index, name)
+
+    casts = []
+    rows = 0
+    for path, name, header in zip(cnv_paths, names, headers):
+        instrument_header = hex_file.parse_header(header.lines)
+        casts.append({
+            "name": name,
+            "source": os.path.abspath(path),
+            "start": rows,
+            "count": header.nvalues,
+            "latitude": instrument_header.nmea_position("NMEA Latitude"),
+            "longitude": instrument_header.nmea_position("NMEA Longitude"),
+            "start_time": header.values.get("start_time", "").split("[")[0].strip(),
+            "header": header_metadata(header),
+        })
+        rows += header.nvalues
+
+    os.makedirs(dataset_dir, exist_ok=True)
+    arrays = {name: np.lib.format.open_memmap(os.path.join(dataset_dir, variable["file"]), mode="w+",
+                                              dtype=np.float64, shape=(rows,))
+              for name, variable in variables.items()}
+    for path, header, cast in zip(cnv_paths, headers, casts):
+        _, data = cnv_file.read_cnv(path)
+        if len(data) != cast["count"]:
+            raise ValueError(f"{path}: {len(data)} scans, but the header says nvalues = {cast['count']}")
+        rows_of_cast = slice(cast["start"], cast["start"] + cast["count"])
+        for name, array in arrays.items():
+            array[rows_of_cast] = data[name] if name in header.names else np.nan
+    for array in arrays.values():
+        array.flush()
+    del arrays
+
+    # The index is written last: a folder without one is an unfinished dataset
+    index = {"format": DATASET_FORMAT, "rows": rows, "variables": variables, "casts": casts}
+    tmp_path = os.path.join(dataset_dir, INDEX_FILE_NAME + ".tmp")
+    with open(tmp_path, "w") as f:
+        json.dump(index, f)
+    os.replace(tmp_path, os.path.join(dataset_dir, INDEX_FILE_NAME))
+    return rows
+
+
+class CruiseDataset:
+    """
+    A cruise dataset written by build_dataset(). Variables are memory-mapped when first used,
+    so loading any casts and variables parses nothing but index.json:
+
+        dataset = CruiseDataset("EN734.ctd")
+        dataset.cast("CTD02", ["prDM", "t090C"])["t090C"]
+        dataset.select(["CTD01", "CTD02"], ["prDM", "sal00"])
+    """
+
+    def __init__(self, dataset_dir):
+        self.path = dataset_dir
+        with open(os.path.join(dataset_dir, INDEX_FILE_NAME), "r") as f:
+            index = json.load(f)
+        if index.get("format") != DATASET_FORMAT:
+            raise ValueError(f"{dataset_dir}: unknown dataset format {index.get('format')}")
+        self.rows = index["rows"]
+        self.variables = index["variables"]
+        self.casts = {cast["name"]: cast for cast in index["casts"]}
+        self._arrays = {}
+
+    def array(self, variable):
+        """All the rows of a variable, memory-mapped."""
+        if variable not in self._arrays:
+            if variable not in self.variables:
+                raise KeyError(f"{self.path}: no variable {variable}")
+            self._arrays[variable] = np.load(os.path.join(self.path, self.variables[variable]["file"]), mmap_mode="r")
+        return self._arrays[variable]
+
+    def header(self, cast):
+        return header_from_metadata(self.casts[cast]["header"])
+
+    def cast(self, cast, variables=None):
+        """{variable: array} of one cast, views of the memory-mapped arrays (no copy)."""
+        entry = self.casts[cast]
+        rows = slice(entry["start"], entry["start"] + entry["count"])
+        return {variable: self.array(variable)[rows] for variable in (variables or self.variables)}
+
+    def select(self, casts=None, variables=None):
+        """
+        {variable: array} of several casts one after the other, with a "cast" array of indexes
+        into the list of casts. The selected rows are copied out of the memory-mapped arrays.
+        """
+        casts = list(casts or self.casts)
+        entries = [self.casts[cast] for cast in casts]
+        selected = {"cast": np.repeat(np.arange(len(entries)), [entry["count"] for entry in entries])}
+        for variable in (variables or self.variables):
+            array = self.array(variable)
+            selected[variable] = np.concatenate([array[entry["start"]:entry["start"] + entry["count"]] for entry in entries]) \
+                if entries else np.zeros(0)
+        return selected
@@ -0,0 +1,254 @@
+import mmap
+import os
+import re
+import warnings
+from datetime import datetime
+
+import numpy as np
+
+# Width of one value in the ASCII data block written by SBE Data Processing
+ASCII_FIELD_WIDTH = 11
+
+# SBE Data Processing pads these header lines so they can be rewritten in place
+PADDED_LINE_WIDTH = 40
+
+# Files up to this size (bytes) are read in one call: mapping them costs more than reading them
+SMALL_FILE_SIZE = 256 * 1024
+
+NAME_PATTERN = re.compile(r"^# name (\d+) = ([^:]*): ?(.*)$")
+SPAN_PATTERN = re.compile(r"^# span (\d+) = (.*)$")
+VALUE_PATTERN = re.compile(r"^# (\w+) = (.*)$")
+# The header lines any of them can match, found in the header text in one pass; the
+# instrument configuration lines (e.g. "#     <Slope>1.0</Slope>") are left out
+KEY_LINE_PATTERN = re.compile(r"\n(# \w[^\n]*)")
+UNIT_PATTERN = re.compile(r"\[(.*?)\]")
+
+
+class CnvHeader:
+    """
+    The parsed header of a .cnv file.
+
+    names are the short column names (e.g. t090C), made unique by appending _1, _2 ...
+    when SBE Data Processing repeats a name (e.g. depSM). long_names and units come from
+    the "# name N = short: long [unit]" lines. Any other "# key = value" line is kept in
+    values, and lines holds the raw header text (without *END*) for writing it back.
+    formats are the printf formats of the columns in the ASCII data block (e.g. ".3f").
+    """
+
+    def __init__(self):
+        self.lines = []
+        self.nquan = 0
+        self.nvalues = 0
+        self.names = []
+        self.short_names = []
+        self.long_names = []
+        self.units = []
+        self.spans = []
+        self.formats = []
+        self.bad_flag = None
+        self.file_type = "ascii"
+        self.values = {}
+        self.data_offset = 0
+        self.newline = b"\n"
+
+    def column(self, name):
+        """Index of a column by (unique) short name."""
+        return self.names.index(name)
+
+
+def unique_names(short_names):
+    names = []
+    seen = {}
+    for name in short_names:
+        count = seen.get(name, 0)
+        seen[name] = count + 1
+        names.append(name if count == 0 else f"{name}_{count}")
+    return names
+
+
+def parse_header(raw_header):
+    """Parse the header bytes (everything before *END*) of a .cnv file."""
+    header = CnvHeader()
+    text = raw_header.decode("latin-1")
+    header.lines = text.splitlines()
+
+    columns = {}
+    spans = {}
+    for line in KEY_LINE_PATTERN.findall("\n" + text):
+        line = line.rstrip()
+        match = NAME_PATTERN.match(line)
+        if match:
+            columns[int(match.group(1))] = (match.group(2).strip(), match.group(3).strip())
+            continue
+        match = SPAN_PATTERN.match(line)
+        if match:
+            spans[int(match.group(1))] = tuple(float(v) for v in match.group(2).split(","))
+            continue
+        match = VALUE_PATTERN.match(line)
+        if match:
+            header.values[match.group(1)] = match.group(2).strip()
+
+    header.nquan = int(header.values.get("nquan", len(columns)))
+    header.nvalues = int(header.values.get("nvalues", 0))
+    header.short_names = [columns[i][0] for i in range(header.nquan)]
+    header.long_names = [columns[i][1] for i in range(header.nquan)]
+    header.units = [(UNIT_PATTERN.search(long_name) or [None, ""])[1] for long_name in header.long_names]
+    header.names = unique_names(header.short_names)
+    header.spans = [spans.get(i) for i in range(header.nquan)]
+    if "bad_flag" in header.values:
+        header.bad_flag = float(header.values["bad_flag"])
+    header.file_type = header.values.get("file_type", "ascii").lower()
+    return header
+
+
+def read_header(path):
+    """Read and parse only the header of a .cnv file."""
+    if os.path.getsize(path) == 0:
+        raise ValueError(f"{path}: empty file, not a .cnv file")
+    with open(path, "rb") as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return header_from_buffer(mapped, path)
+
+
+def header_from_buffer(buffer, path=""):
+    end = buffer.find(b"*END*")
+    if end < 0:
+        raise ValueError(f"{path}: no *END* line, not a .cnv file")
+    line_end = buffer.find(b"\n", end)
+    header = parse_header(buffer[:end])
+    header.data_offset = line_end + 1 if line_end >= 0 else len(buffer)
+    header.newline = b"\r\n" if buffer[end:line_end + 1].endswith(b"\r\n") else b"\n"
+
+    first_line = buffer[header.data_offset:header.data_offset + 4 * ASCII_FIELD_WIDTH * (header.nquan + 1)].split(b"\n")[0]
+    fields = first_line.split() if header.file_type == "ascii" else []
+    header.formats = [field_format(field) for field in fields] if len(fields) == header.nquan else [".4e"] * header.nquan
+    return header
+
+
+def field_format(field):
+    """printf format of a value as written in the data block: '1.234' -> '.3f', '0.0000e+00' -> '.4e'."""
+    mantissa, exponent, _ = field.lower().partition(b"e")
+    decimals = len(mantissa.partition(b".")[2])
+    return f".{decimals}e" if exponent else f".{decimals}f"
+
+
+def structured(values, names):
+    """View a C-contiguous (scans, columns) array as a structured array keyed by column name."""
+    dtype = np.dtype([(name, values.dtype) for name in names])
+    return np.ascontiguousarray(values).view(dtype).reshape(len(values))
+
+
+def decode_ascii(block, header, indexes):
+    """Decode the given columns of the ASCII data block in bulk into a (scans, columns) float64 array."""
+    nquan = header.nquan
+    line_length = nquan * ASCII_FIELD_WIDTH + len(header.newline)
+
+    nvalues = header.nvalues or len(block) // line_length
+    if nvalues and len(block) >= nvalues * line_length and block[line_length - 1] == header.newline[-1]:
+        # Fixed-width layout: cut the block into 11-character fields without splitting lines
+        rows = block[:nvalues * line_length].reshape(nvalues, line_length)[:, :nquan * ASCII_FIELD_WIDTH]
+        fields = rows.reshape(nvalues, nquan, ASCII_FIELD_WIDTH)[:, indexes]
+        fields = np.ascontiguousarray(fields).view(f"S{ASCII_FIELD_WIDTH}")[:, :, 0]
+        try:
+            return fields.astype(np.float64)
+        except ValueError:
+            pass
+
+    # Values wider than their field (or hand-edited files): split on whitespace instead
+    values = np.array(block.tobytes().split(), dtype=np.float64)
+    return values.reshape(-1, nquan)[:, indexes]
+
+
+def read_cnv(path, columns=None, bad_to_nan=False):
+    """
+    Read a .cnv file. Returns (header, data) where data is a NumPy structured array
+    with one field per column (keyed by CnvHeader.names) and one row per scan.
+
+    The data block of a large file is memory-mapped (SMALL_FILE_SIZE): ASCII files are
+    decoded in one pass, binary files (file_type = binary, little-endian float32) are used
+    without copying. columns limits decoding to the named columns. With bad_to_nan=True,
+    values equal to the header's bad_flag become NaN.
+    """
+    size = os.path.getsize(path)
+    if 0 < size <= SMALL_FILE_SIZE:
+        with open(path, "rb") as f:
+            content = f.read()
+        header = header_from_buffer(content, path)
+        block = np.frombuffer(content, dtype=np.uint8, offset=header.data_offset)
+    else:
+        header = read_header(path)
+        block = np.memmap(path, dtype=np.uint8, mode="r", offset=header.data_offset) \
+            if header.data_offset < size else np.zeros(0, np.uint8)
+    names = list(columns) if columns is not None else header.names
+    indexes = [header.column(name) for name in names]
+
+    if header.file_type == "binary":
+        count = header.nvalues * header.nquan if header.nvalues else -1
+        values = block[:len(block) // 4 * 4].view("<f4")
+        values = values[:count] if count >= 0 else values
+        values = values[:len(values) // header.nquan * header.nquan].reshape(-1, header.nquan)
+        if columns is not None or bad_to_nan:
+            values = values[:, indexes]
+    else:
+        values = decode_ascii(block, header, indexes) if len(block) else np.zeros((0, len(indexes)))
+
+    if bad_to_nan and header.bad_flag is not None:
+        values[np.isclose(values, header.bad_flag, rtol=1e-6, atol=0)] = np.nan
+
+    return header, structured(values, names)
+
+
+def write_cnv(path, header, values):
+    """
+    Write an ASCII .cnv file: header.lines with the nquan, nvalues, name and span lines
+    rebuilt from header.short_names, header.long_names and header.formats, then values
+    (a (scans, columns) array) in 11-character fields. NaN is written as header.bad_flag
+    (in exponent format, whatever the column's format) and left out of the spans.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    nquan = len(header.short_names)
+    bad = np.isnan(values)
+    with warnings.catch_warnings():
+        # A column of bad values only has a NaN span
+        warnings.simplefilter("ignore", RuntimeWarning)
+        spans = [(np.nanmin(values[:, i]), np.nanmax(values[:, i])) if len(values) else (0.0, 0.0) for i in range(nquan)]
+
+    columns = [f"# name {i} = {header.short_names[i]}: {header.long_names[i]}" for i in range(nquan)]
+    columns += [f"# span {i} = {low:>10{header.formats[i]}}, {high:>10{header.formats[i]}}".ljust(PADDED_LINE_WIDTH)
+                for i, (low, high) in enumerate(spans)]
+
+    lines = []
+    columns_at = None
+    for line in header.lines:
+        match = VALUE_PATTERN.match(line.rstrip())
+        key = match.group(1) if match else ""
+        if key == "nquan":
+            lines.append(f"# nquan = {nquan}")
+        elif key == "nvalues":
+            lines.append(f"# nvalues = {len(values)}".ljust(PADDED_LINE_WIDTH))
+        elif NAME_PATTERN.match(line.rstrip()) or SPAN_PATTERN.match(line.rstrip()):
+            if columns_at is None:
+                columns_at = len(lines)
+        else:
+            lines.append(line)
+            if key == "units" and columns_at is None:
+                # A new header without name and span lines: they follow "# units = specified"
+                columns_at = len(lines)
+    if columns_at is None:
+        columns_at = len(lines)
+    lines[columns_at:columns_at] = columns
+
+    newline = header.newline.decode("ascii")
+    row_format = "".join(f"%{ASCII_FIELD_WIDTH}{fmt}" for fmt in header.formats)
+    rows = "".join(row_format % tuple(row) + newline for row in values.tolist())
+    if header.bad_flag is not None and bad.any():
+        rows = rows.replace("nan".rjust(ASCII_FIELD_WIDTH), f"{header.bad_flag:{ASCII_FIELD_WIDTH}.3e}")
+    with open(path, "w", encoding="latin-1", newline="") as f:
+        f.write(newline.join(lines) + newline + "*END*" + newline)
+        f.write(rows)
+
+
+def processing_date():
+    """Date in the format of the <module>_date header lines (e.g. Aug 29 2025 15:51:37)."""
+    return datetime.now().strftime("%b %d %Y %H:%M:%S")
+
@@ -0,0 +1,618 @@
+"""
+Headless command-line batch runner.
+
+    python -m ctd_cli run --config config.json --raw CTD*.hex --jobs 4
+    python -m ctd_cli run --config config.json --raw CTD*.hex --batch-size 20
+    python -m ctd_cli run --config config.json --raw CTD*.hex --timeout 300 --stage-retries 2
+    python -m ctd_cli run --config config.json --raw CTD*.hex --output //ship/share/proc --scratch /dev/shm/ctd
+    python -m ctd_cli check --config config.json --raw CTD*.hex
+    python -m ctd_cli watch --config config.json --raw-dir D:/ctd/raw --jobs 2
+    python -m ctd_cli live --config config.json --raw D:/ctd/raw/CTD042.hex --interval 5
+    python -m ctd_cli batch --manifest archive.csv --jobs 4
+    python -m ctd_cli coordinate --spool //server/ctd/spool --manifest archive.csv
+    python -m ctd_cli work --spool //server/ctd/spool --jobs 2
+    python -m ctd_cli plot --psa EN_SeaPlot_TSOO.psa EN_SeaPlot_TTSS.psa --cnv out/CTD*.cnv --output plots --jobs 4
+    python -m ctd_cli export --cnv "out/*_avg.cnv" --output export --dataset EN734_avg.ctd
+    python -m ctd_cli catalog index --catalog casts.sqlite --output D:/EN734/proc --raw-dir D:/EN734/raw
+    python -m ctd_cli catalog find --catalog casts.sqlite --near 36.68 -66.93 --radius 20 --serial 4695
+
+Uses the same configuration files as the GUI and never loads Tk, so it can run on an
+unattended processing machine or from a scheduled task. Relative paths in the
+configuration are resolved from the current directory, as in the GUI.
+"""
+import argparse
+import glob
+import json
+import os
+import sqlite3
+import sys
+import threading
+
+import batch_manifest
+import cast_catalog
+import cnv_export
+import ctd_pipeline
+import job_spool
+import live_cast
+import sea_plot
+import watch_folder
+
+
+def expand_raw_files(patterns):
+    """Expand raw file arguments or config entries (globs and ';'-joined lists) into a file list."""
+    raw_files = []
+    for pattern in patterns:
+        for item in pattern.split(";"):
+            item = item.strip().strip('"')
+            if not item:
+                continue
+            matches = sorted(glob.glob(item))
+            raw_files.extend(matches if matches else [item])
+    return [os.path.normpath(f) for f in raw_files]
+
+
+def open_catalog(path, config=None):
+    """A CastCatalog, or None (with the error printed) if the file cannot be opened."""
+    try:
+        return cast_catalog.CastCatalog(path, config)
+    except (OSError, sqlite3.Error) as e:
+        print(f"Error: cannot open the catalog {path}: {e}", file=sys.stderr)
+        return None
+
+
+def run_command(args):
+    config = ctd_pipeline.load_config(args.config)
+
+    raw_files = expand_raw_files(args.raw if args.raw else config.get("raw_files", []))
+    psa_dir = args.psa_dir or config.get("psa_dir", "")
+    output_file_dir = args.output or config.get("output_file", "")
+    jobs = args.jobs if args.jobs is not None else config.get("jobs", 1)
+    batch_size = args.batch_size if args.batch_size is not None else config.get("batch_size", 1)
+    incremental = config.get("incremental", True) and not args.force
+
+    if not raw_files or not all(os.path.isfile(f) for f in raw_files):
+        missing = [f for f in raw_files if not os.path.isfile(f)]
+        print(f"Error: please select one or more valid raw .hex files. Missing: {missing}", file=sys.stderr)
+        return 1
+
+    if not os.path.isdir(psa_dir):
+        print(f"Error: '{psa_dir}' is not a valid directory containing .psa files.", file=sys.stderr)
+        return 1
+
+    if not output_file_dir:
+        print("Error: no output file directory given.", file=sys.stderr)
+        return 1
+
+    try:
+        stages = ctd_pipeline.selected_stages(config, args.executables_dir)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+    if not stages:
+        print("Error: the configuration has no selected .psa files.", file=sys.stderr)
+        return 1
+
+    catalog = open_catalog(args.catalog or cast_catalog.catalog_path(config, output_file_dir), args.config)
+    if catalog is None:
+        return 1
+
+    print(f"Processing {len(raw_files)} cast(s) through {len(stages)} stage(s) with {jobs} worker(s)"
+          + (f", up to {batch_size} casts per module run" if batch_size > 1 else ""))
+    try:
+        errors = ctd_pipeline.process_casts(raw_files, stages, psa_dir, output_file_dir, jobs=jobs, incremental=incremental,
+                                            after=ctd_pipeline.stage_dependencies(config), catalog=catalog,
+                                            batch_size=batch_size,
+                                            limits=ctd_pipeline.stage_limits(config, args.timeout, args.stage_retries),
+                                            workspace=ctd_pipeline.workspace(config, output_file_dir, args.scratch))
+    finally:
+        catalog.close()
+
+    for err in errors:
+        print(err, file=sys.stderr)
+    if errors:
+        return 1
+
+    print("Selected .psa files have been processed.")
+    return 0
+
+
+def check_command(args):
+    config = ctd_pipeline.load_config(args.config)
+
+    raw_files = expand_raw_files(args.raw if args.raw else config.get("raw_files", []))
+    psa_dir = args.psa_dir or config.get("psa_dir", "")
+    output_file_dir = args.output or config.get("output_file", "")
+
+    try:
+        stages = ctd_pipeline.selected_stages(config, args.executables_dir)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+    _, runnable, errors = ctd_pipeline.preflight(raw_files, stages, psa_dir, output_file_dir,
+                                                 ctd_pipeline.stage_dependencies(config))
+    for err in errors:
+        print(err, file=sys.stderr)
+    print(f"{len(runnable)}/{len(raw_files)} cast(s) ready for {len(stages)} stage(s)")
+    return 1 if errors else 0
+
+
+def watch_command(args):
+    config = ctd_pipeline.load_config(args.config)
+
+    psa_dir = args.psa_dir or config.get("psa_dir", "")
+    output_file_dir = args.output or config.get("output_file", "")
+    jobs = args.jobs if args.jobs is not None else config.get("jobs", 1)
+    incremental = config.get("incremental", True) and not args.force
+
+    if not os.path.isdir(args.raw_dir):
+        print(f"Error: '{args.raw_dir}' is not a directory.", file=sys.stderr)
+        return 1
+
+    if not os.path.isdir(psa_dir):
+        print(f"Error: '{psa_dir}' is not a valid directory containing .psa files.", file=sys.stderr)
+        return 1
+
+    if not output_file_dir:
+        print("Error: no output file directory given.", file=sys.stderr)
+        return 1
+
+    try:
+        stages = ctd_pipeline.selected_stages(config, args.executables_dir)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+    if not stages:
+        print("Error: the configuration has no selected .psa files.", file=sys.stderr)
+        return 1
+
+    catalog = open_catalog(args.catalog or cast_catalog.catalog_path(config, output_file_dir), args.config)
+    if catalog is None:
+        return 1
+
+    # Ctrl+C stops watching; casts already queued are finished first
+    stop_event = threading.Event()
+    watcher = threading.Thread(target=ctd_pipeline.watch_casts, daemon=True,
+                               args=(args.raw_dir, stages, psa_dir, output_file_dir, jobs, incremental, None, stop_event,
+                                     args.settle),
+                               kwargs={"after": ctd_pipeline.stage_dependencies(config), "catalog": catalog,
+                                       "limits": ctd_pipeline.stage_limits(config, args.timeout, args.stage_retries),
+                                       "workspace": ctd_pipeline.workspace(config, output_file_dir, args.scratch)})
+    watcher.start()
+    try:
+        while watcher.is_alive():
+            watcher.join(0.5)
+    except KeyboardInterrupt:
+        print("Stopping: finishing the casts in progress (Ctrl+C again to abort)")
+        stop_event.set()
+        watcher.join()
+    catalog.close()
+    return 0
+
+
+def live_command(args):
+    config = ctd_pipeline.load_config(args.config)
+
+    psa_dir = args.psa_dir or config.get("psa_dir", "")
+    output_file_dir = args.output or config.get("output_file", "")
+    incremental = config.get("incremental", True) and not args.force
+
+    if not os.path.isdir(psa_dir):
+        print(f"Error: '{psa_dir}' is not a valid directory containing .psa files.", file=sys.stderr)
+        return 1
+
+    if not output_file_dir:
+        print("Error: no output file directory given.", file=sys.stderr)
+        return 1
+
+    try:
+        stages = ctd_pipeline.selected_stages(config, args.executables_dir)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+    if not stages:
+        print("Error: the configuration has no selected .psa files.", file=sys.stderr)
+        return 1
+
+    # Ctrl+C stops following the cast; the profile so far is written and the pipeline is not run
+    stop_event = threading.Event()
+    outcome = []
+
+    def follow():
+        try:
+            outcome.append(live_cast.follow_cast(args.raw, stages, psa_dir, output_file_dir, args.interval, args.settle,
+                                                 stop_event))
+        except Exception as e:
+            # Also a malformed .hex, .XMLCON or .psa file: reported below instead of ending the thread silently
+            outcome.append(e)
+
+    follower = threading.Thread(target=follow, daemon=True)
+    follower.start()
+    try:
+        while follower.is_alive():
+            follower.join(0.5)
+    except KeyboardInterrupt:
+        print("Stopping: writing the profile so far")
+        stop_event.set()
+        follower.join()
+
+    if isinstance(outcome[0], Exception):
+        print(f"Error: {outcome[0]}", file=sys.stderr)
+        return 1
+    if not outcome[0] or args.live_only:
+        return 0
+
+    catalog = open_catalog(args.catalog or cast_catalog.catalog_path(config, output_file_dir), args.config)
+    if catalog is None:
+        return 1
+    try:
+        errors = ctd_pipeline.process_casts([args.raw], stages, psa_dir, output_file_dir, incremental=incremental,
+                                            after=ctd_pipeline.stage_dependencies(config), catalog=catalog,
+                                            limits=ctd_pipeline.stage_limits(config, args.timeout, args.stage_retries),
+                                            workspace=ctd_pipeline.workspace(config, output_file_dir, args.scratch))
+    finally:
+        catalog.close()
+
+    for err in errors:
+        print(err, file=sys.stderr)
+    return 1 if errors else 0
+
+
+def batch_command(args):
+    try:
+        casts = batch_manifest.load_manifest(args.manifest, args.config)
+    except (OSError, ValueError) as e:
+        print(f"Error: cannot read the manifest: {e}", file=sys.stderr)
+        return 1
+    if not casts:
+        print("Error: the manifest lists no casts.", file=sys.stderr)
+        return 1
+
+    catalog = None
+    if args.catalog:
+        catalog = open_catalog(args.catalog)
+        if catalog is None:
+            return 1
+
+    # Ctrl+C stops the batch: running stages are killed and the journal keeps what is done
+    cancel_event = threading.Event()
+    result = {}
+
+    def run():
+        result["done"], result["quarantined"], result["errors"] = batch_manifest.run_manifest(
+            args.manifest, args.journal, args.jobs, not args.force, None, cancel_event, args.config, args.executables_dir,
+            args.retries, args.retry_quarantined, catalog, args.batch_size, args.timeout, args.stage_retries, args.scratch)
+
+    runner = threading.Thread(target=run, daemon=True)
+    runner.start()
+    try:
+        while runner.is_alive():
+            runner.join(0.5)
+    except KeyboardInterrupt:
+        print("Stopping: run the same command again to resume")
+        cancel_event.set()
+        runner.join()
+    if catalog:
+        catalog.close()
+    if not result:
+        return 1
+
+    for err in result["errors"]:
+        print(err, file=sys.stderr)
+    for cast in result["quarantined"]:
+        print(f"Quarantined: {cast.raw_file}", file=sys.stderr)
+    print(f"{result['done']}/{len(casts)} cast(s) done, {len(result['quarantined'])} quarantined")
+    return 0 if result["done"] == len(casts) else 1
+
+
+def coordinate_command(args):
+    casts = []
+    if args.manifest:
+        try:
+            casts = batch_manifest.load_manifest(args.manifest, args.config)
+        except (OSError, ValueError) as e:
+            print(f"Error: cannot read the manifest: {e}", file=sys.stderr)
+            return 1
+
+    # Ctrl+C stops handing out jobs; the spool keeps them for the next run
+    stop_event = threading.Event()
+    result = {}
+
+    def run():
+        result["finished"] = job_spool.coordinate(args.spool, casts, args.lease, args.attempts, stop_event=stop_event)
+
+    coordinator = threading.Thread(target=run, daemon=True)
+    coordinator.start()
+    try:
+        while coordinator.is_alive():
+            coordinator.join(0.5)
+    except KeyboardInterrupt:
+        print("Stopping: run the same command again to go on")
+        stop_event.set()
+        coordinator.join()
+    if "finished" not in result:
+        return 1
+
+    failed = [job for job in result["finished"] if job["status"] != "done"]
+    for job in failed:
+        print(f"Failed: {job['raw_file']}: {'; '.join(error for error in job['errors'] if error)}", file=sys.stderr)
+    print(f"{len(result['finished']) - len(failed)} cast(s) done, {len(failed)} failed")
+    return 1 if failed or stop_event.is_set() else 0
+
+
+def work_command(args):
+    # Ctrl+C stops the worker: the jobs it is running are cancelled and given back
+    stop_event = threading.Event()
+    worker = threading.Thread(target=job_spool.run_worker, daemon=True,
+                              args=(args.spool, args.name, args.jobs, args.scratch, args.executables_dir, args.exit_when_idle,
+                                    stop_event))
+    worker.start()
+    try:
+        while worker.is_alive():
+            worker.join(0.5)
+    except KeyboardInterrupt:
+        print("Stopping: giving back the jobs in progress")
+        stop_event.set()
+        worker.join()
+    return 0
+
+
+def plot_command(args):
+    cnv_files = expand_raw_files(args.cnv)
+    missing = [f for f in cnv_files if not os.path.isfile(f)] + [f for f in args.psa if not os.path.isfile(f)]
+    if not cnv_files or missing:
+        print(f"Error: please select one or more valid .cnv and .psa files. Missing: {missing}", file=sys.stderr)
+        return 1
+
+    print(f"Plotting {len(cnv_files)} file(s) with {len(args.psa)} plot(s) on {args.jobs} worker(s)")
+    try:
+        images, errors = sea_plot.plot_casts(args.psa, cnv_files, args.output, jobs=args.jobs, image_format=args.format)
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+    for err in errors:
+        print(err, file=sys.stderr)
+    print(f"{len(images)} plot(s) written to {args.output}")
+    return 1 if errors else 0
+
+
+def export_command(args):
+    cnv_files = expand_raw_files(args.cnv)
+    missing = [f for f in cnv_files if not os.path.isfile(f)]
+    if not cnv_files or missing:
+        print(f"Error: please select one or more valid .cnv files. Missing: {missing}", file=sys.stderr)
+        return 1
+
+    if args.output is None and not args.dataset:
+        print("Error: give --output, --dataset or both.", file=sys.stderr)
+        return 1
+
+    errors = []
+    if args.output is not None:
+        os.makedirs(args.output, exist_ok=True)
+        for cnv_path in cnv_files:
+            try:
+                cnv_export.export_cnv(cnv_path, os.path.join(args.output, os.path.basename(cnv_path) + ".npz"))
+            except (OSError, ValueError) as e:
+                errors.append(f"{cnv_path}: {e}")
+        print(f"{len(cnv_files) - len(errors)} file(s) exported to {args.output}")
+
+    if args.dataset:
+        try:
+            rows = cnv_export.build_dataset(cnv_files, args.dataset)
+        except (OSError, ValueError) as e:
+            errors.append(f"{args.dataset}: {e}")
+        else:
+            print(f"{len(cnv_files)} cast(s), {rows} scans, written to the cruise dataset {args.dataset}")
+
+    for err in errors:
+        print(err, file=sys.stderr)
+    return 1 if errors else 0
+
+
+def catalog_file(args):
+    """The catalog of a catalog command: --catalog, else the one of --config (see cast_catalog.catalog_path())."""
+    if args.catalog:
+        return args.catalog
+    config = ctd_pipeline.load_config(args.config)
+    return cast_catalog.catalog_path(config, config.get("output_file", ""))
+
+
+def catalog_index_command(args):
+    missing = [d for d in args.output + (args.raw_dir or []) if not os.path.isdir(d)]
+    if missing:
+        print(f"Error: not directories: {missing}", file=sys.stderr)
+        return 1
+
+    catalog = open_catalog(catalog_file(args))
+    if catalog is None:
+        return 1
+    errors = 0
+    try:
+        for output_dir in args.output:
+            try:
+                count = catalog.index_folder(output_dir, args.raw_dir or [])
+            except (OSError, ValueError, sqlite3.Error) as e:
+                print(f"Error: {output_dir}: {e}", file=sys.stderr)
+                errors += 1
+            else:
+                print(f"{count} cast(s) of {output_dir} indexed")
+        print(f"{catalog.count()} cast(s) in {catalog.path}")
+    finally:
+        catalog.close()
+    return 1 if errors else 0
+
+
+def catalog_find_command(args):
+    catalog_path = catalog_file(args)
+    if not os.path.isfile(catalog_path):
+        print(f"Error: no catalog {catalog_path}", file=sys.stderr)
+        return 1
+    catalog = open_catalog(catalog_path)
+    if catalog is None:
+        return 1
+    try:
+        casts = catalog.find(cast=args.cast, cruise=args.cruise, serial=args.serial,
+                             near=tuple(args.near) if args.near else None, radius_km=args.radius,
+                             since=args.since, until=args.until, limit=args.limit)
+    finally:
+        catalog.close()
+
+    if args.json:
+        print(json.dumps(casts, indent=4))
+        return 0
+    for cast in casts:
+        print(cast_catalog.format_cast(cast))
+    print(f"{len(casts)} cast(s)")
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="ctd_cli", description="Batch process CTD casts with SBE Data Processing modules.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="Run the configured pipeline on one or more raw .hex files.")
+    run_parser.add_argument("--config", required=True, help="Configuration file saved by the GUI.")
+    run_parser.add_argument("--raw", nargs="+", help="Raw .hex files or glob patterns (default: raw_files from the config).")
+    run_parser.add_argument("--jobs", type=int, help="Number of stages run at the same time, across casts (default: jobs from the config, or 1).")
+    run_parser.add_argument("--psa-dir", help="Override the config's psa_dir.")
+    run_parser.add_argument("--executables-dir", help="Override the config's executables_dir.")
+    run_parser.add_argument("--output", help="Override the config's output_file directory.")
+    run_parser.add_argument("--force", action="store_true", help="Run every stage, even those that are up to date.")
+    run_parser.add_argument("--batch-size", type=int,
+                            help="Run each module that can once for up to this many casts (default: batch_size from the config, or 1).")
+    run_parser.add_argument("--catalog", help="Catalog the processed casts are registered in (default: catalog from the config, "
+                                              f"or {cast_catalog.CATALOG_FILE_NAME} in the output directory).")
+    run_parser.set_defaults(func=run_command)
+
+    check_parser = subparsers.add_parser("check", help="Check the configured pipeline and raw files without running anything.")
+    check_parser.add_argument("--config", required=True, help="Configuration file saved by the GUI.")
+    check_parser.add_argument("--raw", nargs="+", help="Raw .hex files or glob patterns (default: raw_files from the config).")
+    check_parser.add_argument("--psa-dir", help="Override the config's psa_dir.")
+    check_parser.add_argument("--executables-dir", help="Override the config's executables_dir.")
+    check_parser.add_argument("--output", help="Override the config's output_file directory.")
+    check_parser.set_defaults(func=check_command)
+
+    watch_parser = subparsers.add_parser("watch", help="Process every complete cast that lands in a raw directory.")
+    watch_parser.add_argument("--config", required=True, help="Configuration file saved by the GUI.")
+    watch_parser.add_argument("--raw-dir", required=True, help="Directory Seasave writes the .hex, .hdr, .XMLCON and .bl files to.")
+    watch_parser.add_argument("--jobs", type=int, help="Number of casts processed at the same time (default: jobs from the config, or 1).")
+    watch_parser.add_argument("--settle", type=float, default=watch_folder.SETTLE_TIME,
+                              help=f"Seconds a cast's files must stay unchanged before it is processed (default: {watch_folder.SETTLE_TIME:g}).")
+    watch_parser.add_argument("--psa-dir", help="Override the config's psa_dir.")
+    watch_parser.add_argument("--executables-dir", help="Override the config's executables_dir.")
+    watch_parser.add_argument("--output", help="Override the config's output_file directory.")
+    watch_parser.add_argument("--force", action="store_true", help="Run every stage, even those that are up to date.")
+    watch_parser.add_argument("--catalog", help="Catalog the processed casts are registered in (default: as for run).")
+    watch_parser.set_defaults(func=watch_command)
+
+    live_parser = subparsers.add_parser("live", help="Follow a cast while it is recorded, then run the pipeline on it.")
+    live_parser.add_argument("--config", required=True, help="Configuration file saved by the GUI.")
+    live_parser.add_argument("--raw", required=True, help="The .hex file Seasave is writing (it may not exist yet).")
+    live_parser.add_argument("--interval", type=float, default=live_cast.UPDATE_INTERVAL,
+                             help=f"Seconds between two updates of the live profile and plots (default: {live_cast.UPDATE_INTERVAL:g}).")
+    live_parser.add_argument("--settle", type=float, default=live_cast.END_TIME,
+                             help=f"Seconds without new scans after which the cast has ended (default: {live_cast.END_TIME:g}).")
+    live_parser.add_argument("--live-only", action="store_true", help="Do not run the pipeline at the end of the cast.")
+    live_parser.add_argument("--psa-dir", help="Override the config's psa_dir.")
+    live_parser.add_argument("--executables-dir", help="Override the config's executables_dir.")
+    live_parser.add_argument("--output", help="Override the config's output_file directory.")
+    live_parser.add_argument("--force", action="store_true", help="Run every stage at the end of the cast, even those that are up to date.")
+    live_parser.add_argument("--catalog", help="Catalog the processed cast is registered in (default: as for run).")
+    live_parser.set_defaults(func=live_command)
+
+    batch_parser = subparsers.add_parser("batch", help="Process the casts of a manifest, resuming where an earlier run stopped.")
+    batch_parser.add_argument("--manifest", required=True, help=".csv or .json list of casts with raw_file, config and output_dir.")
+    batch_parser.add_argument("--config", help="Configuration for the casts the manifest gives none.")
+    batch_parser.add_argument("--journal", help="Journal file (default: <manifest>.journal.jsonl).")
+    batch_parser.add_argument("--jobs", type=int, default=1, help="Number of stages run at the same time, across casts (default: 1).")
+    batch_parser.add_argument("--retries", type=int, default=batch_manifest.MAX_ATTEMPTS - 1,
+                              help=f"Times a failed cast is tried again in this run (default: {batch_manifest.MAX_ATTEMPTS - 1}).")
+    batch_parser.add_argument("--retry-quarantined", action="store_true", help="Try the quarantined casts again.")
+    batch_parser.add_argument("--executables-dir", help="Override the configurations' executables_dir.")
+    batch_parser.add_argument("--force", action="store_true", help="Run every stage not in the journal, even those that are up to date.")
+    batch_parser.add_argument("--batch-size", type=int, default=1,
+                              help="Run each module that can once for up to this many casts (default: 1).")
+    batch_parser.add_argument("--catalog", help="Catalog the processed casts are registered in (default: none).")
+    batch_parser.set_defaults(func=batch_command)
+
+    coordinate_parser = subparsers.add_parser("coordinate", help="Queue the casts of a manifest for workers on other machines.")
+    coordinate_parser.add_argument("--spool", required=True, help="Spool directory shared with the workers.")
+    coordinate_parser.add_argument("--manifest", help=".csv or .json list of casts to queue (default: only follow the jobs already queued).")
+    coordinate_parser.add_argument("--config", help="Configuration for the casts the manifest gives none.")
+    coordinate_parser.add_argument("--lease", type=float, default=job_spool.LEASE_TIME,
+                                   help=f"Seconds without news from a worker after which its cast is queued again (default: {job_spool.LEASE_TIME}).")
+    coordinate_parser.add_argument("--attempts", type=int, default=batch_manifest.MAX_ATTEMPTS,
+                                   help=f"Attempts per cast, failed runs and expired leases included (default: {batch_manifest.MAX_ATTEMPTS}).")
+    coordinate_parser.set_defaults(func=coordinate_command)
+
+    work_parser = subparsers.add_parser("work", help="Process the casts queued in a spool directory on this machine.")
+    work_parser.add_argument("--spool", required=True, help="Spool directory shared with the coordinator.")
+    work_parser.add_argument("--jobs", type=int, default=1, help="Number of casts processed at the same time (default: 1).")
+    work_parser.add_argument("--name", help="Name of this worker (default: <host>-<process id>).")
+    work_parser.add_argument("--scratch", help="Local folder the casts are processed in (default: in the temporary directory).")
+    work_parser.add_argument("--executables-dir", help="Override the configurations' executables_dir on this machine.")
+    work_parser.add_argument("--exit-when-idle", action="store_true", help="Stop once no cast is queued or being processed.")
+    work_parser.set_defaults(func=work_command)
+
+    for subparser in (run_parser, watch_parser, live_parser, batch_parser):
+        subparser.add_argument("--timeout", type=float,
+                               help="Seconds a stage may run before it is killed, 0 for no limit (default: stage_timeout "
+                                    f"from the config, or {ctd_pipeline.STAGE_TIMEOUT}).")
+        subparser.add_argument("--stage-retries", type=int,
+                               help="Times a stage killed for running too long is run again (default: stage_retries "
+                                    f"from the config, or {ctd_pipeline.STAGE_RETRIES}).")
+        subparser.add_argument("--scratch",
+                               help="Local folder the stages work in; only the final products are copied to the output "
+                                    "directory (default: scratch_dir from the config, or none).")
+
+    plot_parser = subparsers.add_parser("plot", help="Plot .cnv files with Sea Plot .psa files, without SeaPlotW.")
+    plot_parser.add_argument("--psa", nargs="+", required=True, help="Sea Plot .psa files defining the plots.")
+    plot_parser.add_argument("--cnv", nargs="+", required=True, help=".cnv files or glob patterns to plot.")
+    plot_parser.add_argument("--output", required=True, help="Directory the images are written to.")
+    plot_parser.add_argument("--jobs", type=int, default=1, help="Number of worker processes (default: 1).")
+    plot_parser.add_argument("--format", choices=["png", "svg"], help="Image format (default: from the .psa output type).")
+    plot_parser.set_defaults(func=plot_command)
+
+    export_parser = subparsers.add_parser("export", help="Convert .cnv files to .npz files and a memory-mapped cruise dataset.")
+    export_parser.add_argument("--cnv", nargs="+", required=True, help=".cnv files or glob patterns to export.")
+    export_parser.add_argument("--output", help="Directory the <file>.cnv.npz files are written to.")
+    export_parser.add_argument("--dataset", help="Folder of the cruise dataset built from all the files.")
+    export_parser.set_defaults(func=export_command)
+
+    catalog_parser = subparsers.add_parser("catalog", help="Index processed casts in an SQLite catalog and query it.")
+    catalog_subparsers = catalog_parser.add_subparsers(dest="catalog_command", required=True)
+    index_parser = catalog_subparsers.add_parser("index", help="Register the casts of existing output directories.")
+    find_parser = catalog_subparsers.add_parser("find", help="List the casts matching every condition given.")
+    for subparser in (index_parser, find_parser):
+        catalog_file_group = subparser.add_mutually_exclusive_group(required=True)
+        catalog_file_group.add_argument("--catalog", help="Catalog file.")
+        catalog_file_group.add_argument("--config", help="Use the catalog of this configuration.")
+    index_parser.add_argument("--output", nargs="+", required=True, help="Output directories with processed casts.")
+    index_parser.add_argument("--raw-dir", nargs="+", help="Directories with the raw .hex, .hdr and .XMLCON files.")
+    index_parser.set_defaults(func=catalog_index_command)
+    find_parser.add_argument("--cast", help="Cast name, * and ? as wildcards.")
+    find_parser.add_argument("--cruise", help="Cruise name, * and ? as wildcards.")
+    find_parser.add_argument("--serial", help="Sensor serial number.")
+    find_parser.add_argument("--near", nargs=2, type=float, metavar=("LAT", "LON"), help="Position in decimal degrees.")
+    find_parser.add_argument("--radius", type=float, default=10.0, help="Distance from --near in km (default: 10).")
+    find_parser.add_argument("--since", help="Earliest NMEA time, e.g. 2025-07-23 or 2025-07-23T22:00.")
+    find_parser.add_argument("--until", help="Latest NMEA time.")
+    find_parser.add_argument("--limit", type=int, help="At most this many casts.")
+    find_parser.add_argument("--json", action="store_true", help="Print the casts as JSON.")
+    find_parser.set_defaults(func=catalog_find_command)
+
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,1205 @@
+import fnmatch
+import hashlib
+import heapq
+import json
+import os
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import threading
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import align_ctd
+import bin_average
+import bottle_summary
+import build_cache
+import cell_thermal_mass
+import cnv_corrections
+import datcnv
+import low_pass_filter
+import process_usage
+import psa_template
+import run_report
+import sbe_files
+import sea_plot
+import stage_graph
+import watch_folder
+
+# Folder (inside the output directory) holding one private working directory per cast
+WORK_DIR_NAME = ".ctd_work"
+
+# Stages run in-process instead of launching an SBE module. They are selected in the
+# executable dropdown like an executable; each module has run_psa(psa_path).
+# A module with correct(header, values, psa) also runs fused with its neighbours (see fused_chains()).
+NATIVE_STAGES = {"DatCnv (built-in)": datcnv, "AlignCTD (built-in)": align_ctd, "Filter (built-in)": low_pass_filter,
+                 "CellTM (built-in)": cell_thermal_mass, "BinAvg (built-in)": bin_average,
+                 "BottleSum (built-in)": bottle_summary, "SeaPlot (built-in)": sea_plot}
+
+# SBE modules that process every file of their PSA's <InputFileArray> in one run and name
+# each output after its input file, as a run for that cast alone does (see run_stage_batch()).
+# BottleSumW (<cast>.cnv.btl with /f) and SeaPlotW name their outputs differently and the
+# other modules are untested: they run once per cast.
+BATCH_MODULES = {"datcnvw.exe", "alignctdw.exe", "celltmw.exe", "filterw.exe", "loopeditw.exe", "wildeditw.exe",
+                 "derivew.exe", "binavgw.exe", "stripw.exe"}
+
+# Seconds a stage may run before it is killed (0: no limit), unless the configuration says
+# otherwise. SBE modules that hit an error dialog wait for a click that never comes.
+STAGE_TIMEOUT = 900
+# Times a stage killed for running too long is run again
+STAGE_RETRIES = 1
+
+
+def cast_name(raw_file):
+    """Return the cast base name (e.g. CTD01) for a raw .hex file."""
+    return os.path.splitext(os.path.basename(raw_file))[0]
+
+
+def executable_name(executable):
+    """Return the lower-case file name of an executable path saved on Windows or Linux."""
+    return re.split(r"[\\/]", executable)[-1].lower()
+
+
+def native_stage(executable):
+    """Return the module of a built-in stage, or None for an SBE executable."""
+    name = executable_name(executable)
+    for stage_name, module in NATIVE_STAGES.items():
+        if stage_name.lower() == name:
+            return module
+    return None
+
+
+def module_name(executable):
+    """Lower-case name of the SBE module a stage runs or, for a built-in stage, replaces (e.g. datcnvw.exe)."""
+    native = native_stage(executable)
+    return native.SBE_MODULE.lower() if native else executable_name(executable)
+
+
+def xmlcon_path(raw_file):
+    """
+    Return the XMLCON path that belongs to a raw .hex file: <cast>.XMLCON next to it, with
+    the extension and cast name in any case (Seasave writes .XMLCON, which only matches
+    .xmlcon on a case-insensitive file system). A missing file gives <CAST>.xmlcon.
+    """
+    raw_dir = os.path.dirname(raw_file)
+    base_name = cast_name(raw_file)
+    for xmlcon_file in (base_name + ".XMLCON", base_name + ".xmlcon", base_name.upper() + ".xmlcon"):
+        if os.path.isfile(os.path.join(raw_dir, xmlcon_file)):
+            return os.path.join(raw_dir, xmlcon_file)
+
+    expected = (base_name + ".xmlcon").lower()
+    try:
+        with os.scandir(raw_dir or ".") as entries:
+            for entry in entries:
+                if entry.name.lower() == expected:
+                    return os.path.join(raw_dir, entry.name)
+    except OSError:
+        pass
+    return os.path.join(raw_dir, base_name.upper() + ".xmlcon")
+
+
+def uses_xmlcon(executable):
+    """True for the modules given the cast's XMLCON with /c (DatCnvW, DeriveW and BottleSumW)."""
+    exe_basename = module_name(executable)
+    return "datcnvw" in exe_basename or "derivew" in exe_basename or "bottlesumw" in exe_basename
+
+
+def stage_input_file(executable, raw_file, output_file_dir):
+    """Return the file a stage reads: the raw .hex for DatCnvW, the .ros for BottleSumW, otherwise the .cnv."""
+    exe_basename = module_name(executable)
+    base_name = cast_name(raw_file)
+
+    if "datcnvw" in exe_basename:
+        return raw_file
+    elif "bottlesumw" in exe_basename:
+        return os.path.join(output_file_dir, f"{base_name}.ros")
+    return os.path.join(output_file_dir, f"{base_name}.cnv")
+
+
+def stage_psa_values(executable, raw_file, output_file_dir):
+    """
+    Return the PSA slot values (input_dir, output_dir, instrument_path, input_files, output_file)
+    for one (cast, stage), matching the command line built by build_command().
+    """
+    input_file = stage_input_file(executable, raw_file, output_file_dir)
+    input_dir = input_file if "bottlesumw" in module_name(executable) else os.path.dirname(input_file)
+    return (input_dir, output_file_dir, xmlcon_path(raw_file), [os.path.basename(input_file)],
+            f"{cast_name(raw_file)}.cnv")
+
+
+def prepare_cast_workdir(raw_file, stages, psa_dir, output_file_dir):
+    """
+    Create the private working directory for one cast and write its own rendered copy
+    of every selected PSA file into it. The shared PSA files in psa_dir are never modified,
+    so several casts can run at the same time.
+
+    Returns (work_dir, {psa_file: rendered_psa_path}).
+    """
+    work_dir = os.path.join(os.path.abspath(output_file_dir), WORK_DIR_NAME, cast_name(raw_file))
+    os.makedirs(work_dir, exist_ok=True)
+
+    rendered = {}
+    for psa_file, executable, _ in stages:
+        template = psa_template.compile_psa(os.path.join(psa_dir, psa_file))
+        psa_path = os.path.join(work_dir, psa_file)
+        rendered[psa_file] = template.write(psa_path, *stage_psa_values(executable, raw_file, output_file_dir))
+
+    return work_dir, rendered
+
+
+def build_command(executable, raw_file, output_file_dir, psa_file_path):
+    """Build the SBE module command line for one (cast, stage)."""
+    output_file = f"{cast_name(raw_file)}.cnv"
+    input_file = stage_input_file(executable, raw_file, output_file_dir)
+
+    command = [
+        executable,
+        f"/i{input_file}",
+        f"/o{output_file_dir}",
+        f"/f{output_file}",
+        f"/p{psa_file_path}",
+        "/s"
+    ]
+
+    # Append /c<XMLCON> only for DatCnvW, Derive, and bottlesum
+    if uses_xmlcon(executable):
+        command.append(f"/c{xmlcon_path(raw_file)}")
+
+    return command
+
+
+def build_batch_command(executable, output_file_dir, psa_file_path, xmlcon_file=None):
+    """
+    Build the command line running one SBE module for several casts: without /i and /f the
+    module reads the input directory and files of the PSA's <InputFileArray>.
+    """
+    command = [executable, f"/p{psa_file_path}", f"/o{output_file_dir}", "/s"]
+    if xmlcon_file and uses_xmlcon(executable):
+        command.append(f"/c{xmlcon_file}")
+    return command
+
+
+def load_config(config_file_path):
+    """Load a configuration file saved by the GUI."""
+    with open(config_file_path, "r") as config_file:
+        return json.load(config_file)
+
+
+def selected_stages(config, executables_dir=None):
+    """
+    Return the selected stages of a configuration as (psa_file, executable_path, order)
+    tuples sorted by order. The executable path is rebuilt from executables_dir (or the
+    config's executables_dir) and the saved executable name, as the GUI does.
+    Raises ValueError for a selected stage without an executable or with a bad order.
+    """
+    if executables_dir is None:
+        executables_dir = config.get("executables_dir", "")
+
+    stages = []
+    for psa_data in config.get("psa_files", []):
+        if not psa_data.get("selected"):
+            continue
+
+        psa_file = psa_data["psa_file"]
+        executable = psa_data.get("executable", "")
+        if not executable:
+            raise ValueError(f"No executable selected for {psa_file}.")
+        try:
+            order = int(psa_data["order"])
+        except (KeyError, ValueError):
+            raise ValueError(f"Invalid order number for {psa_file}.")
+
+        executable_path = os.path.join(executables_dir, re.split(r"[\\/]", executable)[-1])
+        stages.append((psa_file, executable_path, order))
+
+    stages.sort(key=lambda x: x[2])
+    return stages
+
+
+def notify(events, *event):
+    """Put a progress event on the events queue, if there is one."""
+    if events is not None:
+        events.put(event)
+
+
+def kill_process(process):
+    """Kill a running stage, with any process it started (taskkill /T on Windows, its process group elsewhere)."""
+    if sys.platform == "win32":
+        subprocess.run(["taskkill", "/F", "/T", "/PID", str(process.pid)], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        return
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except OSError:
+        process.kill()
+
+
+def stream_output(pipe, lines, prefix):
+    """Collect a child's output line by line, echoing it as it arrives."""
+    for line in pipe:
+        lines.append(line)
+        print(f"{prefix}{line}", end="")
+    pipe.close()
+
+
+def run_command(command, work_dir, cancel_event=None, prefix="", timeout=None):
+    """
+    Run one stage and wait for it, killing it (and the processes it started) if cancel_event
+    is set or it runs longer than timeout seconds. stdout and stderr are streamed (echoed
+    with prefix) while the stage runs.
+    Returns (returncode, stdout, stderr, stopped, usage): stopped is None, "cancelled" or
+    "timeout", usage the module's {"cpu_time", "max_rss_mb"} (see process_usage.py).
+    """
+    # The module is started directly from its argv: no command shell is launched first. In a
+    # process group of its own (on POSIX), so kill_process() reaches whatever it started.
+    process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, errors="replace",
+                               cwd=work_dir, start_new_session=sys.platform != "win32")
+    watch = process_usage.ProcessUsage(process)
+    stdout_lines, stderr_lines = [], []
+    readers = [threading.Thread(target=stream_output, args=(process.stdout, stdout_lines, prefix), daemon=True),
+               threading.Thread(target=stream_output, args=(process.stderr, stderr_lines, prefix), daemon=True)]
+    for reader in readers:
+        reader.start()
+
+    stopped = None
+    deadline = time.monotonic() + timeout if timeout else None
+    # Polled at growing intervals, as Popen.wait() does: most modules end within a second
+    delay = 0.001
+    try:
+        while watch.poll() is None:
+            if cancel_event is not None and cancel_event.is_set():
+                stopped = "cancelled"
+            elif deadline is not None and time.monotonic() > deadline:
+                stopped = "timeout"
+                print(f"{prefix}{os.path.basename(command[0])} still running after {timeout:g} s, killing it", file=sys.stderr)
+            if stopped:
+                kill_process(process)
+                watch.wait()
+                break
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+    finally:
+        watch.close()
+
+    for reader in readers:
+        # A process the module started may still hold the pipes open: do not wait on it forever
+        reader.join(None if stopped is None else 5)
+    return process.returncode, "".join(stdout_lines), "".join(stderr_lines), stopped, watch.usage()
+
+
+def run_native(run, *args, prefix=""):
+    """
+    Run a built-in stage in-process: run(*args) (e.g. a module's run_psa(psa_path)) returns a
+    one-line summary. Returns (returncode, stdout, stderr, stopped, usage) like run_command().
+    """
+    start = time.thread_time()
+    try:
+        message = run(*args)
+    except Exception as e:
+        return 1, "", f"{type(e).__name__}: {e}", None, {"cpu_time": round(time.thread_time() - start, 3), "max_rss_mb": None}
+    print(f"{prefix}{message}")
+    return 0, message + "\n", "", None, {"cpu_time": round(time.thread_time() - start, 3), "max_rss_mb": None}
+
+
+def stage_dependencies(config):
+    """{psa_file: [psa files it must run after]} from the optional "after" lists of a configuration."""
+    dependencies = {}
+    for psa_data in config.get("psa_files", []):
+        after = psa_data.get("after")
+        if after:
+            dependencies[psa_data["psa_file"]] = [after] if isinstance(after, str) else list(after)
+    return dependencies
+
+
+class StageLimits:
+    """
+    How long each stage may run before it is killed: timeout seconds (0 or None: no limit),
+    or timeouts[psa_file] for the stages that have their own. A stage killed that way is run
+    again up to retries times.
+    """
+
+    def __init__(self, timeout=STAGE_TIMEOUT, retries=STAGE_RETRIES, timeouts=None):
+        self.default_timeout = timeout
+        self.retries = max(0, int(retries or 0))
+        self.timeouts = dict(timeouts or {})
+
+    def timeout(self, psa_file):
+        timeout = self.timeouts.get(psa_file, self.default_timeout)
+        return float(timeout) if timeout else None
+
+
+def stage_limits(config, timeout=None, retries=None):
+    """
+    The StageLimits of a configuration: its "stage_timeout" and "stage_retries" (or timeout
+    and retries, when given) and the optional "timeout" of each PSA file entry.
+    """
+    timeouts = {psa_data["psa_file"]: psa_data["timeout"] for psa_data in config.get("psa_files", [])
+                if psa_data.get("timeout") is not None}
+    return StageLimits(timeout if timeout is not None else config.get("stage_timeout", STAGE_TIMEOUT),
+                       retries if retries is not None else config.get("stage_retries", STAGE_RETRIES), timeouts)
+
+
+def publish_files(source_dir, names, output_dir):
+    """
+    Copy files to output_dir, each under a temporary name first and then renamed over its
+    destination, so a reader of output_dir never sees a partly written file.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    for name in names:
+        tmp_path = os.path.join(output_dir, name + ".tmp")
+        shutil.copyfile(os.path.join(source_dir, name), tmp_path)
+        os.replace(tmp_path, os.path.join(output_dir, name))
+
+
+class Workspace:
+    """
+    A scratch folder on fast local storage where the stages of a run read and write every
+    intermediate file, instead of the output directory (often a network share). Once all
+    the stages of a cast are done, only its final products are published to the output
+    directory (see publish_files()), and its files are removed from the scratch folder; a
+    cast that failed leaves nothing in the output directory.
+
+    The products are the cast files matching publish, file name patterns with {cast} (e.g.
+    "{cast}_avg.cnv", "{cast}*.png"), by default those the pipeline writes last and no stage
+    reads afterwards (see stage_graph.StageGraph.products()). The scratch folder has one
+    folder per output directory, kept from run to run for the build cache.
+    """
+
+    def __init__(self, scratch_dir, output_dir, publish=None):
+        self.output_dir = os.path.abspath(output_dir)
+        digest = hashlib.sha1(self.output_dir.encode("utf-8")).hexdigest()[:8]
+        self.path = os.path.join(os.path.abspath(scratch_dir), f"{os.path.basename(self.output_dir)}_{digest}")
+        self.patterns = list(publish or [])
+
+    def prepare(self, raw_files, graph):
+        """
+        Create the scratch folder and copy into it the files the casts need that no stage
+        writes (e.g. <cast>.cnv for a pipeline starting after DatCnv), from the output directory.
+        """
+        os.makedirs(self.path, exist_ok=True)
+        if not self.patterns:
+            self.patterns = graph.products()
+        for raw_file in raw_files:
+            for patterns in graph.external:
+                for pattern in patterns:
+                    name = stage_graph.cast_pattern(pattern, cast_name(raw_file))
+                    if os.path.isfile(os.path.join(self.output_dir, name)):
+                        shutil.copy2(os.path.join(self.output_dir, name), os.path.join(self.path, name))
+
+    def products(self, base_name):
+        """The names of the files of a cast in the scratch folder that are published."""
+        patterns = [stage_graph.cast_pattern(pattern, base_name).lower() for pattern in self.patterns]
+        return sorted(name for name in build_cache.list_cast_files(self.path, base_name)
+                      if any(fnmatch.fnmatchcase(name.lower(), pattern) for pattern in patterns))
+
+    def publish(self, base_name):
+        """Publish the products of a cast whose stages are all done and clear its files from the scratch folder. Returns their names."""
+        names = self.products(base_name)
+        publish_files(self.path, names, self.output_dir)
+        for name in build_cache.list_cast_files(self.path, base_name):
+            os.remove(os.path.join(self.path, name))
+        return names
+
+
+def workspace(config, output_file_dir, scratch_dir=None):
+    """
+    The Workspace of a configuration: in its "scratch_dir" (or scratch_dir, when given),
+    publishing its "publish" patterns. None, to work in the output directory, without one.
+    """
+    scratch_dir = scratch_dir or config.get("scratch_dir")
+    return Workspace(scratch_dir, output_file_dir, config.get("publish")) if scratch_dir else None
+
+
+def pipeline_graph(stages, psa_dir, after=None):
+    """The dependency graph (a stage_graph.StageGraph) of the selected stages."""
+    return stage_graph.StageGraph(stages, [module_name(executable) for _, executable, _ in stages],
+                                  [os.path.join(psa_dir, psa_file) for psa_file, *_ in stages], after)
+
+
+def check_stages(stages, psa_dir):
+    """
+    Check what the selected stages need whatever the cast: a readable PSA file written for
+    the module the stage runs (e.g. <Bin_Average> for BinAvgW) and an existing executable.
+    Returns ({psa_file: sbe_files.PsaFile}, error messages).
+    """
+    known_modules = {module.lower() for module in sbe_files.PSA_ROOTS.values()}
+    psas, errors = {}, []
+    for psa_file, executable, _ in stages:
+        try:
+            psa = psas[psa_file] = sbe_files.load_psa(os.path.join(psa_dir, psa_file))
+        except (OSError, ET.ParseError) as e:
+            errors.append(f"{psa_file}: cannot read the PSA file: {e}")
+            continue
+
+        module = module_name(executable)
+        if psa.module and module in known_modules and psa.module.lower() != module:
+            chosen = re.split(r"[\\/]", executable)[-1]
+            errors.append(f"{psa_file}: a <{psa.tag}> PSA is for {psa.module}, not {chosen}")
+        if not native_stage(executable) and not os.path.isfile(executable):
+            errors.append(f"{psa_file}: executable not found at: {executable}")
+    return psas, errors
+
+
+def check_cast(raw_file, stages, psas, graph, existing):
+    """
+    Check the files one cast needs before anything runs: the raw .hex, the XMLCON for the
+    modules that use it (with a sensor for every variable their PSA computes), the .bl file
+    when Data Conversion writes a .ros file, and the inputs no stage of the pipeline writes
+    (existing holds the lower-case names in the output directory). Returns error messages.
+    """
+    base_name = cast_name(raw_file)
+    errors = []
+    if not os.path.isfile(raw_file):
+        errors.append(f"{base_name}: raw file not found: {raw_file}")
+
+    for psa_file, executable, _ in stages:
+        psa = psas[psa_file]
+        if uses_xmlcon(executable):
+            xmlcon_file = xmlcon_path(raw_file)
+            try:
+                xmlcon = sbe_files.load_xmlcon(xmlcon_file)
+            except (OSError, ET.ParseError, ValueError) as e:
+                errors.append(f"{base_name}: {psa_file} needs the XMLCON: {e}")
+            else:
+                for tag, needed, full_name in xmlcon.missing_sensors(psa.variables):
+                    errors.append(f"{base_name}: {psa_file} needs {needed} {tag} for '{full_name}', "
+                                  f"{os.path.basename(xmlcon_file)} has {xmlcon.sensors.count(tag)}")
+        if module_name(executable) == "datcnvw.exe" and psa.value("CreateFile", "0") in ("1", "2"):
+            bl_file = os.path.splitext(raw_file)[0] + ".bl"
+            if not os.path.isfile(bl_file):
+                errors.append(f"{base_name}: {psa_file} writes a .ros file, which needs {bl_file}")
+
+    for psa_file, name in graph.missing_inputs(base_name, existing):
+        errors.append(f"{base_name}: {psa_file} needs {name}, which no earlier stage writes and is not in the output directory")
+    return errors
+
+
+def preflight(raw_files, stages, psa_dir, output_file_dir, after=None):
+    """
+    Check every (cast, stage) before anything is launched (see check_stages() and
+    check_cast()) and build the stage dependency graph. A problem with a stage stops the
+    whole batch; a problem with a cast leaves only that cast out.
+    PSA and XMLCON files are parsed once (sbe_files caches them by path and modification time).
+    Returns (graph or None, raw files that can run, error messages).
+    """
+    psas, errors = check_stages(stages, psa_dir)
+    if errors:
+        return None, [], errors
+    try:
+        graph = pipeline_graph(stages, psa_dir, after)
+    except ValueError as e:
+        return None, [], [str(e)]
+
+    existing = {name.lower() for name in os.listdir(output_file_dir)} if os.path.isdir(output_file_dir) else set()
+    runnable = []
+    for raw_file in raw_files:
+        cast_errors = check_cast(raw_file, stages, psas, graph, existing)
+        if cast_errors:
+            errors.extend(cast_errors)
+        else:
+            runnable.append(raw_file)
+    return graph, runnable, errors
+
+
+class CastRun:
+    """One cast going through the pipeline: its working directory, rendered PSA files and build cache."""
+
+    def __init__(self, raw_file, stages, psa_dir, output_file_dir, incremental=False):
+        self.raw_file = raw_file
+        self.base_name = cast_name(raw_file)
+        self.work_dir, self.rendered = prepare_cast_workdir(raw_file, stages, psa_dir, output_file_dir)
+        self.cache = build_cache.CastCache(output_file_dir, self.base_name) if incremental else None
+
+
+def stage_signature(cast, index, graph, output_file_dir):
+    """(cache key, build cache signature) of one (cast, stage), from the cast's own rendered PSA."""
+    psa_file, executable, _ = graph.stages[index]
+    native = native_stage(executable)
+    signature = cast.cache.signature(psa_file, cast.rendered[psa_file], stage_input_file(executable, cast.raw_file, output_file_dir),
+                                     xmlcon_path(cast.raw_file), native.__file__ if native else executable)
+    return f"{index}:{psa_file}", signature
+
+
+def skip_up_to_date(cast, index, graph, key, command, events=None, report=None):
+    psa_file, executable, _ = graph.stages[index]
+    print(f"[{cast.base_name}] {psa_file} is up to date, skipping {executable}")
+    cast.cache.skip(key)
+    notify(events, "stage", cast.base_name, psa_file, "skipped")
+    if report:
+        now = time.time()
+        report.record_stage(cast.base_name, psa_file, executable, command, now, now, None, "skipped")
+
+
+def file_state(path):
+    """(size, mtime) of a file, or None if it does not exist."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def restore_input(cast, input_file, state):
+    """
+    Put back the input of a stage killed by its timeout so it can run again, from the build
+    cache if the cast has one. Returns False when the input is no longer what the stage
+    started from (a module rewriting <cast>.cnv may have written part of it).
+    """
+    if cast.cache:
+        cast.cache.materialize({os.path.basename(input_file)})
+    return file_state(input_file) == state
+
+
+def run_stage(cast, index, graph, output_file_dir, events=None, cancel_event=None, report=None, limits=None):
+    """
+    Run one stage of a cast, or skip it when its cache entry is up to date. A stage running
+    longer than its timeout is killed and run again, up to limits.retries times (see StageLimits).
+    Returns the error message, or None when the stage ran (or was skipped).
+    """
+    psa_file, executable, _ = graph.stages[index]
+    base_name = cast.base_name
+    psa_path = cast.rendered[psa_file]
+    command = build_command(executable, cast.raw_file, output_file_dir, psa_path)
+    input_file = stage_input_file(executable, cast.raw_file, output_file_dir)
+    native = native_stage(executable)
+    cache = cast.cache
+    limits = limits or StageLimits()
+    timeout = limits.timeout(psa_file)
+
+    if cache:
+        key, signature = stage_signature(cast, index, graph, output_file_dir)
+        if cache.is_up_to_date(key, signature):
+            skip_up_to_date(cast, index, graph, key, command, events, report)
+            return None
+        before = cache.before_run(input_file)
+
+    input_state = file_state(input_file)
+    attempt = 0
+    while True:
+        attempt += 1
+        print(f"[{base_name}] Running {executable} for {psa_file}" + (f" (attempt {attempt})" if attempt > 1 else ""))
+        notify(events, "stage", base_name, psa_file, "running")
+        status = "failed"
+        error = None
+        returncode, stdout, stderr, usage = None, "", "", None
+        start = time.time()
+
+        try:
+            if native:
+                returncode, stdout, stderr, stopped, usage = run_native(native.run_psa, psa_path, prefix=f"[{base_name}] ")
+            else:
+                returncode, stdout, stderr, stopped, usage = run_command(command, cast.work_dir, cancel_event,
+                                                                         f"[{base_name}] ", timeout)
+            if stopped == "cancelled":
+                status = "cancelled"
+                error = f"{base_name}: {executable} for {psa_file} was cancelled"
+            elif stopped == "timeout":
+                status = "timeout"
+                error = f"{base_name}: {executable} for {psa_file} was killed after running for {timeout:g} s"
+            elif returncode != 0:
+                error = f"{base_name}: error running {executable} for {psa_file}: {stderr}"
+            else:
+                status = "done"
+                print(f"[{base_name}] {executable} ran successfully for {psa_file}")
+        except FileNotFoundError:
+            error = f"{base_name}: executable not found at: {command[0]}"
+        except Exception as e:
+            error = f"{base_name}: an unexpected error occurred: {str(e)}"
+
+        if report:
+            report.record_stage(base_name, psa_file, executable, command, start, time.time(), returncode, status, stdout,
+                                stderr, usage, attempt)
+        notify(events, "stage", base_name, psa_file, status)
+        if status != "timeout" or attempt > limits.retries:
+            break
+        if not restore_input(cast, input_file, input_state):
+            error += f" (not run again: {os.path.basename(input_file)} was modified)"
+            break
+        notify(events, "error", f"{error}, running it again")
+
+    if error:
+        notify(events, "error", error)
+        if cache:
+            cache.discard(key)
+        return error
+    if cache:
+        # Other stages of the cast may have written files meanwhile: keep only this stage's outputs
+        cache.after_run(key, signature, before, lambda names: graph.outputs(index, base_name, names))
+    return None
+
+
+def fused_chains(graph):
+    """
+    Runs of built-in correction stages (modules with correct(), e.g. AlignCTD, Filter and
+    CellTM) that can work on one in-memory array: each stage after the first reads the
+    <cast>.cnv the stage before it writes, depends on it alone and is its only dependent.
+    Returns {first stage: [stages of the run, in order]} for the runs of two or more stages.
+    """
+    def fusable(s):
+        return hasattr(native_stage(graph.stages[s][1]), "correct")
+
+    chains, fused = {}, set()
+    for s in graph.order:
+        if s in fused or not fusable(s):
+            continue
+        chain = [s]
+        while len(graph.dependents[chain[-1]]) == 1:
+            after = graph.dependents[chain[-1]][0]
+            if not fusable(after) or graph.depends[after] != {chain[-1]} or \
+                    graph.files[after][0] != graph.files[chain[-1]][1]:
+                break
+            chain.append(after)
+        if len(chain) > 1:
+            chains[s] = chain
+            fused.update(chain)
+    return chains
+
+
+def cast_chain(cast, s, chains, graph, completed=()):
+    """
+    The fused run starting at stage s for a cast, or None when its stages run one at a time:
+    with a build cache (every stage keeps its own snapshot of <cast>.cnv) or when an earlier
+    run already did some of them (completed holds their psa files).
+    """
+    chain = chains.get(s)
+    if chain is None or cast.cache is not None or any(graph.stages[t][0] in completed for t in chain):
+        return None
+    return chain
+
+
+def run_fused(cast, chain, graph, output_file_dir, events=None, report=None):
+    """
+    Run a chain of built-in corrections (see fused_chains()) for a cast in one pass: <cast>.cnv
+    is read once, every correction is applied to the same array and the file is written once.
+    Each stage is reported as if it had run on its own, with an even share of the pass's time.
+    Returns the error message, or None.
+    """
+    base_name = cast.base_name
+    psa_files = [graph.stages[s][0] for s in chain]
+    names = " + ".join(psa_files)
+    steps = [(native_stage(graph.stages[s][1]).correct, cast.rendered[graph.stages[s][0]]) for s in chain]
+
+    print(f"[{base_name}] Running {names} in one pass")
+    for psa_file in psa_files:
+        notify(events, "stage", base_name, psa_file, "running")
+    start = time.time()
+    returncode, stdout, stderr, _, usage = run_native(cnv_corrections.run_chain, steps, prefix=f"[{base_name}] ")
+    end = time.time()
+    status = "done" if returncode == 0 else "failed"
+    error = None if returncode == 0 else f"{base_name}: error running {names}: {stderr}"
+
+    share = (end - start) / len(chain)
+    usage = {"cpu_time": round(usage["cpu_time"] / len(chain), 3), "max_rss_mb": None}
+    for n, s in enumerate(chain):
+        psa_file, executable, _ = graph.stages[s]
+        if report:
+            report.record_stage(base_name, psa_file, executable, build_command(executable, cast.raw_file, output_file_dir,
+                                                                                cast.rendered[psa_file]),
+                                start + n * share, start + (n + 1) * share, returncode, status, stdout, stderr, usage)
+        notify(events, "stage", base_name, psa_file, status)
+    if error:
+        notify(events, "error", error)
+    else:
+        print(f"[{base_name}] {names} ran successfully")
+    return error
+
+
+def can_batch(executable):
+    """True for the stages run by an SBE module that can process several casts in one run (BATCH_MODULES)."""
+    return not native_stage(executable) and module_name(executable) in BATCH_MODULES
+
+
+def batch_groups(casts, executable):
+    """
+    Split the casts of one stage into the groups one module run can process: their inputs in
+    the same directory and, for the modules given the XMLCON, the same XMLCON content.
+    """
+    groups = {}
+    for cast in casts:
+        key = (os.path.dirname(os.path.abspath(stage_input_file(executable, cast.raw_file, ""))),
+               build_cache.file_hash(xmlcon_path(cast.raw_file)) if uses_xmlcon(executable) else None)
+        groups.setdefault(key, []).append(cast)
+    return list(groups.values())
+
+
+def run_stage_batch(casts, index, graph, output_file_dir, events=None, cancel_event=None, report=None, limits=None):
+    """
+    Run one stage for several casts with a single launch of its SBE module: one PSA lists
+    the input file of every cast that is not up to date (see run_stage()) and the module
+    writes each cast's output as a run for that cast alone would. The run may take the
+    stage's timeout once per cast.
+
+    A cast the module wrote nothing for (e.g. it stopped at an earlier file) is run again
+    on its own; a cast whose output was written by a module run that failed has failed,
+    unless the run was killed by its timeout and limits allow retries.
+    Returns {cast: error message or None}.
+    """
+    psa_file, executable, _ = graph.stages[index]
+    limits = limits or StageLimits()
+    results, todo, keys = {}, [], {}
+    for cast in casts:
+        if cast.cache:
+            keys[cast] = stage_signature(cast, index, graph, output_file_dir)
+            if cast.cache.is_up_to_date(*keys[cast]):
+                skip_up_to_date(cast, index, graph, keys[cast][0],
+                                build_command(executable, cast.raw_file, output_file_dir, cast.rendered[psa_file]),
+                                events, report)
+                results[cast] = None
+                continue
+        todo.append(cast)
+    if len(todo) < 2:
+        for cast in todo:
+            results[cast] = run_stage(cast, index, graph, output_file_dir, events, cancel_event, report, limits)
+        return results
+
+    befores = {cast: cast.cache.before_run(stage_input_file(executable, cast.raw_file, output_file_dir))
+               for cast in todo if cast.cache}
+    input_files = [stage_input_file(executable, cast.raw_file, output_file_dir) for cast in todo]
+    input_states = {cast: file_state(input_file) for cast, input_file in zip(todo, input_files)}
+    timeout = limits.timeout(psa_file)
+    work_dir = os.path.join(os.path.abspath(output_file_dir), WORK_DIR_NAME, "batch", f"{todo[0].base_name}_{len(todo)}")
+    os.makedirs(work_dir, exist_ok=True)
+    # The cast's rendered PSA has every setting; only the input files differ
+    psa_path = psa_template.compile_psa(todo[0].rendered[psa_file]).write(
+        os.path.join(work_dir, psa_file), os.path.dirname(input_files[0]), output_file_dir,
+        xmlcon_path(todo[0].raw_file), [os.path.basename(input_file) for input_file in input_files],
+        f"{todo[0].base_name}.cnv")
+    command = build_batch_command(executable, output_file_dir, psa_path, xmlcon_path(todo[0].raw_file))
+    names = ", ".join(cast.base_name for cast in todo)
+
+    print(f"[{names}] Running {executable} for {psa_file} ({len(todo)} casts in one run)")
+    for cast in todo:
+        notify(events, "stage", cast.base_name, psa_file, "running")
+    before = build_cache.list_output_files(output_file_dir)
+    start = time.time()
+    try:
+        returncode, stdout, stderr, stopped, usage = run_command(command, work_dir, cancel_event, f"[{names}] ",
+                                                                 timeout and timeout * len(todo))
+    except FileNotFoundError:
+        returncode, stdout, stderr, stopped, usage = None, "", f"executable not found at: {command[0]}", None, None
+    except Exception as e:
+        returncode, stdout, stderr, stopped, usage = None, "", f"an unexpected error occurred: {str(e)}", None, None
+    end = time.time()
+    after = build_cache.list_output_files(output_file_dir)
+    changed = [name for name, stat in after.items() if before.get(name) != stat]
+
+    fallback = []
+    for cast in todo:
+        written = graph.outputs(index, cast.base_name, changed)
+        status, error = "failed", None
+        if stopped == "cancelled":
+            status = "cancelled"
+            error = f"{cast.base_name}: {executable} for {psa_file} was cancelled"
+        elif stopped == "timeout":
+            # The casts it had not reached are run on their own, like those of a run that failed
+            status = "timeout"
+            error = f"{cast.base_name}: {executable} for {psa_file} was killed after running for {timeout * len(todo):g} s"
+            if not written or (limits.retries and restore_input(cast, input_files[todo.index(cast)], input_states[cast])):
+                fallback.append(cast)
+        elif not written:
+            fallback.append(cast)
+            continue
+        elif returncode != 0:
+            error = f"{cast.base_name}: error running {executable} for {psa_file} (with {len(todo) - 1} other casts): {stderr}"
+        else:
+            status = "done"
+            print(f"[{cast.base_name}] {executable} ran successfully for {psa_file}")
+
+        if report:
+            report.record_stage(cast.base_name, psa_file, executable, command, start, end, returncode, status, stdout, stderr,
+                                usage, run_casts=len(todo))
+        notify(events, "stage", cast.base_name, psa_file, status)
+        if cast in fallback:
+            continue
+        if error:
+            notify(events, "error", error)
+            if cast.cache:
+                cast.cache.discard(keys[cast][0])
+        elif cast.cache:
+            cast.cache.after_run(keys[cast][0], keys[cast][1], befores[cast],
+                                 lambda names, cast=cast: graph.outputs(index, cast.base_name, names))
+        results[cast] = error
+
+    for cast in fallback:
+        print(f"[{cast.base_name}] {executable} did not finish {psa_file} in the batch run, running it for this cast alone")
+        results[cast] = run_stage(cast, index, graph, output_file_dir, events, cancel_event, report, limits)
+    return results
+
+
+def resume_stage(cast, index, graph, events=None, report=None):
+    """
+    Account for a stage done in an earlier, interrupted run (see batch_manifest.py) without
+    running it. Its build cache entry, if any, is taken as up to date so the inputs of the
+    next stages are restored from the cache when needed. Returns None, like run_stage().
+    """
+    psa_file, executable, _ = graph.stages[index]
+    key = f"{index}:{psa_file}"
+    if cast.cache and key in cast.cache.entries:
+        cast.cache.skip(key)
+    print(f"[{cast.base_name}] {psa_file} was done in an earlier run, skipping {executable}")
+    notify(events, "stage", cast.base_name, psa_file, "skipped")
+    if report:
+        now = time.time()
+        report.record_stage(cast.base_name, psa_file, executable, [], now, now, None, "skipped")
+    return None
+
+
+def finish_cast(cast, stages, psa_dir, output_file_dir, catalog=None, workspace=None, report=None):
+    """
+    Wrap up a cast whose every stage is done: publish its products from the workspace (a
+    Workspace), if any, register it in the catalog and record it in report. Returns the
+    error message, or None.
+    """
+    if cast.cache:
+        # Put back final products that only exist in the cache (e.g. deleted by hand)
+        cast.cache.materialize()
+    if workspace:
+        try:
+            names = workspace.publish(cast.base_name)
+        except OSError as e:
+            error = f"{cast.base_name}: could not publish its products to {workspace.output_dir}: {e}"
+            if report:
+                report.record_cast(cast.base_name, "failed", error)
+            return error
+        print(f"[{cast.base_name}] Published {', '.join(names) or 'no files'} to {workspace.output_dir}")
+        output_file_dir = workspace.output_dir
+    if catalog:
+        try:
+            catalog.register_cast(cast.raw_file, output_file_dir, stages, psa_dir)
+        except Exception as e:
+            # The cast is processed all the same; index_folder() can catch up later
+            print(f"[{cast.base_name}] Could not be added to the catalog: {e}", file=sys.stderr)
+    if report:
+        report.record_cast(cast.base_name, "done")
+    return None
+
+
+def run_batches(raw_files, graph, psa_dir, output_file_dir, batch_size, jobs=1, incremental=False, events=None,
+                cancel_event=None, report=None, completed=None, journal=None, catalog=None, limits=None, workspace=None):
+    """
+    Run the pipeline on chunks of batch_size casts, up to jobs chunks at a time. Each chunk
+    goes through the stages in dependency order, one stage for all its casts before the
+    next; a stage whose module can process several casts (can_batch()) is run once for the
+    chunk (see run_stage_batch()), any other stage once per cast. Arguments and result as
+    for run_pipeline().
+    """
+    completed = completed or {}
+    stages = graph.stages
+    chains = fused_chains(graph)
+
+    def cancelled():
+        return cancel_event is not None and cancel_event.is_set()
+
+    def run_chunk(chunk):
+        errors, casts = [], {}
+        for c in chunk:
+            try:
+                casts[c] = CastRun(raw_files[c], stages, psa_dir, output_file_dir, incremental)
+            except Exception as e:
+                errors.append(f"{cast_name(raw_files[c])}: failed to prepare PSA files: {e}")
+                notify(events, "error", errors[-1])
+                if report:
+                    report.record_cast(cast_name(raw_files[c]), "failed", errors[-1])
+        done = {c: set() for c in casts}
+
+        for n, s in enumerate(graph.order):
+            psa_file, executable, _ = stages[s]
+            if cancelled():
+                for later in graph.order[n:]:
+                    for cast in casts.values():
+                        notify(events, "stage", cast.base_name, stages[later][0], "cancelled")
+                break
+
+            # A cast whose stage failed is left out of the stages depending on it; one that
+            # went through a fused run (see run_fused()) has done the later stages of the run
+            ready = [c for c in casts if graph.depends[s] <= done[c] and s not in done[c]]
+            results, fused = {}, {}
+            for c in [c for c in ready if psa_file in completed.get(c, ())]:
+                results[c] = resume_stage(casts[c], s, graph, events, report)
+            for c in [c for c in ready if c not in results]:
+                fused[c] = cast_chain(casts[c], s, chains, graph, completed.get(c, ()))
+                if fused[c]:
+                    results[c] = run_fused(casts[c], fused[c], graph, output_file_dir, events, report)
+            todo = [c for c in ready if c not in results]
+            if can_batch(executable):
+                by_cast = {casts[c]: c for c in todo}
+                for group in batch_groups([casts[c] for c in todo], executable):
+                    for cast, error in run_stage_batch(group, s, graph, output_file_dir, events, cancel_event, report,
+                                                       limits).items():
+                        results[by_cast[cast]] = error
+            else:
+                for c in todo:
+                    results[c] = run_stage(casts[c], s, graph, output_file_dir, events, cancel_event, report, limits)
+
+            for c in sorted(results):
+                error = results[c]
+                run = fused.get(c) or [s]
+                if journal and (c in todo or fused.get(c)) and not (error and cancelled()):
+                    for t in run:
+                        journal.record_stage(raw_files[c], stages[t][0], "failed" if error else "done", error)
+                if error:
+                    errors.append(error)
+                else:
+                    done[c].update(run)
+
+        for c, cast in casts.items():
+            if len(done[c]) == len(stages):
+                error = finish_cast(cast, stages, psa_dir, output_file_dir, catalog, workspace, report)
+                if error:
+                    errors.append(error)
+                    notify(events, "error", error)
+        return errors
+
+    chunks = [list(range(n, min(n + batch_size, len(raw_files)))) for n in range(0, len(raw_files), batch_size)]
+    errors = []
+    with ThreadPoolExecutor(max_workers=max(1, int(jobs))) as pool:
+        for chunk_errors in pool.map(run_chunk, chunks):
+            errors.extend(chunk_errors)
+    return errors
+
+
+def run_pipeline(raw_files, graph, psa_dir, output_file_dir, jobs=1, incremental=False, events=None, cancel_event=None,
+                 report=None, completed=None, journal=None, catalog=None, batch_size=1, limits=None, workspace=None):
+    """
+    Run the (cast, stage) tasks of every cast on a pool of jobs workers. A task starts as soon
+    as the stages it depends on (see stage_graph.StageGraph) are done for its cast, earlier
+    casts first: the next cast's DatCnv overlaps the previous cast's Derive, and independent
+    stages of a cast run side by side. With jobs=1 the casts run one after the other, each
+    stage in order. Consecutive built-in corrections run as one task (see run_fused()).
+
+    When a stage fails, the stages depending on it are not run for that cast; its other
+    stages are. completed ({cast index: psa files}) lists stages done by an earlier run,
+    which are not run again (see resume_stage()); journal.record_stage(raw_file, psa_file,
+    status, error) is called as each stage that runs is done or has failed. Once every stage
+    of a cast is done it is registered in catalog (a cast_catalog.CastCatalog), if given.
+    limits (a StageLimits) sets how long a stage may run and how often it is run again
+    after being killed for running too long. With batch_size > 1 the casts are processed in chunks instead (see
+    run_batches()), at most len(raw_files) / jobs casts each, so every worker gets a chunk.
+    With a workspace (a Workspace), output_file_dir is its scratch folder and each cast's
+    products are published to the output directory once its stages are all done.
+    Returns the list of error messages.
+    """
+    # Fewer chunks than workers would leave workers idle: the chunks are made smaller instead
+    batch_size = min(batch_size, -(-len(raw_files) // max(1, int(jobs))))
+    if batch_size > 1 and len(raw_files) > 1:
+        return run_batches(raw_files, graph, psa_dir, output_file_dir, batch_size, jobs, incremental, events,
+                           cancel_event, report, completed, journal, catalog, limits, workspace)
+    completed = completed or {}
+    stages = graph.stages
+    chains = fused_chains(graph)
+    position = {stage: n for n, stage in enumerate(graph.order)}
+    errors = []
+    casts = {}  # cast index -> CastRun (None if it could not be prepared), made when its first stage starts
+    remaining = {}  # (cast index, stage) -> number of its dependencies not done yet
+    ready = []  # heap of (cast index, position in graph.order, stage)
+    done = {}  # cast index -> number of stages done
+
+    for c in range(len(raw_files)):
+        for s in range(len(stages)):
+            if graph.depends[s]:
+                remaining[(c, s)] = len(graph.depends[s])
+            else:
+                heapq.heappush(ready, (c, position[s], s))
+
+    def cancelled():
+        return cancel_event is not None and cancel_event.is_set()
+
+    with ThreadPoolExecutor(max_workers=max(1, int(jobs))) as pool:
+        running = {}
+        while ready or running:
+            while ready and len(running) < max(1, int(jobs)) and not cancelled():
+                c, _, s = heapq.heappop(ready)
+                if c not in casts:
+                    try:
+                        casts[c] = CastRun(raw_files[c], stages, psa_dir, output_file_dir, incremental)
+                    except Exception as e:
+                        casts[c] = None
+                        errors.append(f"{cast_name(raw_files[c])}: failed to prepare PSA files: {e}")
+                        notify(events, "error", errors[-1])
+                        if report:
+                            report.record_cast(cast_name(raw_files[c]), "failed", errors[-1])
+                if casts[c] is None:
+                    continue
+                chain = cast_chain(casts[c], s, chains, graph, completed.get(c, ()))
+                if stages[s][0] in completed.get(c, ()):
+                    running[pool.submit(resume_stage, casts[c], s, graph, events, report)] = (c, [s], True)
+                elif chain:
+                    # The later stages of the run are done by it, not scheduled on their own; they stay
+                    # in remaining until it is done, so a cancelled batch reports them as cancelled
+                    running[pool.submit(run_fused, casts[c], chain, graph, output_file_dir, events,
+                                        report)] = (c, chain, False)
+                else:
+                    running[pool.submit(run_stage, casts[c], s, graph, output_file_dir, events, cancel_event, report,
+                                        limits)] = (c, [s], False)
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                c, run, resumed = running.pop(future)
+                error = future.result()
+                if journal and not resumed and not (error and cancelled()):
+                    for s in run:
+                        journal.record_stage(raw_files[c], stages[s][0], "failed" if error else "done", error)
+                if error:
+                    # The stages depending on the run never become ready for this cast
+                    errors.append(error)
+                    continue
+                done[c] = done.get(c, 0) + len(run)
+                for t in run[1:]:
+                    del remaining[(c, t)]
+                for d in [d for s in run for d in graph.dependents[s] if d not in run]:
+                    remaining[(c, d)] -= 1
+                    if remaining[(c, d)] == 0:
+                        del remaining[(c, d)]
+                        heapq.heappush(ready, (c, position[d], d))
+                if done[c] == len(stages):
+                    error = finish_cast(casts[c], stages, psa_dir, output_file_dir, catalog, workspace, report)
+                    if error:
+                        errors.append(error)
+                        notify(events, "error", error)
+
+    if cancelled():
+        for c, s in sorted([(c, s) for c, _, s in ready] + list(remaining)):
+            if casts.get(c, True) is not None:
+                notify(events, "stage", cast_name(raw_files[c]), stages[s][0], "cancelled")
+    return errors
+
+
+def work_folder(workspace, raw_files, graph, output_file_dir):
+    """The folder the stages of the casts read and write: the workspace's scratch folder, made ready for them, or output_file_dir."""
+    if workspace is None:
+        return output_file_dir
+    workspace.prepare(raw_files, graph)
+    return workspace.path
+
+
+def process_cast(raw_file, stages, psa_dir, output_file_dir, incremental=False, events=None, cancel_event=None,
+                 report=None, after=None, catalog=None, limits=None, workspace=None):
+    """
+    Run every selected stage for a single cast, one at a time in dependency order.
+    With incremental=True, stages whose inputs, PSA, XMLCON and executable are unchanged
+    since the last run are skipped (see build_cache.py).
+
+    Progress is reported on the events queue as ("stage", cast, psa_file, status) tuples,
+    with status "running", "done", "skipped", "failed" or "cancelled", and errors as
+    ("error", message); a stage killed for running longer than its timeout (see StageLimits)
+    has status "timeout". Setting cancel_event stops the cast and kills its running stage.
+    Every stage run (or skip) is recorded in report, a run_report.RunReport, if given, and
+    the processed cast in catalog, a cast_catalog.CastCatalog. A failing stage stops the stages that depend on it.
+    With a workspace (a Workspace) the stages run in its scratch folder and only the cast's
+    final products are published to output_file_dir. Returns the list of error messages.
+    """
+    graph, runnable, errors = preflight([raw_file], stages, psa_dir, output_file_dir, after)
+    for err in errors:
+        notify(events, "error", err)
+    if runnable:
+        errors.extend(run_pipeline(runnable, graph, psa_dir, work_folder(workspace, runnable, graph, output_file_dir), 1,
+                                   incremental, events, cancel_event, report, catalog=catalog, limits=limits,
+                                   workspace=workspace))
+    return errors
+
+
+def process_casts(raw_files, stages, psa_dir, output_file_dir, jobs=1, incremental=False, events=None, cancel_event=None,
+                  after=None, catalog=None, batch_size=1, limits=None, workspace=None):
+    """
+    Run the pipeline for every raw file. Every (cast, stage) is checked by preflight() before
+    anything runs. The stages form a dependency graph (see stage_graph.StageGraph, with the
+    extra "after" dependencies {psa_file: [psa files]}); with jobs > 1
+    up to jobs (cast, stage) tasks run at the same time (see run_pipeline()), each cast in its
+    own working directory. With incremental=True stages that are already up to date are
+    skipped. With batch_size > 1 the modules that can are run once for up to batch_size casts
+    (see run_batches()). limits (a StageLimits) bounds how long each stage may run. See
+    process_cast() for events and cancel_event; a ("finished",
+    errors, report_path) event is put on the queue at the end.
+
+    Every run writes a JSON-lines report (ctd_run_<date>_<time>.jsonl) to the output directory.
+    Each cast whose stages are all done is registered in catalog, a cast_catalog.CastCatalog,
+    if given. With a workspace (a Workspace) the stages read and write in its scratch folder
+    and only the final products of the casts that succeed reach output_file_dir.
+
+    stages is a list of (psa_file, executable_path, order) tuples sorted by order.
+    Returns the list of error messages from all casts.
+    """
+    os.makedirs(output_file_dir, exist_ok=True)
+    report = run_report.RunReport(output_file_dir, raw_files)
+
+    graph, runnable, errors = preflight(raw_files, stages, psa_dir, output_file_dir, after)
+    for err in errors:
+        notify(events, "error", err)
+    if errors:
+        report.record_preflight([cast_name(raw_file) for raw_file in raw_files if raw_file not in runnable], errors)
+    if runnable:
+        errors.extend(run_pipeline(runnable, graph, psa_dir, work_folder(workspace, runnable, graph, output_file_dir), jobs,
+                                   incremental, events, cancel_event, report, catalog=catalog, batch_size=batch_size,
+                                   limits=limits, workspace=workspace))
+
+    summary = report.close(errors)
+    print(run_report.format_summary(summary))
+    print(f"Run report written to {report.path}")
+
+    notify(events, "finished", errors, report.path)
+    return errors
+
+
+def watch_casts(raw_dir, stages, psa_dir, output_file_dir, jobs=1, incremental=True, events=None, stop_event=None,
+                settle_time=watch_folder.SETTLE_TIME, poll_interval=watch_folder.POLL_INTERVAL, after=None, catalog=None,
+                limits=None, workspace=None):
+    """
+    Watch raw_dir and run the pipeline for every complete cast that lands in it (see
+    watch_folder.CastWatcher) on a pool of jobs workers, until stop_event is set; each cast's
+    stages run one at a time in dependency order (after as in process_casts()). Casts already
+    in the directory are queued by the first scan; with incremental=True the stages they have
+    already been through are skipped. Processed casts are registered in catalog, if given;
+    limits is a StageLimits and workspace a Workspace (see process_cast()).
+
+    A ("queued", cast) event is put on the events queue for every cast found; see
+    process_cast() for the other events. Casts still running when stop_event is set are
+    finished, then the run report is closed and a ("finished", errors, report_path) event
+    is sent. Returns the list of error messages.
+    """
+    os.makedirs(output_file_dir, exist_ok=True)
+    stop_event = stop_event or threading.Event()
+    watcher = watch_folder.CastWatcher(raw_dir, settle_time)
+    report = run_report.RunReport(output_file_dir, [])
+    errors = []
+    waiting, running = [], {}
+
+    def collect(cast):
+        cast_errors = running.pop(cast).result()
+        for err in cast_errors:
+            print(err, file=sys.stderr)
+        errors.extend(cast_errors)
+
+    print(f"Watching {raw_dir} for casts with {jobs} worker(s)")
+    with ThreadPoolExecutor(max_workers=max(1, int(jobs))) as pool:
+        while True:
+            waiting.extend(watcher.poll())
+            for raw_file in list(waiting):
+                base_name = cast_name(raw_file)
+                # A cast written again while it is being processed waits for that run to end
+                if base_name in running:
+                    continue
+                waiting.remove(raw_file)
+                print(f"[{base_name}] Complete cast found, queued")
+                notify(events, "queued", base_name)
+                report.raw_files.append(raw_file)
+                running[base_name] = pool.submit(process_cast, raw_file, stages, psa_dir, output_file_dir, incremental,
+                                                 events, None, report, after, catalog, limits, workspace)
+
+            for base_name in [cast for cast, future in running.items() if future.done()]:
+                collect(base_name)
+            if stop_event.wait(poll_interval):
+                break
+
+        for base_name in list(running):
+            collect(base_name)
+
+    summary = report.close(errors)
+    print(run_report.format_summary(summary))
+    print(f"Run report written to {report.path}")
+
+    notify(events, "finished", errors, report.path)
+    return errors
@@ -0,0 +1,416 @@
+import os
+import xml.etree.ElementTree as ET
+
+import numpy as np
+
+import cnv_file
+import hex_file
+import sbe_files
+import seawater
+
+# The Data Conversion module this stage replaces, used to open its PSA files with "Edit PSA"
+SBE_MODULE = "DatCnvW.exe"
+
+# Scan rate of the SBE 9plus
+SCAN_RATE = 24.0
+
+# DatCnv averages the Digiquartz temperature word over this many seconds before using it
+PRESSURE_TEMPERATURE_WINDOW = 30.0
+
+BAD_FLAG = -9.990e-29
+
+# Scans kept around each bottle firing in the .ros file: ScanRangeSource values
+SCAN_RANGE_SOURCES = {1: "BL file"}
+
+
+class Instrument:
+    """
+    The sensors and scan layout of an SBE 911plus configuration (.XMLCON).
+
+    frequency_sensors and voltage_sensors hold the calibration element of each channel in
+    scan order (e.g. a <TemperatureSensor>); spar_sensor is the surface PAR sensor, if any.
+    """
+
+    def __init__(self, xmlcon_path):
+        instrument = sbe_files.load_xmlcon(xmlcon_path).instrument
+
+        def flag(tag):
+            return int(instrument.findtext(tag, "0") or 0)
+
+        self.frequency_channels = 5 - flag("FrequencyChannelsSuppressed")
+        self.voltage_words = 4 - flag("VoltageWordsSuppressed")
+        self.surface_par = flag("SurfaceParVoltageAdded") == 1
+        self.nmea_position = flag("NmeaPositionDataAdded") == 1
+        self.nmea_depth = flag("NmeaDepthDataAdded") == 1
+        self.nmea_time = flag("NmeaTimeAdded") == 1
+        self.scan_time = flag("ScanTimeAdded") == 1
+        self.scans_to_average = max(1, flag("ScansToAverage"))
+
+        sensors = [sensor[0] for sensor in instrument.iter("Sensor") if len(sensor)]
+        self.frequency_sensors = sensors[:self.frequency_channels]
+        self.voltage_sensors = sensors[self.frequency_channels:self.frequency_channels + 2 * self.voltage_words]
+        spar = sensors[self.frequency_channels + 2 * self.voltage_words:]
+        self.spar_sensor = spar[-1] if self.surface_par and spar else None
+
+    def layout(self):
+        """Byte offsets of the parts of a scan, and the number of bytes per scan."""
+        offsets = {"frequencies": 0, "voltages": 3 * self.frequency_channels}
+        position = offsets["voltages"] + 3 * self.voltage_words
+        if self.surface_par:
+            offsets["spar"] = position
+            position += 3
+        if self.nmea_position:
+            offsets["nmea_position"] = position
+            position += 7
+        if self.nmea_depth:
+            position += 3
+        offsets["status"] = position
+        position += 3
+        if self.nmea_time:
+            position += 4
+        if self.scan_time:
+            position += 4
+        return offsets, position
+
+    def sensor(self, tag, ordinal=0, sensors=None):
+        """Channel index and calibration element of the ordinal-th sensor of a type, or (None, None)."""
+        found = [(index, sensor) for index, sensor in enumerate(self.frequency_sensors if sensors is None else sensors)
+                 if sensor.tag == tag]
+        return found[ordinal] if ordinal < len(found) else (None, None)
+
+
+def coefficient(element, tag, default=0.0):
+    text = element.findtext(tag)
+    return float(text) if text and text.strip() else default
+
+
+class Conversion:
+    """
+    Engineering-unit conversion of decoded scans with the calibrations of an Instrument.
+    Each quantity is computed once, on first use, for all scans at the same time.
+
+    For a block of scans in the middle of a cast, first_scan is the number of its first scan
+    and pressure_temperatures the pressure temperature numbers of the pressure_window() - 1
+    scans before it, so the pressure is the same as when the whole cast is converted.
+    """
+
+    def __init__(self, header, scans, instrument, first_scan=1, latitude=None, pressure_temperatures=None):
+        offsets, bytes_per_scan = instrument.layout()
+        if bytes_per_scan != header.bytes_per_scan:
+            raise ValueError(f"the .XMLCON describes {bytes_per_scan} bytes per scan, the .hex header "
+                             f"{header.bytes_per_scan}: wrong .XMLCON for this cast?")
+
+        self.header = header
+        self.instrument = instrument
+        self.rate = SCAN_RATE / instrument.scans_to_average
+        self.first_scan = first_scan
+        self.count = len(scans)
+        self.latitude = latitude
+        self.pressure_temperatures = pressure_temperatures
+        self.cache = {}
+
+        self.frequencies = hex_file.frequencies(scans, offsets["frequencies"], instrument.frequency_channels)
+        self.voltage_numbers = hex_file.twelve_bit_words(scans, offsets["voltages"], instrument.voltage_words)
+        self.spar_numbers = hex_file.twelve_bit_words(scans, offsets["spar"], 1) if "spar" in offsets else None
+        self.position = hex_file.nmea_lat_lon(scans, offsets["nmea_position"]) if "nmea_position" in offsets else None
+        self.pressure_temperature_numbers, self.status, _ = hex_file.status_words(scans, offsets["status"])
+
+    def cached(self, key, compute):
+        if key not in self.cache:
+            self.cache[key] = compute()
+        return self.cache[key]
+
+    def scan_count(self):
+        return np.arange(self.first_scan, self.first_scan + self.count, dtype=np.float64)
+
+    def pressure_window(self):
+        """Number of scans the pressure temperature is averaged over."""
+        return max(1, int(round(PRESSURE_TEMPERATURE_WINDOW * self.rate)))
+
+    def elapsed_time(self):
+        return (self.scan_count() - 1) / self.rate
+
+    def start_time(self):
+        start = self.header.time("System UTC", "System UpLoad Time", "NMEA UTC (Time)")
+        if start is None:
+            raise ValueError("no start time (System UTC) in the .hex header")
+        return start
+
+    def julian_days(self):
+        start = self.start_time()
+        day = start.timetuple().tm_yday + (start.hour * 3600 + start.minute * 60 + start.second) / 86400
+        return day + self.elapsed_time() / 86400
+
+    def voltage(self, channel):
+        return 5.0 * (1.0 - self.voltage_numbers[:, channel] / 4095.0)
+
+    def temperature(self, ordinal):
+        """ITS-90 temperature of the primary (0) or secondary (1) temperature sensor."""
+        def compute():
+            channel, sensor = self.instrument.sensor("TemperatureSensor", ordinal)
+            if sensor is None:
+                raise ValueError(f"no temperature sensor {ordinal + 1} in the .XMLCON")
+            f = self.frequencies[:, channel]
+            if coefficient(sensor, "UseG_J", 1.0):
+                log = np.log(coefficient(sensor, "F0", 1000.0) / f)
+                t = 1.0 / (coefficient(sensor, "G") + (coefficient(sensor, "H") + (coefficient(sensor, "I")
+                           + coefficient(sensor, "J") * log) * log) * log) - 273.15
+            else:
+                log = np.log(coefficient(sensor, "F0_Old", 1000.0) / f)
+                t68 = 1.0 / (coefficient(sensor, "A") + (coefficient(sensor, "B") + (coefficient(sensor, "C")
+                             + coefficient(sensor, "D") * log) * log) * log) - 273.15
+                t = t68 / 1.00024
+            return coefficient(sensor, "Slope", 1.0) * t + coefficient(sensor, "Offset")
+        return self.cached(("temperature", ordinal), compute)
+
+    def pressure(self):
+        """Digiquartz pressure [db], compensated with the running mean of the pressure temperature."""
+        def compute():
+            channel, sensor = self.instrument.sensor("PressureSensor")
+            if sensor is None:
+                raise ValueError("no Digiquartz pressure sensor in the .XMLCON")
+
+            window = self.pressure_window()
+            numbers = self.pressure_temperature_numbers.astype(np.float64)
+            before = self.pressure_temperatures
+            if before is None:
+                before = np.full(window - 1, numbers[0] if len(numbers) else 0.0)
+            padded = np.concatenate([before, numbers])
+            sums = np.cumsum(np.concatenate([[0.0], padded]))
+            numbers = (sums[window:] - sums[:-window]) / window
+            u = coefficient(sensor, "AD590M") * numbers + coefficient(sensor, "AD590B")
+
+            c = coefficient(sensor, "C1") + (coefficient(sensor, "C2") + coefficient(sensor, "C3") * u) * u
+            d = coefficient(sensor, "D1") + coefficient(sensor, "D2") * u
+            t0 = coefficient(sensor, "T1") + (coefficient(sensor, "T2") + (coefficient(sensor, "T3")
+                 + (coefficient(sensor, "T4") + coefficient(sensor, "T5") * u) * u) * u) * u
+            period = 1e6 / self.frequencies[:, channel]
+            x = 1.0 - t0 * t0 / (period * period)
+            psia = c * x * (1.0 - d * x)
+            return coefficient(sensor, "Slope", 1.0) * (psia - 14.7) * 0.689476 + coefficient(sensor, "Offset")
+        return self.cached("pressure", compute)
+
+    def conductivity(self, ordinal):
+        """Conductivity [S/m] of the primary (0) or secondary (1) conductivity sensor."""
+        def compute():
+            channel, sensor = self.instrument.sensor("ConductivitySensor", ordinal)
+            if sensor is None:
+                raise ValueError(f"no conductivity sensor {ordinal + 1} in the .XMLCON")
+            f = self.frequencies[:, channel] / 1000.0
+            t = self.temperature(ordinal)
+            p = self.pressure()
+            if coefficient(sensor, "UseG_J", 1.0):
+                k = sensor.find("Coefficients[@equation='1']")
+                c = (coefficient(k, "G") + (coefficient(k, "H") + (coefficient(k, "I") + coefficient(k, "J") * f) * f) * f * f) \
+                    / (10.0 * (1.0 + coefficient(k, "CTcor") * t + coefficient(k, "CPcor") * p))
+            else:
+                k = sensor.find("Coefficients[@equation='0']")
+                c = (coefficient(k, "A") * f ** coefficient(k, "M") + coefficient(k, "B") * f * f + coefficient(k, "C")
+                     + coefficient(k, "D") * t) / (10.0 * (1.0 + coefficient(k, "CPcor") * p))
+            return coefficient(sensor, "Slope", 1.0) * c + coefficient(sensor, "Offset")
+        return self.cached(("conductivity", ordinal), compute)
+
+    def altimeter(self):
+        channel, sensor = self.instrument.sensor("AltimeterSensor", sensors=self.instrument.voltage_sensors)
+        if sensor is None:
+            raise ValueError("no altimeter in the .XMLCON")
+        return 300.0 * self.voltage(channel) / coefficient(sensor, "ScaleFactor", 15.0) + coefficient(sensor, "Offset")
+
+    def pump_status(self):
+        return (self.status & 1).astype(np.float64)
+
+    def nmea(self, index):
+        if self.position is None:
+            raise ValueError("no NMEA position in the scans (NmeaPositionDataAdded)")
+        return self.position[index]
+
+    def spar(self):
+        """Surface PAR from the SPAR word appended by the deck unit (0-5 V as N / 819)."""
+        sensor = self.instrument.spar_sensor
+        if self.spar_numbers is None or sensor is None:
+            raise ValueError("no surface PAR sensor in the .XMLCON")
+        volts = self.spar_numbers[:, 1] / 819.0
+        return volts * coefficient(sensor, "ConversionFactor", 1.0) * coefficient(sensor, "RatioMultiplier", 1.0)
+
+    def depth(self):
+        latitude = self.header.nmea_position("NMEA Latitude")
+        return seawater.depth_salt_water(self.pressure(), self.latitude if latitude is None else latitude)
+
+
+# FullName of a Data Conversion PSA variable -> (short name, format, conversion)
+VARIABLES = {
+    "Scan Count": ("scan", ".0f", Conversion.scan_count),
+    "Julian Days": ("timeJ", ".6f", Conversion.julian_days),
+    "Time, Elapsed [seconds]": ("timeS", ".3f", Conversion.elapsed_time),
+    "Pressure, Digiquartz [db]": ("prDM", ".3f", Conversion.pressure),
+    "Temperature [ITS-90, deg C]": ("t090C", ".4f", lambda c: c.temperature(0)),
+    "Temperature, 2 [ITS-90, deg C]": ("t190C", ".4f", lambda c: c.temperature(1)),
+    "Temperature Difference, 2 - 1 [ITS-90, deg C]": ("T2-T190C", ".4f", lambda c: c.temperature(1) - c.temperature(0)),
+    "Conductivity [S/m]": ("c0S/m", ".6f", lambda c: c.conductivity(0)),
+    "Conductivity, 2 [S/m]": ("c1S/m", ".6f", lambda c: c.conductivity(1)),
+    "Conductivity Difference, 2 - 1 [S/m]": ("C2-C1S/m", ".6f", lambda c: c.conductivity(1) - c.conductivity(0)),
+    "Altimeter [m]": ("altM", ".2f", Conversion.altimeter),
+    "Pump Status": ("pumps", ".0f", Conversion.pump_status),
+    "Depth [salt water, m]": ("depSM", ".3f", Conversion.depth),
+    "Latitude [deg]": ("latitude", ".5f", lambda c: c.nmea(0)),
+    "Longitude [deg]": ("longitude", ".5f", lambda c: c.nmea(1)),
+    "SPAR/Surface Irradiance": ("spar", ".2f", Conversion.spar),
+}
+
+
+class DatCnvSettings:
+    """The parameters of a Data Conversion PSA file (EN_DatCnv.psa)."""
+
+    def __init__(self, psa_path):
+        root = ET.parse(psa_path).getroot()
+
+        def value(tag, default=""):
+            element = root.find(tag)
+            return element.get("value", default) if element is not None else default
+
+        self.instrument_path = value("InstrumentPath")
+        self.input_dir = value("InputDir")
+        input_files = root.find("InputFileArray")
+        self.input_files = [item.get("value") for item in input_files.iter("ArrayItem")] if input_files is not None else []
+        self.output_dir = value("OutputDir")
+        self.output_file = value("OutputFile")
+        self.name_append = value("NameAppend")
+
+        self.scans_to_skip = int(value("ScansToSkip", "0"))
+        self.scans_to_process = None if value("ProcessScansToEnd", "1") == "1" else int(value("ScansToProcess", "0"))
+        self.merge_header = value("MergeHeaderFile", "1") == "1"
+        self.binary = value("OutputFormat", "0") == "1"
+        self.create_file = int(value("CreateFile", "0"))
+        self.scan_range_source = int(value("ScanRangeSource", "1"))
+        self.scan_range_offset = float(value("ScanRangeOffset", "0"))
+        self.scan_range_duration = float(value("ScanRangeDuration", "2"))
+
+        misc_latitude = root.find("MiscellaneousDataForCalculations/Latitude")
+        self.latitude = float(misc_latitude.get("value")) if misc_latitude is not None else 0.0
+
+        self.variables = []
+        for item in root.iter("CalcArrayItem"):
+            full_name = item.find("Calc/FullName").get("value")
+            if full_name not in VARIABLES:
+                raise ValueError(f"'{full_name}' is not supported by the built-in DatCnv, use DatCnvW.exe")
+            self.variables.append(full_name)
+
+    def output_path(self, input_file, extension):
+        output_file = self.output_file or os.path.basename(input_file)
+        return os.path.join(self.output_dir, os.path.splitext(output_file)[0] + self.name_append + extension)
+
+
+def bottle_scans(bl_path, first_scan, rate, offset, duration):
+    """
+    Rows of the .ros file: for each bottle fired in the .bl file, the scans from its start
+    scan plus offset for duration seconds. Returns (scan numbers, bottle numbers).
+    """
+    scans, bottles = [], []
+    count = int(round(duration * rate)) + 1
+    with open(bl_path, "r", encoding="latin-1") as f:
+        for line in f:
+            parts = [part.strip() for part in line.split(",")]
+            if len(parts) != 5 or not parts[0].isdigit():
+                continue
+            start = int(parts[3]) + int(round(offset * rate))
+            scans.extend(range(start, start + count))
+            bottles.extend([int(parts[0])] * count)
+    return np.array(scans, dtype=np.int64) - first_scan, np.array(bottles, dtype=np.float64)
+
+
+def convert(hex_path, xmlcon_path, settings):
+    """
+    Convert a .hex file to engineering units. Returns (header lines, values, short names,
+    long names, formats, conversion) for the variables of the PSA, plus a flag column.
+    """
+    header, scans = hex_file.read_hex(hex_path)
+    end = None if settings.scans_to_process is None else settings.scans_to_skip + settings.scans_to_process
+    scans = scans[settings.scans_to_skip:end]
+    conversion = Conversion(header, scans, Instrument(xmlcon_path), settings.scans_to_skip + 1, settings.latitude)
+    return (header,) + convert_scans(conversion, settings)
+
+
+def convert_scans(conversion, settings):
+    """The (values, short names, long names, formats, conversion) of the PSA's variables for a Conversion."""
+    short_names, long_names, formats, columns = [], [], [], []
+    for full_name in settings.variables:
+        short_name, fmt, compute = VARIABLES[full_name]
+        short_names.append(short_name)
+        long_names.append(full_name)
+        formats.append(fmt)
+        columns.append(compute(conversion))
+
+    short_names.append("flag")
+    long_names.append("flag")
+    formats.append(".4e")
+    columns.append(np.zeros(conversion.count))
+
+    values = np.column_stack(columns) if columns else np.zeros((conversion.count, 0))
+    return values, short_names, long_names, formats, conversion
+
+
+def cnv_header(hex_header, short_names, long_names, formats, conversion, settings, extra_lines):
+    """The header of the converted file, laid out like DatCnvW's."""
+    header = cnv_file.CnvHeader()
+    header.short_names, header.long_names, header.formats = short_names, long_names, formats
+    header.bad_flag = BAD_FLAG
+
+    start = conversion.start_time()
+    header.lines = (hex_header.lines if settings.merge_header else []) + [
+        "# nquan = 0",
+        "# nvalues = 0",
+        "# units = specified",
+        f"# interval = seconds: {1 / conversion.rate:g}",
+        f"# start_time = {start:%b %d %Y %H:%M:%S} [System UTC, header]",
+        f"# bad_flag = {BAD_FLAG:.3e}",
+    ] + extra_lines + ["# file_type = ascii"]
+    return header
+
+
+def run_psa(psa_path):
+    """
+    Convert the .hex file of a rendered Data Conversion PSA with the .XMLCON of its
+    InstrumentPath, writing <cast>.cnv and/or <cast>.ros as CreateFile asks. Returns a
+    one-line summary.
+    """
+    settings = DatCnvSettings(psa_path)
+    if settings.binary:
+        raise ValueError("binary output is not supported by the built-in DatCnv, use DatCnvW.exe")
+    if not settings.input_files:
+        raise ValueError(f"{psa_path}: no input file")
+
+    hex_path = os.path.join(settings.input_dir, settings.input_files[0])
+    hex_header, values, short_names, long_names, formats, conversion = convert(hex_path, settings.instrument_path, settings)
+    history = [
+        f"# datcnv_date = {cnv_file.processing_date()}, datcnv.py",
+        f"# datcnv_in = {hex_path} {settings.instrument_path}",
+        f"# datcnv_skipover = {settings.scans_to_skip}",
+    ]
+    written = []
+
+    # CreateFile: 0 = .cnv only, 1 = .ros only, 2 = both
+    if settings.create_file in (0, 2):
+        header = cnv_header(hex_header, short_names, long_names, formats, conversion, settings, history)
+        output_path = settings.output_path(hex_path, ".cnv")
+        cnv_file.write_cnv(output_path, header, values)
+        written.append(os.path.basename(output_path))
+
+    if settings.create_file in (1, 2):
+        if settings.scan_range_source not in SCAN_RANGE_SOURCES:
+            raise ValueError("the built-in DatCnv only takes bottle scan ranges from the .bl file, use DatCnvW.exe")
+        bl_path = os.path.splitext(hex_path)[0] + ".bl"
+        rows, bottles = bottle_scans(bl_path, conversion.first_scan, conversion.rate,
+                                     settings.scan_range_offset, settings.scan_range_duration)
+        inside = (rows >= 0) & (rows < len(values))
+        ros_values = np.insert(values[rows[inside]], len(short_names) - 1, bottles[inside], axis=1)
+        ros_history = history + [
+            f"# datcnv_bottle_scan_range_source = {SCAN_RANGE_SOURCES[settings.scan_range_source]}",
+            f"# datcnv_scans_per_bottle = {int(round(settings.scan_range_duration * conversion.rate)) + 1}",
+        ]
+        header = cnv_header(hex_header, short_names[:-1] + ["nbf", "flag"], long_names[:-1] + ["Bottles Fired", "flag"],
+                            formats[:-1] + [".0f", ".4e"], conversion, settings, ros_history)
+        output_path = settings.output_path(hex_path, ".ros")
+        cnv_file.write_cnv(output_path, header, ros_values)
+        written.append(os.path.basename(output_path))
+
+    return f"{os.path.basename(hex_path)}: {conversion.count} scans converted to {', '.join(written)}"
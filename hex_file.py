@@ -0,0 +1,183 @@
+import binascii
+import re
+from datetime import datetime
+
+import numpy as np
+
+HEADER_VALUE_PATTERN = re.compile(r"^\*\s*([^=]*?)\s*=\s*(.*?)\s*$")
+
+
+class HexHeader:
+    """
+    The header of an SBE 9plus .hex file (the same lines as its .hdr file).
+
+    values holds the "* key = value" lines (e.g. values["System UTC"]), lines the raw
+    header text (without *END*) for merging it into the .cnv header.
+    """
+
+    def __init__(self):
+        self.lines = []
+        self.values = {}
+        self.bytes_per_scan = 0
+        self.voltage_words = 0
+        self.data_offset = 0
+
+    def time(self, *keys):
+        """The first of the given header times that is present (e.g. "System UTC"), or None."""
+        for key in keys:
+            if key in self.values:
+                return datetime.strptime(" ".join(self.values[key].split()), "%b %d %Y %H:%M:%S")
+        return None
+
+    def nmea_position(self, key):
+        """NMEA Latitude/Longitude in decimal degrees ("36 15.00 N" -> 36.25), or None."""
+        match = re.match(r"^(\d+)\s+([\d.]+)\s*([NSEW])$", self.values.get(key, ""))
+        if not match:
+            return None
+        degrees = int(match.group(1)) + float(match.group(2)) / 60
+        return -degrees if match.group(3) in "SW" else degrees
+
+
+def parse_header(lines):
+    """A HexHeader from header lines (those of a .hex, .hdr or .cnv file)."""
+    header = HexHeader()
+    header.lines = list(lines)
+    for line in header.lines:
+        match = HEADER_VALUE_PATTERN.match(line)
+        if match and not line.startswith("**"):
+            header.values[match.group(1)] = match.group(2)
+    return header
+
+
+def read_header(path):
+    """Read only the header of a .hex or .hdr file, up to *END*."""
+    lines = []
+    with open(path, "r", encoding="latin-1") as f:
+        for line in f:
+            if line.startswith("*END*"):
+                break
+            lines.append(line.rstrip("\r\n"))
+    return parse_header(lines)
+
+
+def split_header(content, path):
+    """
+    The HexHeader of the start of a .hex file (bytes, *END* line included), with
+    bytes_per_scan, voltage_words and data_offset (the first byte after *END*) set.
+    """
+    end = content.find(b"*END*")
+    if end < 0:
+        raise ValueError(f"{path}: no *END* line, not a .hex file")
+
+    header = parse_header(content[:end].decode("latin-1").splitlines())
+    try:
+        header.bytes_per_scan = int(header.values["Number of Bytes Per Scan"])
+        header.voltage_words = int(header.values.get("Number of Voltage Words", 0))
+    except (KeyError, ValueError):
+        raise ValueError(f"{path}: no 'Number of Bytes Per Scan' in the header")
+
+    line_end = content.find(b"\n", end)
+    header.data_offset = line_end + 1 if line_end >= 0 else len(content)
+    return header
+
+
+def decode_scans(digits, bytes_per_scan, path):
+    """A (scans, bytes per scan) uint8 array from hex digits without white space (whole scans only)."""
+    try:
+        data = binascii.unhexlify(digits)
+    except binascii.Error as e:
+        raise ValueError(f"{path}: bad hex data ({e})")
+    return np.frombuffer(data, dtype=np.uint8).reshape(-1, bytes_per_scan)
+
+
+def read_hex(path):
+    """
+    Read an SBE 9plus .hex file. Returns (header, scans), scans being a (scans, bytes per scan)
+    uint8 array of the whole data block, decoded from hex in one pass. A partly written last
+    scan (a file still being logged) is left out.
+    """
+    with open(path, "rb") as f:
+        content = f.read()
+
+    header = split_header(content, path)
+    digits = b"".join(content[header.data_offset:].split())
+    scan_length = 2 * header.bytes_per_scan
+    return header, decode_scans(digits[:len(digits) // scan_length * scan_length], header.bytes_per_scan, path)
+
+
+def count_scans(path):
+    """Number of complete scans in a .hex file, without decoding them."""
+    with open(path, "rb") as f:
+        content = f.read()
+    header = split_header(content, path)
+    data = content[header.data_offset:]
+    return (len(data) - sum(data.count(space) for space in b" \t\r\n")) // (2 * header.bytes_per_scan)
+
+
+class HexTail:
+    """
+    Follows a .hex file Seasave is still writing. read() returns the scans appended since the
+    last call (a (scans, bytes per scan) uint8 array), reading and decoding only the new bytes;
+    a partly written scan is kept for the next call. header is None until the *END* line is in.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.header = None
+        self.offset = 0
+        self.pending = b""
+
+    def read(self):
+        try:
+            with open(self.path, "rb") as f:
+                f.seek(self.offset)
+                content = f.read()
+        except FileNotFoundError:
+            content = b""
+        self.offset += len(content)
+        self.pending += content
+
+        if self.header is None:
+            end = self.pending.find(b"*END*")
+            if end < 0 or self.pending.find(b"\n", end) < 0:
+                return np.zeros((0, 0), dtype=np.uint8)
+            self.header = split_header(self.pending, self.path)
+            self.pending = self.pending[self.header.data_offset:]
+
+        digits = b"".join(self.pending.split())
+        scan_length = 2 * self.header.bytes_per_scan
+        complete = len(digits) // scan_length * scan_length
+        self.pending = digits[complete:]
+        return decode_scans(digits[:complete], self.header.bytes_per_scan, self.path)
+
+
+def frequencies(scans, offset, count):
+    """Frequency channels (3 bytes each): byte0 * 256 + byte1 + byte2 / 256 Hz."""
+    channels = scans[:, offset:offset + 3 * count].reshape(len(scans), count, 3).astype(np.float64)
+    return channels[..., 0] * 256 + channels[..., 1] + channels[..., 2] / 256
+
+
+def twelve_bit_words(scans, offset, count):
+    """Unpack count 3-byte words into 2 * count 12-bit numbers, in channel order."""
+    words = scans[:, offset:offset + 3 * count].reshape(len(scans), count, 3).astype(np.uint16)
+    numbers = np.empty((len(scans), 2 * count), dtype=np.uint16)
+    numbers[:, 0::2] = (words[..., 0] << 4) | (words[..., 1] >> 4)
+    numbers[:, 1::2] = ((words[..., 1] & 0x0F) << 8) | words[..., 2]
+    return numbers
+
+
+def nmea_lat_lon(scans, offset):
+    """Latitude and longitude appended by the deck unit (7 bytes): 3 bytes each / 50000, then the sign bits."""
+    position = scans[:, offset:offset + 7].astype(np.int64)
+    latitude = (position[:, 0] * 65536 + position[:, 1] * 256 + position[:, 2]) / 50000
+    longitude = (position[:, 3] * 65536 + position[:, 4] * 256 + position[:, 5]) / 50000
+    latitude = np.where(position[:, 6] & 0x80, -latitude, latitude)
+    longitude = np.where(position[:, 6] & 0x40, -longitude, longitude)
+    return latitude, longitude
+
+
+def status_words(scans, offset):
+    """Pressure temperature (12 bits), status bits (4 bits) and modulo count (8 bits)."""
+    status = scans[:, offset:offset + 3].astype(np.uint16)
+    pressure_temperature = (status[:, 0] << 4) | (status[:, 1] >> 4)
+    return pressure_temperature, status[:, 1] & 0x0F, status[:, 2]
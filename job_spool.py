@@ -0,0 +1,402 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+import batch_manifest
+import build_cache
+import ctd_pipeline
+
+# Sub-folders of a spool directory: jobs waiting for a worker, jobs a worker holds a lease on,
+# jobs done, jobs failed (for good once they have had every attempt) and the run log of every job run
+QUEUED_DIR, LEASED_DIR, DONE_DIR, FAILED_DIR, LOGS_DIR = "queued", "leased", "done", "failed", "logs"
+# Settings the coordinator writes for the workers
+SETTINGS_FILE_NAME = "spool.json"
+
+# Seconds a lease lasts without a heartbeat from its worker before the job is queued again
+LEASE_TIME = 120
+# Seconds between two looks at the spool, by the coordinator and by idle workers
+POLL_INTERVAL = 2
+
+
+def write_json(path, data):
+    """Write a JSON file under a temporary name first, so readers never see half of it."""
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(data, f, indent=4)
+    os.replace(tmp_path, path)
+
+
+def read_json(path):
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def job_id(cast):
+    """Identifier of a manifest cast's job: the same for the same raw file, configuration and output directory."""
+    return hashlib.sha1(cast.key.encode("utf-8")).hexdigest()[:12]
+
+
+def job_file_name(job):
+    """
+    File name of a job in the spool. Workers take the queued jobs in file name order: by
+    attempt, then in manifest order, so a job run again waits for those not tried yet.
+    """
+    return f"{job['attempt']}_{job['index']:06d}_{re.sub(r'[^A-Za-z0-9_.-]', '-', job['cast'])}_{job['id']}.json"
+
+
+def file_job_id(name):
+    """The job id of a spool file name (a lease also has "@<worker>")."""
+    return os.path.splitext(name)[0].split("@")[0].rsplit("_", 1)[-1]
+
+
+def file_attempt(name):
+    return int(name.split("_", 1)[0])
+
+
+def lease_worker(name):
+    """The worker holding a lease, from the lease's file name."""
+    return os.path.splitext(name)[0].split("@", 1)[1]
+
+
+def worker_name(name=None):
+    """A worker's name, <host>-<pid> by default, with only characters safe in a file name."""
+    return re.sub(r"[^A-Za-z0-9.-]", "-", name or f"{socket.gethostname()}-{os.getpid()}")
+
+
+class Lease:
+    """A worker's hold on one job: the job's file in the leased folder, kept alive by renew()."""
+
+    def __init__(self, spool, path, job, worker):
+        self.spool = spool
+        self.path = path
+        self.job = job
+        self.worker = worker
+
+    def renew(self):
+        """Tell the coordinator the worker is alive. Returns False if the lease has expired meanwhile."""
+        try:
+            os.utime(self.path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def release(self):
+        """Give the job back without running it (the worker is stopping)."""
+        try:
+            os.rename(self.path, os.path.join(self.spool.path, QUEUED_DIR, job_file_name(self.job)))
+        except OSError:
+            pass
+
+    def finish(self, result):
+        """
+        Record the outcome of the job ({"status": "done" or "failed", ...}) and end the lease.
+        Returns False, recording nothing, if the lease has expired meanwhile (the job is queued
+        again for another worker).
+        """
+        # Renamed first, so the coordinator expiring the lease at the same moment either wins or sees it
+        # gone; the coordinator still counts the renamed file as a lease until the outcome is written
+        finishing_path = self.path[:-len(".json")] + ".finishing"
+        try:
+            os.rename(self.path, finishing_path)
+        except FileNotFoundError:
+            return False
+        folder = DONE_DIR if result["status"] == "done" else FAILED_DIR
+        write_json(os.path.join(self.spool.path, folder, job_file_name(self.job)), dict(self.job, **result))
+        try:
+            os.remove(finishing_path)
+        except FileNotFoundError:
+            pass
+        return True
+
+
+class Spool:
+    """
+    A directory shared by a coordinator and workers on several machines (e.g. a network
+    share) holding one JSON file per job, a cast of a batch manifest to run through its
+    configuration's pipeline:
+
+        queued/<attempt>_<index>_<cast>_<id>.json            waiting for a worker
+        leased/<attempt>_<index>_<cast>_<id>@<worker>.json   being run by that worker
+        done/<attempt>_<index>_<cast>_<id>.json              processed, with its output files
+        failed/<attempt>_<index>_<cast>_<id>.json            failed, with the errors
+        logs/<cast>_<id>_<attempt>@<worker>.jsonl            the run log of each attempt
+
+    A worker claims a job by renaming it from queued/ to leased/, which only one worker
+    can do, and touches the lease while the job runs. The coordinator queues a job again
+    when its lease has not been touched for lease_time seconds of the coordinator's own
+    clock (the machines' clocks need not agree), e.g. because its worker died.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        for folder in (QUEUED_DIR, LEASED_DIR, DONE_DIR, FAILED_DIR, LOGS_DIR):
+            os.makedirs(os.path.join(path, folder), exist_ok=True)
+
+    def folder(self, folder):
+        return os.path.join(self.path, folder)
+
+    def list(self, folder):
+        # A lease being finished (see Lease.finish()) is still a lease, so the job is never in no folder at all
+        extensions = (".json", ".finishing") if folder == LEASED_DIR else (".json",)
+        return sorted(name for name in os.listdir(self.folder(folder)) if name.endswith(extensions))
+
+    def settings(self):
+        try:
+            return read_json(os.path.join(self.path, SETTINGS_FILE_NAME))
+        except (OSError, ValueError):
+            return {"lease_time": LEASE_TIME, "max_attempts": batch_manifest.MAX_ATTEMPTS}
+
+    def submit(self, casts, lease_time=LEASE_TIME, max_attempts=batch_manifest.MAX_ATTEMPTS):
+        """Queue a job for every manifest cast (a batch_manifest.ManifestCast) not in the spool yet. Returns the number queued."""
+        write_json(os.path.join(self.path, SETTINGS_FILE_NAME), {"lease_time": lease_time, "max_attempts": max_attempts})
+        existing = {file_job_id(name) for folder in (QUEUED_DIR, LEASED_DIR, DONE_DIR, FAILED_DIR) for name in self.list(folder)}
+        queued = 0
+        for index, cast in enumerate(casts):
+            job = {"id": job_id(cast), "index": index, "cast": cast.name, "raw_file": os.path.abspath(cast.raw_file),
+                   "config": os.path.abspath(cast.config), "output_dir": os.path.abspath(cast.output_dir), "attempt": 1}
+            if job["id"] in existing:
+                continue
+            existing.add(job["id"])
+            write_json(os.path.join(self.folder(QUEUED_DIR), job_file_name(job)), job)
+            queued += 1
+        return queued
+
+    def claim(self, worker):
+        """Lease the first queued job to worker. Returns a Lease, or None when no job is waiting."""
+        for name in self.list(QUEUED_DIR):
+            lease_path = os.path.join(self.folder(LEASED_DIR), f"{name[:-len('.json')]}@{worker}.json")
+            try:
+                os.rename(os.path.join(self.folder(QUEUED_DIR), name), lease_path)
+            except OSError:
+                # Another worker took it first
+                continue
+            # A rename keeps the file's time: the lease starts now
+            os.utime(lease_path)
+            return Lease(self, lease_path, read_json(lease_path), worker)
+        return None
+
+    def requeue(self, job, error, max_attempts):
+        """Queue a job again for its next attempt, or record it as failed once it has had max_attempts."""
+        job = {key: job[key] for key in ("id", "index", "cast", "raw_file", "config", "output_dir", "attempt")}
+        if job["attempt"] >= max_attempts:
+            write_json(os.path.join(self.folder(FAILED_DIR), job_file_name(job)), dict(job, status="failed", errors=[error]))
+            return False
+        job["attempt"] += 1
+        write_json(os.path.join(self.folder(QUEUED_DIR), job_file_name(job)), job)
+        return True
+
+    def expire(self, seen, lease_time, max_attempts):
+        """
+        Queue again the jobs whose lease has not been renewed for lease_time seconds. seen
+        ({lease file: (mtime, time first seen)}) is kept by the caller from one call to the
+        next. Returns the file names of the leases that expired.
+        """
+        now = time.monotonic()
+        expired = []
+        names = set(self.list(LEASED_DIR))
+        for name in list(seen):
+            if name not in names:
+                del seen[name]
+        for name in names:
+            path = os.path.join(self.folder(LEASED_DIR), name)
+            try:
+                mtime = os.stat(path).st_mtime_ns
+            except FileNotFoundError:
+                continue
+            if name not in seen or seen[name][0] != mtime:
+                seen[name] = (mtime, now)
+                continue
+            if now - seen[name][1] < lease_time:
+                continue
+
+            # Renamed first, so a worker finishing at the same moment either wins or sees the lease gone
+            expiring_path = os.path.splitext(path)[0] + ".expired"
+            try:
+                os.rename(path, expiring_path)
+            except OSError:
+                continue
+            job = read_json(expiring_path)
+            # A worker that died while finishing the job may have written its outcome already
+            outcomes = [os.path.join(self.folder(folder), job_file_name(job)) for folder in (DONE_DIR, FAILED_DIR)]
+            if not any(os.path.isfile(outcome) for outcome in outcomes):
+                self.requeue(job, f"{job['cast']}: the lease of worker {lease_worker(name)} expired", max_attempts)
+            os.remove(expiring_path)
+            del seen[name]
+            expired.append(name)
+        return expired
+
+    def retry_failed(self, max_attempts):
+        """Queue again the failed jobs that have had fewer than max_attempts. Returns their number."""
+        retried = 0
+        for name in self.list(FAILED_DIR):
+            if file_attempt(name) < max_attempts:
+                path = os.path.join(self.folder(FAILED_DIR), name)
+                self.requeue(read_json(path), None, max_attempts)
+                os.remove(path)
+                retried += 1
+        return retried
+
+    def counts(self):
+        """{"queued", "leased", "done", "failed": number of jobs, "workers": names of the workers holding leases}."""
+        leases = self.list(LEASED_DIR)
+        return {"queued": len(self.list(QUEUED_DIR)), "leased": len(leases), "done": len(self.list(DONE_DIR)),
+                "failed": len(self.list(FAILED_DIR)), "workers": sorted({lease_worker(name) for name in leases})}
+
+    def finished(self):
+        """The jobs done and failed, with their results."""
+        return [read_json(os.path.join(self.folder(folder), name)) for folder in (DONE_DIR, FAILED_DIR)
+                for name in self.list(folder)]
+
+    def idle(self):
+        """True when no job is queued or leased."""
+        return not self.list(QUEUED_DIR) and not self.list(LEASED_DIR)
+
+
+def coordinate(spool_path, casts=(), lease_time=LEASE_TIME, max_attempts=batch_manifest.MAX_ATTEMPTS,
+               poll_interval=POLL_INTERVAL, stop_event=None):
+    """
+    Queue the casts (batch_manifest.ManifestCast) in the spool and hand them out until every
+    job of the spool is finished, or stop_event is set: leases not renewed for lease_time
+    seconds are queued again and failed jobs are run again, up to max_attempts attempts in all.
+    Returns the finished jobs.
+    """
+    stop_event = stop_event or threading.Event()
+    spool = Spool(spool_path)
+    queued = spool.submit(casts, lease_time, max_attempts)
+    print(f"{queued} job(s) queued in {spool.path}, leases of {lease_time:g} s, up to {max_attempts} attempt(s) per cast")
+
+    seen = {}
+    last = None
+    while True:
+        for name in spool.expire(seen, lease_time, max_attempts):
+            print(f"Lease {name} expired, its cast is queued again", file=sys.stderr)
+        spool.retry_failed(max_attempts)
+        counts = spool.counts()
+        if counts != last:
+            print(f"queued {counts['queued']}, running {counts['leased']}, done {counts['done']}, failed {counts['failed']}"
+                  + (f" (workers: {', '.join(counts['workers'])})" if counts["workers"] else ""))
+            last = counts
+        if not counts["queued"] and not counts["leased"]:
+            break
+        if stop_event.wait(poll_interval):
+            break
+    return spool.finished()
+
+
+def publish_cast(work_dir, base_name, output_dir):
+    """Copy the files a cast's pipeline wrote in work_dir to output_dir, each replaced in one step. Returns their names."""
+    names = sorted(build_cache.list_cast_files(work_dir, base_name))
+    ctd_pipeline.publish_files(work_dir, names, output_dir)
+    return names
+
+
+def run_job(lease, scratch_dir, executables_dir=None, stop_event=None):
+    """
+    Run the pipeline of a leased job in a folder of scratch_dir, renewing the lease as it
+    runs, then copy the cast's files to the job's output directory and its run log to the
+    spool, and finish the job. If the lease is lost meanwhile (the coordinator gave the job
+    to another worker) the run is cancelled and nothing is copied; if stop_event is set the
+    run is cancelled and the job given back.
+    """
+    job = lease.job
+    settings = lease.spool.settings()
+    work_dir = os.path.join(scratch_dir, job_file_name(job)[:-len(".json")])
+    shutil.rmtree(work_dir, ignore_errors=True)
+    cancel_event, lost, finished = threading.Event(), threading.Event(), threading.Event()
+
+    def heartbeat():
+        while not finished.wait(min(settings["lease_time"] / 4, POLL_INTERVAL)):
+            if stop_event is not None and stop_event.is_set():
+                cancel_event.set()
+                return
+            if not lease.renew():
+                lost.set()
+                cancel_event.set()
+                return
+
+    print(f"[{job['cast']}] Leased by {lease.worker} (attempt {job['attempt']})")
+    heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+    heartbeat_thread.start()
+    start = time.time()
+    try:
+        config = ctd_pipeline.load_config(job["config"])
+        stages = ctd_pipeline.selected_stages(config, executables_dir)
+        if not stages:
+            raise ValueError(f"{job['config']}: the configuration has no selected .psa files.")
+        errors = ctd_pipeline.process_casts([job["raw_file"]], stages, config.get("psa_dir", ""), work_dir,
+                                            after=ctd_pipeline.stage_dependencies(config),
+                                            cancel_event=cancel_event, limits=ctd_pipeline.stage_limits(config))
+    except Exception as e:
+        errors = [f"{job['cast']}: {e}"]
+    finally:
+        finished.set()
+        heartbeat_thread.join()
+
+    # The lease may also have expired since the last heartbeat
+    if not cancel_event.is_set() and not lease.renew():
+        lost.set()
+    try:
+        if lost.is_set():
+            print(f"[{job['cast']}] The lease of {lease.worker} expired, the job was given to another worker", file=sys.stderr)
+            return None
+        if cancel_event.is_set():
+            lease.release()
+            return None
+
+        outputs = [] if errors else publish_cast(work_dir, job["cast"], job["output_dir"])
+        for report_path in sorted(os.listdir(work_dir)) if os.path.isdir(work_dir) else []:
+            if report_path.startswith("ctd_run_") and report_path.endswith(".jsonl"):
+                shutil.copyfile(os.path.join(work_dir, report_path), os.path.join(
+                    lease.spool.folder(LOGS_DIR), f"{job['cast']}_{job['id']}_{job['attempt']}@{lease.worker}.jsonl"))
+        result = {"status": "failed" if errors else "done", "worker": lease.worker, "errors": errors, "outputs": outputs,
+                  "start": start, "end": time.time()}
+        if not lease.finish(result):
+            print(f"[{job['cast']}] The lease of {lease.worker} expired, the job was given to another worker", file=sys.stderr)
+            return None
+        print(f"[{job['cast']}] {result['status']} on {lease.worker} in {result['end'] - start:.1f} s")
+        return result
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def run_worker(spool_path, name=None, jobs=1, scratch_dir=None, executables_dir=None, exit_when_idle=False,
+               stop_event=None, poll_interval=POLL_INTERVAL):
+    """
+    Take jobs from the spool and run them, up to jobs casts at a time, until stop_event is set
+    (the jobs running are cancelled and given back) or, with exit_when_idle, until no job is
+    queued or leased. Each cast is processed in scratch_dir (a folder of the temporary
+    directory by default), on this machine. Returns the number of jobs run.
+    """
+    stop_event = stop_event or threading.Event()
+    spool = Spool(spool_path)
+    worker = worker_name(name)
+    scratch_dir = scratch_dir or os.path.join(tempfile.gettempdir(), "ctd_worker", worker)
+    os.makedirs(scratch_dir, exist_ok=True)
+    runs = []
+
+    def slot():
+        while not stop_event.is_set():
+            lease = spool.claim(worker)
+            if lease is None:
+                if exit_when_idle and spool.idle():
+                    return
+                stop_event.wait(poll_interval)
+                continue
+            if run_job(lease, scratch_dir, executables_dir, stop_event):
+                runs.append(lease.job["id"])
+
+    print(f"Worker {worker} taking jobs from {spool.path}, {jobs} cast(s) at a time")
+    slots = [threading.Thread(target=slot, daemon=True) for _ in range(max(1, int(jobs)))]
+    for thread in slots:
+        thread.start()
+    for thread in slots:
+        while thread.is_alive():
+            thread.join(0.5)
+    return len(runs)
@@ -0,0 +1,213 @@
+import os
+import threading
+import time
+
+import numpy as np
+
+import bin_average
+import cnv_file
+import ctd_pipeline
+import datcnv
+import hex_file
+import sbe_files
+import sea_plot
+import watch_folder
+
+# Seconds between two updates of the live profile and plots
+UPDATE_INTERVAL = 5.0
+
+# Seconds the .hex file must stop growing before the cast is taken as finished
+END_TIME = watch_folder.SETTLE_TIME
+
+# Seconds between two reads of the .hex file
+POLL_INTERVAL = 0.5
+
+# Appended to the cast name for the live files: <cast>_live.cnv and its plots (e.g. <cast>_live_TSOO.png)
+LIVE_APPEND = "_live"
+
+# Built-in stages that can follow a cast scan by scan (a stream(header, psa) function), by the SBE module they replace
+STREAM_MODULES = {module.SBE_MODULE: module for module in ctd_pipeline.NATIVE_STAGES.values() if hasattr(module, "stream")}
+
+
+def replace_file(path, write):
+    """Call write(temporary path) and rename the file to path, so a reader never sees half of it."""
+    temporary = path + ".tmp"
+    write(temporary)
+    os.replace(temporary, path)
+
+
+class LiveCast:
+    """
+    Follows a .hex file Seasave is still writing through the stages of a pipeline that can run
+    on part of a cast: Data Conversion (with the built-in converter), Align CTD, Cell Thermal
+    Mass and Filter (built-in, with their state carried from one block of scans to the next),
+    Bin Average (running sums per bin) and Sea Plot. Each update() costs only the scans
+    appended since the last one; write() writes the bin averages so far to <cast>_live.cnv and
+    plots them with every Sea Plot PSA. The other stages (e.g. Derive, Bottle Summary) are
+    listed in skipped and only run with the pipeline at the end of the cast.
+
+    Raises ValueError when the stages have no Data Conversion writing <cast>.cnv or no Bin
+    Average, or when the built-in converter does not support the Data Conversion PSA.
+    """
+
+    def __init__(self, raw_file, stages, psa_dir, output_file_dir):
+        self.raw_file = raw_file
+        self.base_name = ctd_pipeline.cast_name(raw_file)
+        self.output_path = os.path.join(output_file_dir, self.base_name + LIVE_APPEND + ".cnv")
+        self.settings = self.bin_settings = None
+        self.corrections, self.plots, self.skipped = [], [], []
+        for psa_file, _, _ in stages:
+            psa_path = os.path.join(psa_dir, psa_file)
+            psa = sbe_files.load_psa(psa_path)
+            if psa.module == "DatCnvW.exe" and self.settings is None and psa.value("CreateFile", "0") in ("0", "2"):
+                self.settings = datcnv.DatCnvSettings(psa_path)
+            elif psa.module in STREAM_MODULES:
+                self.corrections.append((STREAM_MODULES[psa.module], psa))
+            elif psa.module == "BinAvgW.exe" and self.bin_settings is None:
+                self.bin_settings = bin_average.BinAvgSettings(psa_path)
+            elif psa.module == "SeaPlotW.exe":
+                self.plots.append(sea_plot.SeaPlotSettings(psa_path))
+            else:
+                self.skipped.append(psa_file)
+        if self.settings is None:
+            raise ValueError("live processing needs a Data Conversion stage writing <cast>.cnv")
+        if self.bin_settings is None:
+            raise ValueError("live processing needs a Bin Average stage")
+        self.stage_names = [psa_file for psa_file, _, _ in stages if psa_file not in self.skipped]
+
+        self.tail = hex_file.HexTail(raw_file)
+        self.instrument = None
+        self.header = None
+        self.streams = []
+        self.bins = None
+        self.pressure_temperatures = None
+        self.scans = 0  # scans read from the .hex file
+        self.changed = False
+
+    def start(self, conversion, short_names, long_names, formats):
+        """Set up the header, the correction streams and the bins from the first converted block."""
+        history = [
+            f"# datcnv_date = {cnv_file.processing_date()}, live_cast.py",
+            f"# datcnv_in = {self.raw_file} {self.instrument_path}",
+            f"# datcnv_skipover = {self.settings.scans_to_skip}",
+        ]
+        self.header = datcnv.cnv_header(self.tail.header, short_names, long_names, formats, conversion, self.settings,
+                                        history)
+        self.header.values["interval"] = f"seconds: {1 / conversion.rate:g}"
+        self.streams = [module.stream(self.header, psa) for module, psa in self.corrections]
+        self.bins = bin_average.BinStream(self.header, self.bin_settings)
+
+    def update(self):
+        """Read, convert, correct and bin the scans appended since the last call. Returns their number."""
+        scans = self.tail.read()
+        if not len(scans):
+            return 0
+        if self.instrument is None:
+            self.instrument_path = ctd_pipeline.xmlcon_path(self.raw_file)
+            self.instrument = datcnv.Instrument(self.instrument_path)
+
+        # ScansToSkip and ScansToProcess of the Data Conversion PSA
+        first = self.scans
+        self.scans += len(scans)
+        settings = self.settings
+        end = len(scans) if settings.scans_to_process is None else settings.scans_to_skip + settings.scans_to_process - first
+        block = scans[max(settings.scans_to_skip - first, 0):max(end, 0)]
+        if not len(block):
+            return len(scans)
+
+        conversion = datcnv.Conversion(self.tail.header, block, self.instrument, max(first, settings.scans_to_skip) + 1,
+                                       settings.latitude, self.pressure_temperatures)
+        values, short_names, long_names, formats, _ = datcnv.convert_scans(conversion, settings)
+        # The pressure temperature is averaged over the scans before, so they are carried over
+        kept = conversion.pressure_window() - 1
+        numbers = conversion.pressure_temperature_numbers
+        before = np.full(kept, numbers[0]) if self.pressure_temperatures is None else self.pressure_temperatures
+        self.pressure_temperatures = np.concatenate([before, numbers])[len(before) + len(numbers) - kept:]
+
+        if self.header is None:
+            self.start(conversion, short_names, long_names, formats)
+        for stream in self.streams:
+            values = stream.push(values)
+        self.bins.add(values)
+        self.changed = True
+        return len(scans)
+
+    def finish(self):
+        """Pass the scans the corrections held back (e.g. for Align CTD's advances) to the bins, at the end of the cast."""
+        if self.header is None:
+            return
+        values = np.zeros((0, len(self.header.short_names)))
+        for stream in self.streams:
+            values = stream.push(values)
+            rest = stream.finish()
+            if rest is not None:
+                values = np.concatenate([values, rest])
+        self.bins.add(values)
+        self.changed = True
+
+    def write(self, final=False):
+        """
+        Write the bin averages so far to <cast>_live.cnv and plot them, replacing the earlier
+        files. With final=True (after finish()) the profile is the one of the whole cast.
+        Returns the number of bins, or None before the first scan.
+        """
+        if self.header is None:
+            return None
+        header = cnv_file.CnvHeader()
+        header.lines = list(self.header.lines)
+        header.bad_flag = self.header.bad_flag
+        values, header.short_names, header.long_names, header.formats = self.bins.profile(final)
+        bin_average.output_header(header, self.bin_settings, self.raw_file)
+        file_type = next((i for i, line in enumerate(header.lines) if line.startswith("# file_type")), len(header.lines))
+        header.lines[file_type:file_type] = [
+            f"# live_stages = {', '.join(self.stage_names)}",
+            f"# live_scans = {self.scans}{'' if final else ', cast in progress'}",
+        ]
+        replace_file(self.output_path, lambda path: cnv_file.write_cnv(path, header, values))
+
+        for settings in self.plots:
+            image = settings.output_path(self.output_path, os.path.dirname(self.output_path))
+            replace_file(image, lambda path: sea_plot.plot_values(settings, header, values, self.output_path, path,
+                                                                  settings.image_format))
+        self.changed = False
+        return len(values)
+
+
+def follow_cast(raw_file, stages, psa_dir, output_file_dir, update_interval=UPDATE_INTERVAL, end_time=END_TIME,
+                stop_event=None, poll_interval=POLL_INTERVAL):
+    """
+    Follow a cast while Seasave records it (see LiveCast), writing the live profile and plots
+    every update_interval seconds, until its .hex file has not grown for end_time seconds (the
+    file may not exist yet when this starts) or stop_event is set. The profile of the whole
+    cast is written at the end. Returns True when the cast ended, False when it was stopped.
+    """
+    os.makedirs(output_file_dir, exist_ok=True)
+    stop_event = stop_event or threading.Event()
+    live = LiveCast(raw_file, stages, psa_dir, output_file_dir)
+    if live.skipped:
+        print(f"[{live.base_name}] Not run live, only at the end of the cast: {', '.join(live.skipped)}")
+    print(f"[{live.base_name}] Following {raw_file}")
+
+    last_scan = None
+    next_update = time.monotonic() + update_interval
+    while True:
+        if live.update():
+            last_scan = time.monotonic()
+        now = time.monotonic()
+        if last_scan is not None and now - last_scan >= end_time:
+            ended = True
+            break
+        if now >= next_update and live.changed:
+            bins = live.write()
+            print(f"[{live.base_name}] {live.scans} scans, {bins} bins in {os.path.basename(live.output_path)}")
+            next_update = now + update_interval
+        if stop_event.wait(poll_interval):
+            ended = False
+            break
+
+    live.finish()
+    bins = live.write(final=ended)
+    if bins is not None:
+        print(f"[{live.base_name}] {'Cast ended' if ended else 'Stopped'}: {live.scans} scans, {bins} bins in "
+              f"{os.path.basename(live.output_path)}")
+    return ended
@@ -0,0 +1,143 @@
+import math
+
+import numpy as np
+
+import cnv_corrections
+import cnv_file
+
+# The Filter module this stage replaces, used to open its PSA files with "Edit PSA"
+SBE_MODULE = "FilterW.exe"
+
+# <FilterTypeArray> values (one per <CalcArray> variable) -> the time constant element used;
+# 0 leaves the variable alone. High-pass filters are left to FilterW.exe.
+FILTER_TYPES = {1: "LowPassTimeConstantA", 2: "LowPassTimeConstantB"}
+FILTER_NAMES = {0: "none", 1: "low pass A", 2: "low pass B"}
+
+# A FilterStream holds back the scans the backward pass has not yet settled on, to within this
+# fraction of a step in the data
+SETTLE_ERROR = 1e-6
+
+
+def low_pass(column, interval, time_constant):
+    """
+    SBE's single-pole low-pass filter (the bilinear transform of 1 / (1 + s time_constant)),
+    run forward then backward for no phase shift:
+    y[n] = a (x[n] + x[n-1]) - b y[n-1], a = 1 / (1 + 2 time_constant / interval), b = a (1 - 2 time_constant / interval).
+    Starting from the first value, a constant goes through unchanged. Bad values are
+    interpolated over and stay bad.
+    """
+    bad = np.isnan(column)
+    if bad.all() or time_constant <= 0:
+        return column
+    good = np.flatnonzero(~bad)
+    x = np.interp(np.arange(len(column)), good, column[good]) if bad.any() else column
+    a, b = coefficients(interval, time_constant)
+    for _ in range(2):
+        x = single_pass(x, a, b)[::-1]
+    return np.where(bad, np.nan, x)
+
+
+def coefficients(interval, time_constant):
+    """(a, b) of the low-pass filter."""
+    a = 1 / (1 + 2 * time_constant / interval)
+    return a, a * (1 - 2 * time_constant / interval)
+
+
+def single_pass(x, a, b, before=None, y0=None):
+    """One pass of the filter over x, continuing from the input before and the output y0 of the scan before it (default: x[0])."""
+    before = x[0] if before is None else before
+    return cnv_corrections.recursive_filter(a * (x + np.r_[before, x[:-1]]), -b, before if y0 is None else y0)
+
+
+def column_filters(header, psa):
+    """(column, filter type) of the variables a Filter PSA filters."""
+    types = [int(value or 0) for value in cnv_corrections.array_values(psa, "FilterTypeArray")]
+    filters = []
+    for column, filter_type in zip(cnv_corrections.variable_columns(header, psa), types):
+        if filter_type == 0 or column is None:
+            continue
+        if filter_type not in FILTER_TYPES:
+            raise ValueError(f"filter type {filter_type} is not supported by the built-in Filter, use FilterW.exe")
+        filters.append((column, filter_type))
+    return filters
+
+
+def correct(header, values, psa):
+    """Low-pass filter the variables of a Filter PSA. Returns the filter_* header lines."""
+    interval = cnv_corrections.scan_interval(header)
+    time_constants = {tag: float(psa.value(tag, "0")) for tag in FILTER_TYPES.values()}
+    filtered = []
+    for column, filter_type in column_filters(header, psa):
+        values[:, column] = low_pass(values[:, column], interval, time_constants[FILTER_TYPES[filter_type]])
+        filtered.append(f"{header.short_names[column]} = {FILTER_NAMES[filter_type]}")
+
+    input_file, _ = cnv_corrections.stage_files(psa)
+    return [
+        f"# filter_date = {cnv_file.processing_date()}, low_pass_filter.py",
+        f"# filter_in = {input_file}",
+        f"# filter_low_pass_tc_A = {time_constants['LowPassTimeConstantA']:g} seconds",
+        f"# filter_low_pass_tc_B = {time_constants['LowPassTimeConstantB']:g} seconds",
+        f"# filter_vars = {', '.join(filtered)}",
+    ]
+
+
+class FilterStream:
+    """
+    low_pass() for a cast that is still being recorded. The forward pass carries on from the
+    last scan returned; the backward pass starts from the last scan in, so push() returns the
+    scans far enough back for it to have settled (to SETTLE_ERROR) and finish() the rest, the
+    same as low_pass() over the whole cast. A bad value is interpolated once the next good
+    value is in.
+    """
+
+    def __init__(self, filters, interval):
+        self.filters = [(column,) + coefficients(interval, time_constant) for column, time_constant in filters
+                        if time_constant > 0]
+        poles = [abs(b) for _, _, b in self.filters if 0 < abs(b) < 1]
+        self.settle = max([math.ceil(math.log(SETTLE_ERROR) / math.log(pole)) for pole in poles], default=0)
+        self.buffer = None
+        self.state = {}  # column -> (input, forward output) of the last scan returned
+
+    def push(self, values):
+        self.buffer = values.copy() if self.buffer is None else np.concatenate([self.buffer, values])
+        end = len(self.buffer) - self.settle
+        for column, _, _ in self.filters:
+            # Scans after the last good value may still be interpolated differently
+            good = np.flatnonzero(~np.isnan(self.buffer[:, column]))
+            end = min(end, good[-1] + 1 - self.settle if len(good) else 0)
+        return self.filtered(max(end, 0))
+
+    def finish(self):
+        return self.filtered(len(self.buffer)) if self.buffer is not None else None
+
+    def filtered(self, end):
+        rows = self.buffer.copy()
+        for column, a, b in self.filters:
+            x = rows[:, column]
+            bad = np.isnan(x)
+            good = np.flatnonzero(~bad)
+            before, y0 = self.state.get(column, (None, None))
+            if not len(good) and before is None:
+                continue
+            if bad.any():
+                # Interpolated from the last good value returned, as low_pass() does over the whole cast
+                positions, known = (good, x[good]) if before is None else (np.r_[-1, good], np.r_[before, x[good]])
+                x = np.interp(np.arange(len(x)), positions, known)
+            forward = single_pass(x, a, b, before, y0)
+            if end:
+                self.state[column] = (x[end - 1], forward[end - 1])
+            rows[:, column] = np.where(bad, np.nan, single_pass(forward[::-1], a, b)[::-1])
+        self.buffer = self.buffer[end:]
+        return rows[:end]
+
+
+def stream(header, psa):
+    """A FilterStream for the variables of a Filter PSA."""
+    time_constants = {tag: float(psa.value(tag, "0")) for tag in FILTER_TYPES.values()}
+    return FilterStream([(column, time_constants[FILTER_TYPES[filter_type]]) for column, filter_type in column_filters(header, psa)],
+                        cnv_corrections.scan_interval(header))
+
+
+def run_psa(psa_path):
+    """Filter the input file of a rendered Filter PSA and write it to its output. Returns a one-line summary."""
+    return cnv_corrections.run_chain([(correct, psa_path)])
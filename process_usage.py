@@ -0,0 +1,107 @@
+import os
+import sys
+import time
+
+if sys.platform == "win32":
+    import ctypes
+    from ctypes import wintypes
+
+    class FILETIME(ctypes.Structure):
+        _fields_ = [("low", wintypes.DWORD), ("high", wintypes.DWORD)]
+
+    class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+        _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD),
+                    ("PeakWorkingSetSize", ctypes.c_size_t), ("WorkingSetSize", ctypes.c_size_t),
+                    ("QuotaPeakPagedPoolUsage", ctypes.c_size_t), ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                    ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t), ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                    ("PagefileUsage", ctypes.c_size_t), ("PeakPagefileUsage", ctypes.c_size_t)]
+
+    # A private instance, so the argument types set here do not change ctypes.windll.kernel32
+    kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    kernel32.OpenProcess.argtypes = [wintypes.DWORD, wintypes.BOOL, wintypes.DWORD]
+    kernel32.OpenProcess.restype = wintypes.HANDLE
+    kernel32.GetProcessTimes.argtypes = [wintypes.HANDLE] + [ctypes.POINTER(FILETIME)] * 4
+    kernel32.K32GetProcessMemoryInfo.argtypes = [wintypes.HANDLE, ctypes.POINTER(PROCESS_MEMORY_COUNTERS), wintypes.DWORD]
+    kernel32.CloseHandle.argtypes = [wintypes.HANDLE]
+
+# Access rights needed to read the times and memory counters of a child process on Windows
+PROCESS_QUERY_LIMITED_INFORMATION = 0x1000
+PROCESS_VM_READ = 0x0010
+
+
+def filetime_seconds(filetime):
+    """A FILETIME duration (100 ns units) in seconds."""
+    return ((filetime.high << 32) | filetime.low) / 1e7
+
+
+class ProcessUsage:
+    """
+    Waits for a child process (a subprocess.Popen) and measures what it used: CPU time (user
+    plus system, in seconds) and peak memory (MB; the peak working set on Windows, the
+    maximum resident set size elsewhere). Both stay None where they cannot be measured.
+
+    Call poll() instead of process.poll(): on POSIX the child is reaped with os.wait4(),
+    which returns its resource usage.
+    """
+
+    def __init__(self, process):
+        self.process = process
+        self.cpu_time = None
+        self.max_rss_mb = None
+        self.handle = None
+        if sys.platform == "win32":
+            # Opened now: the counters can be read from this handle after the process ends
+            self.handle = kernel32.OpenProcess(PROCESS_QUERY_LIMITED_INFORMATION | PROCESS_VM_READ, False, process.pid) or None
+
+    def poll(self):
+        """The exit code once the process has ended (its usage is then measured), else None."""
+        if self.process.returncode is not None:
+            return self.process.returncode
+        if hasattr(os, "wait4"):
+            try:
+                pid, status, rusage = os.wait4(self.process.pid, os.WNOHANG)
+            except ChildProcessError:
+                return self.process.poll()
+            if pid == 0:
+                return None
+            self.process.returncode = os.waitstatus_to_exitcode(status)
+            self.cpu_time = rusage.ru_utime + rusage.ru_stime
+            # ru_maxrss is in bytes on macOS, in kilobytes elsewhere
+            self.max_rss_mb = rusage.ru_maxrss / (1 << 20 if sys.platform == "darwin" else 1 << 10)
+            return self.process.returncode
+
+        returncode = self.process.poll()
+        if returncode is not None:
+            self.read_windows_counters()
+        return returncode
+
+    def wait(self, interval=0.2):
+        """Wait for the process to end; returns its exit code."""
+        while self.poll() is None:
+            time.sleep(interval)
+        return self.process.returncode
+
+    def read_windows_counters(self):
+        if self.handle is None:
+            return
+        try:
+            creation, exit_time, kernel, user = FILETIME(), FILETIME(), FILETIME(), FILETIME()
+            if kernel32.GetProcessTimes(self.handle, ctypes.byref(creation), ctypes.byref(exit_time),
+                                        ctypes.byref(kernel), ctypes.byref(user)):
+                self.cpu_time = filetime_seconds(kernel) + filetime_seconds(user)
+            counters = PROCESS_MEMORY_COUNTERS()
+            counters.cb = ctypes.sizeof(counters)
+            if kernel32.K32GetProcessMemoryInfo(self.handle, ctypes.byref(counters), counters.cb):
+                self.max_rss_mb = counters.PeakWorkingSetSize / (1 << 20)
+        finally:
+            self.close()
+
+    def close(self):
+        if self.handle is not None:
+            kernel32.CloseHandle(self.handle)
+            self.handle = None
+
+    def usage(self):
+        """{"cpu_time": s, "max_rss_mb": MB}, rounded, for the run report."""
+        return {"cpu_time": None if self.cpu_time is None else round(self.cpu_time, 3),
+                "max_rss_mb": None if self.max_rss_mb is None else round(self.max_rss_mb, 1)}
@@ -0,0 +1,93 @@
+import os
+import re
+import threading
+from xml.sax.saxutils import escape
+
+# The PSA elements that are filled in for each cast
+SLOT_PATTERN = re.compile(
+    r'<(?P<tag>InputDir|OutputDir|InstrumentPath|OutputFile)\s+value="[^"]*"\s*/>'
+    r'|<InputFileArray\b[^>]*?/>'
+    r'|<InputFileArray\b[^>]*>.*?</InputFileArray>',
+    re.IGNORECASE | re.DOTALL)
+
+SLOT_NAMES = {"inputdir": "InputDir", "outputdir": "OutputDir", "instrumentpath": "InstrumentPath", "outputfile": "OutputFile"}
+
+_cache_lock = threading.Lock()
+_templates = {}
+
+
+def clean_path(path):
+    """Absolute path with forward slashes, as SBE Data Processing writes them (avoids \\U errors)."""
+    return os.path.abspath(path).replace("\\", "/")
+
+
+def attr(value):
+    """Escape a value for use inside a double-quoted XML attribute."""
+    return escape(value, {'"': "&quot;"})
+
+
+class PsaTemplate:
+    """
+    A PSA file split once into literal text and substitution slots
+    (InputDir, OutputDir, InstrumentPath, InputFileArray and OutputFile).
+    Rendering for a cast only joins strings, the PSA is not parsed again.
+    """
+
+    def __init__(self, path, content):
+        self.path = path
+        self.parts = []
+        self.slots = set()
+
+        position = 0
+        for match in SLOT_PATTERN.finditer(content):
+            slot = SLOT_NAMES[match.group("tag").lower()] if match.group("tag") else "InputFileArray"
+            self.parts.append(content[position:match.start()])
+            self.parts.append((slot,))
+            self.slots.add(slot)
+            position = match.end()
+        self.parts.append(content[position:])
+
+    def render(self, input_dir, output_dir, instrument_path, input_files, output_file):
+        """Return the PSA text for one cast. Slots missing from the file are not added."""
+        values = {
+            "InputDir": f'<InputDir value="{attr(clean_path(input_dir))}" />',
+            "OutputDir": f'<OutputDir value="{attr(clean_path(output_dir))}" />',
+            "InstrumentPath": f'<InstrumentPath value="{attr(clean_path(instrument_path))}" />',
+            "OutputFile": f'<OutputFile value="{attr(output_file)}" />',
+            "InputFileArray": render_input_file_array(input_files),
+        }
+        return "".join(part if isinstance(part, str) else values[part[0]] for part in self.parts)
+
+    def write(self, path, *args):
+        """Render the template and write it to path."""
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(self.render(*args))
+        return path
+
+
+def render_input_file_array(input_files):
+    if not input_files:
+        return '<InputFileArray size="0" GrowBy="-1" />'
+
+    items = "".join(f'    <ArrayItem index="{index}" value="{attr(name)}" />\n'
+                    for index, name in enumerate(input_files))
+    return f'<InputFileArray size="{len(input_files)}" GrowBy="-1" >\n{items}  </InputFileArray>'
+
+
+def compile_psa(path):
+    """Return the template for a PSA file, parsing it only when the file changed since the last call."""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = (stat.st_size, stat.st_mtime_ns)
+
+    with _cache_lock:
+        cached = _templates.get(path)
+        if cached and cached[0] == key:
+            return cached[1]
+
+    with open(path, "r", encoding="utf-8") as f:
+        template = PsaTemplate(path, f.read())
+
+    with _cache_lock:
+        _templates[path] = (key, template)
+    return template
@@ -1,11 +1,15 @@
-import tkinter as tk
-from tkinter import filedialog, messagebox, ttk
 import os
 import subprocess
 import json
-import sv_ttk
-import re
-import pywinstyles, sys
+import sys
+import queue
+import threading
+import time
+
+# GUI-only modules (tkinter, sv_ttk, pywinstyles) are imported by load_gui_modules()
+# so that headless command-line runs never load Tk. The pipeline modules (and NumPy with
+# them) are imported by the functions that use them.
+tk = filedialog = messagebox = ttk = sv_ttk = pywinstyles = None
 
 def get_base_dir():
     if getattr(sys, 'frozen', False):
@@ -18,28 +22,64 @@ def get_base_dir():
 
 BASE_DIR = get_base_dir()
 LAST_USED_CONFIG_FILE = os.path.join(BASE_DIR, "last_used_config.json")
-print(f"Using last used config file at: {LAST_USED_CONFIG_FILE}")
-
-# Initialize the GUI
-root = tk.Tk()
 
-# Global variables for the configuration values
-raw_files_var = tk.StringVar()
-psa_dir_var = tk.StringVar()
-executables_dir_var = tk.StringVar()
-output_file_var = tk.StringVar()
+# Global variables for the configuration values (the Tk variables are created in build_gui())
+root = None
+raw_files_var = None
+psa_dir_var = None
+executables_dir_var = None
+output_file_var = None
+jobs_var = None
+batch_size_var = None
+timeout_var = None
+scratch_dir_var = None
+incremental_var = None
+raw_file_var = []
 executables = []
 sbedataprocessing_exe = ""
 
-# Create an empty list to store the frames for each PSA file
-psa_frames = []
-psa_files_frame = tk.Frame(root)  # Initialize psa_files_frame as a Tkinter frame
+# PSA table: one Treeview row per PSA file (its iid is the file name) and the values of
+# each row by file name, {psa_file: {"executable": ..., "order": ..., "selected": ...}}
+psa_table = None
+psa_rows = {}
+# The widget editing a cell of the PSA table, and the function saving its value
+psa_cell_editor = None
+NO_EXECUTABLE = "Select Executable Path"
+# Extra stage dependencies from the configuration: {psa_file: [psa files it runs after]}
+stage_after = {}
+# Stages with a timeout of their own ({psa_file: seconds}) and the retries after a timeout, from the configuration
+stage_timeouts = {}
+stage_retries = None  # set by build_gui() and load_config_to_gui()
+psa_files_frame = None
+raw_file_display_label = None
+process_button = None
+# Catalog file from the configuration ("" for the default, in the output directory), and
+# the configuration file last loaded or saved, recorded with the casts in the catalog
+catalog_path = ""
+current_config_path = ""
+# File patterns published from the scratch folder, from the configuration (empty: the final products of the pipeline)
+publish_patterns = []
+
+# Background processing thread (only one batch runs at a time)
+processing_thread = None
+
+def load_gui_modules():
+    """Import the GUI-only modules into the module namespace."""
+    global tk, filedialog, messagebox, ttk, sv_ttk, pywinstyles
+    import tkinter as tk
+    from tkinter import filedialog, messagebox, ttk
+    import sv_ttk
+    import pywinstyles
 
 def update_psa_files():
     """
-    Update all .psa files with the correct InstrumentPath, InputDir, and OutputDir.
+    Update all .psa files in the PSA directory with the InstrumentPath, InputDir, OutputDir,
+    input file and output file of the first selected raw file.
     Resolves relative paths to absolute paths and escapes backslashes.
     """
+    import ctd_pipeline
+    import psa_template
+
     updated_files = []
     errors = []
 
@@ -64,60 +104,21 @@ def update_psa_files():
         messagebox.showinfo("PSA Update", "No PSA files found in the PSA directory.")
         return
 
-    for raw_file in raw_files:
-            base_name = os.path.splitext(os.path.basename(raw_file))[0]
-            raw_dir = os.path.dirname(raw_file)
-
-            for psa_file in psa_files:
-                psa_path = os.path.abspath(os.path.join(psa_dir, psa_file))
-
-                # Match executable type
-                exe_basename = ""
-                for exe in executables:
-                    if exe.lower() in psa_file.lower():
-                        exe_basename = exe.lower()
-                        break
-
-                # Determine InputDir
-                if "datcnvw" in exe_basename:
-                    input_dir = raw_dir
-                elif "bottlesumw" in exe_basename:
-                    ros_file = f"{base_name}.ros"
-                    input_dir = os.path.join(output_file_dir, ros_file)
-                else:
-                    input_dir = output_file_dir
-
-                # Convert all paths to forward slashes to avoid \U errors
-                input_dir = os.path.abspath(input_dir).replace("\\", "/")
-                output_file_dir_clean = os.path.abspath(output_file_dir).replace("\\", "/")
-                xmlcon_file = f"{base_name}.XMLCON"
-                instrument_path = os.path.abspath(os.path.join(raw_dir, xmlcon_file)).replace("\\", "/")
+    # The shared PSA files are only pointed at one cast (the first selected) so they can be
+    # opened with "Edit PSA"; processing renders its own copy of each PSA for every cast.
+    raw_file = raw_files[0]
+    selected_executables = {psa_file: row["executable"] for psa_file, row in psa_rows.items()}
 
-                try:
-                    with open(psa_path, "r", encoding="utf-8") as f:
-                        content = f.read()
+    for psa_file in psa_files:
+        psa_path = os.path.abspath(os.path.join(psa_dir, psa_file))
+        executable = selected_executables.get(psa_file, "")
 
-                    # Update InputDir and OutputDir
-                    content = re.sub(r'\s*<InputDir\s+value="[^"]*"\s*/>',
-                                    f'  <InputDir value="{input_dir}" />',
-                                    content, flags=re.IGNORECASE)
-
-                    content = re.sub(r'\s*<OutputDir\s+value="[^"]*"\s*/>',
-                                    f'  <OutputDir value="{output_file_dir_clean}" />',
-                                    content, flags=re.IGNORECASE)
-                    
-                    # Update InstrumentPath only if it exists
-                    if re.search(r'<InstrumentPath value=".*?" ?/>', content):
-                        content = re.sub(r'<InstrumentPath value=".*?" ?/>',
-                                        f'<InstrumentPath value="{instrument_path}" />', content)
-
-                    with open(psa_path, "w", encoding="utf-8") as f:
-                        f.write(content)
-
-                    updated_files.append(psa_path)
-
-                except Exception as e:
-                    errors.append(f"{psa_path}: {e}")
+        try:
+            template = psa_template.compile_psa(psa_path)
+            template.write(psa_path, *ctd_pipeline.stage_psa_values(executable, raw_file, output_file_dir))
+            updated_files.append(psa_path)
+        except Exception as e:
+            errors.append(f"{psa_path}: {e}")
 
     # Show updated files window
     if updated_files:
@@ -151,9 +152,9 @@ def show_updated_files_window(file_list):
     ttk.Button(window, text="Close", command=window.destroy).pack(pady=10)
 
 # Popup window for errors
-def show_errors_window(error_list):
+def show_errors_window(error_list, title="Errors Updating PSA Files"):
     window = tk.Toplevel(root)
-    window.title("Errors Updating PSA Files")
+    window.title(title)
     window.geometry("500x400")
 
     label = tk.Label(window, text="The following errors occurred:", font=("Arial", 12), fg="red")
@@ -223,17 +224,15 @@ def edit_xml_file():
         return
 
     selected_psa_file = []
-    for psa_frame, executable_dropdown, select_var, *_ in psa_frames:
-        if select_var.get():
-            selected_executable = executable_dropdown.get()
-
-            psa_file = psa_frame.winfo_children()[0].cget("text")
+    for psa_file, row in psa_rows.items():
+        if row["selected"]:
+            selected_executable = row["executable"]
 
-            if selected_executable == "Select Executable Path":
+            if selected_executable == NO_EXECUTABLE:
                 messagebox.showerror("Error", f"Please select an executable for {psa_file}.")
                 return
             
-            executable_path = os.path.join(executables_dir_var.get(), selected_executable) if selected_executable != "Select Executable Path" else ""
+            executable_path = os.path.join(executables_dir_var.get(), selected_executable)
             selected_psa_file.append((psa_file, executable_path))
 
     for psa_file, executable, _ in selected_psa_file:
@@ -259,6 +258,13 @@ def edit_xml_file():
 psa_dir_path = ""  # Global variable to store the selected PSA directory
 
 def open_in_sbedataprocessing(psa_dir, psa_file, executable_name):
+    import ctd_pipeline
+
+    # Built-in stages read the PSA of the SBE module they replace, so edit it with that module
+    native = ctd_pipeline.native_stage(executable_name)
+    if native:
+        executable_name = native.SBE_MODULE
+
     # Construct the full path to the executable based on the provided executable name
     sbedataprocessing_exe = os.path.join(executables_dir_var.get(), executable_name)
     print(executable_name)
@@ -279,19 +285,16 @@ def open_in_sbedataprocessing(psa_dir, psa_file, executable_name):
         messagebox.showerror("Error", f"The PSA file '{psa_file}' does not exist.")
         return
 
-    # Wrap executable path and PSA file path in quotes to handle spaces
-    psa_file_path = f'"{psa_file_path}"'
-
     # Log the command to check for issues
-    print(f"Running: {executable_name} {psa_file_path}")
+    print(f"Running: {sbedataprocessing_exe} {psa_file_path}")
 
-    # Launch the executable with the PSA file as an argument
+    # Launch the executable with the PSA file as an argument (no shell: paths with spaces need no quotes)
     try:
-        result = subprocess.run([executable_name, psa_file_path], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=True)
+        result = subprocess.run([sbedataprocessing_exe, psa_file_path], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
         print("Output:", result.stdout)
         print("Error:", result.stderr)
     except FileNotFoundError:
-        messagebox.showerror("Error", f"Executable '{executable_name}' not found at: {executable_name}")
+        messagebox.showerror("Error", f"Executable '{executable_name}' not found at: {sbedataprocessing_exe}")
     except subprocess.CalledProcessError as e:
         # Capture and display any error output
         messagebox.showerror("Error", f"Failed to open PSA file with {executable_name}: {e.stderr}")
@@ -302,11 +305,10 @@ def load_psa_files(psa_dir):
 
     psa_dir_path = psa_dir  # Set the global PSA directory
 
-    # Clear previous frames
-    for frame in psa_frames:
-        frame[0].destroy()  # Destroy only the frame widget (frame[0])
-
-    psa_frames.clear()  # Clear the list of frames to avoid reusing old frames
+    # Clear the previous rows
+    close_psa_cell_editor(save=False)
+    psa_table.delete(*psa_table.get_children())
+    psa_rows.clear()
 
     # List all .psa files in the selected directory
     psa_files = [f for f in os.listdir(psa_dir) if f.endswith('.psa')]
@@ -315,37 +317,162 @@ def load_psa_files(psa_dir):
         messagebox.showwarning("No Files Found", "No .psa files found in the selected directory.")
         return
 
-    # Create a frame for each PSA file
+    # One row per PSA file: no executable, order by position, selected
     for idx, psa_file in enumerate(psa_files):
-        psa_frame = tk.Frame(psa_files_frame)
-        psa_frame.grid(row=idx, sticky="ew", pady=5)
+        psa_rows[psa_file] = {"executable": NO_EXECUTABLE, "order": str(idx + 1), "selected": True}
+        psa_table.insert("", "end", iid=psa_file, text=psa_file, values=psa_row_values(psa_rows[psa_file]))
 
-        # PSA file name label
-        psa_label = tk.Label(psa_frame, text=psa_file, width=30)
-        psa_label.grid(row=0, column=0, padx=5)
 
-        executable_dropdown = ttk.Combobox(psa_frame, values=["Select Executable Path"] + executables)
-        executable_dropdown.grid(row=0, column=1, padx=5)
+def psa_row_values(row):
+    """The cells of a PSA table row after the file name: executable, order, run."""
+    return (row["executable"], row["order"], "Yes" if row["selected"] else "No")
 
-        # Order number entry (initially 1)
-        order_entry = tk.Entry(psa_frame, width=5)
-        order_entry.insert(0, str(idx + 1))  # Default order number is idx + 1
-        order_entry.grid(row=0, column=2, padx=5)
 
-        # Select/Deselect checkbox
-        select_var = tk.BooleanVar(value=True)  # Default is selected
-        select_checkbox = ttk.Checkbutton(psa_frame, text="Run", variable=select_var, style="TCheckbutton")
-        select_checkbox.grid(row=0, column=3, padx=5)
+def set_psa_row(psa_file, **values):
+    """Change the values of a PSA file's row, e.g. set_psa_row("EN_BinAvg.psa", selected=False)."""
+    row = psa_rows[psa_file]
+    row.update(values)
+    psa_table.item(psa_file, values=psa_row_values(row), tags=() if row["selected"] else ("skipped",))
 
-        # Edit PSA Button to open the file in SBEDataprocessing
-        edit_button = ttk.Button(psa_frame, text="Edit PSA", command=lambda psa_file=psa_file, psa_dir=psa_dir, executable_dropdown=executable_dropdown: open_in_sbedataprocessing(psa_dir, psa_file, executable_dropdown.get()))
-        edit_button.grid(row=0, column=4, padx=5)
 
-        # Store the widgets in a tuple for later use
-        psa_frames.append((psa_frame, executable_dropdown, order_entry, select_var, select_checkbox, edit_button))
+def executable_choices():
+    import ctd_pipeline
+
+    return [NO_EXECUTABLE] + executables + list(ctd_pipeline.NATIVE_STAGES)
+
+
+def build_psa_table(parent):
+    """
+    The PSA table with its scrollbar and Edit PSA button, in a new frame of parent.
+
+    A Treeview only draws the rows in view, so hundreds of PSA files cost no widgets. Double-
+    click an Executable or Order cell to edit it in place, click a Run cell (or press Space
+    on the selected rows) to switch it, and double-click a file name to edit the PSA.
+    """
+    global psa_table
+    frame = tk.Frame(parent)
+    frame.grid_rowconfigure(0, weight=1)
+    frame.grid_columnconfigure(0, weight=1)
+
+    psa_table = ttk.Treeview(frame, columns=("executable", "order", "run"), height=12)
+    psa_table.heading("#0", text="PSA File", anchor="w")
+    psa_table.heading("executable", text="Executable", anchor="w")
+    psa_table.heading("order", text="Order")
+    psa_table.heading("run", text="Run")
+    psa_table.column("#0", width=240)
+    psa_table.column("executable", width=200)
+    psa_table.column("order", width=60, anchor="center", stretch=False)
+    psa_table.column("run", width=60, anchor="center", stretch=False)
+    psa_table.tag_configure("skipped", foreground="gray")
+
+    scrollbar = ttk.Scrollbar(frame, orient="vertical", command=psa_table.yview)
+
+    def scrolled(first, last):
+        # A cell editor is placed over its cell, so it is closed when the rows move
+        close_psa_cell_editor()
+        scrollbar.set(first, last)
+
+    psa_table.configure(yscrollcommand=scrolled)
+    psa_table.grid(row=0, column=0, sticky="nsew")
+    scrollbar.grid(row=0, column=1, sticky="ns")
+
+    psa_table.bind("<Button-1>", on_psa_table_click)
+    psa_table.bind("<Double-Button-1>", on_psa_table_double_click)
+    psa_table.bind("<space>", toggle_selected_psa_rows)
+
+    ttk.Button(frame, text="Edit PSA", command=edit_focused_psa).grid(row=1, column=0, columnspan=2, pady=5, sticky="e")
+    return frame
+
+
+def on_psa_table_click(event):
+    close_psa_cell_editor()
+    if psa_table.identify_region(event.x, event.y) != "cell":
+        return
+    psa_file = psa_table.identify_row(event.y)
+    if psa_table.column(psa_table.identify_column(event.x), "id") == "run":
+        set_psa_row(psa_file, selected=not psa_rows[psa_file]["selected"])
+
+
+def on_psa_table_double_click(event):
+    psa_file = psa_table.identify_row(event.y)
+    if not psa_file:
+        return
+    region = psa_table.identify_region(event.x, event.y)
+    column = psa_table.column(psa_table.identify_column(event.x), "id")
+    if region == "tree" or column == "":
+        open_in_sbedataprocessing(psa_dir_path, psa_file, psa_rows[psa_file]["executable"])
+    elif column in ("executable", "order"):
+        open_psa_cell_editor(psa_file, column)
+    return "break"
+
+
+def toggle_selected_psa_rows(event=None):
+    for psa_file in psa_table.selection():
+        set_psa_row(psa_file, selected=not psa_rows[psa_file]["selected"])
+    return "break"
+
+
+def edit_focused_psa():
+    psa_file = psa_table.focus()
+    if not psa_file:
+        messagebox.showinfo("Edit PSA", "Select a PSA file in the table first.")
+        return
+    open_in_sbedataprocessing(psa_dir_path, psa_file, psa_rows[psa_file]["executable"])
+
+
+def open_psa_cell_editor(psa_file, column):
+    """Place a Combobox (executable) or Entry (order) over a cell of the PSA table."""
+    global psa_cell_editor
+    close_psa_cell_editor()
+    psa_table.see(psa_file)
+    bbox = psa_table.bbox(psa_file, column)
+    if not bbox:
+        return
+    x, y, width, height = bbox
+
+    if column == "executable":
+        editor = ttk.Combobox(psa_table, values=executable_choices())
+        editor.set(psa_rows[psa_file]["executable"])
+        editor.bind("<<ComboboxSelected>>", lambda event: close_psa_cell_editor())
+    else:
+        editor = ttk.Entry(psa_table)
+        editor.insert(0, psa_rows[psa_file]["order"])
+        editor.select_range(0, "end")
+    editor.place(x=x, y=y, width=width, height=height)
+    editor.focus_set()
+
+    def save():
+        set_psa_row(psa_file, **{column: editor.get().strip() or psa_rows[psa_file][column]})
+
+    def focus_out(event):
+        # The Combobox list takes the focus while it is open; only close once it is elsewhere
+        def check():
+            focus = str(root.tk.call("focus"))
+            if psa_cell_editor and psa_cell_editor[0] is editor and not focus.startswith(str(editor)):
+                close_psa_cell_editor()
+        root.after_idle(check)
+
+    editor.bind("<Return>", lambda event: close_psa_cell_editor())
+    editor.bind("<Escape>", lambda event: close_psa_cell_editor(save=False))
+    editor.bind("<FocusOut>", focus_out)
+    psa_cell_editor = (editor, save)
+
+
+def close_psa_cell_editor(save=True):
+    """Close the open cell editor of the PSA table, saving its value unless save is False."""
+    global psa_cell_editor
+    if psa_cell_editor is None:
+        return
+    editor, save_value = psa_cell_editor
+    psa_cell_editor = None
+    if save:
+        save_value()
+    editor.destroy()
+    psa_table.focus_set()
 
 # Function to load the last used configuration (only at the start of the app)
 def load_last_used_config():
+    global current_config_path
     print(LAST_USED_CONFIG_FILE)
     if os.path.exists(LAST_USED_CONFIG_FILE):  # Check if the last used config file exists
         try:
@@ -356,6 +483,7 @@ def load_last_used_config():
                     with open(config_file_path, "r") as config_file:
                         config = json.load(config_file)
                         load_config_to_gui(config)  # Update the GUI with the loaded config
+                    current_config_path = config_file_path
                 else:
                     messagebox.showinfo("Info", "Last used config file not found. Please select a new one.")
         except Exception as e:
@@ -381,6 +509,8 @@ def load_config():
         messagebox.showerror("Error", f"Failed to load configuration: {e}")
 
 def save_last_used_config(file_path):
+    global current_config_path
+    current_config_path = file_path
     try:
         with open(LAST_USED_CONFIG_FILE, "w") as f:
             json.dump({"config_file_path": file_path}, f)
@@ -389,6 +519,8 @@ def save_last_used_config(file_path):
         print(f"Error saving last used config: {e}")
 
 def load_config_to_gui(config):
+    import ctd_pipeline
+
     # Update the GUI with values from the loaded configuration
     # Load list of raw files
     raw_files = config.get("raw_files", [])  # Make sure your saved config uses this key
@@ -404,36 +536,34 @@ def load_config_to_gui(config):
     psa_dir_var.set(config.get("psa_dir", ""))
     executables_dir_var.set(config.get("executables_dir", ""))
     output_file_var.set(config.get("output_file", ""))
-
-    # Load executables list
-    global executables
+    jobs_var.set(config.get("jobs", 1))
+    batch_size_var.set(config.get("batch_size", 1))
+    timeout_var.set(config.get("stage_timeout", ctd_pipeline.STAGE_TIMEOUT))
+    scratch_dir_var.set(config.get("scratch_dir", ""))
+    incremental_var.set(config.get("incremental", True))
+
+    # Load executables list, the catalog file, the stage retries and the published files
+    global executables, catalog_path, stage_retries, publish_patterns
     executables = config.get("executables", [])
+    catalog_path = config.get("catalog", "")
+    stage_retries = config.get("stage_retries", ctd_pipeline.STAGE_RETRIES)
+    publish_patterns = config.get("publish", [])
 
     # Load PSA files and their respective data
     load_psa_files(config["psa_dir"])
+    stage_after.clear()
+    stage_after.update(ctd_pipeline.stage_dependencies(config))
+    stage_timeouts.clear()
+    stage_timeouts.update(ctd_pipeline.stage_limits(config).timeouts)
 
-    # Update PSA file data from the config
+    # Update PSA file data from the config; entries for files no longer in the directory are ignored
     for psa_data in config["psa_files"]:
-        for psa_frame, executable_dropdown, order_entry, select_var, select_checkbox, *_ in psa_frames:  # Update here
-            # Check if the psa_frame has the correct PSA file
-            if psa_frame.winfo_children()[0].cget("text") == psa_data["psa_file"]:
-                # Update the executable dropdown
-                executable = psa_data["executable"]
-                executable_name = os.path.basename(executable) if executable else "Select Executable Path"
-                executable_dropdown.set(executable_name)
-
-                # Update the order entry
-                order_entry.delete(0, tk.END)
-                order_entry.insert(0, psa_data["order"])
-
-                # Update the checkbox
-                select_var.set(psa_data["selected"])  # Set the checkbox state
-
-                # Update the Checkbutton state
-                if select_var.get():
-                    select_checkbox.state(["selected"])
-                else:
-                    select_checkbox.state(["!selected"])
+        if psa_data["psa_file"] in psa_rows:
+            executable = psa_data["executable"]
+            set_psa_row(psa_data["psa_file"],
+                        executable=os.path.basename(executable) if executable else NO_EXECUTABLE,
+                        order=str(psa_data["order"]),
+                        selected=bool(psa_data["selected"]))
 
 
 # Function to select the directory containing executable files
@@ -446,10 +576,10 @@ def select_executables_directory():
         executables = [f for f in os.listdir(dir_path) if f.endswith('.exe')]
         print(f"Available executables: {executables}")
 
-        # Update dropdowns with the available executables
-        for _, executable_dropdown, _, _ in psa_frames:
-            executable_dropdown["values"] = ["Select Executable Path"] + executables
-            executable_dropdown.set("Select Executable Path")
+        # The executables chosen so far may not be in the new directory
+        close_psa_cell_editor(save=False)
+        for psa_file in psa_rows:
+            set_psa_row(psa_file, executable=NO_EXECUTABLE)
 
 # Function to save the current configuration to a user-selected config file
 def save_config():
@@ -464,27 +594,39 @@ def save_config():
         "executables_dir": executables_dir_var.get(),
         "executables": executables,
         "output_file": output_file_var.get(),  # Add output file path
+        "jobs": jobs_var.get(),
+        "batch_size": batch_size_var.get(),
+        "stage_timeout": timeout_var.get(),
+        "stage_retries": stage_retries,
+        "incremental": incremental_var.get(),
         "psa_files": []
     }
+    if catalog_path:
+        config["catalog"] = catalog_path
+    if scratch_dir_var.get():
+        config["scratch_dir"] = scratch_dir_var.get()
+    if publish_patterns:
+        config["publish"] = publish_patterns
 
-    for psa_frame, executable_dropdown, order_entry, select_var, select_checkbox, _ in psa_frames:
-        psa_file = psa_frame.winfo_children()[0].cget("text")  # Get the actual string
-        executable = executable_dropdown.get()
-        order = order_entry.get()
+    close_psa_cell_editor()
+    for psa_file in psa_table.get_children():
+        row = psa_rows[psa_file]
 
         # Save the executable file path instead of just the name
         executable_path = ""
-        if executable != "Select Executable Path":
-            executable_path = os.path.join(executables_dir_var.get(), executable)
-
-        selected = select_var.get()
+        if row["executable"] != NO_EXECUTABLE:
+            executable_path = os.path.join(executables_dir_var.get(), row["executable"])
 
         config["psa_files"].append({
             "psa_file": psa_file,
             "executable": executable_path,
-            "order": order,
-            "selected": selected
+            "order": row["order"],
+            "selected": row["selected"]
         })
+        if psa_file in stage_after:
+            config["psa_files"][-1]["after"] = stage_after[psa_file]
+        if psa_file in stage_timeouts:
+            config["psa_files"][-1]["timeout"] = stage_timeouts[psa_file]
 
     try:
         with open(file_path, "w") as f:
@@ -501,6 +643,9 @@ def save_config():
 
 # Main processing function
 def process_data():
+    import cast_catalog
+    import ctd_pipeline
+
     print(f"raw_file_var = {raw_file_var}")
     raw_files = raw_files_var.get().split(";")
     raw_files = [os.path.normpath(f.strip('"')) for f in raw_files if f]
@@ -520,23 +665,22 @@ def process_data():
         messagebox.showerror("Error", "Please select an output file path.")
         return
 
+    close_psa_cell_editor()
     selected_psa_files = []
-    for psa_frame, executable_dropdown, order_entry, select_var, *_ in psa_frames:
-        if select_var.get():
-            selected_executable = executable_dropdown.get()
+    for psa_file, row in psa_rows.items():
+        if row["selected"]:
+            selected_executable = row["executable"]
 
-            psa_file = psa_frame.winfo_children()[0].cget("text")
-
-            if selected_executable == "Select Executable Path":
+            if selected_executable == NO_EXECUTABLE:
                 messagebox.showerror("Error", f"Please select an executable for {psa_file}.")
                 return
             try:
-                order = int(order_entry.get())
+                order = int(row["order"])
             except ValueError:
                 messagebox.showerror("Error", f"Invalid order number for {psa_file}. Please enter a valid integer.")
                 return
             
-            executable_path = os.path.join(executables_dir_var.get(), selected_executable) if selected_executable != "Select Executable Path" else ""
+            executable_path = os.path.join(executables_dir_var.get(), selected_executable)
             selected_psa_files.append((psa_file, executable_path, order))
 
     if not selected_psa_files:
@@ -545,53 +689,268 @@ def process_data():
 
     selected_psa_files.sort(key=lambda x: x[2])
 
+    # Each cast gets its own rendered PSA copies, so stages of several casts can run at once
+    try:
+        jobs = max(1, int(jobs_var.get()))
+    except (ValueError, tk.TclError):
+        messagebox.showerror("Error", "Invalid number of parallel casts. Please enter a valid integer.")
+        return
+    try:
+        batch_size = max(1, int(batch_size_var.get()))
+    except (ValueError, tk.TclError):
+        messagebox.showerror("Error", "Invalid number of casts per module run. Please enter a valid integer.")
+        return
+    try:
+        limits = ctd_pipeline.StageLimits(max(0, int(timeout_var.get())), stage_retries, stage_timeouts)
+    except (ValueError, tk.TclError):
+        messagebox.showerror("Error", "Invalid stage timeout. Please enter a number of seconds (0 for no limit).")
+        return
+
+    # Stages work in the scratch folder, if one is set; only the final products reach the output directory
+    workspace = ctd_pipeline.workspace({"scratch_dir": scratch_dir_var.get(), "publish": publish_patterns}, output_file_dir)
+
+    # Processed casts are registered in the catalog as they finish
+    try:
+        os.makedirs(output_file_dir, exist_ok=True)
+        catalog = cast_catalog.CastCatalog(cast_catalog.catalog_path({"catalog": catalog_path}, output_file_dir),
+                                           current_config_path or None)
+    except Exception as e:
+        messagebox.showerror("Error", f"Cannot open the cast catalog: {e}")
+        return
+
+    # Run the batch on a background thread; it reports back through the events queue
+    global processing_thread
+    events = queue.Queue()
+    cancel_event = threading.Event()
+    progress = show_progress_window(raw_files, selected_psa_files, cancel_event)
+    progress["catalog"] = catalog
+
+    processing_thread = threading.Thread(
+        target=ctd_pipeline.process_casts,
+        args=(raw_files, selected_psa_files, psa_dir, output_file_dir),
+        kwargs={"jobs": jobs, "incremental": incremental_var.get(), "events": events, "cancel_event": cancel_event,
+                "after": stage_after, "catalog": catalog, "batch_size": batch_size, "limits": limits,
+                "workspace": workspace},
+        daemon=True)
+    processing_thread.start()
+    process_button.state(["disabled"])
+
+    root.after(200, poll_progress, events, progress, time.time())
+
+
+# Non-modal progress panel: one row per cast, one column per stage
+def show_progress_window(raw_files, stages, cancel_event):
+    import ctd_pipeline
+
+    window = tk.Toplevel(root)
+    window.title("Processing Progress")
+    window.geometry("800x450")
+
+    columns = [psa_file for psa_file, *_ in stages]
+    tree = ttk.Treeview(window, columns=columns, show="tree headings", height=min(len(raw_files), 12))
+    tree.heading("#0", text="Cast")
+    tree.column("#0", width=100, stretch=False)
+    for psa_file in columns:
+        tree.heading(psa_file, text=os.path.splitext(psa_file)[0])
+        tree.column(psa_file, width=100, anchor="center")
     for raw_file in raw_files:
-        base_name = os.path.splitext(os.path.basename(raw_file))[0]
-        output_file = f"{base_name}.cnv"
+        cast = ctd_pipeline.cast_name(raw_file)
+        if not tree.exists(cast):
+            tree.insert("", "end", iid=cast, text=cast, values=["waiting"] * len(columns))
+    tree.pack(padx=10, pady=10, fill="both", expand=True)
+
+    status_label = tk.Label(window, text="Elapsed: 0:00:00", anchor="w")
+    status_label.pack(padx=10, fill="x")
+
+    tk.Label(window, text="Errors:", anchor="w", fg="red").pack(padx=10, fill="x")
+    errors_listbox = tk.Listbox(window, height=6)
+    errors_listbox.pack(padx=10, pady=5, fill="both", expand=True)
+
+    def cancel():
+        cancel_event.set()
+        cancel_button.state(["disabled"])
+
+    cancel_button = ttk.Button(window, text="Cancel", command=cancel)
+    cancel_button.pack(pady=10)
+
+    # The window can only be closed once the batch has finished
+    window.protocol("WM_DELETE_WINDOW", lambda: None)
+
+    return {"window": window, "tree": tree, "status": status_label, "errors": errors_listbox,
+            "cancel": cancel_button, "cancel_event": cancel_event}
+
+
+def poll_progress(events, progress, start_time):
+    """Apply the events posted by the processing thread to the progress panel."""
+    finished = None
+    try:
+        while True:
+            event = events.get_nowait()
+            if event[0] == "stage":
+                _, cast, psa_file, status = event
+                progress["tree"].set(cast, psa_file, status)
+            elif event[0] == "error":
+                progress["errors"].insert("end", event[1])
+                progress["errors"].see("end")
+            elif event[0] == "finished":
+                finished, report_path = event[1], event[2]
+    except queue.Empty:
+        pass
+
+    elapsed = time.strftime("%H:%M:%S", time.gmtime(time.time() - start_time))
+    if finished is None:
+        progress["status"].config(text=f"Elapsed: {elapsed}")
+        root.after(200, poll_progress, events, progress, start_time)
+        return
+
+    if progress["cancel_event"].is_set():
+        summary = "Processing cancelled"
+    elif finished:
+        summary = f"Processing finished with {len(finished)} error(s)"
+    else:
+        summary = "Selected .psa files have been processed"
+    progress["status"].config(text=f"{summary}. Elapsed: {elapsed}. Run log: {report_path}")
+    progress["catalog"].close()
+
+    tree = progress["tree"]
+    for cast in tree.get_children():
+        for column in tree["columns"]:
+            if tree.set(cast, column) == "waiting":
+                tree.set(cast, column, "not run")
+
+    window = progress["window"]
+    window.protocol("WM_DELETE_WINDOW", window.destroy)
+    progress["cancel"].config(text="Close", command=window.destroy)
+    progress["cancel"].state(["!disabled"])
+    process_button.state(["!disabled"])
 
-        for psa_file, executable, _ in selected_psa_files:
-            psa_file_path = os.path.join(psa_dir, psa_file)
-            print(f"Running {executable} for {psa_file} with raw file {raw_file}")
-
-            exe_basename = os.path.basename(executable).lower()
-
-            if "datcnvw" in exe_basename:
-                input_file = raw_file
-            elif "bottlesumw" in exe_basename:
-                ros_file = f"{base_name}.ros"
-                input_file = os.path.join(output_file_dir, ros_file)
-            else:
-                input_file = os.path.join(output_file_dir, output_file)
-
-
-            command = [
-                executable,
-                f"/i{input_file}",
-                f"/o{output_file_dir}",
-                f"/f{output_file}",
-                f"/p{psa_file_path}",
-                "/s"
-            ]
-
-            # Append /c<XMLCON> only for DatCnvW, Derive, and bottlesum
-            exe_basename = os.path.basename(executable).lower()
-            if "datcnvw" in exe_basename or "derivew" in exe_basename or 'bottlesumw' in exe_basename:
-                xmlcon_file = os.path.splitext(os.path.basename(raw_file))[0].upper() + ".xmlcon"
-                xmlcon_path = os.path.join(os.path.dirname(raw_file), xmlcon_file)
-                command.append(f"/c{xmlcon_path}")
 
+# Columns of the catalog search results: (key, heading, width)
+CATALOG_COLUMNS = [("cruise", "Cruise", 70), ("nmea_utc", "NMEA UTC", 140), ("latitude", "Latitude", 80),
+                   ("longitude", "Longitude", 80), ("scans", "Scans", 60), ("pressure", "Pressure", 100),
+                   ("distance", "km", 60), ("output_dir", "Output Directory", 250)]
+
+
+def show_catalog_window():
+    """Search the cast catalog by name, cruise, sensor serial number, position and time."""
+    import cast_catalog
+
+    window = tk.Toplevel(root)
+    window.title("Find Casts")
+    window.geometry("950x500")
+
+    catalog_var = tk.StringVar(value=cast_catalog.catalog_path({"catalog": catalog_path}, output_file_var.get()))
+    fields = {name: tk.StringVar() for name in ("cast", "cruise", "serial", "latitude", "longitude", "since", "until")}
+    radius_var = tk.StringVar(value="10")
+
+    form = tk.Frame(window)
+    form.pack(padx=10, pady=5, fill="x")
+    form.grid_columnconfigure(1, weight=1)
+    tk.Label(form, text="Catalog:").grid(row=0, column=0, padx=5, pady=2, sticky="w")
+    tk.Entry(form, textvariable=catalog_var).grid(row=0, column=1, columnspan=5, padx=5, pady=2, sticky="ew")
+
+    def browse():
+        path = filedialog.asksaveasfilename(title="Select Cast Catalog", defaultextension=".sqlite",
+                                            confirmoverwrite=False, filetypes=[("SQLite Files", "*.sqlite")])
+        if path:
+            catalog_var.set(path)
+
+    ttk.Button(form, text="Browse", command=browse).grid(row=0, column=6, padx=5, pady=2)
+
+    labels = [("Cast:", "cast"), ("Cruise:", "cruise"), ("Serial Number:", "serial"),
+              ("Latitude:", "latitude"), ("Longitude:", "longitude"), ("Since (UTC):", "since"), ("Until (UTC):", "until")]
+    for n, (label, name) in enumerate(labels):
+        tk.Label(form, text=label).grid(row=1 + n // 3, column=2 * (n % 3), padx=5, pady=2, sticky="w")
+        tk.Entry(form, textvariable=fields[name], width=18).grid(row=1 + n // 3, column=2 * (n % 3) + 1, padx=5, pady=2,
+                                                                  sticky="w")
+    tk.Label(form, text="Radius (km):").grid(row=3, column=2, padx=5, pady=2, sticky="w")
+    tk.Entry(form, textvariable=radius_var, width=18).grid(row=3, column=3, padx=5, pady=2, sticky="w")
+
+    results = ttk.Treeview(window, columns=[key for key, *_ in CATALOG_COLUMNS], show="tree headings")
+    results.heading("#0", text="Cast")
+    results.column("#0", width=90, stretch=False)
+    for key, heading, width in CATALOG_COLUMNS:
+        results.heading(key, text=heading)
+        results.column(key, width=width, anchor="w" if key == "output_dir" else "center", stretch=key == "output_dir")
+    results.pack(padx=10, pady=5, fill="both", expand=True)
+    status_label = tk.Label(window, text="", anchor="w")
+    status_label.pack(padx=10, fill="x")
+
+    def open_catalog():
+        global catalog_path
+        path = catalog_var.get().strip()
+        catalog = cast_catalog.CastCatalog(path)
+        # A catalog other than the default is kept in the configuration
+        if path != cast_catalog.catalog_path({}, output_file_var.get()):
+            catalog_path = path
+        return catalog
+
+    def search():
+        try:
+            near = None
+            if fields["latitude"].get().strip() or fields["longitude"].get().strip():
+                near = (float(fields["latitude"].get()), float(fields["longitude"].get()))
+            radius = float(radius_var.get())
+        except ValueError:
+            messagebox.showerror("Error", "Latitude, longitude and radius must be decimal numbers.", parent=window)
+            return
+        if not os.path.isfile(catalog_var.get().strip()):
+            messagebox.showerror("Error", f"No catalog {catalog_var.get()}", parent=window)
+            return
+        try:
+            catalog = open_catalog()
             try:
-                result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True, shell=True)
-                if result.returncode != 0:
-                    messagebox.showerror("Error", f"Error running {executable} for {psa_file}: {result.stderr}")
-                else:
-                    print(f"{executable} ran successfully for {psa_file}: {result.stdout}")
-            except FileNotFoundError:
-                messagebox.showerror("Error", f"Executable not found at: {command[0]}")
-            except Exception as e:
-                messagebox.showerror("Error", f"An unexpected error occurred: {str(e)}")
+                casts = catalog.find(cast=fields["cast"].get().strip(), cruise=fields["cruise"].get().strip(),
+                                     serial=fields["serial"].get().strip(), near=near, radius_km=radius,
+                                     since=fields["since"].get().strip(), until=fields["until"].get().strip())
+            finally:
+                catalog.close()
+        except Exception as e:
+            messagebox.showerror("Error", f"Catalog search failed: {e}", parent=window)
+            return
+
+        results.delete(*results.get_children())
+        for cast in casts:
+            pressure = (f"{cast['pressure_min']:.1f}-{cast['pressure_max']:.1f}"
+                        if cast["pressure_max"] is not None else "")
+            values = {
+                "cruise": cast["cruise"] or "",
+                "nmea_utc": (cast["nmea_utc"] or "").replace("T", " "),
+                "latitude": f"{cast['latitude']:.4f}" if cast["latitude"] is not None else "",
+                "longitude": f"{cast['longitude']:.4f}" if cast["longitude"] is not None else "",
+                "scans": cast["scans"] if cast["scans"] is not None else "",
+                "pressure": pressure,
+                "distance": f"{cast['distance_km']:.2f}" if "distance_km" in cast else "",
+                "output_dir": cast["output_dir"],
+            }
+            results.insert("", "end", text=cast["name"], values=[values[key] for key, *_ in CATALOG_COLUMNS])
+        status_label.config(text=f"{len(casts)} cast(s)")
+
+    def index_output():
+        output_dir = filedialog.askdirectory(title="Select Output Directory to Index", parent=window,
+                                             initialdir=output_file_var.get() or None)
+        if not output_dir:
+            return
+        # The raw files of the current selection give the sensor serial numbers from their .XMLCON files
+        raw_dirs = sorted({os.path.dirname(os.path.normpath(f.strip('"')))
+                           for f in raw_files_var.get().split(";") if f.strip()})
+        try:
+            catalog = open_catalog()
+            try:
+                count = catalog.index_folder(output_dir, [d for d in raw_dirs if os.path.isdir(d)])
+            finally:
+                catalog.close()
+        except Exception as e:
+            messagebox.showerror("Error", f"Indexing failed: {e}", parent=window)
+            return
+        status_label.config(text=f"{count} cast(s) of {output_dir} indexed")
 
-    messagebox.showinfo("Processing Complete", "Selected .psa files have been processed.")
+    buttons = tk.Frame(window)
+    buttons.pack(pady=10)
+    ttk.Button(buttons, text="Search", command=search).grid(row=0, column=0, padx=5)
+    ttk.Button(buttons, text="Index Output Directory", command=index_output).grid(row=0, column=1, padx=5)
+    ttk.Button(buttons, text="Close", command=window.destroy).grid(row=0, column=2, padx=5)
+    window.bind("<Return>", lambda event: search())
 
 
 def apply_theme_to_titlebar(root):
@@ -607,46 +966,6 @@ def apply_theme_to_titlebar(root):
         root.wm_attributes("-alpha", 0.99)
         root.wm_attributes("-alpha", 1)
 
-# First, apply the theme
-sv_ttk.set_theme("dark")
-
-# Call the override function to fix the checkbox behavior
-override_checkbox_style()
-
-# Then, apply the title bar theme
-apply_theme_to_titlebar(root)
-
-root.title("CTD Processor ")
-
-# Set window icon
-try:
-    root.iconphoto(True, tk.PhotoImage(file=r"C:\Users\bonny\github\ctd_processing\icon.png"))  # Ensure the file path is correct
-except Exception as e:
-    print(f"Error setting icon: {e}")
-
-# Set window size and background color
-root.minsize(670, 300)
-
-# Configure the grid layout
-root.grid_rowconfigure(0, weight=0)
-root.grid_rowconfigure(1, weight=0)
-root.grid_rowconfigure(2, weight=0)
-root.grid_rowconfigure(3, weight=0)
-root.grid_rowconfigure(4, weight=1)
-root.grid_rowconfigure(5, weight=0)
-root.grid_rowconfigure(6, weight=0)
-root.grid_columnconfigure(0, weight=1)
-root.grid_columnconfigure(1, weight=1)
-root.grid_columnconfigure(2, weight=0)
-
-# Variables
-raw_file_var = []
-psa_dir_var = tk.StringVar()
-executables_dir_var = tk.StringVar()
-output_file_var = tk.StringVar()
-psa_frames = []
-executables = []
-
 def select_raw_files():
     files = filedialog.askopenfilenames(title="Select Raw .hex Files", filetypes=[("HEX files", "*.hex")])
     if files:
@@ -660,51 +979,134 @@ def select_raw_files():
 
         print("Selected raw files:", files)
 
-# Layout (unchanged, just for reference)
-tk.Label(root, text="Select Raw .hex File:").grid(row=0, column=0, padx=10, pady=5, sticky="w")
-raw_file_display_label = tk.Label(root, text="No files selected", anchor="w", bg="#2b2b2b", fg="white")
-raw_file_display_label.grid(row=0, column=1, padx=10, pady=5, sticky="ew")
-ttk.Button(root, text="Browse", command=select_raw_files).grid(row=0, column=2, padx=10, pady=5)
-
-tk.Label(root, text="Select Directory Containing .psa Files:").grid(row=1, column=0, padx=10, pady=5, sticky="w")
-tk.Entry(root, textvariable=psa_dir_var, width=50).grid(row=1, column=1, padx=10, pady=5, sticky="ew")
-ttk.Button(root, text="Browse", command=select_psa_directory).grid(row=1, column=2, padx=10, pady=5)
-
-tk.Label(root, text="Select Directory Containing Executables:").grid(row=2, column=0, padx=10, pady=5, sticky="w")
-tk.Entry(root, textvariable=executables_dir_var, width=50).grid(row=2, column=1, padx=10, pady=5, sticky="ew")
-ttk.Button(root, text="Browse", command=select_executables_directory).grid(row=2, column=2, padx=10, pady=5)
+def build_gui():
+    """Create the Tk root window, the configuration variables and the main window layout."""
+    import ctd_pipeline
 
-tk.Label(root, text="Select Output File Directory:").grid(row=3, column=0, padx=10, pady=5, sticky="w")
-tk.Entry(root, textvariable=output_file_var, width=50).grid(row=3, column=1, padx=10, pady=5, sticky="ew")
-ttk.Button(root, text="Browse", command=lambda: output_file_var.set(filedialog.askdirectory(title="Select Output Directory"))).grid(row=3, column=2, padx=10, pady=5)
+    global root, raw_files_var, psa_dir_var, executables_dir_var, output_file_var, jobs_var, batch_size_var, incremental_var
+    global timeout_var, scratch_dir_var, stage_retries
+    global psa_files_frame, raw_file_display_label, process_button
 
-ttk.Button(root, text="Update PSA Files", command=update_psa_files).grid(row=4, column=2, padx=10, pady=10, sticky="ew")
+    # Initialize the GUI
+    root = tk.Tk()
 
-# Frame to hold PSA entries
-psa_files_frame = tk.Frame(root)
-psa_files_frame.grid(row=5, column=0, columnspan=3, padx=10, pady=5, sticky="ew")
+    # Variables
+    raw_files_var = tk.StringVar()
+    psa_dir_var = tk.StringVar()
+    executables_dir_var = tk.StringVar()
+    output_file_var = tk.StringVar()
+    jobs_var = tk.IntVar(value=1)
+    batch_size_var = tk.IntVar(value=1)
+    timeout_var = tk.IntVar(value=ctd_pipeline.STAGE_TIMEOUT)
+    scratch_dir_var = tk.StringVar()
+    incremental_var = tk.BooleanVar(value=True)
+    stage_retries = ctd_pipeline.STAGE_RETRIES
 
-# Process Data Button
-ttk.Button(root, text="Process Data", command=process_data).grid(row=6, column=1, padx=10, pady=20)
+    # First, apply the theme
+    sv_ttk.set_theme("dark")
 
-# Save Configuration Button
-ttk.Button(root, text="Save Configuration", command=save_config).grid(row=7, column=0, padx=10, pady=20)
+    # Call the override function to fix the checkbox behavior
+    override_checkbox_style()
 
-# Load Configuration Button
-ttk.Button(root, text="Load Configuration", command=load_config).grid(row=7, column=2, padx=10, pady=20)
+    # Then, apply the title bar theme
+    apply_theme_to_titlebar(root)
 
+    root.title("CTD Processor ")
 
-sv_ttk.set_theme("dark")
+    # Set window icon
+    try:
+        root.iconphoto(True, tk.PhotoImage(file=r"C:\Users\bonny\github\ctd_processing\icon.png"))  # Ensure the file path is correct
+    except Exception as e:
+        print(f"Error setting icon: {e}")
+
+    # Set window size and background color
+    root.minsize(670, 300)
+
+    # Configure the grid layout
+    root.grid_rowconfigure(0, weight=0)
+    root.grid_rowconfigure(1, weight=0)
+    root.grid_rowconfigure(2, weight=0)
+    root.grid_rowconfigure(3, weight=0)
+    root.grid_rowconfigure(4, weight=0)
+    root.grid_rowconfigure(5, weight=1)
+    root.grid_rowconfigure(6, weight=0)
+    root.grid_columnconfigure(0, weight=1)
+    root.grid_columnconfigure(1, weight=1)
+    root.grid_columnconfigure(2, weight=0)
+
+    # Layout
+    tk.Label(root, text="Select Raw .hex File:").grid(row=0, column=0, padx=10, pady=5, sticky="w")
+    raw_file_display_label = tk.Label(root, text="No files selected", anchor="w", bg="#2b2b2b", fg="white")
+    raw_file_display_label.grid(row=0, column=1, padx=10, pady=5, sticky="ew")
+    ttk.Button(root, text="Browse", command=select_raw_files).grid(row=0, column=2, padx=10, pady=5)
+
+    tk.Label(root, text="Select Directory Containing .psa Files:").grid(row=1, column=0, padx=10, pady=5, sticky="w")
+    tk.Entry(root, textvariable=psa_dir_var, width=50).grid(row=1, column=1, padx=10, pady=5, sticky="ew")
+    ttk.Button(root, text="Browse", command=select_psa_directory).grid(row=1, column=2, padx=10, pady=5)
+
+    tk.Label(root, text="Select Directory Containing Executables:").grid(row=2, column=0, padx=10, pady=5, sticky="w")
+    tk.Entry(root, textvariable=executables_dir_var, width=50).grid(row=2, column=1, padx=10, pady=5, sticky="ew")
+    ttk.Button(root, text="Browse", command=select_executables_directory).grid(row=2, column=2, padx=10, pady=5)
+
+    tk.Label(root, text="Select Output File Directory:").grid(row=3, column=0, padx=10, pady=5, sticky="w")
+    tk.Entry(root, textvariable=output_file_var, width=50).grid(row=3, column=1, padx=10, pady=5, sticky="ew")
+    ttk.Button(root, text="Browse", command=lambda: output_file_var.set(filedialog.askdirectory(title="Select Output Directory"))).grid(row=3, column=2, padx=10, pady=5)
+
+    ttk.Button(root, text="Update PSA Files", command=update_psa_files).grid(row=4, column=2, padx=10, pady=10, sticky="ew")
+
+    # Table of the PSA files
+    psa_files_frame = build_psa_table(root)
+    psa_files_frame.grid(row=5, column=0, columnspan=3, padx=10, pady=5, sticky="nsew")
+
+    # Number of stages run at the same time, across casts
+    jobs_frame = tk.Frame(root)
+    jobs_frame.grid(row=6, column=0, padx=10, pady=20, sticky="w")
+    tk.Label(jobs_frame, text="Parallel Jobs:").grid(row=0, column=0, padx=5)
+    ttk.Spinbox(jobs_frame, from_=1, to=os.cpu_count() or 1, textvariable=jobs_var, width=5).grid(row=0, column=1, padx=5)
+    ttk.Checkbutton(jobs_frame, text="Skip Up-To-Date Stages", variable=incremental_var, style="TCheckbutton").grid(row=0, column=2, padx=5)
+    # Casts given to one run of the modules that can process several (see ctd_pipeline.BATCH_MODULES)
+    tk.Label(jobs_frame, text="Casts per Module Run:").grid(row=1, column=0, padx=5, pady=(5, 0))
+    ttk.Spinbox(jobs_frame, from_=1, to=500, textvariable=batch_size_var, width=5).grid(row=1, column=1, padx=5, pady=(5, 0))
+    # A stage running longer is killed (with anything it started) and run again; 0 for no limit
+    tk.Label(jobs_frame, text="Stage Timeout (s):").grid(row=2, column=0, padx=5, pady=(5, 0))
+    ttk.Spinbox(jobs_frame, from_=0, to=86400, increment=60, textvariable=timeout_var, width=7).grid(row=2, column=1, padx=5, pady=(5, 0))
+    # Local folder for the intermediate files (empty: they are written to the output directory)
+    tk.Label(jobs_frame, text="Scratch Folder:").grid(row=3, column=0, padx=5, pady=(5, 0))
+    tk.Entry(jobs_frame, textvariable=scratch_dir_var, width=20).grid(row=3, column=1, columnspan=2, padx=5, pady=(5, 0), sticky="ew")
+    ttk.Button(jobs_frame, text="Browse", command=lambda: scratch_dir_var.set(
+        filedialog.askdirectory(title="Select Scratch Folder") or scratch_dir_var.get())).grid(row=3, column=3, padx=5, pady=(5, 0))
+
+    # Process Data Button
+    process_button = ttk.Button(root, text="Process Data", command=process_data)
+    process_button.grid(row=6, column=1, padx=10, pady=20)
+
+    # Save Configuration Button
+    ttk.Button(root, text="Save Configuration", command=save_config).grid(row=7, column=0, padx=10, pady=20)
+
+    # Find Casts Button
+    ttk.Button(root, text="Find Casts", command=show_catalog_window).grid(row=7, column=1, padx=10, pady=20)
+
+    # Load Configuration Button
+    ttk.Button(root, text="Load Configuration", command=load_config).grid(row=7, column=2, padx=10, pady=20)
+
+    sv_ttk.set_theme("dark")
 
 # Ensure the load_last_used_config function is called when the app starts
 def start_application():
+    print(f"Using last used config file at: {LAST_USED_CONFIG_FILE}")
+    load_gui_modules()
+    build_gui()
+
     load_last_used_config()  # Try loading the last used config on startup
 
     # After loading the config, start the main event loop
     root.mainloop()
 
-# Main entry point
+# Main entry point: with command-line arguments run headless, otherwise start the GUI
 if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        import ctd_cli
+        sys.exit(ctd_cli.main())
     start_application()
 
 
@@ -6,7 +6,7 @@ a = Analysis(
     pathex=[],
     binaries=[],
     datas=[],
-    hiddenimports=[],
+    hiddenimports=['matplotlib.figure', 'matplotlib.backends.backend_agg'],
     hookspath=[],
     hooksconfig={},
     runtime_hooks=[],
@@ -0,0 +1,140 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime
+
+# Number of stages listed in the summary's "slowest_stages"
+SLOWEST_STAGES = 10
+
+
+def timestamp(seconds):
+    return datetime.fromtimestamp(seconds).isoformat(timespec="milliseconds")
+
+
+class RunReport:
+    """
+    JSON-lines log of one batch, written to ctd_run_<date>_<time>.jsonl in the output directory.
+
+    Every (cast, stage) adds one "stage" line as soon as it finishes, so the log survives a
+    crash, and every cast a "cast" line once it is done or has failed to be prepared or
+    published; close() appends a "summary" line with the slowest stages, the throughput and
+    the peak memory of the modules (to size 'Parallel Jobs' against the memory of the machine).
+    """
+
+    def __init__(self, output_file_dir, raw_files):
+        self.start = time.time()
+        self.raw_files = list(raw_files)
+        self.path = os.path.join(output_file_dir, f"ctd_run_{datetime.fromtimestamp(self.start):%Y%m%d_%H%M%S}.jsonl")
+        self.records = []
+        self.cast_records = []
+        self.lock = threading.Lock()
+
+    def write(self, record):
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record) + "\n")
+
+    def record_stage(self, cast, psa_file, executable, command, start, end, exit_code, status, stdout="", stderr="",
+                     usage=None, attempt=1, run_casts=1):
+        """
+        usage is the {"cpu_time", "max_rss_mb"} of the module run (see process_usage.py);
+        run_casts the number of casts that run processed (see ctd_pipeline.run_stage_batch()).
+        """
+        usage = usage or {}
+        record = {
+            "type": "stage",
+            "cast": cast,
+            "stage": psa_file,
+            "executable": executable,
+            "command": command,
+            "start": timestamp(start),
+            "end": timestamp(end),
+            "wall_time": round(end - start, 3),
+            "exit_code": exit_code,
+            "status": status,
+            "attempt": attempt,
+            "cpu_time": usage.get("cpu_time"),
+            "max_rss_mb": usage.get("max_rss_mb"),
+            "run_casts": run_casts,
+            "stdout": stdout,
+            "stderr": stderr,
+        }
+        with self.lock:
+            self.records.append(record)
+        self.write(record)
+
+    def record_preflight(self, rejected_casts, errors):
+        """Record the casts left out of the batch by the pre-flight check, and why."""
+        self.write({"type": "preflight", "rejected_casts": list(rejected_casts), "errors": list(errors)})
+
+    def record_cast(self, cast, status, error=None):
+        """
+        Record the outcome of a cast: "done" once every stage is done and its products are
+        published, or "failed" when it could not be prepared or published. Only the casts
+        recorded as done count as processed; the others failed a stage or were cancelled.
+        """
+        record = {"type": "cast", "cast": cast, "status": status, "error": error}
+        with self.lock:
+            self.cast_records.append(record)
+        self.write(record)
+
+    def close(self, errors):
+        """Write and return the summary of the batch."""
+        end = time.time()
+        wall_time = end - self.start
+        casts_ok = sum(1 for r in self.cast_records if r["status"] == "done")
+
+        stage_totals = {}
+        peak = None
+        for r in self.records:
+            if r["status"] == "skipped":
+                continue
+            totals = stage_totals.setdefault(r["stage"], {"runs": 0, "wall_time": 0.0, "cpu_time": 0.0, "max_rss_mb": None})
+            totals["runs"] += 1
+            totals["wall_time"] = round(totals["wall_time"] + r["wall_time"], 3)
+            if r["cpu_time"] is not None:
+                # A run processing several casts is recorded once per cast
+                totals["cpu_time"] = round(totals["cpu_time"] + r["cpu_time"] / r["run_casts"], 3)
+            if r["max_rss_mb"] is not None:
+                totals["max_rss_mb"] = max(totals["max_rss_mb"] or 0, r["max_rss_mb"])
+                if peak is None or r["max_rss_mb"] > peak["max_rss_mb"]:
+                    peak = r
+        for totals in stage_totals.values():
+            totals["mean_wall_time"] = round(totals["wall_time"] / totals["runs"], 3)
+
+        slowest = sorted((r for r in self.records if r["status"] != "skipped"), key=lambda r: r["wall_time"], reverse=True)
+
+        summary = {
+            "type": "summary",
+            "start": timestamp(self.start),
+            "end": timestamp(end),
+            "wall_time": round(wall_time, 3),
+            "casts": len(self.raw_files),
+            "casts_ok": casts_ok,
+            "stages_run": sum(t["runs"] for t in stage_totals.values()),
+            "stages_skipped": sum(1 for r in self.records if r["status"] == "skipped"),
+            "casts_per_hour": round(casts_ok * 3600.0 / wall_time, 2) if wall_time > 0 else None,
+            "errors": len(errors),
+            "timeouts": sum(1 for r in self.records if r["status"] == "timeout"),
+            "peak_memory": {"cast": peak["cast"], "stage": peak["stage"], "max_rss_mb": peak["max_rss_mb"]} if peak else None,
+            "stage_totals": stage_totals,
+            "slowest_stages": [{"cast": r["cast"], "stage": r["stage"], "wall_time": r["wall_time"]}
+                               for r in slowest[:SLOWEST_STAGES]],
+        }
+        self.write(summary)
+        return summary
+
+
+def format_summary(summary):
+    """Short human-readable version of a summary, for the console and the GUI."""
+    lines = [f"{summary['casts_ok']}/{summary['casts']} cast(s) processed in {summary['wall_time']:.1f} s"
+             + (f" ({summary['casts_per_hour']} casts/hour)" if summary["casts_per_hour"] else "")]
+    for r in summary["slowest_stages"][:3]:
+        lines.append(f"  slowest: {r['cast']} {r['stage']} {r['wall_time']:.1f} s")
+    if summary.get("peak_memory"):
+        peak = summary["peak_memory"]
+        lines.append(f"  peak memory: {peak['cast']} {peak['stage']} {peak['max_rss_mb']:.0f} MB")
+    if summary.get("timeouts"):
+        lines.append(f"  {summary['timeouts']} stage run(s) killed for running too long")
+    return "\n".join(lines)
@@ -0,0 +1,132 @@
+import os
+import threading
+import xml.etree.ElementTree as ET
+
+# Root element of the PSA files of each SBE module
+PSA_ROOTS = {
+    "Data_Conversion": "DatCnvW.exe",
+    "Align_CTD": "AlignCTDW.exe",
+    "Bin_Average": "BinAvgW.exe",
+    "Bottle_Summary": "BottleSumW.exe",
+    "Buoyancy": "BuoyancyW.exe",
+    "Cell_Thermal_Mass": "CellTMW.exe",
+    "Derive": "DeriveW.exe",
+    "Derive_TEOS_10": "DeriveTEOS_10W.exe",
+    "Filter": "FilterW.exe",
+    "Loop_Edit": "LoopEditW.exe",
+    "Mark_Scan": "MarkScanW.exe",
+    "Sea_Plot": "SeaPlotW.exe",
+    "Section": "SectionW.exe",
+    "Split": "SplitW.exe",
+    "Strip": "StripW.exe",
+    "Translate": "TransW.exe",
+    "ASCII_In": "ASCII_InW.exe",
+    "ASCII_Out": "ASCII_OutW.exe",
+    "Wild_Edit": "WildEditW.exe",
+    "Window_Filter": "W_FilterW.exe",
+}
+
+# XMLCON sensors (element inside <Sensor>) that the variables of a PSA need, by the start
+# of the variable's full name. A variable of the second sensor (", 2" or "2 - 1") needs two.
+SENSOR_VARIABLES = [
+    ("Temperature", ("TemperatureSensor",)),
+    ("Potential Temperature", ("TemperatureSensor", "ConductivitySensor")),
+    ("Conductivity", ("ConductivitySensor",)),
+    ("Pressure, Digiquartz", ("PressureSensor",)),
+    ("Salinity", ("TemperatureSensor", "ConductivitySensor")),
+    ("Density", ("TemperatureSensor", "ConductivitySensor")),
+    ("Sound Velocity", ("TemperatureSensor", "ConductivitySensor")),
+    ("Altimeter", ("AltimeterSensor",)),
+    ("Oxygen, SBE 43", ("OxygenSensor",)),
+    ("Beam Transmission, WET Labs C-Star", ("WET_LabsCStar",)),
+    ("Beam Attenuation, WET Labs C-Star", ("WET_LabsCStar",)),
+    ("Fluorescence, WET Labs ECO-AFL/FL", ("FluoroWetlabECO_AFL_FL_Sensor",)),
+    ("PAR/Irradiance, Biospherical/Licor", ("PAR_BiosphericalLicorChelseaSensor",)),
+    ("SPAR/Surface Irradiance", ("SPAR_Sensor",)),
+]
+
+_cache_lock = threading.Lock()
+_files = {}
+
+
+class PsaFile:
+    """
+    A parsed PSA file: its root element, the SBE module it belongs to (None if the root is
+    not in PSA_ROOTS) and the variables of its calculation arrays as (full name, ordinal).
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.root = ET.parse(path).getroot()
+        self.tag = self.root.tag
+        self.module = PSA_ROOTS.get(self.tag)
+        self.variables = []
+        for item in self.root.iter("CalcArrayItem"):
+            calc = item.find("Calc")
+            full_name = calc.find("FullName") if calc is not None else None
+            if full_name is not None:
+                self.variables.append((full_name.get("value", ""), int(calc.get("Ordinal", "0") or 0)))
+
+    def value(self, tag, default=""):
+        """The value attribute of the first <tag> element, e.g. value("NameAppend")."""
+        element = next(self.root.iter(tag), None)
+        return element.get("value", default) if element is not None else default
+
+
+class XmlconFile:
+    """A parsed .XMLCON file: its <Instrument> element and the sensor type and serial number of each channel in use."""
+
+    def __init__(self, path):
+        self.path = path
+        self.root = ET.parse(path).getroot()
+        self.instrument = self.root.find("Instrument")
+        if self.instrument is None:
+            raise ValueError(f"{path}: no <Instrument>, not an .XMLCON file")
+        self.name = self.instrument.findtext("Name", "")
+        in_use = [sensor[0] for sensor in self.instrument.iter("Sensor") if len(sensor) and sensor[0].tag != "NotInUse"]
+        self.sensors = [sensor.tag for sensor in in_use]
+        # (sensor type, serial number) of the channels in use, in channel order
+        self.serial_numbers = [(sensor.tag, sensor.findtext("SerialNumber", "").strip()) for sensor in in_use]
+
+    def missing_sensors(self, variables):
+        """
+        The sensors this configuration has too few of for a PSA's variables, as (sensor, number
+        needed, first variable needing that many), one per sensor type.
+        """
+        missing = {}
+        for full_name, ordinal in variables:
+            name = full_name.split(" [")[0]
+            needed = 2 if ", 2" in name else ordinal + 1
+            # The longest matching start wins (Potential Temperature before Temperature)
+            matches = [(start, tags) for start, tags in SENSOR_VARIABLES if name.startswith(start)]
+            _, tags = max(matches, key=lambda match: len(match[0]), default=("", ()))
+            for tag in tags:
+                if self.sensors.count(tag) < needed and needed > missing.get(tag, (0, ""))[0]:
+                    missing[tag] = (needed, full_name)
+        return [(tag, needed, full_name) for tag, (needed, full_name) in missing.items()]
+
+
+def load(cls, path):
+    """Parse a file with cls, reusing the parsed object until the file's size or modification time changes."""
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    key = (cls, path)
+    signature = (stat.st_size, stat.st_mtime_ns)
+
+    with _cache_lock:
+        cached = _files.get(key)
+        if cached and cached[0] == signature:
+            return cached[1]
+
+    parsed = cls(path)
+    with _cache_lock:
+        _files[key] = (signature, parsed)
+    return parsed
+
+
+def load_psa(path):
+    return load(PsaFile, path)
+
+
+def load_xmlcon(path):
+    return load(XmlconFile, path)
@@ -0,0 +1,294 @@
+import os
+import threading
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from numpy.lib import recfunctions
+
+import cnv_file
+import seawater
+
+# The Sea Plot module this stage replaces, used to open its PSA files with "Edit PSA"
+SBE_MODULE = "SeaPlotW.exe"
+
+# PlotType of the PSA files drawn: one vertical axis (Axis 0) against up to four horizontal axes
+OVERLAY_PLOT = 2
+
+# OutputType values of a Sea Plot PSA (printer, metafile, JPEG, bitmap) and the format written
+# instead: the metafile as SVG, the bitmaps as compressed PNG
+OUTPUT_FORMATS = {0: "png", 1: "svg", 2: "png", 3: "png"}
+
+# Setup element giving the image size for each OutputType (pixels, or mm for the metafile)
+SIZE_SETUPS = {0: "BitmapSetup", 1: "MetafileSetup", 2: "JpegSetup", 3: "BitmapSetup"}
+
+DPI = 100
+MM_PER_INCH = 25.4
+
+# Horizontal axes 1-4 are drawn bottom, top, second bottom, second top, as SeaPlotW does
+X_AXIS_SIDES = ["bottom", "top", "bottom", "top"]
+
+# Pixels taken by the vertical axis, by each horizontal axis (ticks and label) and by the title
+Y_AXIS_MARGIN = 75
+X_AXIS_MARGIN = 60
+TITLE_MARGIN = 40
+
+# matplotlib is only needed by this stage; it is imported by load_matplotlib() on first use
+Figure = FigureCanvasAgg = None
+
+# Figures are built once per thread and layout, and reused for every cast plotted with it
+_figures = threading.local()
+
+
+def load_matplotlib():
+    global Figure, FigureCanvasAgg
+    if Figure is None:
+        try:
+            from matplotlib.backends.backend_agg import FigureCanvasAgg as canvas
+            from matplotlib.figure import Figure as figure
+        except ImportError:
+            raise ValueError("the built-in SeaPlot needs matplotlib (pip install matplotlib), or use SeaPlotW.exe")
+        Figure, FigureCanvasAgg = figure, canvas
+
+
+def sbe_color(value):
+    """Matplotlib color of an SBE (Windows COLORREF, 0x00BBGGRR) color value."""
+    value = int(value)
+    return "#{:02x}{:02x}{:02x}".format(value & 0xFF, (value >> 8) & 0xFF, (value >> 16) & 0xFF)
+
+
+class PlotAxis:
+    """One Axis element of a Sea Plot PSA."""
+
+    def __init__(self, element):
+        def value(tag, default=""):
+            child = element.find(tag)
+            return child.get("value", default) if child is not None else default
+
+        name = element.find("Calc/FullName")
+        self.full_name = name.get("value") if name is not None else ""
+        self.included = value("IncludeAxis", "1") == "1"
+        self.derived = value("Derived", "0") == "1"
+        self.label = value("CustomLabel") if value("AutoLabel", "1") == "0" else (
+            f"Derived {self.full_name}" if self.derived else self.full_name)
+        self.color = sbe_color(value("LineColor", "0"))
+        self.linear = value("LinearScale", "1") == "1"
+        self.auto_range = value("AutoRange", "1") == "1"
+        self.fixed_range = (float(value("FixedMinimum", "0")), float(value("FixedMaximum", "1")))
+        self.auto_divisions = value("AutoDivisions", "1") == "1"
+        self.major_divisions = int(value("MajorDivisions", "5"))
+        self.reverse = value("ReverseScale", "0") == "1"
+
+
+class SeaPlotSettings:
+    """The plot definition of a Sea Plot PSA file (EN_SeaPlot_TSOO.psa)."""
+
+    def __init__(self, psa_path):
+        root = ET.parse(psa_path).getroot()
+
+        def value(tag, default=""):
+            element = root.find(tag)
+            return element.get("value", default) if element is not None else default
+
+        self.input_dir = value("InputDir")
+        input_files = root.find("InputFileArray")
+        self.input_files = [item.get("value") for item in input_files.iter("ArrayItem")] if input_files is not None else []
+        self.output_dir = value("OutputDir")
+        self.output_file = value("OutputFile")
+        self.name_append = value("NameAppend")
+
+        output_type = int(value("OutputType", "3"))
+        self.image_format = OUTPUT_FORMATS.get(output_type, "png")
+        setup = SIZE_SETUPS.get(output_type, "BitmapSetup")
+        width, height = float(value(f"{setup}/OutputWidth", "600")), float(value(f"{setup}/OutputHeight", "1200"))
+        self.size = (width / MM_PER_INCH, height / MM_PER_INCH) if setup == "MetafileSetup" else (width / DPI, height / DPI)
+
+        self.plot_type = int(value("PlotType", str(OVERLAY_PLOT)))
+        if self.plot_type != OVERLAY_PLOT:
+            raise ValueError(f"PlotType {self.plot_type} is not supported by the built-in SeaPlot, use SeaPlotW.exe")
+        self.title = value("Title")
+        self.add_file_name = value("AddFileName", "1") == "1"
+        self.padding = float(value("AutoRangePadding", "5")) / 100
+        self.skip_at_start = int(value("SkipAtStart", "0"))
+        self.skip_between_points = int(value("SkipBetweenPoints", "0"))
+        self.scans_to_process = None if value("ProcessScansToEnd", "1") == "1" else int(value("ScansToProcess", "1"))
+        self.axes = [PlotAxis(element) for element in root.findall("Axis")]
+
+    def output_path(self, input_file, output_dir=None, image_format=None):
+        """
+        <OutputDir>/<OutputFile without extension><NameAppend>.png, e.g. CTD02_TSOO.png. Given
+        another output_dir (a batch of files), the image is named after the input file.
+        """
+        output_file = os.path.basename(input_file) if output_dir or not self.output_file else self.output_file
+        return os.path.join(output_dir or self.output_dir,
+                            os.path.splitext(output_file)[0] + self.name_append + "." + (image_format or self.image_format))
+
+    def layout_key(self):
+        """Settings that change the figure layout (and so decide whether a cached figure can be reused)."""
+        return (self.size, tuple((axis.full_name, axis.included, axis.label, axis.color, axis.linear, axis.reverse)
+                                 for axis in self.axes))
+
+
+def axis_values(axis, header, values):
+    """The values of an axis variable, derived from the data when the axis asks for it; None if unavailable."""
+    if axis.derived and axis.full_name in seawater.DERIVED_VARIABLES:
+        try:
+            return seawater.derive(axis.full_name, header.long_names, values)[2]
+        except ValueError:
+            return None
+    if axis.full_name in header.long_names:
+        return values[:, header.long_names.index(axis.full_name)]
+    return None
+
+
+def axis_limits(axis, data, padding):
+    if not axis.auto_range:
+        return axis.fixed_range
+    finite = data[np.isfinite(data)]
+    if not len(finite):
+        return axis.fixed_range
+    low, high = float(finite.min()), float(finite.max())
+    pad = (high - low) * padding or 0.5
+    return low - pad, high + pad
+
+
+def build_figure(settings, x_axes):
+    """
+    Build the figure of a Sea Plot layout: the vertical axis on the left and one horizontal
+    axis, with its own line, per plotted variable (x_axes). Returns (figure, host axes,
+    [(PlotAxis, matplotlib axes, line)], title).
+    """
+    load_matplotlib()
+    figure = Figure(figsize=settings.size, dpi=DPI)
+    FigureCanvasAgg(figure)
+    width, height = settings.size[0] * DPI, settings.size[1] * DPI
+    top_axes = X_AXIS_SIDES[:len(x_axes)].count("top")
+    bottom_axes = max(X_AXIS_SIDES[:len(x_axes)].count("bottom"), 1)
+    left, right = Y_AXIS_MARGIN / width, 1 - TITLE_MARGIN / 2 / width
+    bottom = X_AXIS_MARGIN * bottom_axes / height
+    top = 1 - (TITLE_MARGIN + X_AXIS_MARGIN * top_axes) / height
+    host = figure.add_axes([left, bottom, right - left, top - bottom])
+    host.grid(True, color="black", linewidth=0.8)
+    title = figure.suptitle("", y=1 - TITLE_MARGIN / 4 / height, va="top", fontsize=14)
+
+    y_axis = settings.axes[0]
+    host.set_ylabel(y_axis.label)
+    if not y_axis.linear:
+        host.set_yscale("log")
+
+    plotted = []
+    for index, axis in enumerate(x_axes):
+        side = X_AXIS_SIDES[index]
+        ax = host if index == 0 else host.twiny()
+        ax.xaxis.set_ticks_position(side)
+        ax.xaxis.set_label_position(side)
+        if index >= 2:
+            ax.spines[side].set_position(("outward", X_AXIS_MARGIN * 72 / DPI))
+        ax.set_xlabel(axis.label, color=axis.color)
+        ax.tick_params(axis="x", colors=axis.color)
+        if not axis.linear:
+            ax.set_xscale("log")
+        line, = ax.plot([], [], color=axis.color, linewidth=1.5)
+        plotted.append((axis, ax, line))
+    return figure, host, plotted, title
+
+
+def cached_figure(settings, x_axes):
+    """The figure of this thread for the settings' layout and plotted axes, built on first use."""
+    if not hasattr(_figures, "cache"):
+        _figures.cache = {}
+    key = (settings.layout_key(), tuple(settings.axes.index(axis) for axis in x_axes))
+    if key not in _figures.cache:
+        _figures.cache[key] = build_figure(settings, x_axes)
+    return _figures.cache[key]
+
+
+def set_axis_range(axis, ax, limits, y=False):
+    low, high = limits
+    if axis.reverse:
+        low, high = high, low
+    (ax.set_ylim if y else ax.set_xlim)(low, high)
+    if not axis.auto_divisions and axis.linear:
+        (ax.set_yticks if y else ax.set_xticks)(np.linspace(*sorted(limits), axis.major_divisions + 1))
+
+
+def plot_cast(settings, input_file, output_path, image_format=None):
+    """Plot one .cnv file with the (reused) figure of its layout and write the image."""
+    header, data = cnv_file.read_cnv(input_file, bad_to_nan=True)
+    values = recfunctions.structured_to_unstructured(data, dtype=np.float64)
+    return plot_values(settings, header, values, input_file, output_path, image_format)
+
+
+def plot_values(settings, header, values, input_file, output_path, image_format=None):
+    """Plot the (scans, columns) values of a .cnv header, NaN for bad values, as plot_cast() plots input_file."""
+    end = None if settings.scans_to_process is None else settings.skip_at_start + settings.scans_to_process
+    values = values[settings.skip_at_start:end:settings.skip_between_points + 1]
+
+    y_axis = settings.axes[0]
+    y = axis_values(y_axis, header, values)
+    if y is None:
+        raise ValueError(f"{input_file}: no '{y_axis.full_name}' column to plot against")
+
+    # Variables missing from the cast (e.g. no oxygen sensor) get no axis, as with SeaPlotW
+    x_values = [(axis, axis_values(axis, header, values)) for axis in settings.axes[1:5] if axis.included]
+    x_values = [(axis, x) for axis, x in x_values if x is not None]
+
+    figure, host, plotted, title = cached_figure(settings, [axis for axis, _ in x_values])
+    set_axis_range(y_axis, host, axis_limits(y_axis, y, settings.padding), y=True)
+    for (axis, ax, line), (_, x) in zip(plotted, x_values):
+        line.set_data(x, y)
+        set_axis_range(axis, ax, axis_limits(axis, x, settings.padding))
+
+    file_name = os.path.basename(input_file)
+    title.set_text(f"{settings.title}, {file_name}" if settings.add_file_name else settings.title)
+    figure.savefig(output_path, format=image_format or settings.image_format, dpi=DPI, facecolor="white")
+    return output_path
+
+
+def run_psa(psa_path):
+    """
+    Plot the input file of a rendered Sea Plot PSA and write the image to its output
+    directory. Returns a one-line summary.
+    """
+    settings = SeaPlotSettings(psa_path)
+    if not settings.input_files:
+        raise ValueError(f"{psa_path}: no input file")
+    input_file = os.path.join(settings.input_dir, settings.input_files[0])
+    output_path = plot_cast(settings, input_file, settings.output_path(input_file))
+    return f"{os.path.basename(input_file)}: plotted to {os.path.basename(output_path)}"
+
+
+def plot_files(psa_path, input_files, output_dir, image_format=None):
+    """
+    Plot several .cnv files with one PSA in this process, reusing the figure.
+    Returns (image paths, error messages); a file that cannot be plotted does not stop the others.
+    """
+    load_matplotlib()
+    settings = SeaPlotSettings(psa_path)
+    images, errors = [], []
+    for input_file in input_files:
+        try:
+            images.append(plot_cast(settings, input_file, settings.output_path(input_file, output_dir, image_format),
+                                    image_format))
+        except (OSError, ValueError) as e:
+            errors.append(f"{os.path.basename(psa_path)}: {e}")
+    return images, errors
+
+
+def plot_casts(psa_paths, input_files, output_dir, jobs=1, image_format=None):
+    """
+    Plot every .cnv file with every Sea Plot PSA. With jobs > 1 the files are split across
+    worker processes, each drawing its share with one figure per PSA.
+    Returns (image paths, error messages).
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    jobs = max(1, min(int(jobs), len(input_files) or 1))
+    if jobs == 1:
+        results = [plot_files(psa_path, input_files, output_dir, image_format) for psa_path in psa_paths]
+    else:
+        chunks = [input_files[i::jobs] for i in range(jobs)]
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            futures = [pool.submit(plot_files, psa_path, chunk, output_dir, image_format)
+                       for psa_path in psa_paths for chunk in chunks]
+            results = [future.result() for future in futures]
+    return [path for images, _ in results for path in images], [error for _, errors in results for error in errors]
@@ -0,0 +1,131 @@
+"""
+Seawater properties (EOS-80 / UNESCO Technical Paper 44) as SBE Data Processing computes them:
+temperatures are ITS-90 and converted to IPTS-68 for the formulas, pressures are in decibars.
+"""
+import numpy as np
+
+# Conductivity [S/m] of standard seawater (S = 35, T = 15 C, P = 0)
+C3515 = 4.2914
+
+# IPTS-68 temperature per ITS-90 degree
+T68_PER_T90 = 1.00024
+
+
+def depth_salt_water(pressure, latitude):
+    """Depth [m] from pressure [db] in salt water (UNESCO Technical Paper 44), as SBE Data Processing computes depSM."""
+    x = np.sin(np.radians(latitude)) ** 2
+    gravity = 9.780318 * (1.0 + (5.2788e-3 + 2.36e-5 * x) * x) + 1.092e-6 * pressure
+    return ((((-1.82e-15 * pressure + 2.279e-10) * pressure - 2.2512e-5) * pressure + 9.72659) * pressure) / gravity
+
+
+def salinity(conductivity, temperature, pressure):
+    """Practical salinity (PSS-78) from conductivity [S/m], temperature [ITS-90 C] and pressure [db]."""
+    t = temperature * T68_PER_T90
+    r = conductivity / C3515
+    rt = 0.6766097 + t * (2.00564e-2 + t * (1.104259e-4 + t * (-6.9698e-7 + t * 1.0031e-9)))
+    rp = 1 + pressure * (2.070e-5 + pressure * (-6.370e-10 + pressure * 3.989e-15)) / (
+        1 + t * (3.426e-2 + t * 4.464e-4) + r * (4.215e-1 - 3.107e-3 * t))
+    with np.errstate(invalid="ignore"):
+        root = np.sqrt(np.abs(r / (rp * rt)))
+    dt = t - 15
+    s = 0.0080 + root * (-0.1692 + root * (25.3851 + root * (14.0941 + root * (-7.0261 + root * 2.7081))))
+    s += dt / (1 + 0.0162 * dt) * (
+        0.0005 + root * (-0.0056 + root * (-0.0066 + root * (-0.0375 + root * (0.0636 + root * -0.0144)))))
+    return s
+
+
+def sigma_t(salt, temperature):
+    """Density anomaly sigma-t [kg/m^3] at the surface from salinity and temperature [ITS-90 C]."""
+    t = temperature * T68_PER_T90
+    water = 999.842594 + t * (6.793952e-2 + t * (-9.095290e-3 + t * (1.001685e-4 + t * (-1.120083e-6 + t * 6.536332e-9))))
+    with np.errstate(invalid="ignore"):
+        density = (water
+                   + salt * (0.824493 + t * (-4.0899e-3 + t * (7.6438e-5 + t * (-8.2467e-7 + t * 5.3875e-9))))
+                   + salt * np.sqrt(salt) * (-5.72466e-3 + t * (1.0227e-4 - 1.6546e-6 * t))
+                   + 4.8314e-4 * salt * salt)
+    return density - 1000
+
+
+def adiabatic_lapse_rate(salt, t68, pressure):
+    """Adiabatic temperature gradient [C/db] (IPTS-68 temperature)."""
+    ds = salt - 35
+    return (((((-2.1687e-16 * t68 + 1.8676e-14) * t68 - 4.6206e-13) * pressure
+              + ((2.7759e-12 * t68 - 1.1351e-10) * ds + ((-5.4481e-14 * t68 + 8.733e-12) * t68 - 6.7795e-10) * t68
+                 + 1.8741e-8)) * pressure
+             + (-4.2393e-8 * t68 + 1.8932e-6) * ds + ((6.6228e-10 * t68 - 6.836e-8) * t68 + 8.5258e-6) * t68 + 3.5803e-5))
+
+
+def potential_temperature(salt, temperature, pressure, reference_pressure=0.0):
+    """Potential temperature [ITS-90 C] at reference_pressure (Fofonoff's Runge-Kutta integration)."""
+    h = reference_pressure - pressure
+    xk = h * adiabatic_lapse_rate(salt, temperature * T68_PER_T90, pressure)
+    t = temperature * T68_PER_T90 + 0.5 * xk
+    q = xk
+    p = pressure + 0.5 * h
+    xk = h * adiabatic_lapse_rate(salt, t, p)
+    t = t + 0.29289322 * (xk - q)
+    q = 0.58578644 * xk + 0.121320344 * q
+    xk = h * adiabatic_lapse_rate(salt, t, p)
+    t = t + 1.707106781 * (xk - q)
+    q = 3.414213562 * xk - 4.121320344 * q
+    p = p + 0.5 * h
+    xk = h * adiabatic_lapse_rate(salt, t, p)
+    return (t + (xk - 2.0 * q) / 6.0) / T68_PER_T90
+
+
+def sound_velocity(salt, temperature, pressure):
+    """Sound velocity [m/s] (Chen-Millero) from salinity, temperature [ITS-90 C] and pressure [db]."""
+    t = temperature * T68_PER_T90
+    p = pressure / 10  # bars
+    d = 1.727e-3 - 7.9836e-6 * p
+    b = -1.922e-2 - 4.42e-5 * t + (7.3637e-5 + 1.7945e-7 * t) * p
+    a3 = (-3.389e-13 * t + 6.649e-12) * t + 1.100e-10
+    a2 = ((7.988e-12 * t - 1.6002e-10) * t + 9.1041e-9) * t - 3.9064e-7
+    a1 = (((-2.0122e-10 * t + 1.0507e-8) * t - 6.4885e-8) * t - 1.2580e-5) * t + 9.4742e-5
+    a0 = (((-3.21e-8 * t + 2.006e-6) * t + 7.164e-5) * t - 1.262e-2) * t + 1.389
+    a = ((a3 * p + a2) * p + a1) * p + a0
+    c3 = (-2.3643e-12 * t + 3.8504e-10) * t - 9.7729e-9
+    c2 = (((1.0405e-12 * t - 2.5335e-10) * t + 2.5974e-8) * t - 1.7107e-6) * t + 3.1260e-5
+    c1 = (((-6.1185e-10 * t + 1.3621e-7) * t - 8.1788e-6) * t + 6.8982e-4) * t + 0.153563
+    c0 = ((((3.1464e-9 * t - 1.47800e-6) * t + 3.3420e-4) * t - 5.80852e-2) * t + 5.03711) * t + 1402.388
+    c = ((c3 * p + c2) * p + c1) * p + c0
+    with np.errstate(invalid="ignore"):
+        return c + (a + b * np.sqrt(np.abs(salt)) + d * salt) * salt
+
+
+# Temperature and conductivity columns (.cnv long names) of each sensor pair
+SENSOR_COLUMNS = {
+    0: ("Temperature [ITS-90, deg C]", "Conductivity [S/m]"),
+    1: ("Temperature, 2 [ITS-90, deg C]", "Conductivity, 2 [S/m]"),
+}
+
+# Derived variables of SBE Data Processing PSA files: FullName -> (short name, format, sensor
+# pair, function of (salinity, temperature, pressure))
+DERIVED_VARIABLES = {
+    "Salinity, Practical [PSU]": ("sal00", ".4f", 0, lambda s, t, p: s),
+    "Salinity, Practical, 2 [PSU]": ("sal11", ".4f", 1, lambda s, t, p: s),
+    "Density [sigma-t, kg/m^3 ]": ("sigma-t00", ".4f", 0, lambda s, t, p: sigma_t(s, t)),
+    "Density, 2 [sigma-t, kg/m^3 ]": ("sigma-t11", ".4f", 1, lambda s, t, p: sigma_t(s, t)),
+    "Potential Temperature [ITS-90, deg C]": ("potemp090C", ".4f", 0, potential_temperature),
+    "Potential Temperature, 2 [ITS-90, deg C]": ("potemp190C", ".4f", 1, potential_temperature),
+    "Sound Velocity [Chen-Millero, m/s]": ("svCM", ".2f", 0, sound_velocity),
+    "Sound Velocity, 2 [Chen-Millero, m/s]": ("svCM1", ".2f", 1, sound_velocity),
+}
+
+
+def derive(full_name, long_names, values):
+    """
+    Compute a derived variable from the columns of a (rows, columns) array whose columns
+    have the given .cnv long names. Returns (short name, format, values).
+    """
+    def column(long_name):
+        if long_name not in long_names:
+            raise ValueError(f"no '{long_name}' column to derive {full_name} from")
+        return values[:, long_names.index(long_name)]
+
+    short_name, fmt, sensor, compute = DERIVED_VARIABLES[full_name]
+    temperature_name, conductivity_name = SENSOR_COLUMNS[sensor]
+    pressure = column(next((name for name in long_names if name.startswith("Pressure")), "Pressure"))
+    temperature = column(temperature_name)
+    salt = salinity(column(conductivity_name), temperature, pressure)
+    return short_name, fmt, compute(salt, temperature, pressure)
@@ -0,0 +1,144 @@
+import fnmatch
+
+import sbe_files
+
+# Cast files each SBE module reads and writes in the output directory, as (reads, writes).
+# {cast} is the cast name and {append} the NameAppend of the stage's PSA. Modules that are
+# not listed read <cast>.cnv and write it back in place (e.g. AlignCTDW, FilterW, DeriveW).
+MODULE_FILES = {
+    "datcnvw.exe": ((), ("{cast}{append}.cnv", "{cast}{append}.ros")),
+    "binavgw.exe": (("{cast}.cnv",), ("{cast}{append}.cnv",)),
+    "bottlesumw.exe": (("{cast}.ros",), ("{cast}.cnv{append}.btl",)),
+    "rossumw.exe": (("{cast}.ros",), ("{cast}.cnv{append}.btl",)),
+    "seaplotw.exe": (("{cast}.cnv",), ("{cast}{append}.*",)),
+    "ascii_outw.exe": (("{cast}.cnv",), ("{cast}{append}.asc", "{cast}{append}.hdr")),
+    "markscanw.exe": (("{cast}.cnv",), ("{cast}{append}.bsr",)),
+}
+DEFAULT_FILES = (("{cast}.cnv",), ("{cast}{append}.cnv",))
+
+# DatCnv CreateFile value -> which of its two outputs (.cnv, .ros) it writes
+DATCNV_CREATE_FILE = {"0": (0,), "1": (1,), "2": (0, 1)}
+
+
+def stage_files(module, psa_path):
+    """
+    (reads, writes) file name patterns of one stage, from its module and PSA file.
+    Patterns keep the {cast} placeholder, so two stages touch the same file when their
+    patterns are equal.
+    """
+    reads, writes = MODULE_FILES.get(module, DEFAULT_FILES)
+    psa = sbe_files.load_psa(psa_path)
+    if module == "datcnvw.exe":
+        writes = tuple(writes[i] for i in DATCNV_CREATE_FILE.get(psa.value("CreateFile", "0"), (0, 1)))
+    append = psa.value("NameAppend")
+    return reads, tuple(pattern.replace("{append}", append) for pattern in writes)
+
+
+def cast_pattern(pattern, base_name):
+    """A stage file pattern for one cast, e.g. CTD01_avg.cnv."""
+    return pattern.replace("{cast}", base_name)
+
+
+class StageGraph:
+    """
+    The selected stages as a DAG, the same for every cast.
+
+    Stage i depends on the last earlier stage (by order) writing a file it reads, on the
+    stages reading a file it rewrites since that file was last written (so <cast>.cnv is
+    not replaced while another stage still reads it) and on the stages named in its "after"
+    list. Stages writing different products of the same input (e.g. two Sea Plot PSAs and
+    Bin Average after Derive, or Bottle Summary next to the .cnv stages) are independent.
+
+    Raises ValueError for a dependency cycle or an "after" stage that is not selected.
+    """
+
+    def __init__(self, stages, modules, psa_paths, after=None):
+        self.stages = stages
+        self.files = [stage_files(module, psa_path) for module, psa_path in zip(modules, psa_paths)]
+        self.depends = [set() for _ in stages]
+        # Files a stage reads that no earlier stage writes: they must exist before the run
+        self.external = [[] for _ in stages]
+
+        read_anywhere = {pattern for reads, _ in self.files for pattern in reads}
+        last_writer, readers = {}, {}
+        for i, (reads, writes) in enumerate(self.files):
+            for pattern in reads:
+                if pattern in last_writer:
+                    self.depends[i].add(last_writer[pattern])
+                else:
+                    self.external[i].append(pattern)
+            for pattern in writes:
+                self.depends[i].update(readers.get(pattern, ()))
+                # Products no stage reads (plots, .btl) may be written in any order
+                if pattern in read_anywhere and pattern in last_writer:
+                    self.depends[i].add(last_writer[pattern])
+            for pattern in reads:
+                readers.setdefault(pattern, []).append(i)
+            for pattern in writes:
+                last_writer[pattern] = i
+                readers[pattern] = []
+            self.depends[i].discard(i)
+
+        indexes = {psa_file: i for i, (psa_file, *_) in enumerate(stages)}
+        for psa_file, names in (after or {}).items():
+            if psa_file not in indexes:
+                continue
+            for name in names:
+                if name not in indexes:
+                    raise ValueError(f"{psa_file} runs after {name}, which is not a selected stage.")
+                self.depends[indexes[psa_file]].add(indexes[name])
+
+        self.order = self.topological_order()
+        self.dependents = [[j for j in self.order if i in self.depends[j]] for i in range(len(stages))]
+
+    def topological_order(self):
+        """Stage indexes with every stage after the stages it depends on (ties by order)."""
+        remaining = {i: set(depends) for i, depends in enumerate(self.depends)}
+        order = []
+        while remaining:
+            ready = [i for i, depends in remaining.items() if not depends]
+            if not ready:
+                # Walk back through the dependencies until a stage repeats
+                path, stage = [], min(remaining)
+                while stage not in path:
+                    path.append(stage)
+                    stage = min(remaining[stage])
+                cycle = " -> ".join(self.stages[i][0] for i in path[path.index(stage):] + [stage])
+                raise ValueError(f"The stage dependencies have a cycle: {cycle} (each runs after the next).")
+            first = min(ready)
+            order.append(first)
+            del remaining[first]
+            for depends in remaining.values():
+                depends.discard(first)
+        return order
+
+    def missing_inputs(self, base_name, existing):
+        """
+        The files a cast needs from outside the pipeline that are not in existing (lower-case
+        names of the output directory's files), as (psa_file, file name) pairs.
+        """
+        missing = []
+        for i, patterns in enumerate(self.external):
+            for pattern in patterns:
+                name = cast_pattern(pattern, base_name)
+                if name.lower() not in existing:
+                    missing.append((self.stages[i][0], name))
+        return missing
+
+    def products(self):
+        """
+        The file patterns of the pipeline's final products: written by a stage and not read
+        by any stage after the last write (e.g. {cast}_avg.cnv and the plots, but not
+        {cast}.cnv when Bin Average reads it).
+        """
+        unread = set()
+        for i in self.order:
+            reads, writes = self.files[i]
+            unread.difference_update(reads)
+            unread.update(writes)
+        return sorted(unread)
+
+    def outputs(self, index, base_name, names):
+        """The names in a list of file names that stage index writes for a cast."""
+        patterns = [cast_pattern(pattern, base_name).lower() for pattern in self.files[index][1]]
+        return [name for name in names if any(fnmatch.fnmatchcase(name.lower(), pattern) for pattern in patterns)]
@@ -0,0 +1,66 @@
+import os
+import time
+
+# Files Seasave writes for every cast; a cast is queued once all of them are present
+CAST_EXTENSIONS = (".hex", ".hdr", ".xmlcon", ".bl")
+
+# Seconds the files of a cast must keep the same size and time before it is queued
+SETTLE_TIME = 10.0
+
+# Seconds between two scans of the raw directory
+POLL_INTERVAL = 2.0
+
+
+class CastWatcher:
+    """
+    Finds complete casts in a raw directory: a .hex, .hdr, .XMLCON and .bl file with the same
+    base name (extensions in any case) whose sizes and modification times have not changed for
+    settle_time seconds, so a cast Seasave is still writing is left alone.
+
+    poll() returns the .hex files of the casts that became ready since the last call. A cast is
+    returned again if any of its files changes afterwards (e.g. a cast recorded again).
+    """
+
+    def __init__(self, raw_dir, settle_time=SETTLE_TIME, extensions=CAST_EXTENSIONS):
+        self.raw_dir = raw_dir
+        self.settle_time = settle_time
+        self.extensions = tuple(extension.lower() for extension in extensions)
+        self.pending = {}  # cast -> (signature, time it was first seen)
+        self.queued = {}  # cast -> signature it was queued with
+
+    def cast_files(self):
+        """{cast base name: {extension: (path, size, mtime)}} of the directory's cast files."""
+        casts = {}
+        with os.scandir(self.raw_dir) as entries:
+            for entry in entries:
+                base, extension = os.path.splitext(entry.name)
+                if extension.lower() not in self.extensions or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                casts.setdefault(base, {})[extension.lower()] = (entry.path, stat.st_size, stat.st_mtime_ns)
+        return casts
+
+    def poll(self, now=None):
+        now = time.monotonic() if now is None else now
+        ready = []
+        casts = self.cast_files()
+        for cast, files in casts.items():
+            if len(files) < len(self.extensions):
+                self.pending.pop(cast, None)
+                continue
+
+            signature = tuple(sorted(files.items()))
+            if self.queued.get(cast) == signature:
+                continue
+            seen = self.pending.get(cast)
+            if seen is None or seen[0] != signature:
+                # New or still growing: (re)start the settle timer
+                self.pending[cast] = (signature, now)
+            elif now - seen[1] >= self.settle_time:
+                del self.pending[cast]
+                self.queued[cast] = signature
+                ready.append(files[".hex"][0])
+
+        for cast in set(self.pending) - set(casts):
+            del self.pending[cast]
+        return sorted(ready)